@@ -12,22 +12,16 @@ import math
 import re
 import pickle
 import numpy as np
-import scipy
-from scipy.spatial.qhull import QhullError
 from ase import Atoms
 from ase.build import rotate
 from ase.constraints import FixAtoms
-from ase.geometry import find_mic
-from pymatgen.io.ase import AseAtomsAdaptor
-from pymatgen.ext.matproj import MPRester
-from pymatgen.symmetry.analyzer import SpacegroupAnalyzer
-from pymatgen.core.surface import SlabGenerator
-from pymatgen.analysis.adsorption import AdsorbateSiteFinder
-from pymatgen.analysis.local_env import VoronoiNN
+from ase.geometry import find_mic, get_distances
 from .utils import unfreeze_dict, read_rc
+from .tracing import traced
 from .defaults import slab_settings
 
 
+@traced('atoms_operators')
 def make_slabs_from_bulk_atoms(atoms, miller_indices,
                                slab_generator_settings, get_slab_settings):
     '''
@@ -50,6 +44,11 @@ def make_slabs_from_bulk_atoms(atoms, miller_indices,
                 objects. Note that there may be multiple slabs because
                 of different shifts/terminations.
     '''
+    # pymatgen is slow to import, so we only load it when we need it
+    from pymatgen.io.ase import AseAtomsAdaptor
+    from pymatgen.symmetry.analyzer import SpacegroupAnalyzer
+    from pymatgen.core.surface import SlabGenerator
+
     # Get rid of the `miller_index` argument, which is superceded by the
     # `miller_indices` argument.
     try:
@@ -159,6 +158,7 @@ def constrain_slab(atoms, z_cutoff=3.):
     return atoms
 
 
+@traced('atoms_operators')
 def is_structure_invertible(structure):
     '''
     This function figures out whether or not an `pymatgen.Structure` object has
@@ -175,6 +175,8 @@ def is_structure_invertible(structure):
         A boolean indicating whether or not your `ase.Atoms` object is
         symmetric in z-direction (i.e. symmetric with respect to x-y plane).
     '''
+    from pymatgen.symmetry.analyzer import SpacegroupAnalyzer
+
     # If any of the operations involve a transformation in the z-direction,
     # then the structure is invertible.
     sga = SpacegroupAnalyzer(structure, symprec=0.1)
@@ -236,6 +238,7 @@ def tile_atoms(atoms, min_x, min_y):
     return atoms_tiled, (nx, ny)
 
 
+@traced('atoms_operators')
 def find_adsorption_sites(atoms):
     '''
     A wrapper for pymatgen to get all of the adsorption sites of a slab.
@@ -247,12 +250,16 @@ def find_adsorption_sites(atoms):
         sites   A `numpy.ndarray` object that contains the x-y-z coordinates of
                 the adsorptions sites
     '''
+    from pymatgen.io.ase import AseAtomsAdaptor
+    from pymatgen.analysis.adsorption import AdsorbateSiteFinder
+
     struct = AseAtomsAdaptor.get_structure(atoms)
     sites_dict = AdsorbateSiteFinder(struct).find_adsorption_sites(put_inside=True)
     sites = sites_dict['all']
     return sites
 
 
+@traced('atoms_operators')
 def find_bulk_cn_dict(bulk_atoms):
     '''
     Get a dictionary of coordination numbers
@@ -262,6 +269,10 @@ def find_bulk_cn_dict(bulk_atoms):
     `get_surface_sites`.
     https://pymatgen.org/pymatgen.core.surface.html
     '''
+    from pymatgen.io.ase import AseAtomsAdaptor
+    from pymatgen.symmetry.analyzer import SpacegroupAnalyzer
+    from pymatgen.analysis.local_env import VoronoiNN
+
     struct = AseAtomsAdaptor.get_structure(bulk_atoms)
     sga = SpacegroupAnalyzer(struct)
     sym_struct = sga.get_symmetrized_structure()
@@ -283,6 +294,7 @@ def find_bulk_cn_dict(bulk_atoms):
     return cn_dict
 
 
+@traced('atoms_operators')
 def find_surface_atoms_indices(bulk_cn_dict, atoms):
     '''
     A helper function referencing codes from pymatgen to
@@ -303,6 +315,9 @@ def find_surface_atoms_indices(bulk_cn_dict, atoms):
         indices_list    A list that contains the indices of
                         the surface atoms
     '''
+    from pymatgen.io.ase import AseAtomsAdaptor
+    from pymatgen.analysis.local_env import VoronoiNN
+
     struct = AseAtomsAdaptor.get_structure(atoms)
     voronoi_nn = VoronoiNN()
     # Identify index of the surface atoms
@@ -340,8 +355,10 @@ def _plane_normal(coords):
     Output:
         vector  numpy.ndarray. Adsorption vector for an adsorption site.
     """
+    from scipy.linalg import lstsq
+
     A = np.c_[coords[:, 0], coords[:, 1], np.ones(coords.shape[0])]
-    vector, _, _, _ = scipy.linalg.lstsq(A, coords[:, 2])
+    vector, _, _, _ = lstsq(A, coords[:, 2])
     vector[2] = -1.0
     vector /= -np.linalg.norm(vector)
     return vector
@@ -369,6 +386,7 @@ def _ang_between_vectors(v1, v2):
     return angle
 
 
+@traced('atoms_operators')
 def find_adsorption_vector(bulk_cn_dict, slab_atoms, surface_indices, adsorption_site):
     """
     Returns the vector of an adsorption site representing the
@@ -388,6 +406,9 @@ def find_adsorption_vector(bulk_cn_dict, slab_atoms, surface_indices, adsorption
     Output:
         vector            numpy.ndarray. Adsorption vector for an adsorption site.
     """
+    from pymatgen.io.ase import AseAtomsAdaptor
+    from pymatgen.analysis.local_env import VoronoiNN
+
     vnn = VoronoiNN(allow_pathological=True)
 
     slab_atoms += Atoms('U', [adsorption_site])
@@ -421,6 +442,7 @@ def find_adsorption_vector(bulk_cn_dict, slab_atoms, surface_indices, adsorption
     return vector
 
 
+@traced('atoms_operators')
 def add_adsorbate_onto_slab(adsorbate, slab, site):
     '''
     There are a lot of small details that need to be considered when adding an
@@ -459,6 +481,7 @@ def add_adsorbate_onto_slab(adsorbate, slab, site):
     return adslab_constrained
 
 
+@traced('atoms_operators')
 def fingerprint_adslab(atoms):
     '''
     This function will fingerprint a slab+adsorbate atoms object for you.
@@ -487,6 +510,10 @@ def fingerprint_adslab(atoms):
                                                 loose tolerance for
                                                 identifying "neighbors"
     '''
+    from scipy.spatial.qhull import QhullError
+    from pymatgen.io.ase import AseAtomsAdaptor
+    from pymatgen.analysis.local_env import VoronoiNN
+
     # Replace the adsorbate[s] with a single Uranium atom at the first binding
     # site. We need the Uranium there so that pymatgen can find its
     # coordination.
@@ -585,6 +612,7 @@ def __get_coordination_string(nn_info):
     return coordination
 
 
+@traced('atoms_operators')
 def calculate_unit_slab_height(atoms, miller_indices, slab_generator_settings=None):
     '''
     Calculates the height of the smallest unit slab from a given bulk and
@@ -610,6 +638,10 @@ def calculate_unit_slab_height(atoms, miller_indices, slab_generator_settings=No
         del slab_generator_settings['min_vacuum_size']
         del slab_generator_settings['min_slab_size']
 
+    from pymatgen.io.ase import AseAtomsAdaptor
+    from pymatgen.symmetry.analyzer import SpacegroupAnalyzer
+    from pymatgen.core.surface import SlabGenerator
+
     # Instantiate a pymatgen `SlabGenerator`
     structure = AseAtomsAdaptor.get_structure(atoms)
     sga = SpacegroupAnalyzer(structure, symprec=0.1)
@@ -648,6 +680,77 @@ def find_max_movement(atoms_initial, atoms_final):
     return max_movement
 
 
+def warm_start_adslab(adslab, relaxed_slab=None, reference_adslabs=None, min_distance=1.):
+    '''
+    Seed an unrelaxed adslab with the geometries of calculations that we
+    already did so that its relaxation starts closer to where it will end up.
+    We move the slab atoms to where they are in a relaxed bare slab, and then
+    we give the adsorbate the same relaxed geometry (relative to its binding
+    site) as it has in a similar adslab.
+
+    Args:
+        adslab              The `ase.Atoms` object of the adslab to seed. The
+                            slab atoms must be tagged with 0 and the adsorbate
+                            atoms with 1, and the first adsorbate atom must be
+                            the binding atom.
+        relaxed_slab        [Optional] The `ase.Atoms` object of the relaxed
+                            bare slab. Its atoms must be the slab atoms of
+                            `adslab`, in the same order.
+        reference_adslabs   [Optional] A 2-tuple of the initial and relaxed
+                            `ase.Atoms` objects of an adslab with the same
+                            adsorbate, tagged the same way
+        min_distance        A float indicating how close (in Angstroms) the
+                            seeded adsorbate atoms may get to slab atoms. If
+                            the reference geometry would put them closer, then
+                            we leave the adsorbate where it was.
+    Returns:
+        seeded_adslab   A copy of `adslab` with the seeded positions
+        seeded          A dictionary with the Boolean keys 'slab' and
+                        'adsorbate' indicating which parts we actually seeded
+    '''
+    seeded_adslab = adslab.copy()
+    seeded = {'slab': False, 'adsorbate': False}
+    slab_mask = seeded_adslab.get_tags() == 0
+    positions = seeded_adslab.get_positions()
+
+    # Move the slab atoms, but only if the relaxed slab has the same atoms
+    # in the same cell
+    if relaxed_slab is not None:
+        symbols = np.array(seeded_adslab.get_chemical_symbols())[slab_mask]
+        if (len(relaxed_slab) == slab_mask.sum() and
+                relaxed_slab.get_chemical_symbols() == list(symbols) and
+                np.allclose(relaxed_slab.cell, seeded_adslab.cell, atol=1e-3)):
+            movements, _ = find_mic(relaxed_slab.positions - positions[slab_mask],
+                                    seeded_adslab.cell, seeded_adslab.pbc)
+            positions[slab_mask] += movements
+            seeded['slab'] = True
+
+    # Give the adsorbate the relaxed geometry of the reference, measured from
+    # where the reference's binding atom started
+    if reference_adslabs is not None:
+        reference_init, reference_final = reference_adslabs
+        adsorbate_indices = np.where(~slab_mask)[0]
+        reference_init_adsorbate = reference_init[reference_init.get_tags() > 0]
+        reference_final_adsorbate = reference_final[reference_final.get_tags() > 0]
+        if (len(adsorbate_indices) > 0 and
+                reference_final_adsorbate.get_chemical_symbols() ==
+                seeded_adslab[adsorbate_indices].get_chemical_symbols()):
+            offsets, _ = find_mic(reference_final_adsorbate.positions -
+                                  reference_init_adsorbate.positions[0],
+                                  reference_final.cell, reference_final.pbc)
+            adsorbate_positions = positions[adsorbate_indices[0]] + offsets
+            _, distances = get_distances(adsorbate_positions, positions[slab_mask],
+                                         seeded_adslab.cell, seeded_adslab.pbc)
+            if distances.size == 0 or distances.min() >= min_distance:
+                positions[adsorbate_indices] = adsorbate_positions
+                seeded['adsorbate'] = True
+
+    # Set the positions directly so that the slab constraints do not stop us
+    seeded_adslab.arrays['positions'][:] = positions
+    return seeded_adslab, seeded
+
+
+@traced('atoms_operators')
 def get_stoich_from_mpid(mpid):
     '''
     Get the reduced stoichiometry of a Materials Project bulk material.
@@ -669,6 +772,7 @@ def get_stoich_from_mpid(mpid):
     except (FileNotFoundError, EOFError):
         # Get the formula from Materials Project. It'll come out like "CuAl2"
         # or something.
+        from pymatgen.ext.matproj import MPRester
         with MPRester(read_rc('matproj_api_key')) as rester:
             docs = rester.query({'task_ids': mpid}, ['full_formula'])
         formula = docs[0]['full_formula']
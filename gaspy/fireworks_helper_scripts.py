@@ -7,15 +7,20 @@ __authors__ = ['Zachary W. Ulissi', 'Kevin Tran']
 __emails__ = ['zulissi@andrew.cmu.edu', 'ktran@andrew.cmu.edu']
 
 import os
+import io
+import json
+import zlib
+import hashlib
+import functools
+import itertools
 import warnings
-import uuid
 from datetime import datetime
 import getpass
-import pandas as pd
-import ase.io
-from fireworks import Firework, PyTask, LaunchPad, FileWriteTask, Workflow
-from .utils import print_dict, read_rc
-from . import vasp_functions
+from .utils import print_dict, read_rc, get_nested_value, doc_matches_query
+
+# FireWorks, pandas, and ASE's I/O all take a while to import, so we load them
+# inside the functions that need them. This keeps `import gaspy` cheap for
+# multiprocessing workers and FireWorks rockets.
 
 
 def get_launchpad():
@@ -26,12 +31,27 @@ def get_launchpad():
     Returns:
         lpad    An instance of a `fireworks.LaunchPad` object
     '''
+    from fireworks import LaunchPad
+
     configs = read_rc('fireworks_info.lpad')
     configs['port'] = int(configs['port'])  # Make sure that the port is an integer
     lpad = LaunchPad(**configs)
     return lpad
 
 
+# These are the only fields we need from FireWorks to figure out the status of
+# our calculations. We do not pull the rest because the `spec` is big.
+_STATUS_PROJECTION = {'_id': 0, 'fw_id': 1, 'state': 1, 'name': 1}
+
+# 'COMPLETED' is considered running because it's offically done when it's in
+# our atoms collection, not when it's done in FireWorks
+_RUNNING_STATES = set(['COMPLETED', 'READY', 'RESERVED', 'RUNNING', 'PAUSED'])
+
+# We use these fields to fetch the FireWorks for many queries at once. Most of
+# the queries that GASpy makes contain the calculation type and one of these.
+_BATCH_IDENTIFIERS = ('name.mpid', 'name.gasname')
+
+
 def find_n_rockets(query, vasp_settings, _testing=False):
     '''
     This function will check if we have something currently running in our
@@ -51,37 +71,124 @@ def find_n_rockets(query, vasp_settings, _testing=False):
         n_fizzles   An integer for how many FireWorks have fizzled that match
                     the query
     '''
-    # Parse the VASP settings into the FireWorks query, then grab the docs
+    query = _add_vasp_settings_to_query(query, vasp_settings)
+    docs = _get_firework_docs(query=query, _testing=_testing, projection=_STATUS_PROJECTION)
+    return _count_rockets(docs)
+
+
+def find_n_rockets_in_bulk(queries, vasp_settings_list, chunk_size=1000, _testing=False):
+    '''
+    This function does the same thing as `find_n_rockets`, but for many
+    queries at once. Instead of opening one connection and making one query
+    per calculation, we fetch the status of all of the candidate FireWorks with
+    a few `$in` queries and then match them to each query in memory.
+
+    Args:
+        queries             A list of dictionaries that can each be passed as
+                            a `query` argument to the `fireworks` collection
+                            of our FireWorks database
+        vasp_settings_list  A list of dictionaries of VASP settings, one for
+                            each query. These will be automatically parsed
+                            into the queries.
+        chunk_size          The maximum number of identifiers (e.g., mpids) we
+                            put into any single `$in` query
+        _testing            Boolean indicating whether or not you are
+                            currently doing a unit test. You should probably
+                            not be changing the default from False.
+    Returns:
+        rocket_counts   A list of `(n_running, n_fizzles)` tuples, one for
+                        each query and in the same order as the queries
+    '''
+    queries = [_add_vasp_settings_to_query(query, vasp_settings)
+               for query, vasp_settings in zip(queries, vasp_settings_list)]
+
+    # Group the queries by calculation type and identifier so that we can
+    # fetch their candidate FireWorks together
+    groups = {}
+    for i, query in enumerate(queries):
+        id_keys = [key for key in _BATCH_IDENTIFIERS if key in query]
+        if 'name.calculation_type' in query and id_keys:
+            groups.setdefault((query['name.calculation_type'], id_keys[0]), []).append(i)
+        else:
+            groups.setdefault(None, []).append(i)
+
+    docs_by_query = [None] * len(queries)
+    collection = _get_fireworks_collection(_testing)
+    try:
+        for group, indices in groups.items():
+            # We can't batch queries without identifiers, so do them one-by-one
+            if group is None:
+                for i in indices:
+                    docs_by_query[i] = list(collection.find(queries[i], _STATUS_PROJECTION))
+                continue
+
+            # Fetch and index the candidates by their identifier
+            calc_type, id_key = group
+            identifiers = sorted({queries[i][id_key] for i in indices})
+            candidates = {}
+            for j in range(0, len(identifiers), chunk_size):
+                batch_query = {'name.calculation_type': calc_type,
+                               id_key: {'$in': identifiers[j:j+chunk_size]}}
+                for doc in collection.find(batch_query, _STATUS_PROJECTION):
+                    candidates.setdefault(get_nested_value(doc, id_key), []).append(doc)
+
+            # Match the candidates to each query in memory
+            for i in indices:
+                docs_by_query[i] = [doc for doc in candidates.get(queries[i][id_key], [])
+                                    if doc_matches_query(doc, queries[i])]
+    finally:    # Make sure we close the connection
+        collection.database.client.close()
+
+    rocket_counts = [_count_rockets(docs) for docs in docs_by_query]
+    return rocket_counts
+
+
+def _add_vasp_settings_to_query(query, vasp_settings):
+    '''
+    Parse VASP settings into a query for the `fireworks` collection of our
+    FireWorks database. We make a new query instead of modifying the old one.
+
+    Args:
+        query           A dictionary that can be passed as a `query` argument
+                        to the `fireworks` collection of our FireWorks database.
+        vasp_settings   A dictionary of vasp settings
+    Returns:
+        query   A new dictionary with the VASP settings parsed into it
+    '''
+    query = dict(query)
     for key, value in vasp_settings.items():
         query['name.vasp_settings.%s' % key] = value
-    docs = _get_firework_docs(query=query, _testing=_testing)
+    return query
 
-    # Warn the user if there are a bunch of fizzles
-    n_fizzles = __get_n_fizzles(docs)
 
-    # Check if we are running currently. 'COMPLETED' is considered running
-    # because it's offically done when it's in our atoms collection, not
-    # when it's done in FireWorks
-    running_states = set(['COMPLETED', 'READY', 'RESERVED', 'RUNNING', 'PAUSED'])
-    docs_running = [doc for doc in docs if doc['state'] in running_states]
-    n_running = len(docs_running)
+def _count_rockets(docs):
+    '''
+    Count how many FireWorks are running and how many have fizzled. This will
+    warn you if there are any fizzles.
 
+    Arg:
+        docs    A list of dictionaries that we got from our FireWorks database.
+                They need to have the 'fw_id' and 'state' keys.
+    Returns:
+        n_running   An integer for how many of the FireWorks are running
+        n_fizzles   An integer for how many of the FireWorks have fizzled
+    '''
+    n_fizzles = __get_n_fizzles(docs)
+    n_running = len([doc for doc in docs if doc['state'] in _RUNNING_STATES])
     return n_running, n_fizzles
 
 
-def _get_firework_docs(query, _testing):
+def _get_fireworks_collection(_testing):
     '''
-    This function will get some documents from our FireWorks database.
+    Get the `fireworks` collection of our FireWorks database. Remember to close
+    the client when you are done with it.
 
-    Args:
-        query       A dictionary that can be passed as a `query` argument
-                    to the `fireworks` collection of our FireWorks database.
+    Arg:
         _testing    Boolean indicating whether or not you are currently
                     doing a unit test. You should probably not be
                     changing the default from False.
     Returns:
-        docs    A list of dictionaries (i.e, Mongo documents) obtained
-                from the `fireworks` collection of our FireWorks Mongo.
+        collection  A `pymongo.collection.Collection` instance
     '''
     lpad = get_launchpad()
 
@@ -91,9 +198,29 @@ def _get_firework_docs(query, _testing):
         collection = lpad.fireworks
     else:
         collection = lpad.fireworks.database.get_collection('unit_testing_fireworks')
+    return collection
+
 
+def _get_firework_docs(query, _testing, projection=None):
+    '''
+    This function will get some documents from our FireWorks database.
+
+    Args:
+        query       A dictionary that can be passed as a `query` argument
+                    to the `fireworks` collection of our FireWorks database.
+        _testing    Boolean indicating whether or not you are currently
+                    doing a unit test. You should probably not be
+                    changing the default from False.
+        projection  [Optional] A dictionary that can be passed as a
+                    `projection` argument to the `fireworks` collection. If
+                    `None`, then we return the whole documents.
+    Returns:
+        docs    A list of dictionaries (i.e, Mongo documents) obtained
+                from the `fireworks` collection of our FireWorks Mongo.
+    '''
+    collection = _get_fireworks_collection(_testing)
     try:
-        docs = list(collection.find(query))
+        docs = list(collection.find(query, projection))
     finally:    # Make sure we close the connection
         collection.database.client.close()
     return docs
@@ -118,32 +245,35 @@ def __get_n_fizzles(docs):
     return len(fwids_fizzled)
 
 
-def make_firework(atoms, fw_name, vasp_settings):
+def make_firework(atoms, fw_name, vasp_settings, optimizer_settings=None):
     '''
     This function makes a FireWorks rocket to perform a VASP relaxation
 
     Args:
-        atoms           `ase.Atoms` object to relax
-        fw_name         Dictionary of tags/etc to use as the FireWorks name
-        vasp_settings   Dictionary of VASP settings to pass to Vasp()
+        atoms               `ase.Atoms` object to relax
+        fw_name             Dictionary of tags/etc to use as the FireWorks name
+        vasp_settings       Dictionary of VASP settings to pass to Vasp()
+        optimizer_settings  [Optional] Dictionary telling ASE how to relax
+                            structures that VASP cannot relax by itself, e.g.,
+                            ones with Hookean constraints. See
+                            `vasp_functions._optimize_with_ase` and
+                            `vasp_functions._relax_with_ase` for the
+                            options. If `None`, then we use the optional
+                            `fireworks_info.optimizer_settings` field of the
+                            `.gaspyrc.json` file.
     Returns:
         firework    An instance of a `fireworks.Firework` object that is set up
                     to perform a VASP relaxation
     '''
+    from fireworks import Firework, PyTask
+
     # Warn the user if they're submitting a big one
     if len(atoms) > 80:
         warnings.warn('You are making a firework with %i atoms in it. This may '
                       'take awhile.' % len(atoms), RuntimeWarning)
 
-    # Take the `vasp_functions` submodule in GASpy and then pass it out to each
-    # FireWork rocket to use.
-    vasp_filename = vasp_functions.__file__
-    if vasp_filename.split('.')[-1] == 'pyc':   # Make sure we use the source file
-        vasp_filename = vasp_filename[:-3] + 'py'
-    with open(vasp_filename) as file_handle:
-        vasp_functions_contents = file_handle.read()
-    pass_vasp_functions = FileWriteTask(files_to_write=[{'filename': 'vasp_functions.py',
-                                                         'contents': vasp_functions_contents}])
+    # Pass our `vasp_functions` submodule out to the FireWork rocket
+    pass_vasp_functions = _make_vasp_functions_task()
 
     # Convert the atoms object to a string so that we can pass it through
     # FireWorks, and then tell the FireWork rocket to use our `vasp_functions`
@@ -152,9 +282,29 @@ def make_firework(atoms, fw_name, vasp_settings):
     read_atoms_file = PyTask(func='vasp_functions.hex_to_file',
                              args=['slab_in.traj', atom_trajhex])
 
-    # Tell the FireWork rocket to perform the relaxation
-    relax = PyTask(func='vasp_functions.runVasp',
-                   args=['slab_in.traj', 'slab_relaxed.traj', vasp_settings],
+    # Tell the FireWork rocket to perform the relaxation. If the user wants to
+    # store compressed trajectories in GridFS instead of hex strings, or to
+    # store only some of the images, then we tell the rocket that, too. Same
+    # goes for how ASE should relax things.
+    relax_args = ['slab_in.traj', 'slab_relaxed.traj', vasp_settings]
+    trajectory_storage = _get_trajectory_storage()
+    if optimizer_settings is None:
+        optimizer_settings = _get_optimizer_settings()
+    if (optimizer_settings.get('save_state') and
+            trajectory_storage.get('mode', 'hex') != 'gridfs'):
+        warnings.warn('We only save optimizer states into GridFS. If you want to '
+                      'save them, then set the "mode" of your '
+                      '`fireworks_info.trajectory_storage` to "gridfs".',
+                      RuntimeWarning)
+        optimizer_settings = {key: value for key, value in optimizer_settings.items()
+                              if key != 'save_state'}
+    if (trajectory_storage.get('mode', 'hex') != 'hex' or
+            trajectory_storage.get('keep_every', 1) != 1 or
+            optimizer_settings):
+        relax_args.append(trajectory_storage)
+    if optimizer_settings:
+        relax_args.append(optimizer_settings)
+    relax = PyTask(func='vasp_functions.runVasp', args=relax_args,
                    stored_data_varname='opt_results')
 
     fw_name['user'] = getpass.getuser()
@@ -162,6 +312,151 @@ def make_firework(atoms, fw_name, vasp_settings):
     return firework
 
 
+def _get_trajectory_storage():
+    '''
+    Read how the user wants FireWorks to store relaxation trajectories from
+    the optional `fireworks_info.trajectory_storage` key of the `.gaspyrc.json`
+    file. See `vasp_functions.store_trajectory` for the options.
+
+    Returns:
+        trajectory_storage  A dictionary. It is empty if the user did not
+                            specify anything, which means that we will keep
+                            storing hex strings.
+    '''
+    try:
+        return dict(read_rc('fireworks_info.trajectory_storage'))
+    except KeyError:
+        return {}
+
+
+def _get_optimizer_settings():
+    '''
+    Figure out how ASE should relax the structures that VASP cannot relax by
+    itself. We read this from the optional `fireworks_info.optimizer_settings`
+    key of the `.gaspyrc.json` file. See `vasp_functions._optimize_with_ase`
+    for the options.
+
+    Returns:
+        optimizer_settings  A dictionary. It is empty if the user did not
+                            specify anything, which means that we will keep
+                            using BFGS.
+    '''
+    try:
+        return dict(read_rc('fireworks_info.optimizer_settings'))
+    except KeyError:
+        return {}
+
+
+# The payloads that this process has already made sure are in GridFS
+_STORED_PAYLOADS = set()
+
+
+def _make_vasp_functions_task():
+    '''
+    Make the FireTask that writes our `vasp_functions` submodule into the
+    directory of a FireWork rocket.
+
+    By default, we embed the whole source file in each FireWork. If the
+    `fireworks_info.vasp_functions_storage` key of the `.gaspyrc.json` file
+    has `"mode": "gridfs"`, then we instead store one copy of the file in a
+    GridFS bucket of the FireWorks database (named by its SHA-256 hash), and
+    each FireWork gets a `PyTask` that calls `fetch_vasp_functions` to fetch
+    and check that copy. The bucket defaults to "vasp_functions".
+
+    Returns:
+        firetask    An instance of a `fireworks.FileWriteTask` or
+                    `fireworks.PyTask`
+    '''
+    from fireworks import PyTask, FileWriteTask
+
+    contents = _read_vasp_functions()
+    try:
+        storage = dict(read_rc('fireworks_info.vasp_functions_storage'))
+    except KeyError:
+        storage = {}
+
+    if storage.get('mode', 'inline') == 'gridfs':
+        bucket_name = storage.get('bucket', 'vasp_functions')
+        sha256 = _store_vasp_functions(contents, bucket_name)
+        return PyTask(func='gaspy.fireworks_helper_scripts.fetch_vasp_functions',
+                      args=[bucket_name, sha256])
+
+    return FileWriteTask(files_to_write=[{'filename': 'vasp_functions.py',
+                                          'contents': contents}])
+
+
+@functools.lru_cache(maxsize=None)
+def _read_vasp_functions():
+    '''
+    Read the source code of our `vasp_functions` submodule. We read the source
+    file directly instead of importing the module so that we don't have to
+    load VASP/ASE here, and we only read it once per process.
+
+    Returns:
+        contents    A string of the source code
+    '''
+    vasp_filename = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                 'vasp_functions.py')
+    with open(vasp_filename) as file_handle:
+        return file_handle.read()
+
+
+def _store_vasp_functions(contents, bucket_name):
+    '''
+    Make sure that a copy of our `vasp_functions` submodule is in a GridFS
+    bucket of our FireWorks database
+
+    Args:
+        contents    A string of the source code
+        bucket_name A string indicating the GridFS bucket to use
+    Returns:
+        sha256  The SHA-256 hash of the source code, which is also its
+                filename in GridFS
+    '''
+    import gridfs
+
+    raw_bytes = contents.encode('utf-8')
+    sha256 = hashlib.sha256(raw_bytes).hexdigest()
+    if (bucket_name, sha256) not in _STORED_PAYLOADS:
+        lpad = get_launchpad()
+        try:
+            bucket = gridfs.GridFS(lpad.db, bucket_name)
+            if not bucket.exists(filename=sha256):
+                bucket.put(raw_bytes, filename=sha256)
+        finally:    # Make sure we close the connection
+            lpad.fireworks.database.client.close()
+        _STORED_PAYLOADS.add((bucket_name, sha256))
+    return sha256
+
+
+def fetch_vasp_functions(bucket_name, sha256):
+    '''
+    Write the copy of our `vasp_functions` submodule that we stored in GridFS
+    into the current directory. FireWork rockets call this when we store
+    `vasp_functions.py` in GridFS, so it connects to the FireWorks database
+    with the rocket's own `LaunchPad.auto_load()` instead of our
+    `.gaspyrc.json`.
+
+    Args:
+        bucket_name A string indicating the GridFS bucket that the file is in
+        sha256      The SHA-256 hash of the file, which is also its filename
+                    in GridFS
+    '''
+    import gridfs
+    from fireworks import LaunchPad
+
+    lpad = LaunchPad.auto_load()
+    try:
+        contents = gridfs.GridFS(lpad.db, bucket_name).find_one({'filename': sha256}).read()
+    finally:    # Make sure we close the connection
+        lpad.fireworks.database.client.close()
+
+    if hashlib.sha256(contents).hexdigest() != sha256:
+        raise ValueError('The vasp_functions.py in GridFS does not match its hash')
+    with open('vasp_functions.py', 'wb') as file_handle:
+        file_handle.write(contents)
+
+
 def encode_atoms_to_trajhex(atoms):
     '''
     Encode a trajectory-formatted atoms object into a hex string.
@@ -171,21 +466,20 @@ def encode_atoms_to_trajhex(atoms):
     As of the writing of this docstring, we intend to use this mainly
     to store atoms objects in the FireWorks DB, *not* the GASdb (AKA AuxDB).
 
+    We write the trajectory into memory instead of a temporary file, but the
+    bytes are identical to what `atoms.write('foo.traj')` would give you.
+
     Arg:
         atoms   ase.Atoms object to encode
     Output:
         hex_    A hex-encoded string object of the trajectory of the atoms object
     '''
-    # Make the trajectory
-    fname = read_rc('temp_directory') + str(uuid.uuid4()) + '.traj'
-    atoms.write(fname)
+    from ase.io.trajectory import TrajectoryWriter
 
-    # Encode the trajectory
-    with open(fname, 'rb') as fhandle:
-        hex_ = fhandle.read().hex()
-
-    # Clean up
-    os.remove(fname)
+    buffer_ = _TrajectoryBuffer()
+    with TrajectoryWriter(buffer_, 'w') as traj:
+        traj.write(atoms)
+    hex_ = buffer_.value.hex()
     return hex_
 
 
@@ -200,21 +494,34 @@ def decode_trajhex_to_atoms(hex_, index=-1):
         hex_    A hex-encoded string of a trajectory of atoms objects.
         index   Trajectories can contain multiple atoms objects.
                 The `index` is used to specify which atoms object to return.
-                -1 corresponds to the last image.
+                -1 corresponds to the last image. You may also pass a slice
+                or a string like ':' to get a list of images.
     Output:
         atoms   The decoded ase.Atoms object
     '''
-    # Make the trajectory from the hex
-    fname = read_rc('temp_directory') + str(uuid.uuid4()) + '.traj'
-    with open(fname, 'wb') as fhandle:
-        fhandle.write(bytes.fromhex(hex_))
+    # Integer indices are the most common, so we read just that image.
+    # Anything else goes through `ase.io.read` like it always has.
+    if isinstance(index, int):
+        atoms = _decode_trajhex_to_images(hex_, indices=(index,))[0]
+    else:
+        import ase.io
+        atoms = ase.io.read(io.BytesIO(bytes.fromhex(hex_)), index=index, format='traj')
+    return atoms
 
-    # Open up the atoms from the trajectory
-    atoms = ase.io.read(fname, index=index)
 
-    # Clean up
-    os.remove(fname)
-    return atoms
+class _TrajectoryBuffer(io.BytesIO):
+    '''
+    An in-memory file for `ase.io.trajectory.TrajectoryWriter`. The writer
+    closes its file when it is done, which would normally throw away the
+    contents of a `BytesIO`. So we save them as the `value` attribute right
+    before closing.
+    '''
+    value = b''
+
+    def close(self):
+        if not self.closed:
+            self.value = self.getvalue()
+        super().close()
 
 
 def submit_fwork(fwork, _testing=False):
@@ -230,6 +537,8 @@ def submit_fwork(fwork, _testing=False):
         wflow   An instance of the `firework.Workflow` that was added to the
                 FireWorks launch pad.
     '''
+    from fireworks import Workflow
+
     wflow = Workflow([fwork], name='vasp optimization')
 
     if not _testing:
@@ -241,6 +550,36 @@ def submit_fwork(fwork, _testing=False):
     return wflow
 
 
+def submit_fworks(fworks, _testing=False):
+    '''
+    This function will package each FireWork into its own workflow and then
+    add all of them to our FireWorks launchpad in one bulk operation.
+
+    Args:
+        fworks      A sequence of `fireworks.Firework` objects
+        _testing    Boolean indicating whether or not you're doing a unit test.
+                    You probably shouldn't touch this.
+    Returns:
+        wflows  A list of the `firework.Workflow` objects that were added to
+                the FireWorks launch pad
+    '''
+    from fireworks import Workflow
+
+    wflows = [Workflow([fwork], name='vasp optimization') for fwork in fworks]
+
+    if not _testing and len(wflows) > 0:
+        lpad = get_launchpad()
+        if hasattr(lpad, 'bulk_add_wfs'):
+            lpad.bulk_add_wfs(wflows)
+        # Older versions of FireWorks cannot add workflows in bulk
+        else:
+            for wflow in wflows:
+                lpad.add_wf(wflow)
+        print('Submitted %i FireWork rockets' % len(wflows))
+
+    return wflows
+
+
 def get_atoms_from_fwid(fwid, index=-1):
     '''
     Given a Fireworks ID, this function will give you the initial `ase.Atoms`
@@ -262,6 +601,73 @@ def get_atoms_from_fwid(fwid, index=-1):
     return atoms
 
 
+def get_optimizer_state_from_fwid(fwid, lpad=None):
+    '''
+    Get the final state of the ASE optimizer that did a relaxation, e.g., its
+    Hessian. Rockets only save these if you turn on the "save_state" of your
+    `fireworks_info.optimizer_settings` and store your trajectories in
+    GridFS.
+
+    Args:
+        fwid    Integer indicating the FireWorks ID of the relaxation
+        lpad    [Optional] An instance of a `fireworks.LaunchPad` to read
+                with. If you do not supply one, then we will make (and close)
+                one for you.
+    Returns:
+        optimizer_state A dictionary made by
+                        `vasp_functions._write_optimizer_state`, or `None` if
+                        the relaxation did not save one
+    '''
+    close_lpad = lpad is None
+    if close_lpad:
+        lpad = get_launchpad()
+    try:
+        reference = get_optimizer_state_reference_from_fwid(fwid, lpad=lpad)
+        if reference is None:
+            return None
+        return json.loads(read_trajectory_bytes(reference, lpad=lpad).decode('utf-8'))
+    finally:    # Make sure we close the connection
+        if close_lpad:
+            lpad.fireworks.database.client.close()
+
+
+def get_optimizer_state_reference_from_fwid(fwid, lpad=None):
+    '''
+    Find where a relaxation saved the final state of its ASE optimizer. You
+    can pass this reference as the "state" of the `optimizer_settings` of
+    `make_firework` to give a similar relaxation a head start, which is a lot
+    smaller than passing the state itself.
+
+    Args:
+        fwid    Integer indicating the FireWorks ID of the relaxation
+        lpad    [Optional] An instance of a `fireworks.LaunchPad` to read
+                with. If you do not supply one, then we will make (and close)
+                one for you.
+    Returns:
+        reference   Whatever `vasp_functions.runVasp` returned for the
+                    optimizer state---i.e., usually a dictionary that points
+                    to GridFS---or `None` if ASE did not do the relaxation,
+                    if it did not save its state, or if the relaxation did
+                    not finish
+    '''
+    close_lpad = lpad is None
+    if close_lpad:
+        lpad = get_launchpad()
+    try:
+        fw = lpad.get_fw_by_id(fwid)
+    finally:    # Make sure we close the connection
+        if close_lpad:
+            lpad.fireworks.database.client.close()
+
+    try:
+        opt_results = fw.launches[-1].action.stored_data['opt_results']
+    except (IndexError, AttributeError, KeyError):
+        return None
+    if len(opt_results) < 4:
+        return None
+    return opt_results[3]
+
+
 def get_atoms_from_fw(fw, index=-1):
     '''
     This function will return an `ase.Atoms` object given a Firework from our
@@ -281,13 +687,37 @@ def get_atoms_from_fw(fw, index=-1):
     Returns
         atoms   `ase.Atoms` instance from the Firework you provided
     '''
-    # Get the `ase.Atoms` object from FireWork's results
+    atoms = get_images_from_fw(fw, indices=(index,))[0]
+    return atoms
+
+
+def get_images_from_fw(fw, indices=(0, -1)):
+    '''
+    This function is like `get_atoms_from_fw`, except it can return multiple
+    images of the relaxation while decoding the trajectory only once. Use this
+    when you need (for example) both the initial and final images.
+
+    Args:
+        fw      Instance of a `fireworks.core.firework.Firework` class that
+                should probably get obtained from our Launchpad. This can
+                also be any object with the same `fw_id`, `name`, `spec`,
+                `created_on`, `launches`, and `archived_launches` attributes.
+        indices A sequence of integers referring to the indices of the
+                trajectory file that you want to pull the `ase.Atoms`
+                objects from. `0` will be the starting image; `-1` will be
+                the final image; etc.
+    Returns
+        images  A list of `ase.Atoms` instances from the Firework you
+                provided---one for each index
+    '''
+    # Get the `ase.Atoms` objects from FireWork's results. These may be either
+    # hex strings or references to compressed trajectories in GridFS.
     try:
-        atoms_trajhex = fw.launches[-1].action.stored_data['opt_results'][1]
+        stored_trajectory = fw.launches[-1].action.stored_data['opt_results'][1]
     except IndexError:
-        atoms_trajhex = fw.archived_launches[-1].action.stored_data['opt_results'][1]
+        stored_trajectory = fw.archived_launches[-1].action.stored_data['opt_results'][1]
         warnings.warn('Getting atoms from an archive Fireworks launch', RuntimeWarning)
-    atoms = decode_trajhex_to_atoms(atoms_trajhex, index=index)
+    images = _decode_trajectory_bytes_to_images(read_trajectory_bytes(stored_trajectory), indices)
 
     # Get the Firework task that was meant to convert the original hexstring to
     # a trajectory file. We'll get the original atoms from this task (in
@@ -308,21 +738,152 @@ def get_atoms_from_fw(fw, index=-1):
     # We can grab the original trajhex and then transfer its tags & constraints
     # to the newly decoded atoms
     original_atoms = decode_trajhex_to_atoms(trajhexes[0])
+    patched_images = []
+    for atoms in images:
+        try:
+            atoms.set_tags(original_atoms.get_tags())
+            atoms.set_constraint(original_atoms.constraints)
+
+        # Sometimes the length of the initial atoms and the final atoms are
+        # different. If this happens, then add a more useful error message.
+        except ValueError as error:
+            raise ValueError('The number of atoms from beginning to end of '
+                             'calculation has changed for FireWork ID %i'
+                             % fw.fw_id).with_traceback(error.__traceback__)
+
+        # Patch some old, kinda-broken atoms
+        patched_images.append(__patch_old_atoms_tags(fw, atoms))
+
+    return patched_images
+
+
+def _decode_trajhex_to_images(hex_, indices):
+    '''
+    Decode several images out of a hex-encoded trajectory without any
+    temporary files.
+
+    Args:
+        hex_    A hex-encoded string of a trajectory of atoms objects.
+        indices A sequence of integers indicating which images you want
+    Returns:
+        images  A list of the decoded `ase.Atoms` objects, one for each index
+    '''
+    images = _decode_trajectory_bytes_to_images(bytes.fromhex(hex_), indices)
+    return images
+
+
+def _decode_trajectory_bytes_to_images(raw_bytes, indices):
+    '''
+    Decode several images out of the bytes of a trajectory file. The
+    trajectory reader uses the offsets stored in the trajectory to jump
+    straight to each image, so we do not parse the images that we do not ask
+    for.
+
+    Args:
+        raw_bytes   The bytes of a trajectory file
+        indices     A sequence of integers indicating which images you want
+    Returns:
+        images  A list of the decoded `ase.Atoms` objects, one for each index
+    '''
+    from ase.io.trajectory import TrajectoryReader
+
+    with TrajectoryReader(io.BytesIO(raw_bytes)) as traj:
+        images = [traj[index] for index in indices]
+    return images
+
+
+def read_trajectory_bytes(stored_trajectory, lpad=None):
+    '''
+    Get the bytes of a relaxation trajectory that `vasp_functions.runVasp`
+    put into the `stored_data` of a FireWorks launch. Older launches stored
+    a hex string of the trajectory; newer ones may instead store a reference
+    to a compressed copy in GridFS. This function handles both.
+
+    Args:
+        stored_trajectory   The second item of the `opt_results` of a
+                            launch's `stored_data`, i.e., either a hex string
+                            or a dictionary made by
+                            `vasp_functions.store_trajectory`. If you already
+                            have the bytes, then we just give them back.
+        lpad                [Optional] An instance of a
+                            `fireworks.LaunchPad` to read GridFS with. If you
+                            do not supply one, then we will make (and close)
+                            one for you.
+    Returns:
+        raw_bytes   The bytes of the trajectory file
+    '''
+    if isinstance(stored_trajectory, bytes):
+        return stored_trajectory
+    if isinstance(stored_trajectory, str):
+        return bytes.fromhex(stored_trajectory)
+
+    trajectories = read_trajectories_in_bulk([stored_trajectory], lpad=lpad)
     try:
-        atoms.set_tags(original_atoms.get_tags())
-        atoms.set_constraint(original_atoms.constraints)
+        return trajectories[stored_trajectory['sha256']]
+    except KeyError as error:
+        raise FileNotFoundError('Could not find trajectory %s in the "%s" GridFS bucket'
+                                % (stored_trajectory['sha256'], stored_trajectory['bucket'])
+                                ).with_traceback(error.__traceback__)
+
+
+def read_trajectories_in_bulk(references, lpad=None):
+    '''
+    Read many compressed trajectories out of GridFS using one query per
+    bucket.
+
+    Args:
+        references  A sequence of dictionaries made by
+                    `vasp_functions.store_trajectory`
+        lpad        [Optional] An instance of a `fireworks.LaunchPad` to read
+                    GridFS with. If you do not supply one, then we will make
+                    (and close) one for you.
+    Returns:
+        trajectories    A dictionary whose keys are the SHA-256 hashes of
+                        the trajectories and whose values are the
+                        (decompressed) bytes of the trajectories. Anything
+                        we could not find is omitted.
+    '''
+    import gridfs
 
-    # Sometimes the length of the initial atoms and the final atoms are
-    # different. If this happens, then add a more useful error message.
-    except ValueError as error:
-        raise ValueError('The number of atoms from beginning to end of '
-                         'calculation has changed for FireWork ID %i'
-                         % fw.fw_id).with_traceback(error.__traceback__)
+    hashes_by_bucket = {}
+    for reference in references:
+        hashes_by_bucket.setdefault(reference['bucket'], set()).add(reference['sha256'])
 
-    # Patch some old, kinda-broken atoms
-    patched_atoms = __patch_old_atoms_tags(fw, atoms)
+    trajectories = {}
+    if len(hashes_by_bucket) == 0:
+        return trajectories
+    close_lpad = lpad is None
+    if close_lpad:
+        lpad = get_launchpad()
+    try:
+        for bucket_name, hashes in hashes_by_bucket.items():
+            bucket = gridfs.GridFS(lpad.db, bucket_name)
+            for grid_out in bucket.find({'filename': {'$in': list(hashes)}}):
+                compression = grid_out.metadata['compression']
+                trajectories[grid_out.filename] = _decompress_bytes(grid_out.read(), compression)
+    finally:    # Make sure we close the connection
+        if close_lpad:
+            lpad.fireworks.database.client.close()
+    return trajectories
 
-    return patched_atoms
+
+def _decompress_bytes(compressed_bytes, compression):
+    '''
+    Decompress bytes that were compressed by `vasp_functions._compress_bytes`
+
+    Args:
+        compressed_bytes    The bytes you want to decompress
+        compression         A string indicating the algorithm that was used
+                            to compress the bytes, i.e., 'zlib' or 'zstd'
+    Returns:
+        raw_bytes   The decompressed bytes
+    '''
+    if compression == 'zlib':
+        return zlib.decompress(compressed_bytes)
+    elif compression == 'zstd':
+        import zstandard
+        return zstandard.ZstdDecompressor().decompress(compressed_bytes)
+    raise ValueError('Unknown compression "%s"; expected "zlib" or "zstd"' % compression)
 
 
 def __patch_old_atoms_tags(fw, atoms):
@@ -370,7 +931,8 @@ def defuse_lost_runs():
         lpad.defuse_fw(_id)
 
 
-def check_jobs_status(user_ID, num_jobs):
+def check_jobs_status(user_ID, num_jobs=None, states=None, calculation_types=None,
+                      start_date=None, end_date=None, chunk_size=5000):
     '''
     This function returns the status of the submitted FW_jobs as a pandas
     dataframe. The job status are displayed in reversed order (last job to
@@ -382,41 +944,84 @@ def check_jobs_status(user_ID, num_jobs):
     10001  mp-XXX  [1, 1, 0]       0.0      True   slab+adsorbate optimization  'zulissi'  RUNNING       /home/zulissi/fireworks/block_2018-11-25-21-28...
     10000  mp-YYY  [1, 1, 0]       0.0      True   slab+adsorbate optimization  'zulissi'  RUNNING       /home-research/zulissi/fireworks/blocks/block_...
 
+    We get everything with one projected query to the `fireworks` collection
+    and then one query to the `launches` collection per chunk of FireWorks, so
+    this should stay fast even for tens of thousands of jobs.
+
     Args:
-        user:       Your cori user ID, which is usually your CMU andrew ID, input as a string.
-                    For example: 'zulissi' or 'ktran'.
-        num_jobs    Number of submitted job you want to check
+        user:               Your cori user ID, which is usually your CMU
+                            andrew ID, input as a string. For example:
+                            'zulissi' or 'ktran'.
+        num_jobs            [Optional] Number of submitted job you want to
+                            check. Defaults to all of them.
+        states              [Optional] A sequence of strings indicating the
+                            FireWorks states you want, e.g., `['FIZZLED']`
+        calculation_types   [Optional] A sequence of strings indicating the
+                            calculation types you want, e.g.,
+                            `['slab+adsorbate optimization']`
+        start_date          [Optional] A `datetime.datetime` object. We will
+                            only report jobs that were submitted on or after
+                            this.
+        end_date            [Optional] A `datetime.datetime` object. We will
+                            only report jobs that were submitted before this.
+        chunk_size          An integer indicating how many FireWorks we read
+                            (and look up the launches of) at a time
     Returns:
         dataframe   A Pandas DataFrame that contains FW job status. Information includes:
                     user, mpid, miller index, shift, calculation_type (e.g slab_adsorbate
                     optimization, slab optimization), top, adsorbate (if any), job status
                     (e.g. COMPLETED, FIZZLED, READY, DEFUSED), and directories.
     '''
-    lpad = get_launchpad()
-    user_fwids = lpad.get_fw_ids({'name.user': user_ID})
-    user_fwids.sort(reverse=True)
+    import pandas as pd
+
+    # FireWorks saves its dates as ISO-formatted strings
+    query = {'name.user': user_ID}
+    if states is not None:
+        query['state'] = {'$in': list(states)}
+    if calculation_types is not None:
+        query['name.calculation_type'] = {'$in': list(calculation_types)}
+    if start_date is not None or end_date is not None:
+        query['created_on'] = {}
+        if start_date is not None:
+            query['created_on']['$gte'] = start_date.isoformat()
+        if end_date is not None:
+            query['created_on']['$lt'] = end_date.isoformat()
+    name_fields = ('mpid', 'miller', 'shift', 'top', 'calculation_type', 'adsorbate', 'user')
+    projection = {'_id': 0, 'fw_id': 1, 'state': 1, 'launches': {'$slice': 1}}
+    projection.update({'name.' + field: 1 for field in name_fields})
 
-    fireworks_info = []
-    for fwid in user_fwids[:num_jobs]:
-        fw = lpad.get_fw_by_id(fwid)
-
-        # EAFP to get the launch directory, which does not exists for unlaunched fireworks
-        try:
-            launch_dir = fw.launches[0].launch_dir
-        except IndexError:
-            launch_dir = ''
-
-        fw_info = (fwid,
-                   fw.name.get('mpid', ''),
-                   fw.name.get('miller', ''),
-                   fw.name.get('shift', ''),
-                   fw.name.get('top', ''),
-                   fw.name.get('calculation_type', ''),
-                   fw.name.get('adsorbate', ''),
-                   fw.name.get('user', ''),
-                   fw.state,
-                   launch_dir)
-        fireworks_info.append(fw_info)
+    lpad = get_launchpad()
+    try:
+        cursor = lpad.fireworks.find(query, projection, batch_size=chunk_size)
+        cursor = cursor.sort('fw_id', -1)
+        if num_jobs is not None:
+            cursor = cursor.limit(num_jobs)
+
+        # Read the FireWorks in chunks so that we can look up the launch
+        # directories of each chunk with one query
+        fireworks_info = []
+        cursor = iter(cursor)
+        while True:
+            docs = list(itertools.islice(cursor, chunk_size))
+            if len(docs) == 0:
+                break
+            launch_ids = [doc['launches'][0] for doc in docs if doc.get('launches')]
+            launch_dirs = {launch['launch_id']: launch['launch_dir']
+                           for launch in lpad.launches.find({'launch_id': {'$in': launch_ids}},
+                                                            {'_id': 0, 'launch_id': 1, 'launch_dir': 1})}
+
+            for doc in docs:
+                # Unlaunched FireWorks do not have launch directories
+                try:
+                    launch_dir = launch_dirs.get(doc['launches'][0], '')
+                except (KeyError, IndexError):
+                    launch_dir = ''
+                fw_info = ((doc['fw_id'],) +
+                           tuple(doc['name'].get(field, '') for field in name_fields) +
+                           (doc['state'], launch_dir))
+                fireworks_info.append(fw_info)
+    finally:    # Make sure we close the connection
+        lpad.fireworks.database.client.close()
 
     data_labels = ('fwid',
                    'mpid',
@@ -429,7 +1034,11 @@ def check_jobs_status(user_ID, num_jobs):
                    'state',
                    'launch_dir')
     dataframe = pd.DataFrame(fireworks_info, columns=data_labels)
-    pd.set_option('display.max_colwidth', -1)
+    # Older versions of pandas use -1 instead of None to mean "no limit"
+    try:
+        pd.set_option('display.max_colwidth', None)
+    except ValueError:
+        pd.set_option('display.max_colwidth', -1)
     pd.options.display.max_rows = None
 
     return dataframe
@@ -8,13 +8,14 @@ import math
 import numpy as np
 from copy import deepcopy
 import json
+from datetime import datetime
 from tqdm import tqdm
-from pymongo import MongoClient
+from pymongo import MongoClient, InsertOne, UpdateOne, ASCENDING
+from pymongo.errors import BulkWriteError
 from pymongo.collection import Collection
-from pymatgen.ext.matproj import MPRester
-from pymatgen.analysis.pourbaix_diagram import PourbaixDiagram, ELEMENTS_HO
 from . import defaults
 from .utils import read_rc
+from .tracing import span, traced
 from .fireworks_helper_scripts import get_launchpad
 
 
@@ -33,6 +34,8 @@ def get_mongo_collection(collection_tag):
                             'atoms'
                             'adsorption'
                             'surface_energy'
+                            'predictions'
+                            'latest_predictions'
     Returns:
         collection  A mongo collection object corresponding to the collection
                     tag you specified, but with `__enter__` and `__exit__`
@@ -62,11 +65,16 @@ class ConnectableCollection(Collection):
     be open and closed via a `with` statement
     '''
     def __enter__(self):
+        # If we're tracing, then we time how long this connection stays open
+        self._span = span('mongo:' + self.name, category='mongo')
+        self._span.__enter__()
         return self
     def __exit__(self, exception_type, exception_value, exception_traceback):   # noqa: E301
         self.database.client.close()
+        self._span.__exit__(exception_type, exception_value, exception_traceback)
 
 
+@traced('gasdb')
 def get_adsorption_docs(adsorbate=None, extra_projections=None, filters=None):
     '''
     A wrapper for the `aggregate` command that is tailored specifically for the
@@ -175,6 +183,7 @@ def _clean_up_aggregated_docs(docs, expected_keys):
     return cleaned_docs
 
 
+@traced('gasdb')
 def get_surface_docs(extra_projections=None, filters=None):
     '''
     A wrapper for `collection.aggregate` that is tailored specifically for the
@@ -223,6 +232,7 @@ def get_surface_docs(extra_projections=None, filters=None):
     return cleaned_docs
 
 
+@traced('gasdb')
 def get_catalog_docs():
     '''
     A wrapper for `collection.aggregate` that is tailored specifically for the
@@ -263,6 +273,7 @@ def _pull_catalog_from_mongo(pipeline):
     return docs
 
 
+@traced('gasdb')
 def get_catalog_docs_with_predictions(latest_predictions=True):
     '''
     Nearly identical to `get_catalog_docs`, except it also pulls our surrogate
@@ -277,6 +288,10 @@ def get_catalog_docs_with_predictions(latest_predictions=True):
                 'predictions' key that has the surrogate modeling predictions
                 of adsorption energy.
     '''
+    if _use_predictions_collection():
+        return _get_catalog_docs_with_stored_predictions(latest_predictions)
+
+    # Older databases store the predictions inside of the catalog documents.
     # Get the default catalog projection, then append the projections we
     # need to get the predictions.
     projection = defaults.catalog_projection()
@@ -363,6 +378,339 @@ def _add_orr_predictions_to_projection(projection, latest_predictions):
     return projection
 
 
+def _use_predictions_collection():
+    '''
+    Returns:
+        use_collection  A Boolean indicating whether the .gaspyrc.json file has
+                        a `predictions` collection. If it does not, then we
+                        read the predictions that older versions of GASpy
+                        stored inside of the catalog documents.
+    '''
+    try:
+        read_rc('mongo_info.predictions')
+        return True
+    except KeyError:
+        return False
+
+
+def _get_catalog_docs_with_stored_predictions(latest_predictions):
+    '''
+    Does what `get_catalog_docs_with_predictions` does, but with the
+    predictions from the `predictions` and `latest_predictions` collections.
+    The documents look the same as the ones from older databases, i.e.,
+    `doc['predictions']['adsorption_energy'][adsorbate][model]` is a
+    `[timestamp, value]` list (or a list of them).
+
+    Arg:
+        lastest_predictions Boolean indicating whether or not you want either
+                            the latest predictions or all of them.
+    Returns:
+        docs    A list of dictionaries whose key/value pairings are the ones
+                given by `gaspy.defaults.catalog_projection`, along with a
+                'predictions' key.
+    '''
+    if latest_predictions:
+        predictions = get_latest_predictions()
+    else:
+        predictions = get_prediction_history()
+
+    # Nest the predictions of each site like older versions of GASpy did
+    predictions_by_site = {}
+    for prediction in predictions:
+        location = predictions_by_site.setdefault(prediction['site_id'], {})
+        location = location.setdefault(prediction['quantity'], {})
+        if prediction['adsorbate'] is not None:
+            location = location.setdefault(prediction['adsorbate'], {})
+        entry = [prediction['timestamp'], prediction['value']]
+        if latest_predictions:
+            location[prediction['model']] = entry
+        else:
+            location.setdefault(prediction['model'], []).append(entry)
+
+    docs = []
+    for doc in get_catalog_docs():
+        try:
+            doc['predictions'] = predictions_by_site[doc['mongo_id']]
+        except KeyError:
+            continue
+        docs.append(doc)
+    if not docs:
+        warnings.warn('We did not find any predictions for the catalog', RuntimeWarning)
+    return docs
+
+
+def _make_prediction_query(quantity, model_tag, adsorbate, site_ids):
+    '''
+    Makes a Mongo query for our prediction collections. Every argument is
+    optional; we do not filter on the ones that are `None`.
+
+    Args:
+        quantity    A string indicating what was predicted, e.g.,
+                    'adsorption_energy' or 'orr_onset_potential_4e'
+        model_tag   A string indicating the model that made the predictions
+        adsorbate   A string indicating the adsorbate of the predictions
+        site_ids    A sequence of the `mongo_id`s of the catalog documents
+                    that you want the predictions of
+    Returns:
+        query   A dictionary
+    '''
+    query = {}
+    if quantity is not None:
+        query['quantity'] = quantity
+    if model_tag is not None:
+        query['model'] = model_tag
+    if adsorbate is not None:
+        query['adsorbate'] = adsorbate
+    if site_ids is not None:
+        query['site_id'] = {'$in': list(site_ids)}
+    return query
+
+
+@traced('gasdb')
+def get_latest_predictions(quantity=None, model_tag=None, adsorbate=None, site_ids=None):
+    '''
+    Get the newest prediction of each site (for each quantity, adsorbate, and
+    model) from the `latest_predictions` collection. Every argument is an
+    optional filter.
+
+    Args:
+        quantity    A string indicating what was predicted, e.g.,
+                    'adsorption_energy' or 'orr_onset_potential_4e'
+        model_tag   A string indicating the model that made the predictions
+        adsorbate   A string indicating the adsorbate of the predictions
+        site_ids    A sequence of the `mongo_id`s of the catalog documents
+                    that you want the predictions of
+    Returns:
+        docs    A list of dictionaries with the keys `site_id`, `quantity`,
+                `adsorbate`, `model`, `timestamp`, and `value`
+    '''
+    query = _make_prediction_query(quantity, model_tag, adsorbate, site_ids)
+    with get_mongo_collection('latest_predictions') as collection:
+        print('Now pulling the latest predictions...')
+        cursor = collection.find(query, {'_id': 0})
+        docs = [doc for doc in tqdm(cursor)]
+    return docs
+
+
+@traced('gasdb')
+def get_prediction_history(quantity=None, model_tag=None, adsorbate=None, site_ids=None):
+    '''
+    Get every prediction that we have saved in the `predictions` collection,
+    oldest first. Every argument is an optional filter.
+
+    Args:
+        quantity    A string indicating what was predicted, e.g.,
+                    'adsorption_energy' or 'orr_onset_potential_4e'
+        model_tag   A string indicating the model that made the predictions
+        adsorbate   A string indicating the adsorbate of the predictions
+        site_ids    A sequence of the `mongo_id`s of the catalog documents
+                    that you want the predictions of
+    Returns:
+        docs    A list of dictionaries with the keys `site_id`, `quantity`,
+                `adsorbate`, `model`, `timestamp`, and `value`
+    '''
+    query = _make_prediction_query(quantity, model_tag, adsorbate, site_ids)
+    with get_mongo_collection('predictions') as collection:
+        print('Now pulling the prediction history...')
+        cursor = collection.find(query, {'_id': 0}, sort=[('timestamp', ASCENDING)])
+        docs = [doc for doc in tqdm(cursor)]
+    return docs
+
+
+# The fields that identify one series of predictions. The `predictions`
+# collection has one document per series and timestamp, while the
+# `latest_predictions` collection has one document per series.
+PREDICTION_SERIES_KEYS = ('site_id', 'quantity', 'adsorbate', 'model')
+
+
+def _create_prediction_indices():
+    '''
+    Makes sure that our prediction collections have the unique indices that
+    we rely on when we write to them. Creating an index that already exists
+    does nothing.
+    '''
+    series_index = [(key, ASCENDING) for key in PREDICTION_SERIES_KEYS]
+    with get_mongo_collection('predictions') as collection:
+        collection.create_index(series_index + [('timestamp', ASCENDING)], unique=True)
+        collection.create_index([('timestamp', ASCENDING)])
+    with get_mongo_collection('latest_predictions') as collection:
+        collection.create_index(series_index, unique=True)
+        collection.create_index([('quantity', ASCENDING),
+                                 ('adsorbate', ASCENDING),
+                                 ('model', ASCENDING)])
+
+
+@traced('gasdb')
+def write_predictions(site_ids, values, quantity, model_tag,
+                      adsorbate=None, timestamp=None, chunk_size=10000):
+    '''
+    Save a batch of predictions, e.g., everything that one regression job
+    predicted for one adsorbate. We add them to the history in the
+    `predictions` collection, and then we update the `latest_predictions`
+    collection wherever they are newer than what is already there.
+
+    Args:
+        site_ids    A sequence of the `mongo_id`s of the catalog documents
+                    that you made the predictions for
+        values      A sequence of the predictions, one per site, e.g., floats
+        quantity    A string indicating what you predicted, e.g.,
+                    'adsorption_energy' or 'orr_onset_potential_4e'
+        model_tag   A string indicating the model that made the predictions
+        adsorbate   [Optional] A string indicating the adsorbate of the
+                    predictions. Leave it as `None` for quantities that do not
+                    have one, like 'orr_onset_potential_4e'.
+        timestamp   [Optional] A `datetime.datetime` of when you made the
+                    predictions, in UTC. Defaults to now.
+        chunk_size  An integer indicating how many predictions to send to
+                    Mongo at a time
+    Returns:
+        n_predictions   An integer indicating how many predictions we saved
+    '''
+    site_ids = list(site_ids)
+    values = list(values)
+    if len(site_ids) != len(values):
+        raise ValueError('We got %i site IDs but %i predictions'
+                         % (len(site_ids), len(values)))
+    if timestamp is None:
+        timestamp = datetime.utcnow()
+
+    docs = [{'site_id': site_id,
+             'quantity': quantity,
+             'adsorbate': adsorbate,
+             'model': model_tag,
+             'timestamp': timestamp,
+             'value': value}
+            for site_id, value in zip(site_ids, values)]
+    _create_prediction_indices()
+    _write_prediction_docs(docs, chunk_size)
+    return len(docs)
+
+
+def _write_prediction_docs(docs, chunk_size=10000):
+    '''
+    Bulk-writes prediction documents into both of our prediction collections.
+    Writing the same prediction twice does nothing, so you can safely retry
+    batches that failed partway through. This relies on the indices from
+    `_create_prediction_indices`, so call that before you call this.
+
+    Args:
+        docs        A list of dictionaries with the keys `site_id`,
+                    `quantity`, `adsorbate`, `model`, `timestamp`, and `value`
+        chunk_size  An integer indicating how many documents to send to Mongo
+                    at a time
+    '''
+    chunks = [docs[i:i+chunk_size] for i in range(0, len(docs), chunk_size)]
+
+    with get_mongo_collection('predictions') as collection:
+        for chunk in chunks:
+            # Copy the documents so that Mongo does not add `_id`s to them
+            requests = [InsertOne(dict(doc)) for doc in chunk]
+            _bulk_write_ignoring_duplicates(collection, requests)
+
+    # We only match the latest prediction of a series if ours is newer. If the
+    # one in there is newer (or the same), then our upsert runs into the
+    # unique index instead of overwriting it, and we ignore that.
+    with get_mongo_collection('latest_predictions') as collection:
+        for chunk in chunks:
+            requests = []
+            for doc in chunk:
+                query = {key: doc[key] for key in PREDICTION_SERIES_KEYS}
+                query['timestamp'] = {'$lt': doc['timestamp']}
+                update = {'$set': {'timestamp': doc['timestamp'], 'value': doc['value']}}
+                requests.append(UpdateOne(query, update, upsert=True))
+            _bulk_write_ignoring_duplicates(collection, requests)
+
+
+def _bulk_write_ignoring_duplicates(collection, requests):
+    '''
+    Sends unordered bulk writes to a collection, but does not complain about
+    the ones that ran into unique indices.
+
+    Args:
+        collection  The Mongo collection to write to
+        requests    A list of pymongo write operations, e.g., `InsertOne`
+    '''
+    if not requests:
+        return
+    try:
+        collection.bulk_write(requests, ordered=False)
+    except BulkWriteError as error:
+        details = error.details
+        other_errors = [write_error for write_error in details.get('writeErrors', [])
+                        if write_error['code'] != 11000]
+        if other_errors or details.get('writeConcernErrors'):
+            raise
+
+
+@traced('gasdb')
+def migrate_catalog_predictions(chunk_size=10000):
+    '''
+    Older versions of GASpy stored the predictions inside of the catalog
+    documents, as `[timestamp, value]` lists under
+    `predictions.adsorption_energy.<adsorbate>.<model>` and
+    `predictions.orr_onset_potential_4e.<model>`. This function copies them
+    into the `predictions` and `latest_predictions` collections. It skips the
+    predictions that it already copied, so you can run it more than once.
+
+    Arg:
+        chunk_size  An integer indicating how many predictions to send to
+                    Mongo at a time
+    Returns:
+        n_predictions   An integer indicating how many predictions we found
+                        in the catalog
+    '''
+    _create_prediction_indices()
+    n_predictions = 0
+    docs = []
+    with get_mongo_collection('catalog') as collection:
+        print('Now copying the predictions out of the catalog...')
+        cursor = collection.find({'predictions': {'$exists': True}}, {'predictions': 1})
+        for catalog_doc in tqdm(cursor):
+            docs.extend(_unnest_catalog_predictions(catalog_doc))
+            if len(docs) >= chunk_size:
+                _write_prediction_docs(docs, chunk_size)
+                n_predictions += len(docs)
+                docs = []
+    _write_prediction_docs(docs, chunk_size)
+    n_predictions += len(docs)
+    return n_predictions
+
+
+def _unnest_catalog_predictions(catalog_doc):
+    '''
+    Turns the predictions inside of a catalog document into documents for our
+    prediction collections.
+
+    Arg:
+        catalog_doc A dictionary from the `catalog` collection with the `_id`
+                    and `predictions` keys
+    Returns:
+        docs    A list of dictionaries with the keys `site_id`, `quantity`,
+                `adsorbate`, `model`, `timestamp`, and `value`
+    '''
+    # Adsorption energies are nested by adsorbate; everything else is not
+    series = []
+    for quantity, predictions in catalog_doc['predictions'].items():
+        if quantity == 'adsorption_energy':
+            for adsorbate, predictions_by_model in predictions.items():
+                for model, history in predictions_by_model.items():
+                    series.append((quantity, adsorbate, model, history))
+        else:
+            for model, history in predictions.items():
+                series.append((quantity, None, model, history))
+
+    docs = [{'site_id': catalog_doc['_id'],
+             'quantity': quantity,
+             'adsorbate': adsorbate,
+             'model': model,
+             'timestamp': timestamp,
+             'value': value}
+            for quantity, adsorbate, model, history in series
+            for timestamp, value in history]
+    return docs
+
+
+@traced('gasdb')
 def get_unsimulated_catalog_docs(adsorbate,
                                  adsorbate_rotation_list=None,
                                  vasp_settings=None):
@@ -552,6 +900,7 @@ def _hash_doc(doc, ignore_keys=None, _return_hash=True):
         return serialized_doc
 
 
+@traced('gasdb')
 def get_low_coverage_docs(adsorbate, model_tag=defaults.model()):
     '''
     Each surface has many possible adsorption sites. The site with the most
@@ -627,6 +976,7 @@ def get_low_coverage_docs(adsorbate, model_tag=defaults.model()):
     return docs
 
 
+@traced('gasdb')
 def get_low_coverage_dft_docs(adsorbate, filters=None):
     '''
     This function is analogous to the `get_adsorption_docs` function, except it
@@ -730,6 +1080,7 @@ def round_(n, decimals=0):
     return math.floor(n*multiplier + 0.5) / multiplier
 
 
+@traced('gasdb')
 def get_low_coverage_ml_docs(adsorbate, model_tag=defaults.model()):
     '''
     This function is analogous to the `get_catalog_docs` function, except
@@ -750,6 +1101,9 @@ def get_low_coverage_ml_docs(adsorbate, model_tag=defaults.model()):
                 ML-predicted adsorption energy on their respective surfaces, as
                 defined by their (mpid, miller, shift, top) values.
     '''
+    if _use_predictions_collection():
+        return _get_low_coverage_ml_docs_from_predictions(adsorbate, model_tag)
+
     # Get the standard document projection, then round the shift so that we can
     # group more easily. Credit to Vince Browdren on Stack Exchange
     projections = defaults.catalog_projection()
@@ -790,6 +1144,45 @@ def get_low_coverage_ml_docs(adsorbate, model_tag=defaults.model()):
     return cleaned_docs
 
 
+def _get_low_coverage_ml_docs_from_predictions(adsorbate, model_tag):
+    '''
+    Does what `get_low_coverage_ml_docs` does, but with the predictions from
+    the `latest_predictions` collection. The predictions and the catalog may
+    live in different databases, so we join them here instead of in Mongo.
+
+    Args:
+        adsorbate   A string indicating the adsorbate
+        model_tag   A string indicating which model you want to use to predict
+                    the adsorption energy.
+    Returns:
+        docs    A list of dictionaries whose key/value pairings are the ones
+                given by `gaspy.defaults.catalog_projection`, along with an
+                'energy' key. The shifts are rounded to 2 decimal places.
+    '''
+    predictions = get_latest_predictions('adsorption_energy', model_tag, adsorbate)
+    energies = {prediction['site_id']: prediction['value'] for prediction in predictions}
+
+    # Keep the lowest-energy site of each surface
+    low_coverage_docs = {}
+    for doc in get_catalog_docs():
+        try:
+            doc['energy'] = energies[doc['mongo_id']]
+        except KeyError:
+            continue
+        doc['shift'] = round_(doc['shift'], 2)
+        surface = (doc['mpid'], tuple(doc['miller']), doc['shift'], doc['top'])
+        if (surface not in low_coverage_docs or
+                doc['energy'] < low_coverage_docs[surface]['energy']):
+            low_coverage_docs[surface] = doc
+
+    expected_keys = set(defaults.catalog_projection())
+    expected_keys.add('energy')
+    cleaned_docs = _clean_up_aggregated_docs(list(low_coverage_docs.values()),
+                                             expected_keys=expected_keys)
+    return cleaned_docs
+
+
+@traced('gasdb')
 def purge_adslabs(fwids):
     '''
     This function will "purge" adsorption calculations from our database by
@@ -813,6 +1206,7 @@ def purge_adslabs(fwids):
         collection.delete_many({'fwids.slab+adsorbate': {'$in': fwids}})
 
 
+@traced('gasdb')
 def get_electrochemical_stability(mpid, pH, potential):
     '''
     A wrapper for pymatgen to construct Pourbaix amd calculate electrochemical
@@ -828,6 +1222,9 @@ def get_electrochemical_stability(mpid, pH, potential):
         stability    Electrochemical stability of a composition under reaction condition,
                      unit is eV/atom.
     '''
+    from pymatgen.ext.matproj import MPRester
+    from pymatgen.analysis.pourbaix_diagram import PourbaixDiagram, ELEMENTS_HO
+
     mpr = MPRester(read_rc('matproj_api_key'))
     try:
         entry = mpr.get_entries(mpid)[0]
@@ -4,20 +4,22 @@ The output of all the tasks in this submodule are actually dictionaries (or
 "docs" as we define them, which is short for Mongo document). If you want the
 atoms object, then use the gaspy.mongo.make_atoms_from_doc function on the
 output.
+
+`GenerateAdsorptionSites` and `GenerateAdslabs` can spread their per-slab and
+per-site work across a pool of processes. Set their `n_processes` argument, or
+set `task_n_processes` in your `.gaspyrc.json` file to do this for every task.
+The outputs are the same either way.
 '''
 
 __authors__ = ['Zachary W. Ulissi', 'Kevin Tran']
 __emails__ = ['zulissi@andrew.cmu.edu', 'ktran@andrew.cmu.edu']
 
 import pickle
+import math
+import itertools
 import luigi
 import ase
 import numpy as np
-from ase.collections import g2
-from pymatgen.io.ase import AseAtomsAdaptor
-from pymatgen.ext.matproj import MPRester
-from pymatgen.symmetry.analyzer import SpacegroupAnalyzer
-from pymatgen.core.surface import get_symmetrically_distinct_miller_indices
 from .core import save_task_output, make_task_output_object, get_task_output
 from ..mongo import make_doc_from_atoms, make_atoms_from_doc
 from ..atoms_operators import (make_slabs_from_bulk_atoms,
@@ -33,12 +35,74 @@ from ..atoms_operators import (make_slabs_from_bulk_atoms,
                                add_adsorbate_onto_slab)
 from .. import utils, defaults
 
-GASDB_PATH = utils.read_rc('gasdb_path')
-GAS_SETTINGS = defaults.gas_settings()
 BULK_SETTINGS = defaults.bulk_settings()
 SLAB_SETTINGS = defaults.slab_settings()
 ADSLAB_SETTINGS = defaults.adslab_settings()
-ADSORBATES = defaults.adsorbates()
+
+# How close (in Angstroms) two adsorption sites need to be in each direction
+# for us to treat them as the same site
+SITE_TOLERANCE = 0.01
+
+# Whatever the calls of `_map_over_sites` share, e.g., the slab and bulk
+_SHARED_DATA = {}
+
+
+def _get_n_processes(n_processes):
+    '''
+    Figures out how many processes a task should use for its own work
+
+    Arg:
+        n_processes     An integer indicating how many processes the user asked
+                        for. If it is 0, then we use the `task_n_processes`
+                        field of the `.gaspyrc.json` file, or 1 if it is not
+                        there.
+    Returns:
+        n_processes     A positive integer
+    '''
+    if n_processes > 0:
+        return n_processes
+    try:
+        return max(int(utils.read_rc('task_n_processes')), 1)
+    except KeyError:
+        return 1
+
+
+def _set_shared_data(shared_data):
+    ''' Puts the data that `_map_over_sites` shares into this process '''
+    _SHARED_DATA.clear()
+    _SHARED_DATA.update(shared_data)
+
+
+def _map_over_sites(function, inputs, n_processes, shared_data):
+    '''
+    Maps a function over slabs or sites, in order, using a pool of processes
+    if there is more than one process.
+
+    Args:
+        function    A module-level function that takes one input. It can read
+                    whatever all the inputs share from `_SHARED_DATA`.
+        inputs      A list of the inputs
+        n_processes The number of processes to use
+        shared_data A dictionary that we send to each process once (instead
+                    of with each input) and then put into `_SHARED_DATA`
+    Returns:
+        outputs     A list of the inputs mapped through the function
+    '''
+    if n_processes == 1 or len(inputs) <= 1:
+        _set_shared_data(shared_data)
+        try:
+            return [function(input_) for input_ in inputs]
+        finally:
+            _SHARED_DATA.clear()
+
+    chunksize = max(len(inputs) // (4*n_processes), 1)
+    return list(utils.imultimap(function, inputs,
+                                processes=min(n_processes, len(inputs)),
+                                ordered=True, chunksize=chunksize,
+                                initializer=_set_shared_data,
+                                initargs=(shared_data,),
+                                maxtasksperchild=None,
+                                n_calcs=len(inputs)))
 
 
 class GenerateGas(luigi.Task):
@@ -56,6 +120,8 @@ class GenerateGas(luigi.Task):
     gas_name = luigi.Parameter()
 
     def run(self):
+        from ase.collections import g2
+
         atoms = g2[self.gas_name]
         atoms.positions += 10.
         atoms.cell = [20, 20, 20]
@@ -84,6 +150,9 @@ class GenerateBulk(luigi.Task):
     mpid = luigi.Parameter()
 
     def run(self):
+        from pymatgen.ext.matproj import MPRester
+        from pymatgen.io.ase import AseAtomsAdaptor
+
         with MPRester(utils.read_rc('matproj_api_key')) as rester:
             structure = rester.get_structure_by_material_id(self.mpid)
         atoms = AseAtomsAdaptor.get_atoms(structure)
@@ -177,6 +246,8 @@ class GenerateSlabs(luigi.Task):
                     with respect to the way it was enumerated originally by
                     pymatgen.
         '''
+        from pymatgen.io.ase import AseAtomsAdaptor
+
         docs = []
         for struct in slab_structures:
             atoms = AseAtomsAdaptor.get_atoms(struct)
@@ -230,6 +301,11 @@ class GenerateAdsorptionSites(luigi.Task):
                                 as a dictionary.
         bulk_vasp_settings      A dictionary containing the VASP settings of
                                 the relaxed bulk to enumerate slabs from
+        n_processes             An integer indicating how many processes to
+                                find sites with. Defaults to the
+                                `task_n_processes` field of the `.gaspyrc.json`
+                                file, or 1. This does not change the output, so
+                                it is not part of the task's ID.
     Returns:
         docs    A list of dictionaries (also known as "documents", because
                 they'll eventually be put into Mongo as documents) that contain
@@ -258,6 +334,7 @@ class GenerateAdsorptionSites(luigi.Task):
     slab_generator_settings = luigi.DictParameter(SLAB_SETTINGS['slab_generator_settings'])
     get_slab_settings = luigi.DictParameter(SLAB_SETTINGS['get_slab_settings'])
     bulk_vasp_settings = luigi.DictParameter(BULK_SETTINGS['vasp'])
+    n_processes = luigi.IntParameter(0, significant=False)
 
     def requires(self):
         return GenerateSlabs(mpid=self.mpid,
@@ -269,31 +346,18 @@ class GenerateAdsorptionSites(luigi.Task):
     def run(self):
         with open(self.input().path, 'rb') as file_handle:
             slab_docs = pickle.load(file_handle)
+        n_processes = _get_n_processes(self.n_processes)
 
         # For each slab, tile it and then find all the adsorption sites
-        docs_sites = []
-        for slab_doc in slab_docs:
-            slab_atoms = make_atoms_from_doc(slab_doc)
-            slab_atoms_tiled, slab_repeat = tile_atoms(atoms=slab_atoms,
-                                                       min_x=self.min_xy,
-                                                       min_y=self.min_xy)
-            sites = find_adsorption_sites(slab_atoms_tiled)
-
-            # Place a uranium atom on the adsorption site and then tag it with
-            # a `1`, which is our way of saying that it is an adsorbate
-            for site in sites:
-                adsorbate = ase.Atoms('U')
-                adsorbate.translate(site)
-                adslab_atoms = slab_atoms_tiled.copy() + adsorbate
-                adslab_atoms[-1].tag = 1
-                # Turn the atoms into a document, then save it
-                doc = make_doc_from_atoms(adslab_atoms)
-                doc['fwids'] = slab_doc['fwids']
-                doc['shift'] = slab_doc['shift']
-                doc['top'] = slab_doc['top']
-                doc['slab_repeat'] = slab_repeat
-                doc['adsorption_site'] = site
-                docs_sites.append(doc)
+        tiled_slabs = _map_over_sites(_tile_slab_and_find_sites, slab_docs,
+                                      n_processes, {'min_xy': self.min_xy})
+
+        # Then make a document for each site
+        slabs_and_sites = [(i, site) for i, (_, _, sites) in enumerate(tiled_slabs)
+                           for site in sites]
+        shared_data = {'slab_docs': slab_docs, 'tiled_slabs': tiled_slabs}
+        docs_sites = _map_over_sites(_make_site_doc, slabs_and_sites,
+                                     n_processes, shared_data)
         save_task_output(self, docs_sites)
 
     def output(self):
@@ -360,6 +424,8 @@ class GenerateAdslabs(luigi.Task):
                                        placed along the adsorption vector so it is normal
                                        to the local plane of slabs.
 
+    You can also pass `n_processes` to place the adsorbates with more than one
+    process. Refer to `GenerateAdsorptionSites` for details.
     '''
     adsorbate_name = luigi.Parameter()
     rotation = luigi.DictParameter(ADSLAB_SETTINGS['rotation'])
@@ -369,6 +435,7 @@ class GenerateAdslabs(luigi.Task):
     slab_generator_settings = luigi.DictParameter(SLAB_SETTINGS['slab_generator_settings'])
     get_slab_settings = luigi.DictParameter(SLAB_SETTINGS['get_slab_settings'])
     bulk_vasp_settings = luigi.DictParameter(BULK_SETTINGS['vasp'])
+    n_processes = luigi.IntParameter(0, significant=False)
 
     def requires(self):
         from .calculation_finders import FindBulk   # local import to avoid import errors
@@ -378,7 +445,8 @@ class GenerateAdslabs(luigi.Task):
                                                             min_xy=self.min_xy,
                                                             slab_generator_settings=self.slab_generator_settings,
                                                             get_slab_settings=self.get_slab_settings,
-                                                            bulk_vasp_settings=self.bulk_vasp_settings)}
+                                                            bulk_vasp_settings=self.bulk_vasp_settings,
+                                                            n_processes=self.n_processes)}
 
     def run(self):
         with open(self.input()['bulk'].path, 'rb') as bulk_file_handle:
@@ -389,50 +457,449 @@ class GenerateAdslabs(luigi.Task):
         with open(self.input()['adsorption_sites'].path, 'rb') as file_handle:
             site_docs = pickle.load(file_handle)
 
-        # prepare the supercell slab for adsorption vector
-        slab_atoms = make_atoms_from_doc(site_docs[0])
-        del slab_atoms[-1]
-        supercell_slab_atoms = slab_atoms.repeat((2, 2, 1))
-        surface_atoms_list = find_surface_atoms_indices(bulk_cn_dict, supercell_slab_atoms)
+        # Prepare the supercell slab of each termination for the adsorption
+        # vectors
+        surface_data = {}
+        for site_doc in site_docs:
+            termination = (site_doc['shift'], site_doc['top'])
+            if termination not in surface_data:
+                slab_atoms = make_atoms_from_doc(site_doc)
+                del slab_atoms[-1]
+                surface_data[termination] = _find_surface_data(bulk_cn_dict, slab_atoms)
 
         # Get and (euler) rotate the adsorbate
-        adsorbate = ADSORBATES[self.adsorbate_name].copy()
+        adsorbate = defaults.adsorbates()[self.adsorbate_name].copy()
         adsorbate.euler_rotate(**self.rotation)
 
         # Fetch each slab and then replace the Uranium marker with the
         # adsorbate
-        docs_adslabs = []
-        for site_doc in site_docs:
-            slab = make_atoms_from_doc(site_doc)
-            del slab[-1]
-
-            # Find the adsorption vector.
-            adsorption_vector = find_adsorption_vector(bulk_cn_dict, supercell_slab_atoms,
-                                                       surface_atoms_list, site_doc['adsorption_site'])
-
-            # make a copy here so the original adsorbate is not further rotated
-            # to align to the adsorption vector at each iteration
-            aligned_adsorbate = adsorbate.copy()
-            aligned_adsorbate.rotate(np.array([0., 0., 1.]), adsorption_vector)
-            adslab = add_adsorbate_onto_slab(adsorbate=aligned_adsorbate,
-                                             slab=slab,
-                                             site=site_doc['adsorption_site'])
-
-            # Turn the adslab into a document, add the correct fields, and save
-            doc = make_doc_from_atoms(adslab)
-            doc['fwids'] = site_doc['fwids']
-            doc['shift'] = site_doc['shift']
-            doc['top'] = site_doc['top']
-            doc['slab_repeat'] = site_doc['slab_repeat']
-            doc['adsorption_site'] = site_doc['adsorption_site']
-            doc['adsorption_vector'] = adsorption_vector
-            docs_adslabs.append(doc)
+        shared_data = {'adsorbate': adsorbate,
+                       'bulk_cn_dict': bulk_cn_dict,
+                       'surface_data': surface_data}
+        docs_adslabs = _map_over_sites(_make_adslab_doc_from_site_doc, site_docs,
+                                       _get_n_processes(self.n_processes), shared_data)
         save_task_output(self, docs_adslabs)
 
     def output(self):
         return make_task_output_object(self)
 
 
+def _place_adsorbate(adsorbate, slab, site, bulk_cn_dict, supercell_slab_atoms, surface_indices):
+    '''
+    Aligns an adsorbate to the adsorption vector of a site and then puts it
+    onto the slab
+
+    Args:
+        adsorbate               An `ase.Atoms` object of the (rotated)
+                                adsorbate. It will not be modified.
+        slab                    An `ase.Atoms` object of the tiled slab
+        site                    A 3-long sequence of floats indicating the
+                                Cartesian coordinates of the adsorption site
+        bulk_cn_dict            The output of `find_bulk_cn_dict` for the bulk
+                                of the slab
+        supercell_slab_atoms    The slab repeated (2, 2, 1) times
+        surface_indices         The output of `find_surface_atoms_indices` for
+                                the supercell
+    Returns:
+        adslab              An `ase.Atoms` object of the slab with the
+                            adsorbate on it
+        adsorption_vector   A (3,1) `np.ndarray` of the adsorption vector
+    '''
+    adsorption_vector = find_adsorption_vector(bulk_cn_dict, supercell_slab_atoms,
+                                               surface_indices, site)
+
+    # make a copy here so the original adsorbate is not further rotated
+    # to align to the adsorption vector at each iteration
+    aligned_adsorbate = adsorbate.copy()
+    aligned_adsorbate.rotate(np.array([0., 0., 1.]), adsorption_vector)
+    adslab = add_adsorbate_onto_slab(adsorbate=aligned_adsorbate, slab=slab, site=site)
+    return adslab, adsorption_vector
+
+
+def _find_surface_data(bulk_cn_dict, slab_atoms_tiled):
+    '''
+    Finds what we need to calculate the adsorption vectors of the sites on one
+    termination. `GenerateAdslabs` and `GenerateAdslab` both use this so that
+    they align their adsorbates the same way.
+
+    Args:
+        bulk_cn_dict        The output of `find_bulk_cn_dict` for the bulk of
+                            the slab
+        slab_atoms_tiled    An `ase.Atoms` object of the tiled slab (without
+                            any adsorbate)
+    Returns:
+        supercell_slab_atoms    The tiled slab repeated (2, 2, 1) times
+        surface_indices         The output of `find_surface_atoms_indices` for
+                                the supercell
+    '''
+    supercell_slab_atoms = slab_atoms_tiled.repeat((2, 2, 1))
+    surface_indices = find_surface_atoms_indices(bulk_cn_dict, supercell_slab_atoms)
+    return supercell_slab_atoms, surface_indices
+
+
+def _tile_slab_and_find_sites(slab_doc):
+    '''
+    Helper for `GenerateAdsorptionSites` that tiles a slab and then finds its
+    adsorption sites. It reads `min_xy` from `_SHARED_DATA`.
+
+    Arg:
+        slab_doc    A document made by `GenerateSlabs`
+    Returns:
+        slab_atoms_tiled    The tiled slab as an `ase.Atoms` object
+        slab_repeat         The number of times we repeated the slab in the x
+                            and y directions
+        sites               The adsorption sites of the tiled slab
+    '''
+    slab_atoms = make_atoms_from_doc(slab_doc)
+    slab_atoms_tiled, slab_repeat = tile_atoms(atoms=slab_atoms,
+                                               min_x=_SHARED_DATA['min_xy'],
+                                               min_y=_SHARED_DATA['min_xy'])
+    sites = find_adsorption_sites(slab_atoms_tiled)
+    return slab_atoms_tiled, slab_repeat, sites
+
+
+def _make_site_doc(slab_and_site):
+    '''
+    Helper for `GenerateAdsorptionSites` that places a uranium atom on a site
+    and then turns it into a document. It reads `slab_docs` and the outputs of
+    `_tile_slab_and_find_sites` (`tiled_slabs`) from `_SHARED_DATA`.
+
+    Arg:
+        slab_and_site   A 2-tuple of the index of the slab and the site
+    Returns:
+        doc     A document with a uranium atom at the adsorption site
+    '''
+    i, site = slab_and_site
+    slab_doc = _SHARED_DATA['slab_docs'][i]
+    slab_atoms_tiled, slab_repeat, _ = _SHARED_DATA['tiled_slabs'][i]
+
+    # Place a uranium atom on the adsorption site and then tag it with a `1`,
+    # which is our way of saying that it is an adsorbate
+    adsorbate = ase.Atoms('U')
+    adsorbate.translate(site)
+    adslab_atoms = slab_atoms_tiled.copy() + adsorbate
+    adslab_atoms[-1].tag = 1
+
+    # Turn the atoms into a document
+    doc = make_doc_from_atoms(adslab_atoms)
+    doc['fwids'] = slab_doc['fwids']
+    doc['shift'] = slab_doc['shift']
+    doc['top'] = slab_doc['top']
+    doc['slab_repeat'] = slab_repeat
+    doc['adsorption_site'] = site
+    return doc
+
+
+def _make_adslab_doc_from_site_doc(site_doc):
+    '''
+    Helper for `GenerateAdslabs` that replaces the uranium marker of a site
+    with the adsorbate. It reads the `adsorbate` and `bulk_cn_dict` from
+    `_SHARED_DATA`, along with `surface_data`---i.e., the output of
+    `_find_surface_data` for each (shift, top) termination.
+
+    Arg:
+        site_doc    A document made by `GenerateAdsorptionSites`
+    Returns:
+        doc     A document of the adslab
+    '''
+    slab = make_atoms_from_doc(site_doc)
+    del slab[-1]
+    termination = (site_doc['shift'], site_doc['top'])
+    supercell_slab_atoms, surface_indices = _SHARED_DATA['surface_data'][termination]
+    adslab, adsorption_vector = _place_adsorbate(adsorbate=_SHARED_DATA['adsorbate'],
+                                                 slab=slab,
+                                                 site=site_doc['adsorption_site'],
+                                                 bulk_cn_dict=_SHARED_DATA['bulk_cn_dict'],
+                                                 supercell_slab_atoms=supercell_slab_atoms,
+                                                 surface_indices=surface_indices)
+
+    # Turn the adslab into a document and add the correct fields
+    doc = make_doc_from_atoms(adslab)
+    doc['fwids'] = site_doc['fwids']
+    doc['shift'] = site_doc['shift']
+    doc['top'] = site_doc['top']
+    doc['slab_repeat'] = site_doc['slab_repeat']
+    doc['adsorption_site'] = site_doc['adsorption_site']
+    doc['adsorption_vector'] = adsorption_vector
+    return doc
+
+
+class _GenerateSurfaceData(luigi.Task):
+    '''
+    This task caches everything we need to put an adsorbate onto one
+    termination of a facet---i.e., the tiled slab, its adsorption sites, the
+    coordination numbers of its bulk, and the indices of its surface atoms---so
+    that `GenerateAdslab` can make one adslab at a time without redoing any of
+    it.
+
+    Args:
+        shift                   A float indicating the shift of the slab
+        top                     A Boolean indicating whether we want the top or
+                                the bottom of the slab
+        mpid                    A string indicating the Materials Project ID of
+                                the bulk you want to enumerate sites from
+        miller_indices          A 3-tuple containing the three Miller indices
+                                of the slab you want to enumerate sites from
+        min_xy                  A float indicating the minimum width (in both
+                                the x and y directions) of the slab (Angstroms)
+                                before we enumerate adsorption sites on it.
+        slab_generator_settings We use pymatgen's `SlabGenerator` class to
+                                enumerate surfaces. You can feed the arguments
+                                for that class here as a dictionary.
+        get_slab_settings       We use the `get_slabs` method of pymatgen's
+                                `SlabGenerator` class. You can feed the
+                                arguments for the `get_slabs` method here
+                                as a dictionary.
+        bulk_vasp_settings      A dictionary containing the VASP settings of
+                                the relaxed bulk to enumerate slabs from
+    Returns:
+        doc     A dictionary of the tiled slab that can be turned into an
+                `ase.Atoms` object with `gaspy.mongo.make_atoms_from_doc`. It
+                also contains the following fields:
+                    fwids                   A subdictionary containing the
+                                            FWIDs of the prerequisite
+                                            calculations
+                    shift                   Float indicating the
+                                            shift/termination of the slab
+                    top                     Boolean indicating whether or not
+                                            the slab is oriented upwards
+                    slab_repeat             2-tuple of integers indicating the
+                                            number of times the unit slab was
+                                            repeated in the x and y directions
+                    adsorption_sites        A list of the Cartesian coordinates
+                                            of all the adsorption sites on the
+                                            tiled slab
+                    bulk_cn_dict            The output of `find_bulk_cn_dict`
+                    surface_atoms_indices   The output of
+                                            `find_surface_atoms_indices` for
+                                            the tiled slab repeated (2, 2, 1)
+                                            times
+    '''
+    shift = luigi.FloatParameter()
+    top = luigi.BoolParameter()
+    mpid = luigi.Parameter()
+    miller_indices = luigi.TupleParameter()
+    min_xy = luigi.FloatParameter(ADSLAB_SETTINGS['min_xy'])
+    slab_generator_settings = luigi.DictParameter(SLAB_SETTINGS['slab_generator_settings'])
+    get_slab_settings = luigi.DictParameter(SLAB_SETTINGS['get_slab_settings'])
+    bulk_vasp_settings = luigi.DictParameter(BULK_SETTINGS['vasp'])
+
+    def requires(self):
+        from .calculation_finders import FindBulk   # local import to avoid import errors
+        return {'bulk': FindBulk(mpid=self.mpid, vasp_settings=self.bulk_vasp_settings),
+                'slabs': GenerateSlabs(mpid=self.mpid,
+                                       miller_indices=self.miller_indices,
+                                       slab_generator_settings=self.slab_generator_settings,
+                                       get_slab_settings=self.get_slab_settings,
+                                       bulk_vasp_settings=self.bulk_vasp_settings)}
+
+    def run(self):
+        with open(self.input()['bulk'].path, 'rb') as file_handle:
+            bulk_doc = pickle.load(file_handle)
+        bulk_cn_dict = find_bulk_cn_dict(make_atoms_from_doc(bulk_doc))
+
+        with open(self.input()['slabs'].path, 'rb') as file_handle:
+            slab_docs = pickle.load(file_handle)
+        for slab_doc in slab_docs:
+            if math.isclose(slab_doc['shift'], self.shift, abs_tol=0.01) and slab_doc['top'] == self.top:
+                break
+        else:
+            raise RuntimeError('You just tried to make an adslab that we could '
+                               'not enumerate. Try changing the shift, top, or '
+                               'miller.')
+
+        # Tile the slab and find everything we need to put adsorbates on it
+        slab_atoms = make_atoms_from_doc(slab_doc)
+        slab_atoms_tiled, slab_repeat = tile_atoms(atoms=slab_atoms,
+                                                   min_x=self.min_xy,
+                                                   min_y=self.min_xy)
+        sites = find_adsorption_sites(slab_atoms_tiled)
+
+        doc = make_doc_from_atoms(slab_atoms_tiled)
+        _, surface_atoms_indices = _find_surface_data(bulk_cn_dict, make_atoms_from_doc(doc))
+        doc['fwids'] = slab_doc['fwids']
+        doc['shift'] = slab_doc['shift']
+        doc['top'] = slab_doc['top']
+        doc['slab_repeat'] = slab_repeat
+        doc['adsorption_sites'] = list(sites)
+        doc['bulk_cn_dict'] = bulk_cn_dict
+        doc['surface_atoms_indices'] = surface_atoms_indices
+        save_task_output(self, doc)
+
+    def output(self):
+        return make_task_output_object(self)
+
+
+class GenerateAdslab(luigi.Task):
+    '''
+    This task makes the adslab for a single adsorption site. It gives the
+    same document as the matching one from `GenerateAdslabs`, but it only
+    places and aligns the one adsorbate we asked for. So if you only want a
+    handful of sites on a facet, this is much cheaper.
+
+    Args:
+        adsorption_site         A 3-tuple of floats containing the Cartesian
+                                coordinates of the adsorption site. It needs to
+                                be one of the sites that `GenerateAdsorptionSites`
+                                would enumerate. This is ignored if
+                                `adsorbate_name` is an empty string, in which
+                                case we use the first site of the slab.
+        shift                   A float indicating the shift of the slab
+        top                     A Boolean indicating whether the adsorption
+                                site is on the top or the bottom of the slab
+        adsorbate_name          A string indicating which adsorbate to use. It
+                                should be one of the keys within the
+                                `gaspy.defaults.ADSORBATES` dictionary.
+        rotation                A dictionary containing the angles (in degrees)
+                                in which to rotate the adsorbate after it is
+                                placed at the adsorption site. The keys for
+                                each of the angles are 'phi', 'theta', and
+                                psi'.
+        mpid                    A string indicating the Materials Project ID of
+                                the bulk you want to enumerate sites from
+        miller_indices          A 3-tuple containing the three Miller indices
+                                of the slab you want to enumerate sites from
+        min_xy                  A float indicating the minimum width (in both
+                                the x and y directions) of the slab (Angstroms)
+                                before we enumerate adsorption sites on it.
+        slab_generator_settings We use pymatgen's `SlabGenerator` class to
+                                enumerate surfaces. You can feed the arguments
+                                for that class here as a dictionary.
+        get_slab_settings       We use the `get_slabs` method of pymatgen's
+                                `SlabGenerator` class. You can feed the
+                                arguments for the `get_slabs` method here
+                                as a dictionary.
+        bulk_vasp_settings      A dictionary containing the VASP settings of
+                                the relaxed bulk to enumerate slabs from
+    Returns:
+        doc     A dictionary of the adslab with the same fields as the
+                documents made by `GenerateAdslabs`
+    '''
+    adsorption_site = luigi.TupleParameter()
+    shift = luigi.FloatParameter()
+    top = luigi.BoolParameter()
+    adsorbate_name = luigi.Parameter()
+    rotation = luigi.DictParameter(ADSLAB_SETTINGS['rotation'])
+    mpid = luigi.Parameter()
+    miller_indices = luigi.TupleParameter()
+    min_xy = luigi.FloatParameter(ADSLAB_SETTINGS['min_xy'])
+    slab_generator_settings = luigi.DictParameter(SLAB_SETTINGS['slab_generator_settings'])
+    get_slab_settings = luigi.DictParameter(SLAB_SETTINGS['get_slab_settings'])
+    bulk_vasp_settings = luigi.DictParameter(BULK_SETTINGS['vasp'])
+
+    def requires(self):
+        return _GenerateSurfaceData(shift=self.shift,
+                                    top=self.top,
+                                    mpid=self.mpid,
+                                    miller_indices=self.miller_indices,
+                                    min_xy=self.min_xy,
+                                    slab_generator_settings=self.slab_generator_settings,
+                                    get_slab_settings=self.get_slab_settings,
+                                    bulk_vasp_settings=self.bulk_vasp_settings)
+
+    def run(self):
+        with open(self.input().path, 'rb') as file_handle:
+            surface_doc = pickle.load(file_handle)
+        sites = surface_doc['adsorption_sites']
+
+        # Make sure that we are asking for a site that we would have
+        # enumerated. Empty slabs do not care about the site, so we just use
+        # the first one like `GenerateAdslabs` would.
+        if self.adsorbate_name == '':
+            site = sites[0]
+        else:
+            site_index = make_site_index(sites)
+            matches = find_sites_in_index(site_index, self.adsorption_site)
+            matches = [i for i in matches
+                       if np.allclose(sites[i], self.adsorption_site, atol=SITE_TOLERANCE)]
+            if not matches:
+                raise RuntimeError('You just tried to make an adslab that we '
+                                   'could not enumerate. Try changing the '
+                                   'adsorption site, shift, top, or miller.')
+            site = sites[matches[0]]
+
+        # Get and (euler) rotate the adsorbate
+        adsorbate = defaults.adsorbates()[self.adsorbate_name].copy()
+        adsorbate.euler_rotate(**self.rotation)
+
+        # Use the same supercell as `GenerateAdslabs` so that we get the same
+        # adsorption vector
+        slab = make_atoms_from_doc(surface_doc)
+        supercell_slab_atoms = slab.repeat((2, 2, 1))
+        adslab, adsorption_vector = _place_adsorbate(adsorbate=adsorbate,
+                                                     slab=slab,
+                                                     site=site,
+                                                     bulk_cn_dict=surface_doc['bulk_cn_dict'],
+                                                     supercell_slab_atoms=supercell_slab_atoms,
+                                                     surface_indices=surface_doc['surface_atoms_indices'])
+
+        doc = make_doc_from_atoms(adslab)
+        doc['fwids'] = surface_doc['fwids']
+        doc['shift'] = surface_doc['shift']
+        doc['top'] = surface_doc['top']
+        doc['slab_repeat'] = surface_doc['slab_repeat']
+        doc['adsorption_site'] = site
+        doc['adsorption_vector'] = adsorption_vector
+        save_task_output(self, doc)
+
+    def output(self):
+        return make_task_output_object(self)
+
+
+def _quantize_site(site):
+    '''
+    Rounds the coordinates of a site onto a grid whose spacing is twice our
+    site tolerance, so that any two sites that are within tolerance of each
+    other fall in the same or in neighboring grid cells.
+
+    Arg:
+        site    A 3-long sequence of floats
+    Returns:
+        key     A 3-tuple of integers
+    '''
+    return tuple(int(round(coordinate / (2*SITE_TOLERANCE))) for coordinate in site)
+
+
+def make_site_index(sites):
+    '''
+    Makes an index that lets us look up adsorption sites by their coordinates
+    without having to compare against every site.
+
+    Arg:
+        sites   A sequence of 3-long sequences of floats, e.g., the
+                `adsorption_site` of each of the documents made by
+                `GenerateAdslabs`
+    Returns:
+        site_index  A dictionary whose keys are quantized sites and whose
+                    values are lists of the positions of those sites within
+                    `sites`. Use it with `find_sites_in_index`.
+    '''
+    site_index = {}
+    for i, site in enumerate(sites):
+        site_index.setdefault(_quantize_site(site), []).append(i)
+    return site_index
+
+
+def find_sites_in_index(site_index, site):
+    '''
+    Finds the sites that might be within `SITE_TOLERANCE` of a site. You
+    still need to check the candidates yourself (e.g., with `np.allclose`),
+    because some of them may be up to two grid spacings away.
+
+    Args:
+        site_index  The output of `make_site_index`
+        site        A 3-long sequence of floats
+    Returns:
+        candidates  A sorted list of the positions of the candidate sites
+    '''
+    key = _quantize_site(site)
+    candidates = []
+    for offset in itertools.product((-1, 0, 1), repeat=3):
+        neighbor = tuple(k + o for k, o in zip(key, offset))
+        candidates.extend(site_index.get(neighbor, []))
+    return sorted(candidates)
+
+
 class GenerateAllSitesFromBulk(luigi.Task):
     '''
     This task will enumerate all the adsorption sites from a single bulk.
@@ -536,6 +1003,10 @@ class _EnumerateDistinctFacets(luigi.Task):
         return FindBulk(mpid=self.mpid, vasp_settings=self.bulk_vasp_settings)
 
     def run(self):
+        from pymatgen.io.ase import AseAtomsAdaptor
+        from pymatgen.symmetry.analyzer import SpacegroupAnalyzer
+        from pymatgen.core.surface import get_symmetrically_distinct_miller_indices
+
         with open(self.input().path, 'rb') as file_handle:
             bulk_doc = pickle.load(file_handle)
 
@@ -8,16 +8,16 @@ __emails__ = ['zulissi@andrew.cmu.edu', 'ktran@andrew.cmu.edu']
 
 import warnings
 from copy import deepcopy
+import os
+import time
 import pickle
 import luigi
 from ase.constraints import FixAtoms
-from pymatgen.io.ase import AseAtomsAdaptor
-from pymatgen.symmetry.analyzer import SpacegroupAnalyzer
-from pymatgen.core.surface import SlabGenerator
 from .. import defaults
+from ..utils import get_nested_value, doc_matches_query
 from ..mongo import make_atoms_from_doc, make_doc_from_atoms
 from ..gasdb import get_mongo_collection
-from ..fireworks_helper_scripts import find_n_rockets
+from ..fireworks_helper_scripts import find_n_rockets, find_n_rockets_in_bulk
 from .core import save_task_output, make_task_output_object, get_task_output
 from .make_fireworks import (MakeGasFW,
                              MakeBulkFW,
@@ -77,9 +77,16 @@ class FindCalculation(luigi.Task):
         # If there's no match in our `atoms` collection, then check if our
         # FireWorks system is currently running it
         if calc_found is False:
-            n_running, n_fizzles = find_n_rockets(self.fw_query,
-                                                  self.vasp_settings,
-                                                  _testing=_testing)
+            # `resolve_calculations` may have already counted our rockets
+            try:
+                n_running, n_fizzles = self._rocket_counts
+                del self._rocket_counts
+                if not self._has_recent_batch_miss():
+                    raise AttributeError
+            except AttributeError:
+                n_running, n_fizzles = find_n_rockets(self.fw_query,
+                                                      self.vasp_settings,
+                                                      _testing=_testing)
 
             # If we aren't running yet, then start running
             if n_running == 0:
@@ -174,10 +181,28 @@ class FindCalculation(luigi.Task):
             _ = get_task_output(self)   # noqa: F841
             return True
 
-        # If it's not pickled, then check Mongo
+        # If it's not pickled, then check Mongo. If `resolve_calculations`
+        # just checked Mongo for us and found nothing, then don't bother.
         except FileNotFoundError:
+            if self._has_recent_batch_miss():
+                return False
             return self._find_and_save_calculation()
 
+    def _has_recent_batch_miss(self):
+        '''
+        Luigi hands the same task instance to everybody who makes a task with
+        the same parameters, so a long-running process may ask us whether we
+        are complete long after `resolve_calculations` looked for us. We
+        therefore only trust its misses for `BATCH_RESOLUTION_TTL` seconds.
+
+        Returns:
+            recent_miss A Boolean indicating whether `resolve_calculations`
+                        recently looked for our calculation and did not find
+                        it
+        '''
+        miss_time = getattr(self, '_batch_miss_time', None)
+        return miss_time is not None and time.time() - miss_time < BATCH_RESOLUTION_TTL
+
     def output(self):
         return make_task_output_object(self)
 
@@ -515,6 +540,10 @@ class FindSurface(FindCalculation):
             surface_atoms_constrained   `ase.Atoms` object of the surface to
                                         submit to Fireworks for relaxation
         '''
+        from pymatgen.io.ase import AseAtomsAdaptor
+        from pymatgen.symmetry.analyzer import SpacegroupAnalyzer
+        from pymatgen.core.surface import SlabGenerator
+
         # Get the bulk and convert to `pymatgen.Structure` object
         with open(self.input().path, 'rb') as file_handle:
             bulk_doc = pickle.load(file_handle)
@@ -572,3 +601,213 @@ class FindSurface(FindCalculation):
 
         atoms.constraints += [FixAtoms(mask=mask)]
         return atoms
+
+
+# These are the fields that we use to fetch candidate documents for many
+# calculation finders at once. Every `gasdb_query` has the calculation type
+# and one of the identifiers.
+_BATCH_IDENTIFIERS = ('fwname.mpid', 'fwname.gasname')
+# How many seconds we trust that a calculation that `resolve_calculations`
+# did not find is still not there
+BATCH_RESOLUTION_TTL = 300.
+
+
+def resolve_calculations(tasks, chunk_size=1000, _testing=False):
+    '''
+    Calling `complete` on thousands of `FindCalculation` tasks means thousands
+    of nearly identical Mongo queries, which is slow. This function finds the
+    calculations for many tasks at once by fetching all of the candidate
+    documents with a few `$in` queries and then matching them in memory with
+    each task's `gasdb_query`. Every match is saved as the output of its task,
+    and every miss is remembered (for `BATCH_RESOLUTION_TTL` seconds) so that
+    the task's `complete` method does not query Mongo again. We also count the
+    FireWorks rockets of every miss in bulk so that the task's `run` method
+    does not need to query FireWorks.
+
+    You should call this function right before you schedule a large number of
+    tasks, e.g., via `schedule_tasks(tasks, resolve_calculations=True)`.
+
+    Args:
+        tasks       An iterable of `luigi.Task` instances. We will walk through
+                    their static requirements to find all of the
+                    `FindCalculation` tasks within them.
+        chunk_size  The maximum number of identifiers (e.g., mpids) we put into
+                    any single `$in` query
+        _testing    Boolean indicating whether or not you are doing a unit
+                    test. You probably shouldn't touch this.
+    Returns:
+        n_found     An integer indicating how many calculations we found
+    '''
+    finders = _get_calculation_finders(tasks)
+
+    # `FindSurface` tasks need their bulks before they can make their queries,
+    # so we resolve everything else first
+    surface_finders = [task for task in finders if isinstance(task, FindSurface)]
+    other_finders = [task for task in finders if not isinstance(task, FindSurface)]
+    n_found, missing_finders = _resolve_calculation_finders(other_finders, chunk_size)
+    n_found_surfaces, missing_surface_finders = _resolve_calculation_finders(surface_finders,
+                                                                             chunk_size)
+    n_found += n_found_surfaces
+    missing_finders += missing_surface_finders
+
+    # Count the rockets of everything we did not find
+    if missing_finders:
+        rocket_counts = find_n_rockets_in_bulk([task.fw_query for task in missing_finders],
+                                               [task.vasp_settings for task in missing_finders],
+                                               chunk_size=chunk_size,
+                                               _testing=_testing)
+        for task, counts in zip(missing_finders, rocket_counts):
+            task._rocket_counts = counts
+    return n_found
+
+
+def _get_calculation_finders(tasks):
+    '''
+    Walks through the static requirements of Luigi tasks to find all of the
+    `FindCalculation` tasks.
+
+    Arg:
+        tasks   An iterable of `luigi.Task` instances
+    Returns:
+        finders A list of the unique `FindCalculation` instances we found
+    '''
+    finders = {}
+    seen_task_ids = set()
+    tasks_to_check = list(tasks)
+    while tasks_to_check:
+        task = tasks_to_check.pop()
+        if task.task_id in seen_task_ids:
+            continue
+        seen_task_ids.add(task.task_id)
+
+        if isinstance(task, FindCalculation):
+            finders[task.task_id] = task
+        # Some tasks (e.g., `CalculateSurfaceEnergy`) check themselves in
+        # `requires`. We let Luigi report those errors later.
+        try:
+            tasks_to_check.extend(luigi.task.flatten(task.requires()))
+        except RuntimeError:
+            pass
+    return list(finders.values())
+
+
+def find_calculation_docs(finders, chunk_size=1000):
+    '''
+    Find the `atoms` documents that many `FindCalculation` tasks would find,
+    but without saving anything. We fetch all of the candidate documents with
+    a few `$in` queries and then match them in memory with each task's
+    `gasdb_query`, so the matching is the same as the tasks' own.
+
+    Args:
+        finders     A sequence of `FindCalculation` instances. Their
+                    `_load_attributes` methods must be callable, so
+                    `FindSurface` tasks whose requirements are not done will
+                    not work.
+        chunk_size  The maximum number of identifiers (e.g., mpids) we put
+                    into any single `$in` query
+    Returns:
+        docs    A list with one item per task. Each item is the newest
+                matching document, or an empty dictionary if we found
+                nothing.
+    '''
+    # Group the tasks by their calculation type and identifier so that we can
+    # fetch their candidate documents together
+    groups = {}
+    for i, task in enumerate(finders):
+        task._load_attributes()
+        calc_type = task.gasdb_query['fwname.calculation_type']
+        id_key = [key for key in _BATCH_IDENTIFIERS if key in task.gasdb_query][0]
+        groups.setdefault((calc_type, id_key), []).append(i)
+
+    docs = [{} for _ in finders]
+    with get_mongo_collection('atoms') as collection:
+        for (calc_type, id_key), indices in groups.items():
+            identifiers = sorted({finders[i].gasdb_query[id_key] for i in indices})
+
+            # Fetch and index the candidates by their identifier
+            candidates = {}
+            for j in range(0, len(identifiers), chunk_size):
+                query = {'fwname.calculation_type': calc_type,
+                         id_key: {'$in': identifiers[j:j+chunk_size]}}
+                for doc in collection.find(query):
+                    identifier = get_nested_value(doc, id_key)
+                    candidates.setdefault(identifier, []).append(doc)
+
+            # Match the candidates to each task in memory
+            for i in indices:
+                task = finders[i]
+                matches = [doc for doc in candidates.get(task.gasdb_query[id_key], [])
+                           if doc_matches_query(doc, task.gasdb_query)]
+                docs[i] = task._remove_old_docs(matches)
+    return docs
+
+
+def get_calculation_docs(finders, chunk_size=1000):
+    '''
+    Get the documents that `FindCalculation` tasks would give us. If a task
+    has already been run, then we use its output. Otherwise we find its
+    document in bulk with `find_calculation_docs`.
+
+    Args:
+        finders     A sequence of `FindCalculation` instances
+        chunk_size  The maximum number of identifiers (e.g., mpids) we put
+                    into any single `$in` query
+    Returns:
+        docs    A list with one item per task. Each item is the document that
+                the task would give, or an empty dictionary if we found
+                nothing.
+    '''
+    docs = [None for _ in finders]
+    indices_to_query = []
+    for i, finder in enumerate(finders):
+        if os.path.isfile(finder.output().path):
+            docs[i] = get_task_output(finder)
+        else:
+            indices_to_query.append(i)
+
+    finders_to_query = [finders[i] for i in indices_to_query]
+    for i, doc in zip(indices_to_query, find_calculation_docs(finders_to_query, chunk_size)):
+        docs[i] = doc
+    return docs
+
+
+def _resolve_calculation_finders(finders, chunk_size):
+    '''
+    Does the heavy lifting for `resolve_calculations`
+
+    Args:
+        finders     A list of `FindCalculation` instances
+        chunk_size  The maximum number of identifiers (e.g., mpids) we put
+                    into any single `$in` query
+    Returns:
+        n_found         An integer indicating how many calculations we found
+        missing_finders A list of the tasks whose calculations we did not find
+    '''
+    unresolved_finders = []
+    for task in finders:
+        if os.path.isfile(task.output().path):
+            continue
+        try:
+            task._load_attributes()
+        # Some tasks (i.e., `FindSurface`) can't make their queries until their
+        # own requirements are done. Let Luigi deal with those.
+        except FileNotFoundError:
+            continue
+        unresolved_finders.append(task)
+
+    n_found = 0
+    missing_finders = []
+    docs = find_calculation_docs(unresolved_finders, chunk_size)
+    miss_time = time.time()
+    for task, doc in zip(unresolved_finders, docs):
+        if doc != {}:
+            try:
+                save_task_output(task, doc)
+            # If we've already saved the output, then move on
+            except luigi.target.FileAlreadyExists:
+                pass
+            n_found += 1
+        else:
+            task._batch_miss_time = miss_time
+            missing_finders.append(task)
+    return n_found, missing_finders
@@ -8,20 +8,26 @@ __emails__ = ['zulissi@andrew.cmu.edu', 'ktran@andrew.cmu.edu']
 
 import os
 import types
-from collections import Iterable
+from collections.abc import Iterable
 import pickle
 import warnings
 with warnings.catch_warnings():
     warnings.filterwarnings('ignore', category=DeprecationWarning)
     import luigi
-from .. import utils
-from ..fireworks_helper_scripts import get_launchpad
+from .. import utils, tracing
+from ..fireworks_helper_scripts import get_launchpad, read_trajectory_bytes
 
-GASDB_PATH = utils.read_rc('gasdb_path')
-TASKS_CACHE_LOCATION = utils.read_rc('gasdb_path') + '/pickles/'
+
+def _get_tasks_cache_location():
+    '''
+    Returns the folder where we pickle all of our task outputs. We read this
+    from the `.gaspyrc.json` file only when we need it (instead of at import)
+    so that importing GASpy does not require any configuration.
+    '''
+    return utils.read_rc('gasdb_path') + '/pickles/'
 
 
-def schedule_tasks(tasks, workers=1, local_scheduler=False):
+def schedule_tasks(tasks, workers=1, local_scheduler=False, resolve_calculations=False):
     '''
     This light wrapping function will execute any tasks you want through the
     Luigi host that is listed in the `.gaspyrc.json` file.
@@ -38,7 +44,20 @@ def schedule_tasks(tasks, workers=1, local_scheduler=False):
                             scheduling, then we will use our Luigi daemon
                             to manage things, which should be the status
                             quo.
+        resolve_calculations    A Boolean indicating whether to look for the
+                                calculations of all of the `FindCalculation`
+                                tasks within `tasks` in bulk before
+                                scheduling them (see
+                                `gaspy.tasks.calculation_finders.resolve_calculations`).
+                                This saves a lot of Mongo queries when you
+                                schedule many tasks at once.
     '''
+    if resolve_calculations:
+        # `calculation_finders` imports this module, so we import it here
+        from .calculation_finders import resolve_calculations as _resolve_calculations
+        tasks = list(tasks)
+        _resolve_calculations(tasks)
+
     luigi_host = utils.read_rc('luigi_host')
     luigi_port = utils.read_rc('luigi_port')
 
@@ -48,6 +67,10 @@ def schedule_tasks(tasks, workers=1, local_scheduler=False):
                                 '"task_process_context" with value "None" is not '
                                 'of type string.')
 
+        # If we're tracing, then have Luigi tell us when each task starts and finishes
+        if tracing.is_enabled():
+            tracing.register_luigi_hooks()
+
         if local_scheduler is False:
             luigi.build(tasks, workers=workers, scheduler_host=luigi_host, scheduler_port=luigi_port)
         else:
@@ -98,19 +121,20 @@ def run_task(task, force=False):
             os.remove(task.output().path)
 
         # After prerequisites are done, run the task
-        run_results = task.run()
-
-        # If there are dynamic dependencies, then run them
-        if isinstance(run_results, types.GeneratorType):
-            for dependency in run_results:
-                if isinstance(dependency, luigi.Task):
-                    run_task(dependency)
-                # Sometimes we can actually get a list of dynamic
-                # dependendencies instead of one at a time. We address that
-                # here.
-                elif isinstance(dependency, Iterable):
-                    for dep in dependency:
-                        run_task(dep)
+        with tracing.task_span(task):
+            run_results = task.run()
+
+            # If there are dynamic dependencies, then run them
+            if isinstance(run_results, types.GeneratorType):
+                for dependency in run_results:
+                    if isinstance(dependency, luigi.Task):
+                        run_task(dependency)
+                    # Sometimes we can actually get a list of dynamic
+                    # dependendencies instead of one at a time. We address that
+                    # here.
+                    elif isinstance(dependency, Iterable):
+                        for dep in dependency:
+                            run_task(dep)
 
 
 def make_task_output_object(task):
@@ -144,7 +168,7 @@ def make_task_output_location(task):
     '''
     task_name = type(task).__name__
     task_id = task.task_id
-    file_name = TASKS_CACHE_LOCATION + '%s/%s.pkl' % (task_name, task_id)
+    file_name = _get_tasks_cache_location() + '%s/%s.pkl' % (task_name, task_id)
     return file_name
 
 
@@ -167,9 +191,10 @@ def save_task_output(task, output):
         task    Instance of a luigi task whose output you want to write to
         output  Whatever object that you want to save
     '''
-    with task.output().temporary_path() as task.temp_output_path:
-        with open(task.temp_output_path, 'wb') as file_handle:
-            pickle.dump(output, file_handle)
+    with tracing.span('save_task_output', category='pickle'):
+        with task.output().temporary_path() as task.temp_output_path:
+            with open(task.temp_output_path, 'wb') as file_handle:
+                pickle.dump(output, file_handle)
 
 
 def get_task_output(task):
@@ -184,8 +209,9 @@ def get_task_output(task):
         output  Whatever was saved by the task
     '''
     target = task.output()
-    with open(target.path, 'rb') as file_handle:
-        output = pickle.load(file_handle)
+    with tracing.span('get_task_output', category='pickle'):
+        with open(target.path, 'rb') as file_handle:
+            output = pickle.load(file_handle)
     return output
 
 
@@ -199,12 +225,13 @@ class DumpFWToTraj(luigi.Task):
     def run(self):
         lpad = get_launchpad()
         fw = lpad.get_fw_by_id(self.fwid)
-        atoms_trajhex = fw.launches[-1].action.stored_data['opt_results'][1]
+        stored_trajectory = fw.launches[-1].action.stored_data['opt_results'][1]
+        traj_bytes = read_trajectory_bytes(stored_trajectory, lpad=lpad)
 
-        # Write a blank token file to indicate this was done so that the entry is not written again
+        # Write the trajectory so that the entry is not written again
         with self.output().temporary_path() as self.temp_output_path:
-            with open(self.temp_output_path, 'w') as fhandle:
-                fhandle.write(utils.decode_trajhex_to_atoms(atoms_trajhex))
+            with open(self.temp_output_path, 'wb') as fhandle:
+                fhandle.write(traj_bytes)
 
     def output(self):
-        return luigi.LocalTarget(GASDB_PATH+'/FW_structures/%s.traj' % (self.fwid))
+        return luigi.LocalTarget(utils.read_rc('gasdb_path') + '/FW_structures/%s.traj' % (self.fwid))
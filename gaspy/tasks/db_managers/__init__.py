@@ -8,13 +8,18 @@ __email__ = 'ktran@andrew.cmu.edu'
 
 # flake8: noqa
 
-from .catalog import update_catalog_collection
+from .catalog import (update_catalog_collection,
+                      enqueue_catalog_work,
+                      run_catalog_worker)
 from .atoms import update_atoms_collection
 from .adsorption import update_adsorption_collection
 from .surfaces import update_surface_energy_collection
 
 
-def update_all_collections(n_processes=1):
-    update_atoms_collection(n_processes=n_processes)
-    update_adsorption_collection(n_processes=n_processes)
-    update_surface_energy_collection(n_processes=n_processes)
+def update_all_collections(n_processes=1, full_reconciliation=None):
+    update_atoms_collection(n_processes=n_processes,
+                            full_reconciliation=full_reconciliation)
+    update_adsorption_collection(n_processes=n_processes,
+                                 full_reconciliation=full_reconciliation)
+    update_surface_energy_collection(n_processes=n_processes,
+                                     full_reconciliation=full_reconciliation)
@@ -7,19 +7,28 @@ information.
 __authors__ = ['Zachary W. Ulissi', 'Kevin Tran']
 __emails__ = ['zulissi@andrew.cmu.edu', 'ktran@andrew.cmu.edu']
 
+import os
+import json
+import itertools
 import traceback
 import warnings
 from datetime import datetime
+import numpy as np
 import luigi
 from ..core import get_task_output, schedule_tasks
-from ..metadata_calculators import CalculateAdsorptionEnergy
-from ...utils import print_dict, multimap
+from ..metadata_calculators import (CalculateAdsorptionEnergy,
+                                    CalculateAdsorbateBasisEnergies,
+                                    calculate_adsorbate_basis_energies)
+from ..calculation_finders import get_calculation_docs
+from .watermarks import CollectionUpdate, make_new_atoms_docs_query
+from ... import defaults
+from ...utils import print_dict, multimap, imultimap, unfreeze_dict
 from ...mongo import make_atoms_from_doc, make_doc_from_atoms
 from ...gasdb import get_mongo_collection
 from ...atoms_operators import fingerprint_adslab, find_max_movement
 
 
-def update_adsorption_collection(n_processes=1):
+def update_adsorption_collection(n_processes=1, chunk_size=1000, full_reconciliation=None):
     '''
     This function will parse and dump all of the completed adsorption
     calculations in our `atoms` Mongo collection into our `adsorption`
@@ -32,88 +41,306 @@ def update_adsorption_collection(n_processes=1):
                         you are re-creating your collection from scratch, you
                         may want to want to increase this argument as high as
                         you can.
+        chunk_size      An integer indicating how many adsorption calculations
+                        to process (and then write to the `adsorption`
+                        collection) at a time. Bigger chunks mean fewer
+                        queries, but more RAM.
+        full_reconciliation A Boolean indicating whether to compare every
+                            adsorption calculation in the `atoms` collection
+                            against the `adsorption` collection (`True`) or to
+                            look only at the ones added since the last time we
+                            ran (`False`). If `None`, then we do a full
+                            reconciliation only if it has been a while since
+                            the last one.
     '''
-    # Figure out what we need to dump
-    missing_docs = _find_atoms_docs_not_in_adsorption_collection()
+    # If the last update did not finish, then this picks up where it left off
+    update = CollectionUpdate('adsorption', full_reconciliation)
+    fwids_missing = update.skip_finished(_find_fwids_not_in_adsorption_collection(update.watermark))
+    print('[%s] Creating %i adsorption documents...'
+          % (datetime.now(), len(fwids_missing)))
+
+    # We do everything in chunks so that we never hold the whole backlog in
+    # memory, and we save a checkpoint after each chunk so that an interrupted
+    # update keeps whatever it had finished
+    n_created = 0
+    for i in range(0, len(fwids_missing), chunk_size):
+        fwids = fwids_missing[i:i+chunk_size]
+        with get_mongo_collection('atoms') as collection:
+            missing_docs = list(collection.find({'fwid': {'$in': fwids}}))
+        adsorption_docs = _make_adsorption_docs_from_atoms_docs(missing_docs, n_processes)
+
+        # Save the documents as they come in
+        fwids_pending = {doc['fwid'] for doc in missing_docs}
+        docs = list(itertools.islice(adsorption_docs, 1000))
+        while docs:
+            with get_mongo_collection('adsorption') as collection:
+                collection.insert_many(docs, ordered=False)
+            n_created += len(docs)
+            fwids_pending -= {doc['fwids']['slab+adsorbate'] for doc in docs}
+            docs = list(itertools.islice(adsorption_docs, 1000))
+        print('[%s] Created %i/%i new entries in the adsorption collection'
+              % (datetime.now(), n_created, len(fwids_missing)))
+
+        # Whatever we could not add (e.g., because the bare slab is not done
+        # yet) needs to be looked at again next time
+        update.commit_chunk(fwids[-1], fwids_pending)
+
+    update.finish()
+
+
+def _make_adsorption_docs_from_atoms_docs(atoms_docs, n_processes=1):
+    '''
+    Turn adsorption calculations from our `atoms` collection into documents
+    for our `adsorption` collection
 
-    # Calculate adsorption energies
+    Args:
+        atoms_docs  A list of dictionaries taken from our `atoms` Mongo
+                    collection
+        n_processes An integer indicating how many processes to use
+    Returns:
+        adsorption_docs     A generator that yields the documents for our
+                            `adsorption` collection. Calculations that we
+                            could not make documents for are skipped.
+    '''
+    # Calculate adsorption energies. We do as many as we can directly from
+    # the `atoms` collection, and then let Luigi handle the rest.
     print('[%s] Calculating adsorption energies...' % datetime.now())
-    calc_energy_docs = multimap(__run_calculate_adsorption_energy_task,
-                                missing_docs, processes=n_processes,
-                                maxtasksperchild=10, chunksize=100,
-                                n_calcs=len(missing_docs))
+    calc_energy_docs, leftover_docs = _calculate_adsorption_energies_in_bulk(atoms_docs)
+    if len(leftover_docs) > 0:
+        print('[%s] Calculating %i adsorption energies with Luigi...'
+              % (datetime.now(), len(leftover_docs)))
+        calc_energy_docs.extend(multimap(__run_calculate_adsorption_energy_task,
+                                         leftover_docs, processes=n_processes,
+                                         maxtasksperchild=10, chunksize=100,
+                                         n_calcs=len(leftover_docs)))
     # Clean up
     cleaned_calc_energy_docs = __clean_calc_energy_docs(calc_energy_docs,
-                                                        missing_docs)
+                                                        atoms_docs)
+    if len(cleaned_calc_energy_docs) == 0:
+        return iter([])
 
-    # Turn the adsorption energies into `adsorption` documents, then save them
+    # Turn the adsorption energies into `adsorption` documents
     print('[%s] Creating adsorption documents...' % datetime.now())
-    adsorption_docs = multimap(__create_adsorption_doc,
-                               cleaned_calc_energy_docs,
-                               processes=n_processes,
-                               maxtasksperchild=1,
-                               chunksize=100,
-                               n_calcs=len(cleaned_calc_energy_docs))
+    return _create_adsorption_docs(cleaned_calc_energy_docs,
+                                   n_processes=n_processes)
+
+
+def _find_fwids_not_in_adsorption_collection(watermark=None):
+    '''
+    This function will get the FWIDs of adsorption calculations that are
+    inside our `atoms` collection, but not inside our `adsorption` collection.
+
+    Arg:
+        watermark   [Optional] A dictionary returned by
+                    `watermarks.get_watermark`. If you pass it, then we only
+                    look at the `atoms` documents that were added since the
+                    watermark and at the pending FWIDs. Otherwise we look at
+                    all of them.
+    Returns:
+        fwids_missing   A set of integers indicating the FWIDs of the
+                        adsorption calculations that have not yet been added
+                        to the `adsorption` collection
+    '''
+    # Find the FWIDs of the documents inside our atoms collection
+    query = {'fwname.calculation_type': 'slab+adsorbate optimization',
+             'fwname.adsorbate': {'$ne': ''}}
+    if watermark is not None:
+        query.update(make_new_atoms_docs_query(watermark))
+    with get_mongo_collection('atoms') as collection:
+        projection = {'fwid': 'fwid', '_id': 0}
+        docs_atoms = list(collection.find(query, projection))
+    fwids_in_atoms = set(doc['fwid'] for doc in docs_atoms)
 
-    # Now write the documents
-    if len(adsorption_docs) > 0:
-        print('[%s] Creating %i new entries in the adsorption collection...'
-              % (datetime.now(), len(adsorption_docs)))
-        with get_mongo_collection('adsorption') as collection:
-            collection.insert_many(adsorption_docs)
-        print('[%s] Created %i new entries in the adsorption collection'
-              % (datetime.now(), len(adsorption_docs)))
+    # Find the FWIDs of the documents inside our adsorption collection. If we
+    # are only looking at new documents, then we only need to check those.
+    adsorption_query = {}
+    if watermark is not None and watermark['value'] is not None:
+        adsorption_query = {'fwids.slab+adsorbate': {'$in': list(fwids_in_atoms)}}
+    with get_mongo_collection('adsorption') as collection:
+        docs_adsorption = list(collection.find(adsorption_query, {'fwids': 'fwids', '_id': 0}))
+    fwids_in_adsorption = set(doc['fwids']['slab+adsorbate'] for doc in docs_adsorption)
 
+    fwids_missing = fwids_in_atoms - fwids_in_adsorption
+    return fwids_missing
 
-def _find_atoms_docs_not_in_adsorption_collection():
+
+def _find_atoms_docs_not_in_adsorption_collection(watermark=None):
     '''
     This function will get the Mongo documents of adsorption calculations that
     are inside our `atoms` collection, but not inside our `adsorption`
     collection.
 
+    Arg:
+        watermark   [Optional] A dictionary returned by
+                    `watermarks.get_watermark`. If you pass it, then we only
+                    look at the `atoms` documents that were added since the
+                    watermark and at the pending FWIDs. Otherwise we look at
+                    all of them.
     Returns:
         missing_ads_docs    A list of adsorption documents from the `atoms`
                             collection that have not yet been added to the
                             `adsorption` collection.
     '''
-    # Find the FWIDs of the documents inside our adsorption collection
-    with get_mongo_collection('adsorption') as collection:
-        docs_adsorption = list(collection.find({}, {'fwids': 'fwids', '_id': 0}))
-    fwids_in_adsorption = set(doc['fwids']['slab+adsorbate'] for doc in docs_adsorption)
-
-    # Find the FWIDs of the documents inside our atoms collection
+    fwids_missing = _find_fwids_not_in_adsorption_collection(watermark)
     with get_mongo_collection('atoms') as collection:
-        query = {'fwname.calculation_type': 'slab+adsorbate optimization',
-                 'fwname.adsorbate': {'$ne': ''}}
-        projection = {'fwid': 'fwid', '_id': 0}
-        docs_atoms = list(collection.find(query, projection))
-        fwids_in_atoms = set(doc['fwid'] for doc in docs_atoms)
-
-        # Pull the atoms documents of everything that's missing from our
-        # adsorption collection. Although we use `find` a second time, this
-        # time we are getting the whole document (not just the FWID), so we
-        # only want to do this for the things we need.
-        fwids_missing = fwids_in_atoms - fwids_in_adsorption
         missing_ads_docs = list(collection.find({'fwid': {'$in': list(fwids_missing)}}))
     return missing_ads_docs
 
 
-def __run_calculate_adsorption_energy_task(atoms_doc):
+def _calculate_adsorption_energies_in_bulk(atoms_docs, chunk_size=1000):
     '''
-    This function will parse adsorption documents from our `atoms` collection,
-    create Luigi tasks to calculate adsorption energies for each document, run
-    the tasks, and then give you the results.
+    Running a `CalculateAdsorptionEnergy` task for every new adsorption
+    calculation means a full Luigi dependency walk, pickle writes, and a few
+    Mongo queries just to subtract three numbers. This function instead finds
+    the adslab, bare slab, and gas documents that those tasks would find using
+    a few bulk queries, and then it calculates all of the adsorption energies
+    at once. If a task has already been run, then we use its output instead.
+
+    Args:
+        atoms_docs  A list of dictionaries taken from our `atoms` Mongo
+                    collection
+        chunk_size  The maximum number of identifiers (e.g., mpids) we put
+                    into any single `$in` query
+    Returns:
+        energy_docs     A list of dictionaries with the same format as the
+                        output of the `CalculateAdsorptionEnergy` task
+        leftover_docs   A list of the `atoms_docs` that we could not
+                        calculate adsorption energies for, e.g., because we
+                        have not relaxed the bare slab yet. You should let
+                        Luigi handle these.
+    '''
+    energy_docs = []
+    leftover_docs = []
+
+    # Make the tasks that Luigi would have run. If the tasks are already done,
+    # then just use their output like Luigi would.
+    tasks = []
+    for atoms_doc in atoms_docs:
+        try:
+            task = __make_calculate_adsorption_energy_task(atoms_doc)
+        except (KeyError, TypeError, ValueError):
+            leftover_docs.append(atoms_doc)
+            continue
+        if os.path.isfile(task.output().path):
+            energy_docs.append(get_task_output(task))
+        else:
+            tasks.append((atoms_doc, task))
+
+    # Find all of the documents we need at once
+    finders = {}
+    for _, task in tasks:
+        requirements = task.requires()
+        for key in ['bare_slab_doc', 'adslab_doc']:
+            finders.setdefault(requirements[key].task_id, requirements[key])
+    finder_docs = _get_finder_docs(list(finders.values()), chunk_size)
+    basis_energies = _get_basis_energies({task.gas_vasp_settings for _, task in tasks}, chunk_size)
+
+    # Gather the energies of everything we found
+    adsorbates = defaults.adsorbates()
+    adslab_energies, slab_energies, adsorbate_energies, found = [], [], [], []
+    for atoms_doc, task in tasks:
+        requirements = task.requires()
+        adslab_doc = finder_docs[requirements['adslab_doc'].task_id]
+        slab_doc = finder_docs[requirements['bare_slab_doc'].task_id]
+        basis = basis_energies[task.gas_vasp_settings]
+        try:
+            adslab_energy = adslab_doc['results']['energy']
+            slab_energy = slab_doc['results']['energy']
+            adsorbate_energy = sum(basis[atom] for atom in
+                                   adsorbates[task.adsorbate_name].get_chemical_symbols())
+            if adslab_energy is None or slab_energy is None:
+                raise KeyError('energy')
+        # If something is missing, then let Luigi figure it out
+        except (KeyError, TypeError):
+            leftover_docs.append(atoms_doc)
+            continue
+        adslab_energies.append(adslab_energy)
+        slab_energies.append(slab_energy)
+        adsorbate_energies.append(adsorbate_energy)
+        found.append((adslab_doc, slab_doc))
+
+    # Calculate all of the adsorption energies at once
+    adsorption_energies = (np.array(adslab_energies, dtype=float) -
+                           np.array(slab_energies, dtype=float) -
+                           np.array(adsorbate_energies, dtype=float))
+    for adsorption_energy, (adslab_doc, slab_doc) in zip(adsorption_energies, found):
+        energy_docs.append({'adsorption_energy': float(adsorption_energy),
+                            'fwids': {'adslab': adslab_doc['fwid'],
+                                      'slab': slab_doc['fwid']}})
+    return energy_docs, leftover_docs
+
+
+def _get_finder_docs(finders, chunk_size):
+    '''
+    Get the documents that `FindCalculation` tasks would give us, keyed by
+    task. Refer to `gaspy.tasks.calculation_finders.get_calculation_docs`.
+
+    Args:
+        finders     A list of `FindCalculation` instances
+        chunk_size  The maximum number of identifiers (e.g., mpids) we put
+                    into any single `$in` query
+    Returns:
+        docs    A dictionary whose keys are the task IDs of the finders and
+                whose values are the documents they would give. Finders
+                that found nothing get empty dictionaries.
+    '''
+    docs = {finder.task_id: doc
+            for finder, doc in zip(finders, get_calculation_docs(finders, chunk_size))}
+    return docs
+
+
+def _get_basis_energies(gas_vasp_settings_set, chunk_size):
+    '''
+    Get the outputs that `CalculateAdsorbateBasisEnergies` would give us for
+    several sets of VASP settings.
+
+    Args:
+        gas_vasp_settings_set   A set of the (frozen) VASP settings of the gas
+                                relaxations
+        chunk_size              The maximum number of identifiers we put into
+                                any single `$in` query
+    Returns:
+        basis_energies  A dictionary whose keys are the items in
+                        `gas_vasp_settings_set` and whose values are the
+                        outputs of the `CalculateAdsorbateBasisEnergies`
+                        task. If we could not find all of the gases, then the
+                        value is an empty dictionary.
+    '''
+    # Sort the settings so that we always do things in the same order
+    gas_vasp_settings_list = sorted(gas_vasp_settings_set,
+                                    key=lambda settings: json.dumps(unfreeze_dict(settings),
+                                                                    sort_keys=True))
+    basis_energies = {}
+    for gas_vasp_settings in gas_vasp_settings_list:
+        task = CalculateAdsorbateBasisEnergies(vasp_settings=gas_vasp_settings)
+        if os.path.isfile(task.output().path):
+            basis_energies[gas_vasp_settings] = get_task_output(task)
+            continue
+
+        gas_finders = task.requires()
+        gas_docs = _get_finder_docs(list(gas_finders.values()), chunk_size)
+        try:
+            gas_energies = {gas_name: gas_docs[finder.task_id]['results']['energy']
+                            for gas_name, finder in gas_finders.items()}
+            basis_energies[gas_vasp_settings] = calculate_adsorbate_basis_energies(gas_energies)
+        except (KeyError, TypeError):
+            basis_energies[gas_vasp_settings] = {}
+    return basis_energies
+
+
+def __make_calculate_adsorption_energy_task(atoms_doc):
+    '''
+    Make the `CalculateAdsorptionEnergy` task that corresponds to an adsorption
+    document from our `atoms` collection
 
     Args:
         atoms_doc   A dictionary taken from our `atoms` Mongo collection
     Returns:
-        energy_doc  A dictionary obtained from the output of the
-                    `CalculateAdsorptionEnergy` task
+        task    An instance of the `CalculateAdsorptionEnergy` task
     '''
     # Reformat the site because of silly historical reasons
     adsorption_site = atoms_doc['fwname']['adsorption_site']
 
-    # Create, run, and return the output of the task
     task = CalculateAdsorptionEnergy(adsorption_site=adsorption_site,
                                      shift=atoms_doc['fwname']['shift'],
                                      top=atoms_doc['fwname']['top'],
@@ -122,6 +349,23 @@ def __run_calculate_adsorption_energy_task(atoms_doc):
                                      mpid=atoms_doc['fwname']['mpid'],
                                      miller_indices=atoms_doc['fwname']['miller'],
                                      adslab_vasp_settings=atoms_doc['fwname']['vasp_settings'])
+    return task
+
+
+def __run_calculate_adsorption_energy_task(atoms_doc):
+    '''
+    This function will parse adsorption documents from our `atoms` collection,
+    create Luigi tasks to calculate adsorption energies for each document, run
+    the tasks, and then give you the results.
+
+    Args:
+        atoms_doc   A dictionary taken from our `atoms` Mongo collection
+    Returns:
+        energy_doc  A dictionary obtained from the output of the
+                    `CalculateAdsorptionEnergy` task
+    '''
+    # Create, run, and return the output of the task
+    task = __make_calculate_adsorption_energy_task(atoms_doc)
     try:
         schedule_tasks([task], local_scheduler=True)
         energy_doc = get_task_output(task)
@@ -168,7 +412,7 @@ def __clean_calc_energy_docs(docs, missing_docs):
                         `_find_atoms_docs_not_in_adsorption_collection`
     Returns:
         cleaned_docs    The `docs` arguments, but with empty and duplicate
-                        documents removed
+                        documents removed. This may be an empty list.
     '''
     missing_fwids = {doc['fwid'] for doc in missing_docs}
     cleaned_docs = []
@@ -179,13 +423,110 @@ def __clean_calc_energy_docs(docs, missing_docs):
                 cleaned_docs.append(doc)
                 missing_fwids.remove(fwid)
 
+    # This happens when a whole chunk is waiting on bare slabs. The caller
+    # keeps those FWIDs pending, so we just move on.
     if len(cleaned_docs) == 0:
-        raise RuntimeError('None of the %i documents we got from the '
-                           '`CalculateAdsorptionEnergy` tasks match the %i '
-                           'missing FWIDs' % (len(docs), len(missing_docs)))
+        warnings.warn('None of the %i documents we got from the '
+                      '`CalculateAdsorptionEnergy` tasks match the %i '
+                      'missing FWIDs' % (len(docs), len(missing_docs)),
+                      RuntimeWarning)
     return cleaned_docs
 
 
+def _create_adsorption_docs(energy_docs, n_processes=1, chunk_size=1000):
+    '''
+    Turn the outputs of many `CalculateAdsorptionEnergy` tasks into documents
+    for our `adsorption` collection. We pull the `atoms` documents for each
+    chunk with a single query and then fingerprint the adslabs with one pool
+    of workers that lasts for the whole update.
+
+    Args:
+        energy_docs     A list of dictionaries created by the
+                        `CalculateAdsorptionEnergy` task
+        n_processes     An integer indicating how many processes to
+                        fingerprint with
+        chunk_size      How many energy documents to pull `atoms` documents
+                        for at a time
+    Returns:
+        adsorption_docs     A generator that yields the documents for the
+                            `adsorption` collection
+    '''
+    inputs = _iterate_adsorption_doc_inputs(energy_docs, chunk_size)
+    backend = 'serial' if n_processes == 1 else 'process'
+    adsorption_docs = imultimap(__make_adsorption_doc, inputs,
+                                backend=backend,
+                                processes=n_processes,
+                                chunksize=10,
+                                maxtasksperchild=None,
+                                n_calcs=len(energy_docs))
+    return adsorption_docs
+
+
+def _iterate_adsorption_doc_inputs(energy_docs, chunk_size):
+    '''
+    Pull the `atoms` documents that we need to make `adsorption` documents,
+    one chunk at a time. We also figure out how far each bare slab moved
+    here, because many adslabs share the same bare slab.
+
+    Args:
+        energy_docs     A list of dictionaries created by the
+                        `CalculateAdsorptionEnergy` task
+        chunk_size      How many energy documents to pull `atoms` documents
+                        for at a time
+    Yields:
+        inputs  A 3-tuple of the energy document, the adslab document from
+                the `atoms` collection, and a dictionary with the 'fwid',
+                'directory', 'calculation_date', and 'max_bare_slab_movement'
+                of the bare slab
+    '''
+    slab_infos = {}
+    for i in range(0, len(energy_docs), chunk_size):
+        energy_docs_chunk = energy_docs[i:i+chunk_size]
+        fwids = set()
+        for energy_doc in energy_docs_chunk:
+            fwids.add(energy_doc['fwids']['adslab'])
+            fwids.add(energy_doc['fwids']['slab'])
+        fwids -= set(slab_infos)
+        with get_mongo_collection('atoms') as collection:
+            atoms_docs = {doc['fwid']: doc for doc in
+                          collection.find({'fwid': {'$in': list(fwids)}})}
+
+        for energy_doc in energy_docs_chunk:
+            adslab_fwid = energy_doc['fwids']['adslab']
+            slab_fwid = energy_doc['fwids']['slab']
+            try:
+                adslab_doc = atoms_docs[adslab_fwid]
+                if slab_fwid not in slab_infos:
+                    slab_infos[slab_fwid] = __make_slab_info(atoms_docs[slab_fwid])
+            except KeyError as error:
+                warnings.warn('Could not find FireWork %s in the atoms collection, so we '
+                              'are not making an adsorption document for adslab %i'
+                              % (error, adslab_fwid), RuntimeWarning)
+                continue
+            yield energy_doc, adslab_doc, slab_infos[slab_fwid]
+
+
+def __make_slab_info(slab_doc):
+    '''
+    Pull out the information about a bare slab that goes into `adsorption`
+    documents
+
+    Arg:
+        slab_doc    A dictionary from the `atoms` collection of a bare slab
+    Returns:
+        slab_info   A dictionary with the 'fwid', 'directory',
+                    'calculation_date', and 'max_bare_slab_movement' of the
+                    bare slab
+    '''
+    bare_slab_init = make_atoms_from_doc(slab_doc['initial_configuration'])
+    bare_slab_final = make_atoms_from_doc(slab_doc)
+    slab_info = {'fwid': slab_doc['fwid'],
+                 'directory': slab_doc['directory'],
+                 'calculation_date': slab_doc['calculation_date'],
+                 'max_bare_slab_movement': find_max_movement(bare_slab_init, bare_slab_final)}
+    return slab_info
+
+
 def __create_adsorption_doc(energy_doc):
     '''
     This function will create a Mongo document for the `adsorption` collection
@@ -195,15 +536,43 @@ def __create_adsorption_doc(energy_doc):
         energy_doc  A dictionary created by the `CalculateAdsorptionEnergy`
                     task
     '''
-    # Get the `atoms` documents for the slab and adslab
-    with get_mongo_collection('atoms') as collection:
-        adslab_doc = list(collection.find({'fwid': energy_doc['fwids']['adslab']}))[0]
-        slab_doc = list(collection.find({'fwid': energy_doc['fwids']['slab']}))[0]
+    for inputs in _iterate_adsorption_doc_inputs([energy_doc], chunk_size=1):
+        adsorption_doc = __make_adsorption_doc(inputs)
+        return adsorption_doc
+
+
+def _get_initial_adslab(adslab_doc):
+    '''
+    Get the configuration that an adslab was supposed to start from. For
+    warm-started adslabs, this is the ideal configuration that we saved
+    instead of the seeded one that the relaxation actually started from.
+    Otherwise the fingerprints and movement filters would describe the site
+    that the seed drifted to instead of the site that we asked for.
+
+    Arg:
+        adslab_doc  A dictionary from the `atoms` collection of an adslab
+    Returns:
+        adslab_init An `ase.Atoms` object of the initial adslab
+    '''
+    if adslab_doc['fwname'].get('warm_start') and 'ideal_configuration' in adslab_doc:
+        return make_atoms_from_doc(adslab_doc['ideal_configuration'])
+    return make_atoms_from_doc(adslab_doc['initial_configuration'])
+
+
+def __make_adsorption_doc(inputs):
+    '''
+    This function does the heavy lifting for `__create_adsorption_doc` and
+    `_create_adsorption_docs`.
+
+    Arg:
+        inputs  A 3-tuple yielded by `_iterate_adsorption_doc_inputs`
+    Returns:
+        adsorption_doc  A dictionary for the `adsorption` collection
+    '''
+    energy_doc, adslab_doc, slab_info = inputs
 
     # Get some pertinent `ase.Atoms` objects
-    bare_slab_init = make_atoms_from_doc(slab_doc['initial_configuration'])
-    bare_slab_final = make_atoms_from_doc(slab_doc)
-    adslab_init = make_atoms_from_doc(adslab_doc['initial_configuration'])
+    adslab_init = _get_initial_adslab(adslab_doc)
     adslab_final = make_atoms_from_doc(adslab_doc)
     # In GASpy, atoms tagged with 0's are slab atoms. Atoms tagged with
     # integers > 0 are adsorbates. We use that information to pull our the slab
@@ -217,9 +586,8 @@ def __create_adsorption_doc(energy_doc):
     fp_init = fingerprint_adslab(adslab_init)
     fp_final = fingerprint_adslab(adslab_final)
 
-    # Figure out how far the bare slab moved during relaxation. Then do the
-    # same for the slab and the adsorbate.
-    max_bare_slab_movement = find_max_movement(bare_slab_init, bare_slab_final)
+    # Figure out how far the slab and the adsorbate moved during relaxation.
+    # We already did the bare slab.
     max_slab_movement = find_max_movement(slab_init, slab_final)
     max_ads_movement = find_max_movement(adsorbate_init, adsorbate_final)
 
@@ -238,14 +606,14 @@ def __create_adsorption_doc(energy_doc):
     adsorption_doc['slab_repeat'] = adslab_doc['fwname']['slab_repeat']
     adsorption_doc['vasp_settings'] = adslab_doc['fwname']['vasp_settings']
     adsorption_doc['fwids'] = {'slab+adsorbate': adslab_doc['fwid'],
-                               'slab': slab_doc['fwid']}
+                               'slab': slab_info['fwid']}
     adsorption_doc['fw_directories'] = {'slab+adsorbate': adslab_doc['directory'],
-                                        'slab': slab_doc['directory']}
+                                        'slab': slab_info['directory']}
     adsorption_doc['fp_final'] = fp_final
     adsorption_doc['fp_init'] = fp_init
-    adsorption_doc['movement_data'] = {'max_bare_slab_movement': max_bare_slab_movement,
+    adsorption_doc['movement_data'] = {'max_bare_slab_movement': slab_info['max_bare_slab_movement'],
                                        'max_slab_movement': max_slab_movement,
                                        'max_adsorbate_movement': max_ads_movement}
     adsorption_doc['calculation_dates'] = {'slab+adsorbate': adslab_doc['calculation_date'],
-                                           'slab': slab_doc['calculation_date']}
+                                           'slab': slab_info['calculation_date']}
     return adsorption_doc
@@ -9,19 +9,43 @@ __emails__ = ['zulissi@andrew.cmu.edu', 'ktran@andrew.cmu.edu']
 
 from datetime import datetime
 import warnings
-import uuid
-import subprocess
+import os
+import json
+import gzip
+import pickle
+import shutil
+import tarfile
+import tempfile
+from types import SimpleNamespace
 import ase
 import ase.io
-from ase.calculators.vasp import Vasp2
+from ase.calculators.singlepoint import SinglePointCalculator
 from ... import defaults
 from ...utils import read_rc, multimap
 from ...mongo import make_doc_from_atoms
 from ...gasdb import get_mongo_collection
-from ...fireworks_helper_scripts import get_launchpad, get_atoms_from_fw
-
-
-def update_atoms_collection(n_processes=1):
+from ...fireworks_helper_scripts import (get_launchpad,
+                                         get_images_from_fw,
+                                         decode_trajhex_to_atoms,
+                                         read_trajectories_in_bulk)
+from .watermarks import CollectionUpdate
+
+# The only parts of the `fireworks` and `launches` documents that we need to
+# make an `atoms` document
+_FIREWORK_PROJECTION = {'fw_id': 1, 'name': 1, 'spec._tasks': 1, 'spec.ideal_configuration': 1,
+                        'launches': 1, 'archived_launches': 1,
+                        'created_on': 1, 'updated_on': 1, '_id': 0}
+_LAUNCH_PROJECTION = {'launch_id': 1, 'launch_dir': 1, 'fworker.name': 1,
+                      'action.stored_data.opt_results': 1, 'action.gridfs_id': 1,
+                      '_id': 0}
+
+# The only files in our old launch backups that we need to recover the VASP
+# forces
+_VASP_BACKUP_FILES = ('slab_relaxed.traj', 'ase-sort.dat', 'INCAR', 'KPOINTS',
+                      'POTCAR', 'POSCAR', 'CONTCAR', 'OUTCAR', 'vasprun.xml')
+
+
+def update_atoms_collection(n_processes=1, chunk_size=1000, full_reconciliation=None):
     '''
     This function will dump all of the completed FireWorks into our `atoms` Mongo
     collection. It will not dump anything that is already there.
@@ -37,50 +61,228 @@ def update_atoms_collection(n_processes=1):
                         If you are re-creating your collection from a full
                         FireWorks database, you may want to increase this
                         argument.
+        chunk_size      An integer indicating how many FireWorks to pull
+                        from the LaunchPad (and then write to the `atoms`
+                        collection) at a time. Bigger chunks mean fewer
+                        queries, but more RAM.
+        full_reconciliation A Boolean indicating whether to compare every
+                            completed FireWork against the `atoms` collection
+                            (`True`) or to look only at FireWorks that were
+                            updated since the last time we ran (`False`). If
+                            `None`, then we do a full reconciliation only if
+                            it has been a while since the last one.
     '''
-    fwids_missing = _find_fwids_missing_from_atoms_collection()
-
-    # Make the documents
+    # If the last update did not finish, then this picks up where it left off
+    update = CollectionUpdate('atoms', full_reconciliation,
+                              find_watermark=_get_latest_fw_update_time)
+    fwids_missing = update.skip_finished(_find_fwids_missing_from_atoms_collection(update.watermark))
     print('[%s] Creating %i atoms documents...'
           % (datetime.now(), len(fwids_missing)))
-    docs = multimap(_make_atoms_doc_from_fwid, fwids_missing,
-                    processes=n_processes, chunksize=100,
-                    n_calcs=len(fwids_missing))
-    # Clean up `_make_atoms_doc_from_fwid` failures
-    docs = [doc for doc in docs if doc is not None]
-
-    # Now write the documents
-    if len(docs) > 0:
-        print('[%s] Creating %i new entries in the atoms collection...'
-              % (datetime.now(), len(docs)))
-        with get_mongo_collection('atoms') as collection:
-            collection.insert_many(docs)
-        print('[%s] Created %i new entries in the atoms collection'
-              % (datetime.now(), len(docs)))
-
 
-def _find_fwids_missing_from_atoms_collection():
+    # We pull and write the FireWorks in chunks so that we do not need to
+    # hold every trajectory in memory at once, and we save a checkpoint after
+    # each chunk so that an interrupted update keeps whatever it had finished
+    n_created = 0
+    for i in range(0, len(fwids_missing), chunk_size):
+        fwids = fwids_missing[i:i+chunk_size]
+        fws = _get_fireworks_in_bulk(fwids)
+        docs = multimap(_make_atoms_doc_from_fw, fws,
+                        processes=n_processes, chunksize=100,
+                        n_calcs=len(fws))
+        # Clean up `_make_atoms_doc_from_fw` failures, but remember them so
+        # that we try them again next time
+        fwids_failed = [fw.fw_id for fw, doc in zip(fws, docs) if doc is None]
+        docs = [doc for doc in docs if doc is not None]
+
+        # Now write the documents
+        if len(docs) > 0:
+            with get_mongo_collection('atoms') as collection:
+                collection.insert_many(docs, ordered=False)
+            n_created += len(docs)
+            print('[%s] Created %i/%i new entries in the atoms collection'
+                  % (datetime.now(), n_created, len(fwids_missing)))
+        update.commit_chunk(fwids[-1], fwids_failed)
+
+    update.finish()
+
+
+def _find_fwids_missing_from_atoms_collection(watermark=None):
     '''
     This method will get the FireWork IDs that are marked as 'COMPLETED' in
     our LaunchPad, but have not yet been added to our `atoms` Mongo
     collection.
 
+    Arg:
+        watermark   [Optional] A dictionary returned by
+                    `watermarks.get_watermark`. If you pass it, then we only
+                    look at the FireWorks that were updated since the
+                    watermark and at the pending FireWorks. Otherwise we look
+                    at all of them.
     Returns:
         fwids_missing   A set of integers containing the FireWork IDs of
                         the calculations we have not yet added to our
                         `atoms` Mongo collection.
     '''
-    with get_mongo_collection('atoms') as collection:
-        docs = list(collection.find({}, {'fwid': 'fwid', '_id': 0}))
-    fwids_in_atoms = set(doc['fwid'] for doc in docs)
+    incremental = watermark is not None and watermark['value'] is not None
 
     lpad = get_launchpad()
-    fwids_completed = set(lpad.get_fw_ids({'state': 'COMPLETED'}))
+    query = {'state': 'COMPLETED'}
+    if incremental:
+        query['$or'] = [{'updated_on': {'$gte': watermark['value']}},
+                        {'fw_id': {'$in': watermark['pending_fwids']}}]
+    fwids_completed = set(lpad.get_fw_ids(query))
+
+    # If we are only looking at new FireWorks, then we only need to check
+    # those against the `atoms` collection
+    atoms_query = {}
+    if incremental:
+        atoms_query = {'fwid': {'$in': list(fwids_completed)}}
+    with get_mongo_collection('atoms') as collection:
+        docs = list(collection.find(atoms_query, {'fwid': 'fwid', '_id': 0}))
+    fwids_in_atoms = set(doc['fwid'] for doc in docs)
 
     fwids_missing = fwids_completed - fwids_in_atoms
     return fwids_missing
 
 
+def _get_latest_fw_update_time():
+    '''
+    Returns the `updated_on` field of the most recently updated FireWork that
+    is 'COMPLETED', which is what we use as the watermark of our `atoms`
+    collection. FireWorks saves these as ISO-formatted strings, which sort
+    chronologically. Returns `None` if nothing has been completed yet.
+    '''
+    lpad = get_launchpad()
+    doc = lpad.fireworks.find_one({'state': 'COMPLETED'},
+                                  {'updated_on': 1, '_id': 0},
+                                  sort=[('updated_on', -1)])
+    if doc is None:
+        return None
+    return doc['updated_on']
+
+
+def _get_fireworks_in_bulk(fwids):
+    '''
+    Pull the parts of the FireWorks that we need to make `atoms` documents
+    using only one query to the `fireworks` collection and one query to the
+    `launches` collection. This is a lot faster than calling
+    `LaunchPad.get_fw_by_id` for each FireWork, which hydrates the entire
+    FireWork and all of its launches.
+
+    Arg:
+        fwids   A sequence of integers indicating the FireWork IDs you want
+    Returns:
+        fws     A list of `types.SimpleNamespace` objects that mimic the
+                `fireworks.Firework` objects we would have gotten from
+                `LaunchPad.get_fw_by_id`, but with only the attributes that
+                `_make_atoms_doc_from_fw` needs. FireWorks that we could not
+                find are omitted.
+    '''
+    from fireworks.utilities.fw_serializers import reconstitute_dates
+
+    lpad = get_launchpad()
+    try:
+        fw_docs = list(lpad.fireworks.find({'fw_id': {'$in': list(fwids)}},
+                                           _FIREWORK_PROJECTION))
+        launch_ids = [launch_id for doc in fw_docs
+                      for launch_id in doc.get('launches', []) + doc.get('archived_launches', [])]
+        launch_docs = lpad.launches.find({'launch_id': {'$in': launch_ids}},
+                                         _LAUNCH_PROJECTION)
+        launches = {doc['launch_id']: _make_launch_from_doc(doc, lpad) for doc in launch_docs}
+        _resolve_trajectory_references(launches.values(), lpad)
+    finally:    # Make sure we close the connection
+        lpad.fireworks.database.client.close()
+
+    fws = []
+    for doc in fw_docs:
+        fw = SimpleNamespace(fw_id=doc['fw_id'],
+                             name=doc['name'],
+                             spec=doc['spec'],
+                             created_on=reconstitute_dates(doc.get('created_on')),
+                             updated_on=reconstitute_dates(doc.get('updated_on')),
+                             launches=[launches[launch_id] for launch_id in doc.get('launches', [])
+                                       if launch_id in launches],
+                             archived_launches=[launches[launch_id] for launch_id in
+                                                doc.get('archived_launches', [])
+                                                if launch_id in launches])
+        fws.append(fw)
+    return fws
+
+
+def _make_launch_from_doc(doc, lpad):
+    '''
+    Turn a (projected) document from the `launches` collection into an object
+    that mimics the parts of `fireworks.Launch` that we use.
+
+    Args:
+        doc     A dictionary from the `launches` collection that was obtained
+                with the `_LAUNCH_PROJECTION` projection
+        lpad    An instance of a `fireworks.LaunchPad`. We need it for the
+                launches whose actions FireWorks moved into GridFS.
+    Returns:
+        launch  A `types.SimpleNamespace` with the `launch_id`, `launch_dir`,
+                `fworker.name`, and `action.stored_data` attributes
+    '''
+    action = doc.get('action') or {}
+    if 'gridfs_id' in action:
+        action = _load_action_from_gridfs(action['gridfs_id'], lpad)
+    launch = SimpleNamespace(launch_id=doc['launch_id'],
+                             launch_dir=doc.get('launch_dir'),
+                             fworker=SimpleNamespace(name=doc.get('fworker', {}).get('name', '')),
+                             action=SimpleNamespace(stored_data=action.get('stored_data', {})))
+    return launch
+
+
+def _load_action_from_gridfs(gridfs_id, lpad):
+    '''
+    When a launch document gets too big for Mongo, FireWorks moves its action
+    into the `launches_fs` GridFS bucket and leaves only a `gridfs_id` behind.
+    This function loads the action the same way that
+    `LaunchPad.get_launch_by_id` does.
+
+    Args:
+        gridfs_id   The `gridfs_id` of the action (a string or an ObjectId)
+        lpad        An instance of a `fireworks.LaunchPad`
+    Returns:
+        action  A dictionary of the whole action
+    '''
+    import gridfs
+    from bson.objectid import ObjectId
+
+    fs = getattr(lpad, 'gridfs_fallback', None)
+    if fs is None:
+        fs = gridfs.GridFS(lpad.db, 'launches_fs')
+    return json.loads(fs.get(ObjectId(gridfs_id)).read())
+
+
+def _resolve_trajectory_references(launches, lpad):
+    '''
+    Some launches store references to compressed trajectories in GridFS
+    instead of the trajectories themselves. This function reads all of those
+    trajectories at once and then puts their bytes into the launches, so that
+    the workers do not each need to connect to GridFS.
+
+    Args:
+        launches    An iterable of the objects made by `_make_launch_from_doc`.
+                    They are modified in place.
+        lpad        An instance of a `fireworks.LaunchPad`
+    '''
+    launches = [launch for launch in launches
+                if isinstance(launch.action.stored_data.get('opt_results', [None, None])[1], dict)]
+    references = [launch.action.stored_data['opt_results'][1] for launch in launches]
+    trajectories = read_trajectories_in_bulk(references, lpad=lpad)
+
+    # If a trajectory is missing, then we leave the reference alone and let
+    # `_make_atoms_doc_from_fw` deal with it
+    for launch, reference in zip(launches, references):
+        try:
+            opt_results = list(launch.action.stored_data['opt_results'])
+            opt_results[1] = trajectories[reference['sha256']]
+            launch.action.stored_data['opt_results'] = opt_results
+        except KeyError:
+            pass
+
+
 def _make_atoms_doc_from_fwid(fwid):
     '''
     For each fireworks object, turn the results into a mongo doc so that we
@@ -93,28 +295,55 @@ def _make_atoms_doc_from_fwid(fwid):
         doc     A dictionary that contains various information about
                 a calculation. Intended to be inserted into Mongo.
     '''
-    # Get the `ase.Atoms` objects of the initial and final images
-    lpad = get_launchpad()
-    fw = lpad.get_fw_by_id(fwid)
+    fws = _get_fireworks_in_bulk([fwid])
+    if len(fws) == 0:
+        raise ValueError('Could not find FireWork %s in our FireWorks database' % fwid)
+    fw = fws[0]
+    doc = _make_atoms_doc_from_fw(fw)
+    return doc
+
+
+def _make_atoms_doc_from_fw(fw):
+    '''
+    Turn a FireWork into a mongo doc so that we can dump the mongo doc into
+    the Aux DB.
+
+    Args:
+        fw      Instance of a `fireworks.Firework`, or one of the lighter
+                objects made by `_get_fireworks_in_bulk`
+    Returns:
+        doc     A dictionary that contains various information about
+                a calculation. Intended to be inserted into Mongo.
+    '''
+    # Get the `ase.Atoms` objects of the initial and final images. We decode
+    # the trajectory only once for both of them.
     try:
-        starting_atoms = get_atoms_from_fw(fw, index=0)
-        atoms = get_atoms_from_fw(fw, index=-1)
+        starting_atoms, atoms = get_images_from_fw(fw, indices=(0, -1))
 
     # Sometimes the length of the initial atoms and the final atoms are
     # different. If this happens, then defuse the Firework
     except ValueError:
         fwid = fw.fw_id
+        lpad = get_launchpad()
         lpad.defuse_fw(fwid)
         warnings.warn('Defused FireWork %i because the number of initial '
                       'and final atoms differed.' % fwid)
         return None
 
+    # Skip FireWorks whose compressed trajectories have gone missing from GridFS
+    except FileNotFoundError as error:
+        warnings.warn('Skipping FireWork %i:  %s' % (fw.fw_id, error), RuntimeWarning)
+        return None
+
     # Turn the atoms objects into a document and then add additional
     # information
     doc = make_doc_from_atoms(atoms)
     doc['initial_configuration'] = make_doc_from_atoms(starting_atoms)
+    ideal_configuration = _get_ideal_configuration(fw)
+    if ideal_configuration is not None:
+        doc['ideal_configuration'] = ideal_configuration
     doc['fwname'] = fw.name
-    doc['fwid'] = fwid
+    doc['fwid'] = fw.fw_id
     doc['directory'] = fw.launches[-1].launch_dir
     doc['calculation_date'] = fw.updated_on
 
@@ -123,6 +352,27 @@ def _make_atoms_doc_from_fwid(fwid):
     return doc
 
 
+def _get_ideal_configuration(fw):
+    '''
+    Warm-started FireWorks do not start from the ideal (i.e., unseeded)
+    configuration of their adslabs, so `MakeAdslabFW` saves that configuration
+    in their specs. This function fetches it.
+
+    Arg:
+        fw      Instance of a `fireworks.Firework`, or one of the lighter
+                objects made by `_get_fireworks_in_bulk`
+    Returns:
+        doc     A dictionary of the ideal configuration that can be turned
+                into an `ase.Atoms` object with
+                `gaspy.mongo.make_atoms_from_doc`, or `None` if the FireWork
+                was not warm-started
+    '''
+    ideal_configuration = fw.spec.get('ideal_configuration')
+    if not fw.name.get('warm_start') or ideal_configuration is None:
+        return None
+    return make_doc_from_atoms(decode_trajhex_to_atoms(ideal_configuration))
+
+
 def __patch_old_document(doc, atoms, fw):
     '''
     We've tried, tested, and failed a lot of times when making FireWorks.
@@ -197,49 +447,103 @@ def __get_final_atoms_object_with_vasp_forces(launch_id):
     FireWorks launch ID. It will also make sure that the ase.Atoms object
     will have VASP-calculated forces attached to it.
 
+    Extracting the backups takes a while, so we cache the results in the
+    `gasdb_path` folder.
+
     Arg:
         launch_id   An integer representing the FireWorks launch ID of the
                     atoms object you want to get
     Returns:
-        atoms   ase.Atoms object with the VASP-calculated forces
+        atoms   ase.Atoms object with the VASP-calculated energy and forces
+                attached via a `SinglePointCalculator`
     '''
-    # We will be opening a temporary directory where we will unzip the
-    # FireWorks launch directory
-    fw_launch_file = (read_rc('fireworks_info.backup_directory') + '/%d.tar.gz' % launch_id)
-    temp_loc = __dump_file_to_tmp(fw_launch_file)
-
-    # Load the atoms object and then load the correct (DFT) forces from the
-    # OUTCAR/etc info
+    # Load the cache if it exists
+    cache_name = read_rc('gasdb_path') + '/patched_vasp_atoms/%d.pkl' % launch_id
     try:
-        atoms = ase.io.read('%s/slab_relaxed.traj' % temp_loc)
-        vasp2 = Vasp2(atoms, restart=True, directory=temp_loc)
-        vasp2.read_results()
-
-    # Clean up behind us
-    finally:
-        subprocess.call('rm -r %s' % temp_loc, shell=True)
+        with open(cache_name, 'rb') as file_handle:
+            atoms = pickle.load(file_handle)
+
+    except (FileNotFoundError, EOFError):
+        from ase.calculators.vasp import Vasp2
+
+        # We will be opening a temporary directory where we will unzip only
+        # the parts of the FireWorks launch directory that we need
+        fw_launch_file = (read_rc('fireworks_info.backup_directory') + '/%d.tar.gz' % launch_id)
+        temp_loc = __dump_file_to_tmp(fw_launch_file, members=_VASP_BACKUP_FILES)
+
+        # Load the atoms object and then load the correct (DFT) forces from the
+        # OUTCAR/etc info
+        try:
+            atoms = ase.io.read(os.path.join(temp_loc, 'slab_relaxed.traj'))
+            vasp2 = Vasp2(atoms, restart=True, directory=temp_loc)
+            vasp2.read_results()
+
+            # The VASP calculator needs the directory we are about to delete,
+            # so we keep only its results
+            atoms.set_calculator(SinglePointCalculator(atoms,
+                                                       energy=vasp2.results['energy'],
+                                                       forces=vasp2.results['forces']))
+
+        # Clean up behind us
+        finally:
+            shutil.rmtree(temp_loc, ignore_errors=True)
+
+        # Cache it
+        os.makedirs(os.path.dirname(cache_name), exist_ok=True)
+        with open(cache_name, 'wb') as file_handle:
+            pickle.dump(atoms, file_handle)
 
     return atoms
 
 
-def __dump_file_to_tmp(file_name):
+def __dump_file_to_tmp(file_name, members=None):
     '''
-    Take the contents of a directory and then dump it into a temporary
+    Take the contents of a tarred directory and then dump it into a temporary
     directory while simultaneously unzipping it. This makes reading from
-    FireWorks directories faster.
+    FireWorks directories faster. We stream through the archive once and
+    only write the files that we need.
 
-    Arg:
-        file_name   String indicating what directory you want to dump
+    Args:
+        file_name   String indicating what tarball you want to dump
+        members     [Optional] An iterable of strings indicating the names of
+                    the files you want, e.g., `('OUTCAR', 'INCAR')`. Files
+                    that were gzipped inside the archive (e.g.,
+                    `OUTCAR.gz`) count as their unzipped names. Defaults to
+                    all of the files.
     Returns:
         temp_loc    A string indicating where we just dumped the directory
     '''
-    # Make the temporary directory
-    temp_loc = '/tmp/%s/' % uuid.uuid4()
-    subprocess.call('mkdir %s' % temp_loc, shell=True)
+    if not os.path.isfile(file_name):
+        raise FileNotFoundError('Could not find %s' % file_name)
+    if members is not None:
+        members = set(members)
 
-    # Move to the temporary folder and unzip everything
-    subprocess.call('tar -C %s -xf %s' % (temp_loc, file_name), shell=True)
-    subprocess.call('gunzip -q %s/* > /dev/null' % temp_loc, shell=True)
+    temp_loc = tempfile.mkdtemp() + '/'
+    try:
+        with tarfile.open(file_name, mode='r|*') as tar:
+            for member in tar:
+                if not member.isfile():
+                    continue
+
+                # Only take the files we need. We flatten the directory and
+                # unzip things as we go.
+                name = os.path.basename(member.name)
+                is_gzipped = name.endswith('.gz')
+                if is_gzipped:
+                    name = name[:-3]
+                if members is not None and name not in members:
+                    continue
+
+                file_handle = tar.extractfile(member)
+                if is_gzipped:
+                    file_handle = gzip.GzipFile(fileobj=file_handle)
+                with open(os.path.join(temp_loc, name), 'wb') as output:
+                    shutil.copyfileobj(file_handle, output)
+
+    # Don't leave half-dumped directories lying around
+    except BaseException:
+        shutil.rmtree(temp_loc, ignore_errors=True)
+        raise
 
     return temp_loc
 
@@ -9,23 +9,37 @@ WARNING:  You may want to run these bash commands prior to running this
     export OMP_NUM_THREADS=1
 They will stop numpy/scipy from trying to parallelize over all the cores, which
 will slow us down since we are already parallelizing via multiprocess.
+
+If you want to grow the catalog with more than one machine, then use
+`enqueue_catalog_work` to put the bulks into our `catalog_queue` Mongo
+collection, and then call `run_catalog_worker` from as many processes on as
+many nodes as you like. Each worker claims one bulk at a time with a lease that
+it keeps renewing while it works. If a worker dies, then its lease runs out and
+another worker will pick the bulk back up.
 '''
 
 __authors__ = ['Zachary W. Ulissi', 'Kevin Tran']
 __emails__ = ['zulissi@andrew.cmu.edu', 'ktran@andrew.cmu.edu']
 
-from datetime import datetime
+import os
+import socket
+import threading
+import traceback
+import uuid
+from datetime import datetime, timedelta
+import math
+import itertools
 import pickle
 import luigi
-import multiprocess
-from pymatgen.ext.matproj import MPRester
+from bson.objectid import ObjectId
+from pymongo import UpdateOne, ReturnDocument
 from ..core import (schedule_tasks,
                     get_task_output,
                     save_task_output,
                     make_task_output_object)
 from ..atoms_generators import GenerateAllSitesFromBulk
 from ... import defaults
-from ...utils import read_rc, unfreeze_dict
+from ...utils import read_rc, unfreeze_dict, imultimap
 from ...mongo import make_atoms_from_doc
 from ...gasdb import get_mongo_collection
 from ...atoms_operators import fingerprint_adslab
@@ -34,6 +48,14 @@ BULK_SETTINGS = defaults.bulk_settings()
 SLAB_SETTINGS = defaults.slab_settings()
 ADSLAB_SETTINGS = defaults.adslab_settings()
 
+# How close (in Angstroms) two shifts or sites have to be for us to consider
+# them the same
+_SITE_TOLERANCE = 0.01
+# The keys that identify a site in the catalog
+_SITE_IDENTITY_KEYS = ('mpid', 'miller', 'min_xy', 'slab_generator_settings',
+                       'get_slab_settings', 'bulk_vasp_settings', 'shift', 'top',
+                       'slab_repeat', 'adsorption_site')
+
 
 def update_catalog_collection(elements, max_miller, n_processes=1, mp_query=None):
     '''
@@ -68,14 +90,222 @@ def update_catalog_collection(elements, max_miller, n_processes=1, mp_query=None
     mpids = get_task_output(get_mpid_task)
 
     # For each MPID, enumerate all the sites and then add them to our `catalog`
-    # Mongo collection. Do this in parallel because it can be.
-    if n_processes > 1:
+    # Mongo collection. Do this in parallel because it can be. If we have
+    # fewer bulks than processes, then parallelize the fingerprinting within
+    # each bulk instead.
+    if n_processes > 1 and len(mpids) >= n_processes:
+        # `multiprocess` pulls in `dill`, so we only import it when we need it
+        import multiprocess
         with multiprocess.Pool(n_processes) as pool:
             list(pool.imap(func=lambda mpid: __run_insert_to_catalog_task(mpid, max_miller),
                            iterable=mpids, chunksize=20))
     else:
         for mpid in mpids:
-            __run_insert_to_catalog_task(mpid, max_miller)
+            __run_insert_to_catalog_task(mpid, max_miller, n_processes)
+
+
+def enqueue_catalog_work(elements, max_miller, mp_query=None):
+    '''
+    This function will add a work item to our `catalog_queue` Mongo collection
+    for each bulk that we need to enumerate, so that `run_catalog_worker` can
+    enumerate them. Bulks that are already in the queue are left alone.
+
+    Args:
+        elements        A list of strings indicating the elements you are
+                        looking for, e.g., ['Cu', 'Al']
+        max_miller      An integer indicating the maximum Miller index to be
+                        enumerated
+        mp_query        We get our bulks from The Materials Project. This
+                        dictionary argument is used as a Mongo query to The
+                        Materials Project Database. See
+                        `update_catalog_collection` for details.
+    Returns:
+        n_queued    An integer indicating how many new work items we added
+    '''
+    # Python doesn't like mutable arguments
+    if mp_query is None:
+        mp_query = {}
+
+    get_mpid_task = _GetMpids(elements=elements, mp_query=mp_query)
+    schedule_tasks([get_mpid_task])
+    mpids = get_task_output(get_mpid_task)
+
+    # We upsert with an `_id` made from the work itself so that queueing the
+    # same thing twice does nothing
+    now = datetime.utcnow()
+    requests = [UpdateOne({'_id': '%s_%i' % (mpid, max_miller)},
+                          {'$setOnInsert': {'mpid': mpid,
+                                            'max_miller': max_miller,
+                                            'state': 'queued',
+                                            'attempts': 0,
+                                            'worker': None,
+                                            'lease_expires_on': None,
+                                            'error': None,
+                                            'created_on': now,
+                                            'updated_on': now}},
+                          upsert=True)
+                for mpid in sorted(mpids)]
+    if len(requests) == 0:
+        return 0
+    with get_mongo_collection('catalog_queue') as collection:
+        result = collection.bulk_write(requests, ordered=False)
+    return result.upserted_count
+
+
+def run_catalog_worker(n_processes=1, lease_seconds=1800, heartbeat_seconds=300,
+                       max_attempts=3):
+    '''
+    This function will keep claiming work items from our `catalog_queue` Mongo
+    collection and then enumerating them into our `catalog` collection until
+    there is nothing left to do. You can run as many of these as you want at
+    once, on as many nodes as you want.
+
+    Each worker uses its own local Luigi scheduler instead of our Luigi
+    daemon, because the queue already makes sure that no two workers
+    enumerate the same bulk.
+
+    Args:
+        n_processes         An integer indicating how many processes this
+                            worker should fingerprint sites with
+        lease_seconds       An integer indicating how long (in seconds) other
+                            workers should wait for this worker before they
+                            assume it died and reclaim its work
+        heartbeat_seconds   An integer indicating how often (in seconds) this
+                            worker renews its lease. Should be well under
+                            `lease_seconds`.
+        max_attempts        An integer indicating how many times we try a
+                            work item before we mark it as failed
+    Returns:
+        n_done  An integer indicating how many work items this worker finished
+    '''
+    worker = '%s:%i:%s' % (socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+    n_done = 0
+    while True:
+        work = _claim_catalog_work(worker, lease_seconds, max_attempts)
+        if work is None:
+            print('[%s] Catalog worker %s found no more work after finishing %i items'
+                  % (datetime.now(), worker, n_done))
+            return n_done
+
+        # Keep renewing our lease while we work so that nobody steals it
+        stop_heartbeat = threading.Event()
+        heartbeat = threading.Thread(target=_renew_catalog_lease,
+                                     args=(work['_id'], worker, lease_seconds,
+                                           heartbeat_seconds, stop_heartbeat),
+                                     daemon=True)
+        heartbeat.start()
+        try:
+            task = _InsertSitesToCatalog(work['mpid'], work['max_miller'],
+                                         n_processes=n_processes)
+            schedule_tasks([task], local_scheduler=True, resolve_calculations=True)
+            if not task.complete():
+                raise RuntimeError('Could not enumerate %s. Its bulk calculation '
+                                   'may not be done yet.' % work['mpid'])
+            error = None
+        except Exception:
+            error = traceback.format_exc()
+        finally:
+            stop_heartbeat.set()
+            heartbeat.join()
+
+        _finish_catalog_work(work, worker, error, max_attempts)
+        if error is None:
+            n_done += 1
+
+
+def _claim_catalog_work(worker, lease_seconds, max_attempts):
+    '''
+    Atomically claim a work item from the `catalog_queue` collection. We can
+    claim things that are queued, or things whose workers stopped renewing
+    their leases.
+
+    Args:
+        worker          A string identifying the worker
+        lease_seconds   An integer indicating how long the lease lasts
+        max_attempts    An integer indicating how many times we try a work
+                        item before we give up on it
+    Returns:
+        work    The work item (a dictionary), or `None` if there is nothing
+                left to claim
+    '''
+    now = datetime.utcnow()
+    with get_mongo_collection('catalog_queue') as collection:
+        # Workers that died on the last attempt of their work will never
+        # finish it, so we mark it as failed for them
+        collection.update_many({'state': 'running',
+                                'lease_expires_on': {'$lt': now},
+                                'attempts': {'$gte': max_attempts}},
+                               {'$set': {'state': 'failed',
+                                         'error': 'The lease expired',
+                                         'updated_on': now}})
+
+        query = {'$or': [{'state': 'queued'},
+                         {'state': 'running', 'lease_expires_on': {'$lt': now}}],
+                 'attempts': {'$lt': max_attempts}}
+        update = {'$set': {'state': 'running',
+                           'worker': worker,
+                           'lease_expires_on': now + timedelta(seconds=lease_seconds),
+                           'updated_on': now},
+                  '$inc': {'attempts': 1}}
+        work = collection.find_one_and_update(query, update,
+                                              sort=[('attempts', 1), ('_id', 1)],
+                                              return_document=ReturnDocument.AFTER)
+    return work
+
+
+def _renew_catalog_lease(work_id, worker, lease_seconds, heartbeat_seconds, stop):
+    '''
+    Keep pushing back the expiration of a worker's lease until it tells us to
+    stop. Meant to be run in a background thread.
+
+    Args:
+        work_id             The `_id` of the work item
+        worker              A string identifying the worker that owns the lease
+        lease_seconds       An integer indicating how long each renewal lasts
+        heartbeat_seconds   An integer indicating how often we renew
+        stop                A `threading.Event` that tells us to stop
+    '''
+    while not stop.wait(heartbeat_seconds):
+        now = datetime.utcnow()
+        try:
+            with get_mongo_collection('catalog_queue') as collection:
+                collection.update_one({'_id': work_id, 'worker': worker, 'state': 'running'},
+                                      {'$set': {'lease_expires_on': now + timedelta(seconds=lease_seconds),
+                                                'updated_on': now}})
+        # Missing one heartbeat is not the end of the world; the lease should
+        # be long enough to survive it
+        except Exception:
+            traceback.print_exc()
+
+
+def _finish_catalog_work(work, worker, error, max_attempts):
+    '''
+    Record how a work item went. Failed items go back into the queue until
+    they run out of attempts.
+
+    Args:
+        work            The work item (a dictionary) that we claimed
+        worker          A string identifying the worker that claimed it
+        error           A string of the traceback if the work failed, or
+                        `None` if it succeeded
+        max_attempts    An integer indicating how many times we try a work
+                        item before we give up on it
+    '''
+    if error is None:
+        state = 'done'
+    elif work['attempts'] >= max_attempts:
+        state = 'failed'
+    else:
+        state = 'queued'
+
+    # We only touch the item if we still own it, in case our lease ran out
+    # and someone else took it
+    with get_mongo_collection('catalog_queue') as collection:
+        collection.update_one({'_id': work['_id'], 'worker': worker, 'state': 'running'},
+                              {'$set': {'state': state,
+                                        'error': error,
+                                        'lease_expires_on': None,
+                                        'updated_on': datetime.utcnow()}})
 
 
 class _GetMpids(luigi.Task):
@@ -129,6 +359,7 @@ class _GetMpids(luigi.Task):
             query[key] = value
 
         # Ask Materials Project for any matches
+        from pymatgen.ext.matproj import MPRester
         with MPRester(read_rc('matproj_api_key')) as rester:
             results = rester.query(query, ['task_id'])
 
@@ -140,7 +371,7 @@ class _GetMpids(luigi.Task):
         return make_task_output_object(self)
 
 
-def __run_insert_to_catalog_task(mpid, max_miller):
+def __run_insert_to_catalog_task(mpid, max_miller, n_processes=1):
     '''
     Very light wrapper to instantiate a `_InsertSitesToCatalog` task and then
     run it manually.
@@ -150,10 +381,12 @@ def __run_insert_to_catalog_task(mpid, max_miller):
                             bulk you want to enumerate sites from
         max_miller          An integer indicating the maximum Miller index to
                             be enumerated
+        n_processes         An integer indicating how many processes the task
+                            should fingerprint new sites with
     '''
-    task = _InsertSitesToCatalog(mpid, max_miller)
+    task = _InsertSitesToCatalog(mpid, max_miller, n_processes=n_processes)
     try:
-        schedule_tasks([task], local_scheduler=False)
+        schedule_tasks([task], local_scheduler=False, resolve_calculations=True)
 
     # We need bulk calculations to enumerate our catalog. If these calculations
     # aren't done, then we won't find the Luigi task pickles. If this happens,
@@ -190,6 +423,10 @@ class _InsertSitesToCatalog(luigi.Task):
                                 as a dictionary.
         bulk_vasp_settings      A dictionary containing the VASP settings of
                                 the relaxed bulk to enumerate slabs from
+        n_processes             An integer indicating how many processes to
+                                fingerprint new sites with. This does not
+                                change the output, so it is not part of the
+                                task's identity.
     Returns:
         docs    A list of all of the Mongo documents (i.e., dictionaries)
                 from the `catalog` collection that match the arguments you
@@ -201,6 +438,7 @@ class _InsertSitesToCatalog(luigi.Task):
     slab_generator_settings = luigi.DictParameter(SLAB_SETTINGS['slab_generator_settings'])
     get_slab_settings = luigi.DictParameter(SLAB_SETTINGS['get_slab_settings'])
     bulk_vasp_settings = luigi.DictParameter(BULK_SETTINGS['vasp'])
+    n_processes = luigi.IntParameter(1, significant=False)
 
     def requires(self):
         return GenerateAllSitesFromBulk(mpid=self.mpid,
@@ -216,60 +454,167 @@ class _InsertSitesToCatalog(luigi.Task):
         '''
         with open(self.input().path, 'rb') as file_handle:
             site_docs = pickle.load(file_handle)
+        settings = {'mpid': self.mpid,
+                    'min_xy': self.min_xy,
+                    'slab_generator_settings': unfreeze_dict(self.slab_generator_settings),
+                    'get_slab_settings': unfreeze_dict(self.get_slab_settings),
+                    'bulk_vasp_settings': unfreeze_dict(self.bulk_vasp_settings)}
+
+        # Fetch all of the sites we already have for this bulk at once, and
+        # then try to find each adsorption site among them
         with get_mongo_collection('catalog') as collection:
-
-            # Try to find each adsorption site in our catalog
-            incumbent_docs = []
-            inserted_docs = []
-            for site_doc in site_docs:
-                query = {'mpid': self.mpid,
-                         'miller': site_doc['miller'],
-                         'min_xy': self.min_xy,
-                         'slab_generator_settings': unfreeze_dict(self.slab_generator_settings),
-                         'get_slab_settings': unfreeze_dict(self.get_slab_settings),
-                         'bulk_vasp_settings': unfreeze_dict(self.bulk_vasp_settings),
-                         'shift': {'$gt': site_doc['shift'] - 0.01,
-                                   '$lt': site_doc['shift'] + 0.01},
-                         'top': site_doc['top'],
-                         'slab_repeat': site_doc['slab_repeat'],
-                         'adsorption_site.0': {'$gt': site_doc['adsorption_site'][0] - 0.01,
-                                               '$lt': site_doc['adsorption_site'][0] + 0.01},
-                         'adsorption_site.1': {'$gt': site_doc['adsorption_site'][1] - 0.01,
-                                               '$lt': site_doc['adsorption_site'][1] + 0.01},
-                         'adsorption_site.2': {'$gt': site_doc['adsorption_site'][2] - 0.01,
-                                               '$lt': site_doc['adsorption_site'][2] + 0.01}}
-                docs_in_catalog = list(collection.find(query))
-
-                # If a site is in the catalog, then we don't need to add it
-                if len(docs_in_catalog) >= 1:
-                    incumbent_docs.append(docs_in_catalog[0])
-
-                # If a site is not in the catalog, then create the document
-                elif len(docs_in_catalog) == 0:
-                    doc = site_doc.copy()
-                    doc['mpid'] = self.mpid
-                    doc['min_xy'] = self.min_xy
-                    doc['slab_generator_settings'] = unfreeze_dict(self.slab_generator_settings)
-                    doc['get_slab_settings'] = unfreeze_dict(self.get_slab_settings)
-                    doc['bulk_vasp_settings'] = unfreeze_dict(self.bulk_vasp_settings)
-                    doc['adsorption_site'] = tuple(doc['adsorption_site'])
-                    doc['fwids'] = site_doc['fwids']
-                    # Add fingerprint information to the document
-                    atoms = make_atoms_from_doc(doc)
-                    fingerprint = fingerprint_adslab(atoms)
-                    for key, value in fingerprint.items():
-                        doc[key] = value
-
-                    # It's faster to write in bulk instead of one-at-a-time, so
-                    # save the document to one list that we'll write to
-                    inserted_docs.append(doc)
-
-            # Add the documents to the catalog
-            if not _testing and len(inserted_docs) > 0:
-                collection.insert_many(inserted_docs)
-                print('[%s] Created %i new entries in the catalog collection'
-                      % (datetime.now(), len(inserted_docs)))
+            catalog_docs = list(collection.find(settings))
+        matches = _find_sites_in_catalog(site_docs, catalog_docs)
+
+        # If a site is in the catalog, then we don't need to add it. If it's
+        # not, then create the document.
+        incumbent_docs = []
+        new_docs = []
+        for site_doc, match in zip(site_docs, matches):
+            if match is not None:
+                incumbent_docs.append(match)
+            else:
+                doc = site_doc.copy()
+                doc.update(settings)
+                doc['adsorption_site'] = tuple(doc['adsorption_site'])
+                doc['fwids'] = site_doc['fwids']
+                new_docs.append(doc)
+
+        # Add fingerprint information to the new documents
+        backend = 'serial' if self.n_processes == 1 else 'process'
+        fingerprints = imultimap(_fingerprint_catalog_doc, new_docs,
+                                 backend=backend, processes=self.n_processes,
+                                 chunksize=10, n_calcs=len(new_docs))
+        inserted_docs = []
+        for doc, fingerprint in zip(new_docs, fingerprints):
+            for key, value in fingerprint.items():
+                doc[key] = value
+            inserted_docs.append(doc)
+
+        # Add the documents to the catalog
+        if not _testing and len(inserted_docs) > 0:
+            _upsert_catalog_docs(inserted_docs)
+            print('[%s] Created %i new entries in the catalog collection'
+                  % (datetime.now(), len(inserted_docs)))
         save_task_output(self, incumbent_docs + inserted_docs)
 
     def output(self):
         return make_task_output_object(self)
+
+
+def _find_sites_in_catalog(site_docs, catalog_docs):
+    '''
+    Match enumerated adsorption sites to the sites that are already in our
+    catalog. Two sites match when they have the same Miller indices, top,
+    and slab repeat, and when their shifts and adsorption sites are within
+    `_SITE_TOLERANCE` of each other. We do this in memory by putting the
+    catalog sites into a grid whose spacing is the tolerance, so we only
+    compare each site to the catalog sites in the neighboring grid cells.
+
+    Args:
+        site_docs       A list of the site documents created by the
+                        `GenerateAllSitesFromBulk` task
+        catalog_docs    A list of documents from the `catalog` collection
+                        that have the same bulk and settings as the sites
+    Returns:
+        matches     A list with one item per site. Each item is the first
+                    catalog document that matches the site, or `None` if
+                    nothing matched.
+    '''
+    grid = {}
+    for i, doc in enumerate(catalog_docs):
+        try:
+            key = _make_site_key(doc)
+        except (KeyError, IndexError, TypeError):
+            continue
+        grid.setdefault(key, []).append(i)
+
+    matches = []
+    for site_doc in site_docs:
+        key = _make_site_key(site_doc)
+        targets = (site_doc['shift'], *site_doc['adsorption_site'][:3])
+
+        # Look in this cell and every neighboring cell
+        candidates = []
+        group_key, cell = key[:3], key[3]
+        for offset in itertools.product((-1, 0, 1), repeat=len(cell)):
+            neighbor = tuple(index + delta for index, delta in zip(cell, offset))
+            candidates.extend(grid.get(group_key + (neighbor,), []))
+
+        # Use the same (strict) tolerances as our old Mongo queries, and keep
+        # the first match in the catalog's natural order like they did
+        match = None
+        for i in sorted(candidates):
+            doc = catalog_docs[i]
+            values = (doc['shift'], *doc['adsorption_site'][:3])
+            if all(target - _SITE_TOLERANCE < value < target + _SITE_TOLERANCE
+                   for value, target in zip(values, targets)):
+                match = doc
+                break
+        matches.append(match)
+    return matches
+
+
+def _make_site_key(doc):
+    '''
+    Make the key that `_find_sites_in_catalog` uses to put a site into its
+    grid
+
+    Arg:
+        doc     A dictionary with the 'miller', 'top', 'slab_repeat', 'shift',
+                and 'adsorption_site' keys
+    Returns:
+        key     A 4-tuple of the Miller indices, top, slab repeat, and the
+                grid cell of the shift and adsorption site
+    '''
+    values = (doc['shift'], *doc['adsorption_site'][:3])
+    cell = tuple(math.floor(value / _SITE_TOLERANCE) for value in values)
+    key = (_freeze(doc['miller']), doc['top'], _freeze(doc['slab_repeat']), cell)
+    return key
+
+
+def _freeze(value):
+    '''
+    Turn lists (which Mongo gives us) and tuples (which we make) into
+    tuples so that they compare and hash the same way
+    '''
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(element) for element in value)
+    return value
+
+
+def _fingerprint_catalog_doc(doc):
+    '''
+    Fingerprint the adslab of a catalog document
+
+    Arg:
+        doc     A catalog document without the fingerprint information
+    Returns:
+        fingerprint     The output of `gaspy.atoms_operators.fingerprint_adslab`
+    '''
+    atoms = make_atoms_from_doc(doc)
+    fingerprint = fingerprint_adslab(atoms)
+    return fingerprint
+
+
+def _upsert_catalog_docs(docs, chunk_size=1000):
+    '''
+    Write new documents to the catalog with unordered bulk upserts. We upsert
+    instead of insert so that two runs that try to add the same site at the
+    same time do not create duplicates.
+
+    Args:
+        docs        A list of catalog documents. Like `insert_many`, we add
+                    an `_id` to each of them.
+        chunk_size  How many documents to write per `bulk_write`
+    '''
+    requests = []
+    for doc in docs:
+        doc.setdefault('_id', ObjectId())
+        query = {key: doc[key] for key in _SITE_IDENTITY_KEYS}
+        insertion = {key: value for key, value in doc.items() if key not in query}
+        requests.append(UpdateOne(query, {'$setOnInsert': insertion}, upsert=True))
+
+    with get_mongo_collection('catalog') as collection:
+        for i in range(0, len(requests), chunk_size):
+            collection.bulk_write(requests[i:i+chunk_size], ordered=False)
@@ -17,9 +17,10 @@ from ...utils import unfreeze_dict, multimap
 from ...gasdb import get_mongo_collection
 from ...mongo import make_atoms_from_doc
 from ...atoms_operators import find_max_movement
+from .watermarks import CollectionUpdate, make_new_atoms_docs_query
 
 
-def update_surface_energy_collection(n_processes=1):
+def update_surface_energy_collection(n_processes=1, chunk_size=100, full_reconciliation=None):
     '''
     This function will parse and dump all of the completed surface energy
     calculations in our `atoms` Mongo collection into our `surface_energy`
@@ -32,11 +33,26 @@ def update_surface_energy_collection(n_processes=1):
                         you are re-creating your collection from scratch, you
                         may want to want to increase this argument as high as
                         you can.
+        chunk_size      An integer indicating how many surfaces to process
+                        (and then write to the `surface_energy` collection) at
+                        a time
+        full_reconciliation A Boolean indicating whether to compare every
+                            surface energy calculation in the `atoms`
+                            collection against the `surface_energy` collection
+                            (`True`) or to look only at the ones added since
+                            the last time we ran (`False`). If `None`, then we
+                            do a full reconciliation only if it has been a
+                            while since the last one.
     '''
+    # If the last update did not finish, then this picks up where it left off
+    update = CollectionUpdate('surface_energy', full_reconciliation)
+
     # Identify the surfaces that have been at least partially calculated, but
-    # not yet added to the surface energy collection
-    atoms_docs = _find_atoms_docs_not_in_surface_energy_collection()
-    surfaces = set()
+    # not yet added to the surface energy collection. We only need the FWIDs
+    # and names of the calculations to do this.
+    atoms_docs = _find_atoms_docs_not_in_surface_energy_collection(update.watermark,
+                                                                    projection={'fwid': 1, 'fwname': 1, '_id': 0})
+    fwids_by_surface = {}
     for doc in atoms_docs:
         mpid = doc['fwname']['mpid']
         miller_indices = tuple(doc['fwname']['miller'])
@@ -48,70 +64,101 @@ def update_surface_energy_collection(n_processes=1):
         # Define a surface according to mpid, miller, shift, and calculation
         # settings
         surface = (mpid, miller_indices, shift, vasp_settings)
-        surfaces.add(surface)
-
-    # Create a `CalculateSurfaceEnergy` task for each surface energy
-    # calculation that is in-progress.
-    tasks = [CalculateSurfaceEnergy(mpid=mpid,
-                                    miller_indices=miller_indices,
-                                    shift=shift,
-                                    vasp_settings={key: value for key, value in vasp_settings})
-             for mpid, miller_indices, shift, vasp_settings in surfaces]
-
-    # Run each task and then see which ones are done
-    print('[%s] Calculating surface energies...' % datetime.now())
-    multimap(__run_calculate_surface_energy_task, tasks,
-             processes=n_processes, maxtasksperchild=10, chunksize=100,
-             n_calcs=len(tasks))
-    completed_tasks = [task for task in tasks if task.complete()]
-
-    # Parse the completed tasks into documents for us to save
-    print('[%s] Creating surface energy documents...' % datetime.now())
-    surface_energy_docs = multimap(__create_surface_energy_doc,
-                                   completed_tasks,
-                                   processes=n_processes,
-                                   maxtasksperchild=1,
-                                   chunksize=100,
-                                   n_calcs=len(completed_tasks))
-
-    if len(surface_energy_docs) > 0:
-        print('[%s] Creating %i new entries in the surface energy collection...'
-              % (datetime.now(), len(surface_energy_docs)))
-        with get_mongo_collection('surface_energy') as collection:
-            collection.insert_many(surface_energy_docs)
-        print('[%s] Created %i new entries in the surface energy collection'
-              % (datetime.now(), len(surface_energy_docs)))
-
-
-def _find_atoms_docs_not_in_surface_energy_collection():
+        fwids_by_surface.setdefault(surface, set()).add(doc['fwid'])
+
+    # We go through the surfaces in order of their lowest FWID so that our
+    # checkpoints can skip the ones that an interrupted update already did
+    surfaces_by_fwid = {min(fwids): surface for surface, fwids in fwids_by_surface.items()}
+    surface_fwids = update.skip_finished(surfaces_by_fwid)
+    print('[%s] Calculating surface energies for %i surfaces...'
+          % (datetime.now(), len(surface_fwids)))
+
+    n_created = 0
+    for i in range(0, len(surface_fwids), chunk_size):
+        chunk_fwids = surface_fwids[i:i+chunk_size]
+        surfaces = [surfaces_by_fwid[fwid] for fwid in chunk_fwids]
+
+        # Create a `CalculateSurfaceEnergy` task for each surface energy
+        # calculation that is in-progress.
+        tasks = [CalculateSurfaceEnergy(mpid=mpid,
+                                        miller_indices=miller_indices,
+                                        shift=shift,
+                                        vasp_settings={key: value for key, value in vasp_settings})
+                 for mpid, miller_indices, shift, vasp_settings in surfaces]
+
+        # Run each task and then see which ones are done
+        multimap(__run_calculate_surface_energy_task, tasks,
+                 processes=n_processes, maxtasksperchild=10, chunksize=100,
+                 n_calcs=len(tasks))
+        completed_tasks = [task for task in tasks if task.complete()]
+
+        # Parse the completed tasks into documents for us to save
+        surface_energy_docs = multimap(__create_surface_energy_doc,
+                                       completed_tasks,
+                                       processes=n_processes,
+                                       maxtasksperchild=1,
+                                       chunksize=100,
+                                       n_calcs=len(completed_tasks))
+        if len(surface_energy_docs) > 0:
+            with get_mongo_collection('surface_energy') as collection:
+                collection.insert_many(surface_energy_docs, ordered=False)
+            n_created += len(surface_energy_docs)
+            print('[%s] Created %i new entries in the surface energy collection'
+                  % (datetime.now(), n_created))
+
+        # Surfaces that are still missing some of their relaxations need to be
+        # looked at again next time
+        fwids_pending = ({fwid for surface in surfaces for fwid in fwids_by_surface[surface]} -
+                         {fwid for doc in surface_energy_docs for fwid in doc['fwids']})
+        update.commit_chunk(chunk_fwids[-1], fwids_pending)
+
+    update.finish()
+
+
+def _find_atoms_docs_not_in_surface_energy_collection(watermark=None, projection=None):
     '''
     This function will get the Mongo documents of surface energy calculations
     that are inside our `atoms` collection, but not inside our `surface_energy`
     collection.
 
+    Args:
+        watermark   [Optional] A dictionary returned by
+                    `watermarks.get_watermark`. If you pass it, then we only
+                    look at the `atoms` documents that were added since the
+                    watermark and at the pending FWIDs. Otherwise we look at
+                    all of them.
+        projection  [Optional] A dictionary indicating which parts of the
+                    documents you want. Defaults to all of them.
     Returns:
         missing_docs    A list of surface energy documents from the `atoms`
                         collection that have not yet been added to the
                         `surface_energy` collection.
     '''
-    # Find the FWIDs of the documents inside our surface energy collection
+    # Find the FWIDs of the documents inside our atoms collection
+    query = {'fwname.calculation_type': 'surface energy optimization'}
+    if watermark is not None:
+        query.update(make_new_atoms_docs_query(watermark))
+    with get_mongo_collection('atoms') as collection:
+        fwid_projection = {'fwid': 'fwid', '_id': 0}
+        docs_atoms = list(collection.find(query, fwid_projection))
+    fwids_in_atoms = {doc['fwid'] for doc in docs_atoms}
+
+    # Find the FWIDs of the documents inside our surface energy collection. If
+    # we are only looking at new documents, then we only need to check those.
+    se_query = {}
+    if watermark is not None and watermark['value'] is not None:
+        se_query = {'fwids': {'$in': list(fwids_in_atoms)}}
     with get_mongo_collection('surface_energy') as collection:
-        surface_energy_docs = list(collection.find({}, {'fwids': 'fwids', '_id': 0}))
+        surface_energy_docs = list(collection.find(se_query, {'fwids': 'fwids', '_id': 0}))
     fwids_in_se = {fwid for doc in surface_energy_docs for fwid in doc['fwids']}
 
-    # Find the FWIDs of the documents inside our atoms collection
+    # Pull the atoms documents of everything that's missing from our
+    # surface energy collection. Although we use `find` a second time, this
+    # time we are getting the whole document (not just the FWID), so we
+    # only want to do this for the things we need.
+    fwids_missing = fwids_in_atoms - fwids_in_se
     with get_mongo_collection('atoms') as collection:
-        query = {'fwname.calculation_type': 'surface energy optimization'}
-        projection = {'fwid': 'fwid', '_id': 0}
-        docs_atoms = list(collection.find(query, projection))
-        fwids_in_atoms = {doc['fwid'] for doc in docs_atoms}
-
-        # Pull the atoms documents of everything that's missing from our
-        # adsorption collection. Although we use `find` a second time, this
-        # time we are getting the whole document (not just the FWID), so we
-        # only want to do this for the things we need.
-        fwids_missing = fwids_in_atoms - fwids_in_se
-        missing_docs = list(collection.find({'fwid': {'$in': list(fwids_missing)}}))
+        missing_docs = list(collection.find({'fwid': {'$in': list(fwids_missing)}}, projection))
     return missing_docs
 
 
@@ -0,0 +1,304 @@
+'''
+This module keeps track of how far each of our collection updaters has gotten,
+so that they only need to look at things that are newer than the last update
+instead of comparing our entire history every time.
+
+For each collection, we save a "watermark" (e.g., the newest `updated_on` of the
+FireWorks we have looked at), the FWIDs that we looked at but could not add yet
+(so that we try them again next time), and when we last did a full
+reconciliation. The watermarks live in a JSON file in the `gasdb_path` folder.
+
+Updates write their results in chunks. After each chunk, we save a checkpoint
+next to the watermark so that an update that crashes or times out can pick up
+where it left off instead of starting over.
+'''
+
+__author__ = 'Kevin Tran'
+__email__ = 'ktran@andrew.cmu.edu'
+
+import os
+import json
+import uuid
+from datetime import datetime, timedelta
+from bson.objectid import ObjectId
+from ...utils import read_rc
+from ...gasdb import get_mongo_collection
+
+# How often we compare everything instead of just the new things, in case
+# something slipped past a watermark
+FULL_RECONCILIATION_INTERVAL = timedelta(days=7)
+
+# How we write the dates of the full reconciliations. We spell it out instead
+# of using `isoformat`, which drops the microseconds when they are zero.
+RECONCILIATION_DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def _get_watermarks_file():
+    ''' Returns the location of the file we store the watermarks in '''
+    return os.path.join(read_rc('gasdb_path'), 'watermarks.json')
+
+
+def _read_watermarks():
+    '''
+    Returns:
+        watermarks  A dictionary whose keys are the collection tags and whose
+                    values are the watermark dictionaries. Empty if we have
+                    not made any watermarks yet.
+    '''
+    try:
+        with open(_get_watermarks_file()) as file_handle:
+            return json.load(file_handle)
+    except FileNotFoundError:
+        return {}
+
+
+def get_watermark(collection_tag):
+    '''
+    Get the watermark of one of our collections
+
+    Arg:
+        collection_tag  A string indicating the collection, e.g., 'atoms'
+    Returns:
+        watermark   A dictionary with the following keys:
+                        value                       The watermark itself, or
+                                                    `None` if we have not made
+                                                    one yet
+                        pending_fwids               A list of FWIDs that we
+                                                    should look at again
+                        last_full_reconciliation    A string of when we last
+                                                    compared everything
+                                                    (formatted with
+                                                    `RECONCILIATION_DATE_FORMAT`),
+                                                    or `None`
+    '''
+    watermark = {'value': None, 'pending_fwids': [], 'last_full_reconciliation': None}
+    watermark.update(_read_watermarks().get(collection_tag, {}))
+    return watermark
+
+
+def set_watermark(collection_tag, value, pending_fwids=(), full_reconciliation=False):
+    '''
+    Save the watermark of one of our collections. This also clears any
+    checkpoint of the collection.
+
+    Args:
+        collection_tag      A string indicating the collection, e.g., 'atoms'
+        value               The new watermark. It needs to be JSON-serializable.
+        pending_fwids       An iterable of FWIDs that we should look at again
+                            next time, e.g., calculations that we could not
+                            process yet
+        full_reconciliation A Boolean indicating whether this update compared
+                            everything instead of just the new things
+    '''
+    watermarks = _read_watermarks()
+    watermark = watermarks.get(collection_tag, {})
+    watermark['value'] = value
+    watermark['pending_fwids'] = sorted(set(pending_fwids))
+    if full_reconciliation:
+        watermark['last_full_reconciliation'] = datetime.now().strftime(RECONCILIATION_DATE_FORMAT)
+    # A new watermark means that the update finished
+    watermark.pop('checkpoint', None)
+    watermarks[collection_tag] = watermark
+    _write_watermarks(watermarks)
+
+
+def _write_watermarks(watermarks):
+    '''
+    Write the watermarks to a temporary file and then move it so that an
+    interrupted write cannot corrupt the file.
+
+    Arg:
+        watermarks  A dictionary whose keys are the collection tags and whose
+                    values are the watermark dictionaries
+    '''
+    file_name = _get_watermarks_file()
+    temp_file_name = file_name + '.' + str(uuid.uuid4())
+    with open(temp_file_name, 'w') as file_handle:
+        json.dump(watermarks, file_handle, indent=4, sort_keys=True)
+    os.replace(temp_file_name, file_name)
+
+
+def get_checkpoint(collection_tag):
+    '''
+    Get the checkpoint of an update that did not finish
+
+    Arg:
+        collection_tag  A string indicating the collection, e.g., 'atoms'
+    Returns:
+        checkpoint  A dictionary with the keys `value`, `pending_fwids`,
+                    `last_fwid`, and `full_reconciliation`, or `None` if the
+                    last update finished
+    '''
+    return _read_watermarks().get(collection_tag, {}).get('checkpoint')
+
+
+def set_checkpoint(collection_tag, value, last_fwid, pending_fwids=(),
+                   full_reconciliation=False):
+    '''
+    Save how far an update has gotten
+
+    Args:
+        collection_tag      A string indicating the collection, e.g., 'atoms'
+        value               The watermark that the collection will have once
+                            the update finishes
+        last_fwid           An integer indicating the last FWID that the
+                            update has written (or given up on). Updates go
+                            through FWIDs in increasing order.
+        pending_fwids       An iterable of FWIDs that we should look at again
+                            next time
+        full_reconciliation A Boolean indicating whether the update is
+                            comparing everything instead of just the new things
+    '''
+    watermarks = _read_watermarks()
+    watermark = watermarks.setdefault(collection_tag, {})
+    watermark['checkpoint'] = {'value': value,
+                               'last_fwid': last_fwid,
+                               'pending_fwids': sorted(set(pending_fwids)),
+                               'full_reconciliation': full_reconciliation}
+    _write_watermarks(watermarks)
+
+
+def needs_full_reconciliation(collection_tag, interval=FULL_RECONCILIATION_INTERVAL):
+    '''
+    Figure out whether it's time to compare everything in a collection instead
+    of just the new things
+
+    Args:
+        collection_tag  A string indicating the collection, e.g., 'atoms'
+        interval        A `datetime.timedelta` indicating how often we should
+                        do full reconciliations
+    Returns:
+        needs_full_reconciliation   A Boolean
+    '''
+    watermark = get_watermark(collection_tag)
+    if watermark['value'] is None or watermark['last_full_reconciliation'] is None:
+        return True
+    last_full_reconciliation = datetime.strptime(watermark['last_full_reconciliation'],
+                                                 RECONCILIATION_DATE_FORMAT)
+    return datetime.now() - last_full_reconciliation > interval
+
+
+def get_newest_atoms_doc_id():
+    '''
+    Collections that we make from our `atoms` collection use the `_id` of the
+    newest `atoms` document as their watermark. We use `_id` instead of FWID
+    because `_id`s follow the order in which documents were added, while
+    calculations with low FWIDs can finish long after ones with high FWIDs.
+
+    Returns:
+        newest_id   A string of the ObjectId of the newest document in the
+                    `atoms` collection, or `None` if the collection is empty
+    '''
+    with get_mongo_collection('atoms') as collection:
+        doc = collection.find_one({}, {'_id': 1}, sort=[('_id', -1)])
+    if doc is None:
+        return None
+    return str(doc['_id'])
+
+
+def make_new_atoms_docs_query(watermark):
+    '''
+    Make a query for the `atoms` documents that were added after a watermark
+    made by `get_newest_atoms_doc_id`, plus the ones whose FWIDs are still
+    pending.
+
+    Arg:
+        watermark   A dictionary returned by `get_watermark`
+    Returns:
+        query   A dictionary that you can add to a Mongo query of the `atoms`
+                collection. Empty if there is no watermark yet.
+    '''
+    if watermark['value'] is None:
+        return {}
+    return {'$or': [{'_id': {'$gt': ObjectId(watermark['value'])}},
+                    {'fwid': {'$in': watermark['pending_fwids']}}]}
+
+
+class CollectionUpdate:
+    '''
+    Keeps track of an update of one of our collections:  whether it is a full
+    reconciliation, which watermark it started from, which watermark it will
+    finish with, and what it has done so far. If the last update of the
+    collection did not finish, then this picks up from its checkpoint.
+
+    Typical use:
+        update = CollectionUpdate('atoms', full_reconciliation, find_watermark)
+        fwids = update.skip_finished(find_missing_fwids(update.watermark))
+        for chunk in chunks_of(fwids):
+            ...
+            update.commit_chunk(chunk[-1], fwids_we_could_not_add)
+        update.finish()
+    '''
+    def __init__(self, collection_tag, full_reconciliation=None,
+                 find_watermark=get_newest_atoms_doc_id):
+        '''
+        Args:
+            collection_tag      A string indicating the collection, e.g.,
+                                'atoms'
+            full_reconciliation A Boolean indicating whether to compare
+                                everything instead of just the new things. If
+                                `None`, then we do a full reconciliation only
+                                if it has been a while since the last one.
+            find_watermark      A function that returns the current watermark
+                                of the collection
+        '''
+        self.collection_tag = collection_tag
+        self.previous_watermark = get_watermark(collection_tag)
+        checkpoint = get_checkpoint(collection_tag)
+
+        if checkpoint is not None:
+            print('[%s] Resuming the %s update after FWID %s...'
+                  % (datetime.now(), collection_tag, checkpoint['last_fwid']))
+            self.full_reconciliation = checkpoint['full_reconciliation']
+            self.value = checkpoint['value']
+            self.last_fwid = checkpoint['last_fwid']
+            self.pending_fwids = set(checkpoint['pending_fwids'])
+
+        else:
+            if full_reconciliation is None:
+                full_reconciliation = needs_full_reconciliation(collection_tag)
+            self.full_reconciliation = full_reconciliation
+            # Find the new watermark before looking for anything so that
+            # whatever shows up while we are working gets picked up next time
+            self.value = find_watermark() or self.previous_watermark['value']
+            self.last_fwid = None
+            self.pending_fwids = set()
+
+    @property
+    def watermark(self):
+        '''
+        The watermark that we should look for new things with, or `None` if
+        we should look at everything
+        '''
+        if self.full_reconciliation:
+            return None
+        return self.previous_watermark
+
+    def skip_finished(self, fwids):
+        '''
+        Arg:
+            fwids   An iterable of integers indicating the FWIDs we need to do
+        Returns:
+            fwids   A sorted list of the FWIDs that come after our checkpoint
+        '''
+        return sorted(fwid for fwid in fwids
+                      if self.last_fwid is None or fwid > self.last_fwid)
+
+    def commit_chunk(self, last_fwid, pending_fwids=()):
+        '''
+        Save a checkpoint after writing a chunk of documents
+
+        Args:
+            last_fwid       An integer indicating the highest FWID of the chunk
+            pending_fwids   An iterable of FWIDs in the chunk that we could not
+                            add and should look at again next time
+        '''
+        self.last_fwid = last_fwid
+        self.pending_fwids.update(pending_fwids)
+        set_checkpoint(self.collection_tag, self.value, self.last_fwid,
+                       self.pending_fwids, self.full_reconciliation)
+
+    def finish(self):
+        ''' Save the new watermark and clear the checkpoint '''
+        set_watermark(self.collection_tag, self.value, self.pending_fwids,
+                      self.full_reconciliation)
@@ -12,14 +12,21 @@ __authors__ = ['Zachary W. Ulissi', 'Kevin Tran']
 __emails__ = ['zulissi@andrew.cmu.edu', 'ktran@andrew.cmu.edu']
 
 import pickle
-import math
-import numpy as np
+import warnings
 import luigi
-from .atoms_generators import GenerateGas, GenerateBulk, GenerateAdslabs
+from .atoms_generators import GenerateGas, GenerateBulk, GenerateAdslab
 from .. import defaults
 from ..mongo import make_atoms_from_doc
-from ..utils import unfreeze_dict
-from ..fireworks_helper_scripts import make_firework, submit_fwork, get_launchpad
+from ..utils import unfreeze_dict, read_rc
+from ..gasdb import get_mongo_collection
+from ..atoms_operators import fingerprint_adslab, warm_start_adslab
+from .core import schedule_tasks
+from ..fireworks_helper_scripts import (make_firework,
+                                        encode_atoms_to_trajhex,
+                                        submit_fwork,
+                                        submit_fworks,
+                                        get_optimizer_state_reference_from_fwid,
+                                        _get_optimizer_settings)
 
 GAS_SETTINGS = defaults.gas_settings()
 BULK_SETTINGS = defaults.bulk_settings()
@@ -27,6 +34,50 @@ SLAB_SETTINGS = defaults.slab_settings()
 ADSLAB_SETTINGS = defaults.adslab_settings()
 
 
+def submit_fireworks_in_batches(tasks, batch_size=100, local_scheduler=False, _testing=False):
+    '''
+    Luigi runs each of our `FireworkMaker` tasks on its own, which means one
+    trip to the LaunchPad per FireWork. This function instead makes the
+    FireWorks of many tasks and then submits them in bulk.
+
+    Args:
+        tasks       A list of `FireworkMaker` tasks, e.g., `MakeAdslabFW`
+        batch_size  An integer indicating how many FireWorks to submit at a
+                    time
+        local_scheduler A Boolean indicating whether to run the requirements
+                        of the tasks with a local Luigi scheduler instead of
+                        our Luigi daemon (see `gaspy.tasks.core.schedule_tasks`)
+        _testing    Boolean indicating whether or not you're doing a unit test.
+                    You probably shouldn't touch this.
+    Returns:
+        fworks  A list of the `fireworks.Firework` objects that we submitted
+    '''
+    # Make all of the atoms objects first
+    requirements = [task.requires() for task in tasks]
+    requirements = [requirement for requirement in requirements if requirement]
+    if len(requirements) > 0:
+        schedule_tasks(requirements, local_scheduler=local_scheduler)
+
+    fworks = []
+    for i in range(0, len(tasks), batch_size):
+        batch = []
+        for task in tasks[i:i+batch_size]:
+            # One bad task (e.g., a bulk that is too big or one whose
+            # requirements are still running) should not stop the rest of them
+            try:
+                batch.append((task, task.create_firework()))
+            except (ValueError, RuntimeError, FileNotFoundError) as error:
+                warnings.warn('Could not make a FireWork for %s:  %s' % (task, error),
+                              RuntimeWarning)
+        submit_fworks([fwork for _, fwork in batch], _testing=_testing)
+
+        # Let Luigi know that we've made the FireWorks
+        for task, fwork in batch:
+            task._complete = True
+            fworks.append(fwork)
+    return fworks
+
+
 class FireworkMaker(luigi.Task):
     _complete = False
 
@@ -39,6 +90,24 @@ class FireworkMaker(luigi.Task):
         '''
         return self._complete
 
+    def run(self, _testing=False):
+        '''
+        Make and submit the FireWork that this task defines. Each child class
+        needs a `create_firework` method that returns an instance of a
+        `fireworks.Firework`.
+
+        Do not use `_testing=True` unless you are unit testing.
+        '''
+        fwork = self.create_firework()
+        _ = submit_fwork(fwork=fwork, _testing=_testing)    # noqa: F841
+
+        # Let Luigi know that we've made the FireWork
+        self._complete = True
+
+        # Pass out the firework for testing, if necessary
+        if _testing is True:
+            return fwork
+
 
 class MakeGasFW(FireworkMaker):
     '''
@@ -54,8 +123,7 @@ class MakeGasFW(FireworkMaker):
     def requires(self):
         return GenerateGas(gas_name=self.gas_name)
 
-    def run(self, _testing=False):
-        ''' Do not use `_test=True` unless you are unit testing '''
+    def create_firework(self):
         # Parse the input atoms object
         with open(self.input().path, 'rb') as file_handle:
             doc = pickle.load(file_handle)
@@ -69,14 +137,7 @@ class MakeGasFW(FireworkMaker):
         fwork = make_firework(atoms=atoms,
                               fw_name=fw_name,
                               vasp_settings=vasp_settings)
-        _ = submit_fwork(fwork=fwork, _testing=_testing)    # noqa: F841
-
-        # Let Luigi know that we've made the FireWork
-        self._complete = True
-
-        # Pass out the firework for testing, if necessary
-        if _testing is True:
-            return fwork
+        return fwork
 
 
 class MakeBulkFW(FireworkMaker):
@@ -94,8 +155,7 @@ class MakeBulkFW(FireworkMaker):
     def requires(self):
         return GenerateBulk(mpid=self.mpid)
 
-    def run(self, _testing=False):
-        ''' Do not use `_test=True` unless you are unit testing '''
+    def create_firework(self):
         # Parse the input atoms object
         with open(self.input().path, 'rb') as file_handle:
             doc = pickle.load(file_handle)
@@ -116,18 +176,10 @@ class MakeBulkFW(FireworkMaker):
         fwork = make_firework(atoms=atoms,
                               fw_name=fw_name,
                               vasp_settings=vasp_settings)
-        _ = submit_fwork(fwork=fwork, _testing=_testing)    # noqa: F841
 
         # Increase the priority because it's a bulk
-        lpad = get_launchpad()
-        lpad.set_priority(fwork.fw_id, 100)
-
-        # Let Luigi know that we've made the FireWork
-        self._complete = True
-
-        # Pass out the firework for testing, if necessary
-        if _testing is True:
-            return fwork
+        fwork.spec['_priority'] = 100
+        return fwork
 
 
 class MakeAdslabFW(FireworkMaker):
@@ -170,13 +222,21 @@ class MakeAdslabFW(FireworkMaker):
                                 as a dictionary.
         bulk_vasp_settings      A dictionary containing the VASP settings of
                                 the relaxed bulk to enumerate slabs from
+        warm_start              A Boolean indicating whether to seed the
+                                adslab with the relaxed bare slab and with the
+                                relaxed adsorbate of the most similar adslab
+                                that we already calculated on this surface.
+                                You can also turn this on for every adslab
+                                with the `fireworks_info.warm_start` field of
+                                your `.gaspyrc.json` file.
     '''
     adsorption_site = luigi.TupleParameter()
     shift = luigi.FloatParameter()
     top = luigi.BoolParameter()
     vasp_settings = luigi.DictParameter(ADSLAB_SETTINGS['vasp'])
+    warm_start = luigi.BoolParameter(False, significant=False)
 
-    # Passed to `GenerateAdslabs`
+    # Passed to `GenerateAdslab`
     adsorbate_name = luigi.Parameter()
     rotation = luigi.DictParameter(ADSLAB_SETTINGS['rotation'])
     mpid = luigi.Parameter()
@@ -187,33 +247,25 @@ class MakeAdslabFW(FireworkMaker):
     bulk_vasp_settings = luigi.DictParameter(BULK_SETTINGS['vasp'])
 
     def requires(self):
-        return GenerateAdslabs(adsorbate_name=self.adsorbate_name,
-                               rotation=self.rotation,
-                               mpid=self.mpid,
-                               miller_indices=self.miller_indices,
-                               min_xy=self.min_xy,
-                               slab_generator_settings=self.slab_generator_settings,
-                               get_slab_settings=self.get_slab_settings,
-                               bulk_vasp_settings=self.bulk_vasp_settings)
-
-    def run(self, _testing=False):
-        ''' Do not use `_testing=True` unless you are unit testing '''
-        # Parse the possible adslab structures and find the one that matches
-        # the site, shift, and top values we're looking for
+        '''
+        We only make the one adslab we want instead of the whole facet. This
+        gives the same document as the matching one from `GenerateAdslabs`.
+        '''
+        return GenerateAdslab(adsorption_site=self.adsorption_site,
+                              shift=self.shift,
+                              top=self.top,
+                              adsorbate_name=self.adsorbate_name,
+                              rotation=self.rotation,
+                              mpid=self.mpid,
+                              miller_indices=self.miller_indices,
+                              min_xy=self.min_xy,
+                              slab_generator_settings=self.slab_generator_settings,
+                              get_slab_settings=self.get_slab_settings,
+                              bulk_vasp_settings=self.bulk_vasp_settings)
+
+    def create_firework(self):
         with open(self.input().path, 'rb') as file_handle:
-            adslab_docs = pickle.load(file_handle)
-        if self.adsorbate_name != '':
-            doc = self._find_matching_adslab_doc(adslab_docs=adslab_docs,
-                                                 adsorption_site=self.adsorption_site,
-                                                 shift=self.shift,
-                                                 top=self.top)
-        # Hacky solution for finding empty slabs, where we don't care about the
-        # site. This is only here because we are still (unfortunately) using
-        # the adslab infrastructure to do slab calculations.
-        else:
-            doc = self._find_matching_adslab_doc_for_slab(adslab_docs=adslab_docs,
-                                                          shift=self.shift,
-                                                          top=self.top)
+            doc = pickle.load(file_handle)
         atoms = make_atoms_from_doc(doc)
 
         # Create, package, and submit the FireWork
@@ -229,76 +281,177 @@ class MakeAdslabFW(FireworkMaker):
                    'top': self.top,
                    'slab_repeat': doc['slab_repeat'],
                    'vasp_settings': vasp_settings}
+
+        # Start from the nearest thing we have already relaxed, and then note
+        # where we got it from
+        optimizer_settings = None
+        ideal_atoms = atoms
+        if self.adsorbate_name != '' and (self.warm_start or _read_warm_start_setting()):
+            atoms, provenance = self._warm_start(atoms, doc['slab_repeat'])
+            if provenance is not None:
+                fw_name['warm_start'] = provenance
+                optimizer_settings = _find_warm_optimizer_settings(atoms, provenance['adslab'])
+
         fwork = make_firework(atoms=atoms,
                               fw_name=fw_name,
-                              vasp_settings=vasp_settings)
-        _ = submit_fwork(fwork=fwork, _testing=_testing)    # noqa: F841
+                              vasp_settings=vasp_settings,
+                              optimizer_settings=optimizer_settings)
 
-        # Let Luigi know that we've made the FireWork
-        self._complete = True
+        # The first image of a warm-started relaxation is the seeded adslab,
+        # so we save the ideal one for the fingerprints and movement filters
+        if 'warm_start' in fw_name:
+            fwork.spec['ideal_configuration'] = encode_atoms_to_trajhex(ideal_atoms)
+        return fwork
 
-        # Pass out the firework for testing, if necessary
-        if _testing is True:
-            return fwork
-
-    @staticmethod
-    def _find_matching_adslab_doc(adslab_docs, adsorption_site, shift, top):
+    def _warm_start(self, adslab, slab_repeat):
         '''
-        This helper function is used to parse through a list of documents
-        created by the `GenerateAdslabs` task, and then find one that has
-        matching values for site, shift, and top. If it doesn't find one, then
-        it'll throw an error.  If there's more than one match, then it will
-        just return the first one without any notification
+        Seed an adslab with the relaxed bare slab of this surface and with the
+        relaxed adsorbate of the most similar adslab on this surface. We
+        leave whatever we cannot find in its ideal, unrelaxed position.
 
         Args:
-            adslab_docs     A list of dictionaryies created by
-                            `GenerateAdslabs`
-            adsorption_site A 3-long sequence of floats indicating the
-                            Cartesian coordinates of the adsorption site
-            shift           A float indicating the shift (i.e., slab
-                            termination)
-            top             A Boolean indicating whether or not the site is on
-                            the top or the bottom of the slab
+            adslab      The `ase.Atoms` object of the adslab we are making
+            slab_repeat A 2-tuple of integers indicating how many times we
+                        repeated the unit slab to make `adslab`
         Returns:
-            doc     The first dictionary within the `adslab_docs` list that has
-            matching site, shift, and top values
+            adslab      The seeded `ase.Atoms` object
+            provenance  A dictionary whose 'slab' and 'adslab' keys are the
+                        FWIDs of the calculations we seeded from (or `None`
+                        for the parts we did not seed), or `None` if we did
+                        not seed anything
         '''
-        for doc in adslab_docs:
-            if np.allclose(doc['adsorption_site'], adsorption_site, atol=0.01):
-                if math.isclose(doc['shift'], shift, abs_tol=0.01):
-                    if doc['top'] == top:
-                        return doc
-
-        raise RuntimeError('You just tried to make an adslab FireWork rocket '
-                           'that we could not enumerate. Try changing the '
-                           'adsorption site, shift, top, or miller.')
-
-    @staticmethod
-    def _find_matching_adslab_doc_for_slab(adslab_docs, shift, top):
+        slab_doc = self._find_relaxed_slab_doc(slab_repeat)
+        adsorption_doc = self._find_similar_adsorption_doc(adslab)
+
+        relaxed_slab = None if slab_doc is None else make_atoms_from_doc(slab_doc)
+        reference_adslabs = None
+        if adsorption_doc is not None:
+            reference_adslabs = (make_atoms_from_doc(adsorption_doc['initial_configuration']),
+                                 make_atoms_from_doc(adsorption_doc))
+        adslab, seeded = warm_start_adslab(adslab, relaxed_slab, reference_adslabs)
+
+        if not any(seeded.values()):
+            return adslab, None
+        provenance = {'slab': slab_doc['fwid'] if seeded['slab'] else None,
+                      'adslab': (adsorption_doc['fwids']['slab+adsorbate']
+                                 if seeded['adsorbate'] else None)}
+        return adslab, provenance
+
+    def _find_relaxed_slab_doc(self, slab_repeat):
         '''
-        This method is nearly identical to the `_find_matching_adslab_doc`
-        method, except it ignores the adsorption site. This is used mainly in
-        case you are trying to make a bare Adslab.
+        Find the newest relaxation of the bare slab that this adslab sits on.
+        We do bare slab relaxations with the adslab infrastructure, so they
+        are the adslab documents with an empty adsorbate.
 
-        Args:
-            adslab_docs     A list of dictionaryies created by
-                            `GenerateAdslabs`
-            shift           A float indicating the shift (i.e., slab
-                            termination)
-            top             A Boolean indicating whether or not the site is on
-                            the top or the bottom of the slab
+        Arg:
+            slab_repeat A 2-tuple of integers indicating how many times we
+                        repeated the unit slab
         Returns:
-            doc     The first dictionary within the `adslab_docs` list that has
-            matching site, shift, and top values
+            doc     The document from our `atoms` collection, or `None` if we
+                    have not relaxed the slab yet
+        '''
+        query = {'fwname.calculation_type': 'slab+adsorbate optimization',
+                 'fwname.adsorbate': '',
+                 'fwname.mpid': self.mpid,
+                 'fwname.miller': self.miller_indices,
+                 'fwname.shift': {'$gte': self.shift - 1e-3, '$lte': self.shift + 1e-3},
+                 'fwname.top': self.top,
+                 'fwname.slab_repeat': slab_repeat}
+        for key, value in self.vasp_settings.items():
+            # We don't care if these VASP settings change
+            if key not in set(['nsw', 'isym', 'symprec', 'lwave', 'lcharg']):
+                query['fwname.vasp_settings.%s' % key] = value
+
+        with get_mongo_collection('atoms') as collection:
+            return collection.find_one(query, sort=[('fwid', -1)])
+
+    def _find_similar_adsorption_doc(self, adslab):
         '''
-        for doc in adslab_docs:
-            if math.isclose(doc['shift'], shift, abs_tol=0.01):
-                if doc['top'] == top:
-                    return doc
+        Find the relaxed adslab on this surface whose initial site looks the
+        most like the site of this adslab. We only consider adslabs with the
+        same adsorbate and rotation, and whose sites had the same coordination
+        as this one. Of those, we prefer ones whose next-nearest coordination
+        and neighbor coordinations also match, then ones whose adsorbates
+        stayed at their sites, and then newer ones.
+
+        Arg:
+            adslab  The `ase.Atoms` object of the unrelaxed adslab
+        Returns:
+            doc     The document from our `adsorption` collection, or `None`
+                    if we have not relaxed any similar adslabs yet
+        '''
+        fingerprint = fingerprint_adslab(adslab)
+        query = {'adsorbate': self.adsorbate_name,
+                 'mpid': self.mpid,
+                 'miller': self.miller_indices,
+                 'shift': {'$gte': self.shift - 1e-3, '$lte': self.shift + 1e-3},
+                 'top': self.top,
+                 'adsorbate_rotation.phi': self.rotation['phi'],
+                 'adsorbate_rotation.theta': self.rotation['theta'],
+                 'adsorbate_rotation.psi': self.rotation['psi'],
+                 'fp_init.coordination': fingerprint['coordination']}
+        projection = {'atoms': 1, 'results': 1,
+                      'initial_configuration': 1, 'fwids': 1,
+                      'fp_init': 1, 'fp_final': 1}
+
+        with get_mongo_collection('adsorption') as collection:
+            docs = list(collection.find(query, projection))
+        if len(docs) == 0:
+            return None
+
+        def similarity(doc):
+            fp_init = doc['fp_init']
+            return (fp_init.get('nextnearestcoordination') == fingerprint['nextnearestcoordination'],
+                    sorted(fp_init.get('neighborcoord', [])) == sorted(fingerprint['neighborcoord']),
+                    doc['fp_final'].get('coordination') == fp_init['coordination'],
+                    doc['fwids']['slab+adsorbate'])
+        return max(docs, key=similarity)
+
+
+
+def _find_warm_optimizer_settings(atoms, fwid):
+    '''
+    If ASE will relax an adslab (i.e., it has constraints that VASP cannot
+    handle, such as Hookean ones), then we start its optimizer from where the
+    optimizer of a similar adslab finished.
 
-        raise RuntimeError('You just tried to make an adslab FireWork rocket '
-                           'that we could not enumerate. Try changing the '
-                           'shift, top, or miller.')
+    Args:
+        atoms   The `ase.Atoms` object that we are about to relax
+        fwid    The FWID of the adslab that we seeded the adsorbate from, or
+                `None` if we did not seed it
+    Returns:
+        optimizer_settings  A dictionary for `make_firework`, or `None` if we
+                            should use the default settings
+    '''
+    if fwid is None:
+        return None
+    if all(constraint.todict()['name'] == 'FixAtoms' for constraint in atoms.constraints):
+        return None
+
+    # We only pass along where the state is. The rocket fetches it (and
+    # ignores it if it came from a different kind of optimizer), so that we
+    # do not copy a whole Hessian into every FireWork.
+    reference = get_optimizer_state_reference_from_fwid(fwid)
+    if not isinstance(reference, dict):
+        return None
+    optimizer_settings = _get_optimizer_settings()
+    optimizer_settings['state'] = reference
+    return optimizer_settings
+
+
+def _read_warm_start_setting():
+    '''
+    Read the optional `fireworks_info.warm_start` key of the `.gaspyrc.json`
+    file, which turns on warm starts for every `MakeAdslabFW` task.
+
+    Returns:
+        warm_start  A Boolean. It is `False` if the user did not specify
+                    anything.
+    '''
+    try:
+        return bool(read_rc('fireworks_info.warm_start'))
+    except KeyError:
+        return False
 
 
 class MakeSurfaceFW(FireworkMaker):
@@ -325,8 +478,7 @@ class MakeSurfaceFW(FireworkMaker):
     shift = luigi.FloatParameter()
     vasp_settings = luigi.DictParameter(SLAB_SETTINGS['vasp'])
 
-    def run(self, _testing=False):
-        ''' Do not use `_testing=True` unless you are unit testing '''
+    def create_firework(self):
         # Create, package, and submit the FireWork
         atoms = make_atoms_from_doc(unfreeze_dict(self.atoms_doc))
         vasp_settings = unfreeze_dict(self.vasp_settings)
@@ -339,11 +491,4 @@ class MakeSurfaceFW(FireworkMaker):
         fwork = make_firework(atoms=atoms,
                               fw_name=fw_name,
                               vasp_settings=vasp_settings)
-        _ = submit_fwork(fwork=fwork, _testing=_testing)    # noqa: F841
-
-        # Let Luigi know that we've made the FireWork
-        self._complete = True
-
-        # Pass out the firework for testing, if necessary
-        if _testing is True:
-            return fwork
+        return fwork
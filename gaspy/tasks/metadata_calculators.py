@@ -9,17 +9,16 @@ import sys
 import pickle
 import numpy as np
 import luigi
-import statsmodels.api as statsmodels
-from pymatgen.io.ase import AseAtomsAdaptor
-from pymatgen.symmetry.analyzer import SpacegroupAnalyzer
-from pymatgen.core.surface import SlabGenerator
 from .core import save_task_output, make_task_output_object, get_task_output
-from .calculation_finders import FindBulk, FindGas, FindAdslab, FindSurface
+from .calculation_finders import (FindBulk,
+                                  FindGas,
+                                  FindAdslab,
+                                  FindSurface,
+                                  get_calculation_docs)
 from ..mongo import make_atoms_from_doc
 from .. import utils
 from .. import defaults
 
-GASDB_PATH = utils.read_rc('gasdb_path')
 GAS_SETTINGS = defaults.gas_settings()
 BULK_SETTINGS = defaults.bulk_settings()
 SE_BULK_SETTINGS = defaults.surface_energy_bulk_settings()
@@ -142,6 +141,155 @@ class CalculateAdsorptionEnergy(luigi.Task):
         return make_task_output_object(self)
 
 
+class CalculateAdsorptionEnergies(luigi.Task):
+    '''
+    This task will calculate the adsorption energies of many sites on one
+    surface. It gives the same results as one `CalculateAdsorptionEnergy` task
+    per site, but it finds the bare slab and the adsorbate energy only once,
+    and it looks up the adslab relaxations of all the sites together instead
+    of going through one Luigi task (and pickle) per site. If we cannot find
+    some of the adslabs, then we let their `FindAdslab` tasks find or start
+    them.
+
+    Args:
+        adsorption_sites        A sequence of 3-tuples of floats containing
+                                the Cartesian coordinates of the adsorption
+                                sites you want the energies of
+        shift                   A float indicating the shift of the slab
+        top                     A Boolean indicating whether the adsorption
+                                sites are on the top or the bottom of the slab
+        adsorbate_name          A string indicating which adsorbate to use. It
+                                should be one of the keys within the
+                                `gaspy.defaults.adsorbates` dictionary.
+        rotation                A dictionary containing the angles (in degrees)
+                                in which to rotate the adsorbate after it is
+                                placed at the adsorption site. The keys for
+                                each of the angles are 'phi', 'theta', and
+                                psi'.
+        mpid                    A string indicating the Materials Project ID of
+                                the bulk you want to enumerate sites from
+        miller_indices          A 3-tuple containing the three Miller indices
+                                of the slab[s] you want to enumerate sites from
+        min_xy                  A float indicating the minimum width (in both
+                                the x and y directions) of the slab (Angstroms)
+                                before we enumerate adsorption sites on it.
+        slab_generator_settings We use pymatgen's `SlabGenerator` class to
+                                enumerate surfaces. You can feed the arguments
+                                for that class here as a dictionary.
+        get_slab_settings       We use the `get_slabs` method of pymatgen's
+                                `SlabGenerator` class. You can feed the
+                                arguments for the `get_slabs` method here
+                                as a dictionary.
+        gas_vasp_settings       A dictionary containing the VASP settings of
+                                the gas relaxation of the adsorbate
+        bulk_vasp_settings      A dictionary containing the VASP settings of
+                                the relaxed bulk to enumerate slabs from
+        adslab_vasp_settings    A dictionary containing your VASP settings
+                                for the adslab relaxation
+    Returns:
+        docs    A list with one dictionary per site, in the same order as
+                `adsorption_sites`. Each one is what `CalculateAdsorptionEnergy`
+                would give for that site.
+    '''
+    adsorption_sites = luigi.ListParameter()
+    shift = luigi.FloatParameter()
+    top = luigi.BoolParameter()
+    adsorbate_name = luigi.Parameter()
+    rotation = luigi.DictParameter(ADSLAB_SETTINGS['rotation'])
+    mpid = luigi.Parameter()
+    miller_indices = luigi.TupleParameter()
+    min_xy = luigi.FloatParameter(ADSLAB_SETTINGS['min_xy'])
+    slab_generator_settings = luigi.DictParameter(SLAB_SETTINGS['slab_generator_settings'])
+    get_slab_settings = luigi.DictParameter(SLAB_SETTINGS['get_slab_settings'])
+    gas_vasp_settings = luigi.DictParameter(GAS_SETTINGS['vasp'])
+    bulk_vasp_settings = luigi.DictParameter(BULK_SETTINGS['vasp'])
+    adslab_vasp_settings = luigi.DictParameter(ADSLAB_SETTINGS['vasp'])
+
+    def requires(self):
+        return {'adsorbate_energy': CalculateAdsorbateEnergy(self.adsorbate_name,
+                                                             self.gas_vasp_settings),
+                'bare_slab_doc': self._make_adslab_finder(adsorption_site=(0., 0., 0.),
+                                                          adsorbate_name='',
+                                                          rotation={'phi': 0., 'theta': 0., 'psi': 0.})}
+
+    def _make_adslab_finder(self, adsorption_site, adsorbate_name, rotation):
+        ''' Makes a `FindAdslab` task on this task's surface '''
+        return FindAdslab(adsorption_site=tuple(adsorption_site),
+                          shift=self.shift,
+                          top=self.top,
+                          vasp_settings=self.adslab_vasp_settings,
+                          adsorbate_name=adsorbate_name,
+                          rotation=rotation,
+                          mpid=self.mpid,
+                          miller_indices=self.miller_indices,
+                          min_xy=self.min_xy,
+                          slab_generator_settings=self.slab_generator_settings,
+                          get_slab_settings=self.get_slab_settings,
+                          bulk_vasp_settings=self.bulk_vasp_settings)
+
+    def run(self):
+        with open(self.input()['adsorbate_energy'].path, 'rb') as file_handle:
+            ads_energy = pickle.load(file_handle)
+
+        with open(self.input()['bare_slab_doc'].path, 'rb') as file_handle:
+            slab_doc = pickle.load(file_handle)
+        slab_atoms = make_atoms_from_doc(slab_doc)
+        slab_energy = slab_atoms.get_potential_energy(apply_constraint=False)
+
+        # Look up all of the adslabs at once, and then let Luigi handle the
+        # ones that we could not find
+        finders = [self._make_adslab_finder(adsorption_site=site,
+                                            adsorbate_name=self.adsorbate_name,
+                                            rotation=self.rotation)
+                   for site in self.adsorption_sites]
+        adslab_docs = get_calculation_docs(finders)
+        missing_indices = [i for i, doc in enumerate(adslab_docs) if not doc]
+        if len(missing_indices) > 0:
+            yield [finders[i] for i in missing_indices]
+            for i in missing_indices:
+                adslab_docs[i] = get_task_output(finders[i])
+
+        # The adslab documents' energies are the same ones that their atoms
+        # objects would give us, so we skip making the atoms objects
+        adslab_energies = np.array([doc['results']['energy'] for doc in adslab_docs], dtype=float)
+        adsorption_energies = adslab_energies - slab_energy - ads_energy
+        docs = [{'adsorption_energy': float(adsorption_energy),
+                 'fwids': {'adslab': adslab_doc['fwid'],
+                           'slab': slab_doc['fwid']}}
+                for adsorption_energy, adslab_doc in zip(adsorption_energies, adslab_docs)]
+        save_task_output(self, docs)
+
+    def output(self):
+        return make_task_output_object(self)
+
+
+def group_adsorption_energy_tasks(tasks):
+    '''
+    Turn many `CalculateAdsorptionEnergy` tasks into as few
+    `CalculateAdsorptionEnergies` tasks as we can, i.e., one per surface,
+    adsorbate, and set of settings.
+
+    Arg:
+        tasks   An iterable of `CalculateAdsorptionEnergy` instances
+    Returns:
+        batched_tasks   A list of `CalculateAdsorptionEnergies` instances. Each
+                        site shows up only once, and the sites keep the order
+                        in which they first appeared in `tasks`.
+    '''
+    sites_by_surface = {}
+    for task in tasks:
+        kwargs = task.param_kwargs.copy()
+        site = tuple(kwargs.pop('adsorption_site'))
+        surface = tuple(sorted(kwargs.items()))
+        sites = sites_by_surface.setdefault(surface, [])
+        if site not in sites:
+            sites.append(site)
+
+    batched_tasks = [CalculateAdsorptionEnergies(adsorption_sites=sites, **dict(surface))
+                     for surface, sites in sites_by_surface.items()]
+    return batched_tasks
+
+
 class CalculateAdsorbateEnergy(luigi.Task):
     '''
     This task will calculate the energy of an adsorbate via algebraic
@@ -219,16 +367,32 @@ class CalculateAdsorbateBasisEnergies(luigi.Task):
             gas_energies[adsorbate_name] = atoms.get_potential_energy(apply_constraint=False)
 
         # Calculate and save the basis energies from the gas phase energies
-        basis_energies = {'H': gas_energies['H2']/2.,
-                          'O': gas_energies['H2O'] - gas_energies['H2'],
-                          'C': gas_energies['CO'] - (gas_energies['H2O']-gas_energies['H2']),
-                          'N': gas_energies['N2']/2.}
+        basis_energies = calculate_adsorbate_basis_energies(gas_energies)
         save_task_output(self, basis_energies)
 
     def output(self):
         return make_task_output_object(self)
 
 
+def calculate_adsorbate_basis_energies(gas_energies):
+    '''
+    Calculate the basis energies that `CalculateAdsorbateBasisEnergies` uses
+
+    Arg:
+        gas_energies    A dictionary whose keys are 'CO', 'H2', 'H2O', and 'N2'
+                        and whose values are their respective DFT energies
+    Returns:
+        basis_energies  A dictionary whose keys are the basis elements and
+                        whose values are their respective energies, e.g.,
+                        {'H': foo, 'O': bar}
+    '''
+    basis_energies = {'H': gas_energies['H2']/2.,
+                      'O': gas_energies['H2O'] - gas_energies['H2'],
+                      'C': gas_energies['CO'] - (gas_energies['H2O']-gas_energies['H2']),
+                      'N': gas_energies['N2']/2.}
+    return basis_energies
+
+
 class CalculateSurfaceEnergy(luigi.Task):
     '''
     Calculate the surface energy of a slab
@@ -347,6 +511,9 @@ class CalculateSurfaceEnergy(luigi.Task):
         # Luigi will probably call this method multiple times. We only need to
         # do it once though.
         if not hasattr(self, 'unit_slab_height'):
+            from pymatgen.io.ase import AseAtomsAdaptor
+            from pymatgen.symmetry.analyzer import SpacegroupAnalyzer
+            from pymatgen.core.surface import SlabGenerator
 
             # Delete some slab generator settings that we don't care about for a
             # unit slab
@@ -456,6 +623,8 @@ class CalculateSurfaceEnergy(luigi.Task):
                                             on the surface energy
                                             (eV/Angstrom**2)
         '''
+        import statsmodels.api as statsmodels
+
         # Load each surface
         atoms_list = [make_atoms_from_doc(doc) for doc in docs]
 
@@ -24,6 +24,7 @@ from ..atoms_operators import (make_slabs_from_bulk_atoms,
                                remove_adsorbate,
                                calculate_unit_slab_height,
                                find_max_movement,
+                               warm_start_adslab,
                                get_stoich_from_mpid)
 
 # Things we need to do the tests
@@ -36,6 +37,8 @@ import pickle
 import numpy as np
 import numpy.testing as npt
 import ase.io
+from ase import Atoms
+from ase.build import fcc111
 from pymatgen.io.ase import AseAtomsAdaptor
 from pymatgen.symmetry.analyzer import SpacegroupAnalyzer
 from pymatgen.core.surface import get_symmetrically_distinct_miller_indices
@@ -547,6 +550,68 @@ def test_find_max_movement():
     assert isinstance(max_movement, float)
 
 
+def _make_warm_start_adslab(slab, x_offset=0.):
+    ''' Puts a tagged CO molecule on top of the last atom of a slab '''
+    adsorbate = Atoms('CO', positions=[[0., 0., 0.], [0., 0., 1.15]], tags=[1, 1])
+    adsorbate.positions += slab.positions[-1] + [x_offset, 0., 2.]
+    adslab = adsorbate + slab
+    adslab.cell = slab.cell
+    adslab.pbc = slab.pbc
+    return constrain_slab(adslab)
+
+
+def test_warm_start_adslab():
+    slab = fcc111('Cu', size=(2, 2, 3), vacuum=10.)
+    slab.set_tags(0)
+    adslab = _make_warm_start_adslab(slab)
+
+    # Make a relaxed slab with an atom that wrapped around the cell
+    relaxed_slab = slab.copy()
+    relaxed_slab.positions[-4:, 2] -= 0.1
+    relaxed_slab.positions[-1] += relaxed_slab.cell[0]
+
+    # Make a reference adslab at a different site whose adsorbate tilted
+    reference_init = _make_warm_start_adslab(slab, x_offset=1.)
+    reference_final = reference_init.copy()
+    reference_final.positions[0] += [0., 0., -0.1]
+    reference_final.positions[1] += [0.3, 0., 0.]
+
+    seeded_adslab, seeded = warm_start_adslab(adslab, relaxed_slab,
+                                              (reference_init, reference_final))
+    assert seeded == {'slab': True, 'adsorbate': True}
+    npt.assert_allclose(seeded_adslab.positions[2:-4], adslab.positions[2:-4])
+    npt.assert_allclose(seeded_adslab.positions[-4:] - adslab.positions[-4:],
+                        [[0., 0., -0.1]] * 4, atol=1e-8)
+    npt.assert_allclose(seeded_adslab.positions[:2] - adslab.positions[:2],
+                        [[0., 0., -0.1], [0.3, 0., 0.]], atol=1e-8)
+    assert seeded_adslab.get_chemical_symbols() == adslab.get_chemical_symbols()
+    npt.assert_array_equal(seeded_adslab.get_tags(), adslab.get_tags())
+    assert len(seeded_adslab.constraints) == len(adslab.constraints)
+    # Make sure we did not touch the original
+    npt.assert_allclose(adslab.positions, _make_warm_start_adslab(slab).positions)
+
+
+def test_warm_start_adslab_mismatches():
+    slab = fcc111('Cu', size=(2, 2, 3), vacuum=10.)
+    slab.set_tags(0)
+    adslab = _make_warm_start_adslab(slab)
+
+    # Nothing to start from
+    seeded_adslab, seeded = warm_start_adslab(adslab)
+    assert seeded == {'slab': False, 'adsorbate': False}
+    npt.assert_allclose(seeded_adslab.positions, adslab.positions)
+
+    # A slab with different atoms
+    relaxed_slab = fcc111('Cu', size=(2, 2, 4), vacuum=10.)
+    assert warm_start_adslab(adslab, relaxed_slab)[1]['slab'] is False
+
+    # A reference whose adsorbate would end up inside of the slab
+    reference_init = _make_warm_start_adslab(slab)
+    reference_final = reference_init.copy()
+    reference_final.positions[:2, 2] -= 2.
+    assert warm_start_adslab(adslab, None, (reference_init, reference_final))[1]['adsorbate'] is False
+
+
 def test_get_stoich_from_mpid():
     '''
     Test out three different MPIDs whose stoichiometries we looked up manually
@@ -0,0 +1 @@
+''' This script is intetionally blank '''
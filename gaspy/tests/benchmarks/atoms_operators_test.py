@@ -0,0 +1,118 @@
+''' Benchmarks for the `atoms_operators` submodule '''
+
+__author__ = 'Kevin Tran'
+__email__ = 'ktran@andrew.cmu.edu'
+
+# Modify the python path so that we find/use the .gaspyrc.json in the testing
+# folder instead of the main folder
+import os
+os.environ['PYTHONPATH'] = '/home/GASpy/gaspy/tests:' + os.environ['PYTHONPATH']
+
+# Things we're benchmarking
+from ...atoms_operators import (make_slabs_from_bulk_atoms,
+                                constrain_slab,
+                                find_adsorption_sites,
+                                find_surface_atoms_indices,
+                                find_adsorption_vector,
+                                fingerprint_adslab,
+                                remove_adsorbate)
+
+# Things we need to do the benchmarks
+import pytest
+import pickle
+from .. import test_cases
+from ... import defaults
+
+TESTS_LOCATION = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+REGRESSION_BASELINES_LOCATION = os.path.join(TESTS_LOCATION, 'regression_baselines',
+                                             'atoms_operators', '')
+TEST_CASE_LOCATION = os.path.join(TESTS_LOCATION, 'test_cases', '')
+SLAB_NAMES = sorted(os.listdir(TEST_CASE_LOCATION + 'slabs/'))
+ADSLAB_NAMES = sorted(os.listdir(TEST_CASE_LOCATION + 'adslabs/'))
+BULK_NAMES = sorted(os.listdir(TEST_CASE_LOCATION + 'bulks/'))
+SLAB_SETTINGS = defaults.slab_settings()
+
+
+def _get_bulk_cn_dict(slab_name):
+    '''
+    Gets the bulk coordination numbers that we cached for one of our test
+    slabs, e.g., 'Cu_211.traj'
+    '''
+    with open(REGRESSION_BASELINES_LOCATION + 'bulk_cn_dicts.pkl', 'rb') as file_handle:
+        bulk_cn_dicts = pickle.load(file_handle)
+    bulk_composition = slab_name.split('.')[0].split('_')[0]
+    return bulk_cn_dicts[bulk_composition]
+
+
+@pytest.mark.benchmark(group='make_slabs_from_bulk_atoms')
+@pytest.mark.parametrize('bulk_name', BULK_NAMES)
+@pytest.mark.parametrize('miller_indices', [(1, 1, 1), (2, 1, 1)])
+def test_make_slabs_from_bulk_atoms(benchmark, bulk_name, miller_indices):
+    atoms = test_cases.get_bulk_atoms(bulk_name)
+    slabs = benchmark(make_slabs_from_bulk_atoms, atoms, miller_indices,
+                      SLAB_SETTINGS['slab_generator_settings'],
+                      SLAB_SETTINGS['get_slab_settings'])
+    assert len(slabs) > 0
+
+
+@pytest.mark.benchmark(group='constrain_slab')
+@pytest.mark.parametrize('slab_name', SLAB_NAMES)
+def test_constrain_slab(benchmark, slab_name):
+    atoms = test_cases.get_slab_atoms(slab_name)
+    atoms_constrained = benchmark(constrain_slab, atoms)
+    assert len(atoms_constrained.constraints) == len(atoms.constraints) + 1
+
+
+@pytest.mark.benchmark(group='find_adsorption_sites')
+@pytest.mark.parametrize('slab_name', SLAB_NAMES)
+def test_find_adsorption_sites(benchmark, slab_name):
+    atoms = test_cases.get_slab_atoms(slab_name)
+    sites = benchmark(find_adsorption_sites, atoms)
+    assert len(sites) > 0
+
+
+@pytest.mark.benchmark(group='find_surface_atoms_indices')
+@pytest.mark.parametrize('slab_name', SLAB_NAMES)
+def test_find_surface_atoms_indices(benchmark, slab_name):
+    cn_dict = _get_bulk_cn_dict(slab_name)
+    atoms = test_cases.get_slab_atoms(slab_name)
+    surface_indices = benchmark(find_surface_atoms_indices, cn_dict, atoms)
+    assert len(surface_indices) > 0
+
+
+@pytest.mark.benchmark(group='find_adsorption_vector')
+@pytest.mark.parametrize('slab_name', SLAB_NAMES)
+def test_find_adsorption_vector(benchmark, slab_name):
+    '''
+    We time how long it takes to find the vectors of all of the sites that
+    we cached for each slab, because that is how we use this function.
+    '''
+    cn_dict = _get_bulk_cn_dict(slab_name)
+    atoms = test_cases.get_slab_atoms(slab_name).repeat((2, 2, 1))
+    surface_indices = find_surface_atoms_indices(cn_dict, atoms)
+    sites_and_vectors_file = (REGRESSION_BASELINES_LOCATION + 'adsorption_vectors_list_for_' +
+                              slab_name.split('.')[0] + '.pkl')
+    with open(sites_and_vectors_file, 'rb') as file_handle:
+        sites = [site_and_vector['site'] for site_and_vector in pickle.load(file_handle)]
+
+    def find_adsorption_vectors():
+        return [find_adsorption_vector(cn_dict, atoms, surface_indices, site)
+                for site in sites]
+    vectors = benchmark(find_adsorption_vectors)
+    assert len(vectors) == len(sites)
+
+
+@pytest.mark.benchmark(group='fingerprint_adslab')
+@pytest.mark.parametrize('adslab_name', ADSLAB_NAMES)
+def test_fingerprint_adslab(benchmark, adslab_name):
+    atoms = test_cases.get_adslab_atoms(adslab_name)
+    fingerprint = benchmark(fingerprint_adslab, atoms)
+    assert 'coordination' in fingerprint
+
+
+@pytest.mark.benchmark(group='remove_adsorbate')
+@pytest.mark.parametrize('adslab_name', ADSLAB_NAMES)
+def test_remove_adsorbate(benchmark, adslab_name):
+    adslab = test_cases.get_adslab_atoms(adslab_name)
+    slab, binding_positions = benchmark(remove_adsorbate, adslab)
+    assert len(slab) + sum(adslab.get_tags() != 0) == len(adslab)
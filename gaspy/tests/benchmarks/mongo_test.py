@@ -0,0 +1,43 @@
+''' Benchmarks for the `mongo` submodule '''
+
+__author__ = 'Kevin Tran'
+__email__ = 'ktran@andrew.cmu.edu'
+
+# Things we're benchmarking
+from ...mongo import (make_doc_from_atoms,
+                      make_atoms_from_doc)
+
+# Things we need to do the benchmarks
+import pytest
+import os
+import ase.io
+
+TEST_CASE_LOCATION = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                  os.pardir, 'test_cases', '')
+
+
+def _list_structure_files():
+    '''
+    Lists the bulks, slabs, and adslabs in our test cases, e.g.,
+    'slabs/Cu_211.traj'
+    '''
+    return [folder + file_name
+            for folder in ['bulks/', 'slabs/', 'adslabs/']
+            for file_name in sorted(os.listdir(TEST_CASE_LOCATION + folder))]
+
+
+@pytest.mark.benchmark(group='make_doc_from_atoms')
+@pytest.mark.parametrize('structure_file', _list_structure_files())
+def test_make_doc_from_atoms(benchmark, structure_file):
+    atoms = ase.io.read(TEST_CASE_LOCATION + structure_file)
+    doc = benchmark(make_doc_from_atoms, atoms)
+    assert doc['atoms']['natoms'] == len(atoms)
+
+
+@pytest.mark.benchmark(group='make_atoms_from_doc')
+@pytest.mark.parametrize('structure_file', _list_structure_files())
+def test_make_atoms_from_doc(benchmark, structure_file):
+    atoms = ase.io.read(TEST_CASE_LOCATION + structure_file)
+    doc = make_doc_from_atoms(atoms)
+    new_atoms = benchmark(make_atoms_from_doc, doc)
+    assert new_atoms.get_chemical_symbols() == atoms.get_chemical_symbols()
@@ -13,26 +13,46 @@ os.environ['PYTHONPATH'] = '/home/GASpy/gaspy/tests:' + os.environ['PYTHONPATH']
 # Things we are testing
 from ..fireworks_helper_scripts import (get_launchpad,
                                         find_n_rockets,
+                                        find_n_rockets_in_bulk,
+                                        _add_vasp_settings_to_query,
+                                        _count_rockets,
                                         _get_firework_docs,
                                         __get_n_fizzles,
                                         make_firework,
                                         encode_atoms_to_trajhex,
                                         decode_trajhex_to_atoms,
                                         submit_fwork,
+                                        submit_fworks,
                                         check_jobs_status,
                                         get_atoms_from_fwid,
+                                        get_optimizer_state_from_fwid,
+                                        get_optimizer_state_reference_from_fwid,
                                         get_atoms_from_fw,
+                                        get_images_from_fw,
+                                        _decode_trajhex_to_images,
+                                        read_trajectory_bytes,
+                                        read_trajectories_in_bulk,
+                                        _decompress_bytes,
+                                        fetch_vasp_functions,
                                         __patch_old_atoms_tags)
 
 # Things we need to do the tests
 import pytest
 import warnings
+from datetime import datetime
 import pickle
+import json
+from types import SimpleNamespace
 import getpass
+import zlib
+import hashlib
+import gridfs
 import pandas as pd
 import ase
+import ase.io
 from fireworks import Firework, LaunchPad, FileWriteTask, PyTask, Workflow
 from . import test_cases
+from .. import fireworks_helper_scripts
 from ..utils import read_rc
 from .. import defaults
 
@@ -103,6 +123,54 @@ def test__get_firework_docs():
     assert docs[0]['fw_id'] == query['fw_id']
 
 
+def test__get_firework_docs_with_projection():
+    query = {'fw_id': 353903}
+    projection = {'_id': 0, 'fw_id': 1, 'state': 1}
+    docs = _get_firework_docs(query, _testing=True, projection=projection)
+    assert set(docs[0].keys()) == {'fw_id', 'state'}
+
+
+def test_find_n_rockets_does_not_mutate_query():
+    query = {'fw_id': 353903}
+    find_n_rockets(query, vasp_settings={'encut': 350}, _testing=True)
+    assert query == {'fw_id': 353903}
+
+
+def test_find_n_rockets_in_bulk():
+    '''
+    The bulk version should give us the same answers as the one-by-one version
+    '''
+    queries = [{'fw_id': fwid} for fwid in [353903, 365912, 355429, 369302, 355479]]
+    queries.append({'name.calculation_type': 'unit cell optimization', 'name.mpid': 'mp-30'})
+    vasp_settings_list = [{} for _ in queries]
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        rocket_counts = find_n_rockets_in_bulk(queries, vasp_settings_list, _testing=True)
+        expected_rocket_counts = [find_n_rockets(query, vasp_settings, _testing=True)
+                                  for query, vasp_settings in zip(queries, vasp_settings_list)]
+    assert rocket_counts == expected_rocket_counts
+
+
+def test__add_vasp_settings_to_query():
+    query = {'name.mpid': 'mp-30'}
+    new_query = _add_vasp_settings_to_query(query, {'encut': 350, 'kpts': [4, 4, 1]})
+    assert new_query == {'name.mpid': 'mp-30',
+                         'name.vasp_settings.encut': 350,
+                         'name.vasp_settings.kpts': [4, 4, 1]}
+    assert query == {'name.mpid': 'mp-30'}
+
+
+def test__count_rockets():
+    docs = [{'state': 'COMPLETED', 'fw_id': 0},
+            {'state': 'RUNNING', 'fw_id': 1},
+            {'state': 'DEFUSED', 'fw_id': 2},
+            {'state': 'FIZZLED', 'fw_id': 3}]
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        assert _count_rockets(docs) == (2, 1)
+
+
 def test___warn_about_fizzles():
     with warnings.catch_warnings(record=True) as warning_manager:
         warnings.simplefilter('always')
@@ -169,6 +237,67 @@ def test_make_firework():
         assert 'You are making a firework with' in str(warning_manager[-1].message)
 
 
+def test_make_firework_with_optimizer_settings():
+    ''' If we tell ASE how to relax things, then the rocket should know it, too '''
+    atoms = ase.Atoms('CO')
+    fw_name = {'calculation_type': 'gas phase optimization', 'gasname': 'CO'}
+    vasp_settings = defaults.gas_settings()['vasp']
+    optimizer_settings = {'optimizer': 'BFGS', 'hessian': 'model'}
+    fwork = make_firework(atoms, fw_name, vasp_settings, optimizer_settings)
+    relax = fwork.tasks[-1]
+    assert relax['args'] == ['slab_in.traj', 'slab_relaxed.traj', vasp_settings,
+                             fireworks_helper_scripts._get_trajectory_storage(),
+                             optimizer_settings]
+
+
+def test_make_firework_with_gridfs_payload(monkeypatch, tmpdir):
+    '''
+    If we store `vasp_functions.py` in GridFS, then each FireWork should carry
+    a small loader that points to one stored copy instead of the whole file.
+    '''
+    storage = {'mode': 'gridfs', 'bucket': 'unit_testing_vasp_functions'}
+    real_read_rc = fireworks_helper_scripts.read_rc
+    monkeypatch.setattr(fireworks_helper_scripts, 'read_rc',
+                        lambda key=None: (storage if key == 'fireworks_info.vasp_functions_storage'
+                                          else real_read_rc(key)))
+    lpad = get_launchpad()
+    bucket = gridfs.GridFS(lpad.db, storage['bucket'])
+    try:
+        atoms = ase.Atoms('CO')
+        fw_name = {'calculation_type': 'gas phase optimization', 'gasname': 'CO'}
+        vasp_settings = defaults.gas_settings()['vasp']
+        fwork = make_firework(atoms, fw_name, vasp_settings)
+        fwork_again = make_firework(atoms, fw_name, vasp_settings)
+        pass_vasp_functions = fwork.tasks[0]
+
+        with open('/home/GASpy/gaspy/vasp_functions.py', 'rb') as file_handle:
+            contents = file_handle.read()
+        sha256 = hashlib.sha256(contents).hexdigest()
+        assert isinstance(pass_vasp_functions, PyTask)
+        assert pass_vasp_functions['func'] == 'gaspy.fireworks_helper_scripts.fetch_vasp_functions'
+        assert pass_vasp_functions['args'] == [storage['bucket'], sha256]
+        assert fwork_again.tasks[0]['args'] == pass_vasp_functions['args']
+
+        # We should have stored exactly one copy
+        grid_outs = list(bucket.find({'filename': sha256}))
+        assert len(grid_outs) == 1
+        assert grid_outs[0].read() == contents
+
+        # The rockets should be able to fetch that copy with their own
+        # LaunchPads
+        monkeypatch.setattr(LaunchPad, 'auto_load', staticmethod(get_launchpad))
+        monkeypatch.chdir(tmpdir)
+        fetch_vasp_functions(*pass_vasp_functions['args'])
+        with open('vasp_functions.py', 'rb') as file_handle:
+            assert file_handle.read() == contents
+
+    finally:
+        for grid_out in bucket.find():
+            bucket.delete(grid_out._id)
+        fireworks_helper_scripts._STORED_PAYLOADS.clear()
+        lpad.fireworks.database.client.close()
+
+
 @pytest.mark.parametrize('adslab_atoms_name',
                          ['CO_dissociate_Pt12Si5_110.traj',
                           'CO_top_Cu_211.traj',
@@ -242,6 +371,39 @@ def test_decode_trajhex_to_atoms(adslab_atoms_name):
     assert atoms == expected_atoms
 
 
+@pytest.mark.parametrize('adslab_atoms_name',
+                         ['CO_dissociate_Pt12Si5_110.traj',
+                          'CO_top_Cu_211.traj'])
+def test_trajhex_matches_trajectory_file(adslab_atoms_name):
+    '''
+    We encode in memory now, but the bytes should be exactly the same as if
+    we wrote a trajectory file the old way
+    '''
+    atoms = test_cases.get_adslab_atoms(adslab_atoms_name)
+    file_name = read_rc('temp_directory') + adslab_atoms_name
+    atoms.write(file_name)
+    try:
+        with open(file_name, 'rb') as file_handle:
+            expected_trajhex = file_handle.read().hex()
+    finally:
+        os.remove(file_name)
+
+    assert encode_atoms_to_trajhex(atoms) == expected_trajhex
+
+
+def test_decode_trajhex_to_atoms_index():
+    images = [ase.Atoms('CO', positions=[[0., 0., 0.], [0., 0., z]]) for z in (1., 1.1, 1.2)]
+    file_name = read_rc('temp_directory') + 'images.traj'
+    ase.io.write(file_name, images)
+    with open(file_name, 'rb') as file_handle:
+        trajhex = file_handle.read().hex()
+    os.remove(file_name)
+
+    assert decode_trajhex_to_atoms(trajhex, index=1).positions[1][2] == 1.1
+    assert decode_trajhex_to_atoms(trajhex).positions[1][2] == 1.2
+    assert len(decode_trajhex_to_atoms(trajhex, index=':')) == 3
+
+
 def test_submit_fwork():
     atoms = ase.Atoms('CO')
     fw_name = {'calculation_type': 'gas phase optimization', 'gasname': 'CO'}
@@ -253,6 +415,44 @@ def test_submit_fwork():
     assert wflow.name == 'vasp optimization'
 
 
+def test_submit_fworks():
+    atoms = ase.Atoms('CO')
+    fw_name = {'calculation_type': 'gas phase optimization', 'gasname': 'CO'}
+    vasp_settings = defaults.gas_settings()['vasp']
+    fworks = [make_firework(atoms, fw_name.copy(), vasp_settings) for _ in range(3)]
+    wflows = submit_fworks(fworks, _testing=True)
+    assert len(wflows) == 3
+    for wflow, fwork in zip(wflows, fworks):
+        assert isinstance(wflow, Workflow)
+        assert wflow.name == 'vasp optimization'
+        assert wflow.fws == [fwork]
+
+
+def test_submit_fworks_to_launchpad(monkeypatch):
+    '''
+    We should add the workflows in bulk if the LaunchPad can, and one at a
+    time if it cannot, but never both
+    '''
+    fworks = [Firework([], name={'foo': i}) for i in range(3)]
+    added = []
+
+    def bulk_add_wfs(wflows):
+        added.extend(wflows)
+        raise AttributeError('Something broke in the middle of the insert')
+    lpad = SimpleNamespace(bulk_add_wfs=bulk_add_wfs)
+    monkeypatch.setattr(fireworks_helper_scripts, 'get_launchpad', lambda: lpad)
+    with pytest.raises(AttributeError):
+        submit_fworks(fworks)
+    assert len(added) == 3
+
+    # Older versions of FireWorks
+    added = []
+    lpad = SimpleNamespace(add_wf=added.append)
+    monkeypatch.setattr(fireworks_helper_scripts, 'get_launchpad', lambda: lpad)
+    wflows = submit_fworks(fworks)
+    assert added == wflows
+
+
 @pytest.mark.parametrize('fw_file', FIREWORKS_FILES)
 def test_get_atoms_from_fwid(fw_file):
     fwid = int(fw_file.split('.')[0].split('/')[-1])
@@ -260,6 +460,42 @@ def test_get_atoms_from_fwid(fw_file):
     assert isinstance(atoms, ase.Atoms)
 
 
+@pytest.mark.parametrize('fw_file', FIREWORKS_FILES)
+def test_get_optimizer_state_from_fwid(fw_file):
+    ''' VASP did these relaxations, so there should not be any optimizer states '''
+    fwid = int(fw_file.split('.')[0].split('/')[-1])
+    assert get_optimizer_state_from_fwid(fwid) is None
+
+
+def test_get_optimizer_state_from_fwid_with_state():
+    ''' Make sure we can read what `vasp_functions.runVasp` stores '''
+    optimizer_state = {'optimizer': 'BFGS', 'n_steps': 3, 'hessian': [[70., 0.], [0., 70.]]}
+    stored_state = json.dumps(optimizer_state).encode('utf-8').hex()
+    launch = SimpleNamespace(action=SimpleNamespace(stored_data={
+        'opt_results': ['CO', 'trajhex', -14.8, stored_state]}))
+    lpad = SimpleNamespace(get_fw_by_id=lambda fwid: SimpleNamespace(launches=[launch]))
+    assert get_optimizer_state_from_fwid(1, lpad=lpad) == optimizer_state
+
+
+def test_get_optimizer_state_reference_from_fwid(monkeypatch):
+    ''' We should pass along the reference and close any LaunchPad that we make '''
+    reference = {'storage': 'gridfs', 'bucket': 'trajectories', 'sha256': 'foo', 'size': 1}
+    launch = SimpleNamespace(action=SimpleNamespace(stored_data={
+        'opt_results': ['CO', 'trajhex', -14.8, reference]}))
+    closed = []
+    client = SimpleNamespace(close=lambda: closed.append(True))
+    lpad = SimpleNamespace(get_fw_by_id=lambda fwid: SimpleNamespace(launches=[launch]),
+                           fireworks=SimpleNamespace(database=SimpleNamespace(client=client)))
+    monkeypatch.setattr(fireworks_helper_scripts, 'get_launchpad', lambda: lpad)
+    assert get_optimizer_state_reference_from_fwid(1) == reference
+    assert closed == [True]
+
+    # VASP relaxations do not have states
+    launch.action.stored_data['opt_results'] = ['CO', 'trajhex', -14.8]
+    assert get_optimizer_state_reference_from_fwid(1, lpad=lpad) is None
+    assert closed == [True]
+
+
 @pytest.mark.parametrize('fw_file', FIREWORKS_FILES)
 def test__get_atoms_from_fw(fw_file):
     with open(fw_file, 'rb') as file_handle:
@@ -268,6 +504,66 @@ def test__get_atoms_from_fw(fw_file):
     assert isinstance(atoms, ase.Atoms)
 
 
+@pytest.mark.parametrize('fw_file', FIREWORKS_FILES)
+def test_get_images_from_fw(fw_file):
+    with open(fw_file, 'rb') as file_handle:
+        fw = pickle.load(file_handle)
+    starting_atoms, atoms = get_images_from_fw(fw, indices=(0, -1))
+
+    assert starting_atoms == get_atoms_from_fw(fw, index=0)
+    assert atoms == get_atoms_from_fw(fw, index=-1)
+    assert list(starting_atoms.get_tags()) == list(atoms.get_tags())
+
+
+def test__decode_trajhex_to_images():
+    images = [ase.Atoms('CO', positions=[[0., 0., 0.], [0., 0., z]]) for z in (1., 1.1, 1.2)]
+    file_name = read_rc('temp_directory') + 'images.traj'
+    ase.io.write(file_name, images)
+    with open(file_name, 'rb') as file_handle:
+        hex_ = file_handle.read().hex()
+    os.remove(file_name)
+
+    first_image, last_image = _decode_trajhex_to_images(hex_, indices=(0, -1))
+    assert first_image.positions[1][2] == 1.
+    assert last_image.positions[1][2] == 1.2
+
+
+def test_read_trajectory_bytes():
+    atoms = ase.Atoms('CO', positions=[[0., 0., 0.], [0., 0., 1.2]])
+    trajhex = encode_atoms_to_trajhex(atoms)
+    traj_bytes = bytes.fromhex(trajhex)
+
+    # Legacy hex strings and already-decoded bytes
+    assert read_trajectory_bytes(trajhex) == traj_bytes
+    assert read_trajectory_bytes(traj_bytes) == traj_bytes
+
+    # References to GridFS
+    lpad = get_launchpad()
+    bucket = gridfs.GridFS(lpad.db, 'unit_testing_trajectories')
+    sha256 = hashlib.sha256(traj_bytes).hexdigest()
+    file_id = bucket.put(zlib.compress(traj_bytes), filename=sha256,
+                         metadata={'compression': 'zlib', 'size': len(traj_bytes)})
+    try:
+        reference = {'storage': 'gridfs', 'bucket': 'unit_testing_trajectories',
+                     'sha256': sha256, 'size': len(traj_bytes)}
+        assert read_trajectory_bytes(reference, lpad=lpad) == traj_bytes
+        assert read_trajectories_in_bulk([reference], lpad=lpad) == {sha256: traj_bytes}
+
+        # Missing trajectories
+        with pytest.raises(FileNotFoundError):
+            read_trajectory_bytes(dict(reference, sha256='foo'), lpad=lpad)
+        assert read_trajectories_in_bulk([dict(reference, sha256='foo')], lpad=lpad) == {}
+    finally:
+        bucket.delete(file_id)
+
+
+def test__decompress_bytes():
+    raw_bytes = b'foo' * 100
+    assert _decompress_bytes(zlib.compress(raw_bytes), 'zlib') == raw_bytes
+    with pytest.raises(ValueError):
+        _decompress_bytes(raw_bytes, 'bar')
+
+
 @pytest.mark.parametrize('fw_file', FIREWORKS_FILES)
 def test___patch_old_atoms(fw_file):
     with open(fw_file, 'rb') as file_handle:
@@ -300,3 +596,32 @@ def test_check_jobs_user(user, n_jobs):
     assert isinstance(dataframe, pd.DataFrame)
     assert user == dataframe['user'].unique()
     assert n_jobs == len(dataframe.index)
+    # The newest jobs should come first
+    assert list(dataframe['fwid']) == sorted(dataframe['fwid'], reverse=True)
+
+
+def test_check_jobs_status_filters():
+    user = 'zulissi'
+    states = ['COMPLETED']
+    calculation_types = ['slab+adsorbate optimization']
+    start_date = datetime(2018, 1, 1)
+    end_date = datetime(2019, 1, 1)
+    dataframe = check_jobs_status(user, 10, states=states,
+                                  calculation_types=calculation_types,
+                                  start_date=start_date, end_date=end_date,
+                                  chunk_size=3)
+
+    assert len(dataframe.index) == 10
+    assert set(dataframe['state']) == set(states)
+    assert set(dataframe['calculation_type']) == set(calculation_types)
+    # Completed jobs should always have a launch directory
+    assert all(dataframe['launch_dir'] != '')
+
+    # Make sure the date filters are applied
+    lpad = get_launchpad()
+    try:
+        for fwid in dataframe['fwid']:
+            doc = lpad.fireworks.find_one({'fw_id': int(fwid)}, {'created_on': 1})
+            assert start_date.isoformat() <= doc['created_on'] < end_date.isoformat()
+    finally:
+        lpad.fireworks.database.client.close()
@@ -15,6 +15,7 @@ import os
 os.environ['PYTHONPATH'] = '/home/GASpy/gaspy/tests:' + os.environ['PYTHONPATH']
 
 # Things we're testing
+from .. import gasdb
 from ..gasdb import (get_mongo_collection,
                      ConnectableCollection,
                      get_adsorption_docs,
@@ -24,6 +25,11 @@ from ..gasdb import (get_mongo_collection,
                      get_catalog_docs_with_predictions,
                      _add_adsorption_energy_predictions_to_projection,
                      _add_orr_predictions_to_projection,
+                     get_latest_predictions,
+                     get_prediction_history,
+                     write_predictions,
+                     migrate_catalog_predictions,
+                     _unnest_catalog_predictions,
                      get_surface_docs,
                      get_unsimulated_catalog_docs,
                      _get_attempted_adsorption_docs,
@@ -43,7 +49,7 @@ import copy
 import pickle
 import random
 import hashlib
-from datetime import datetime
+from datetime import datetime, timedelta
 from bson.objectid import ObjectId
 from pymongo import MongoClient
 from pymongo.collection import Collection
@@ -239,6 +245,32 @@ def test__pull_catalog_from_mongo():
                     raise
 
 
+@pytest.fixture
+def prediction_collections():
+    '''
+    Empties the unit testing prediction collections before and after a test so
+    that the tests do not depend on each other
+    '''
+    def empty_prediction_collections():
+        for collection_tag in ['predictions', 'latest_predictions']:
+            with get_mongo_collection(collection_tag) as collection:
+                collection.delete_many({})
+
+    empty_prediction_collections()
+    yield
+    empty_prediction_collections()
+
+
+@pytest.fixture
+def catalog_predictions(prediction_collections):
+    '''
+    Our unit testing catalog stores its predictions the old way, so we copy
+    them into the unit testing prediction collections first
+    '''
+    migrate_catalog_predictions()
+
+
+@pytest.mark.usefixtures('catalog_predictions')
 @pytest.mark.parametrize('latest_predictions', [True, False])
 def test_get_catalog_docs_with_predictions(latest_predictions):
     docs = get_catalog_docs_with_predictions(latest_predictions=latest_predictions)
@@ -256,6 +288,93 @@ def test_get_catalog_docs_with_predictions(latest_predictions):
             assert isinstance(orr_prediction[1], float)
 
 
+@pytest.mark.usefixtures('catalog_predictions')
+@pytest.mark.parametrize('latest_predictions', [True, False])
+def test_get_catalog_docs_with_predictions_from_catalog(monkeypatch, latest_predictions):
+    '''
+    The predictions collections should give us the same predictions as the
+    ones stored inside the catalog
+    '''
+    docs = get_catalog_docs_with_predictions(latest_predictions=latest_predictions)
+    monkeypatch.setattr(gasdb, '_use_predictions_collection', lambda: False)
+    expected_docs = get_catalog_docs_with_predictions(latest_predictions=latest_predictions)
+
+    predictions_by_site = {doc['mongo_id']: doc['predictions'] for doc in docs}
+    assert len(expected_docs) > 0
+    for expected_doc in expected_docs:
+        assert predictions_by_site[expected_doc['mongo_id']] == expected_doc['predictions']
+
+
+def test_write_predictions():
+    site_ids = [doc['mongo_id'] for doc in get_catalog_docs()[:2]]
+    model_tag = 'unit_testing_model'
+    now = datetime.utcnow().replace(microsecond=0)
+    try:
+        assert write_predictions(site_ids, [1., 2.], 'adsorption_energy', model_tag,
+                                 adsorbate='CO', timestamp=now) == 2
+        # Older predictions should go into the history but not replace the
+        # latest ones, and writing the same thing twice should do nothing
+        write_predictions(site_ids, [3., 4.], 'adsorption_energy', model_tag,
+                          adsorbate='CO', timestamp=now - timedelta(days=1))
+        write_predictions(site_ids, [1., 2.], 'adsorption_energy', model_tag,
+                          adsorbate='CO', timestamp=now)
+        write_predictions(site_ids[:1], [0.5], 'orr_onset_potential_4e', model_tag)
+
+        latest_predictions = get_latest_predictions('adsorption_energy', model_tag, 'CO')
+        assert {doc['site_id']: doc['value'] for doc in latest_predictions} == dict(zip(site_ids, [1., 2.]))
+        assert all(doc['timestamp'] == now for doc in latest_predictions)
+
+        history = get_prediction_history('adsorption_energy', model_tag, site_ids=site_ids[:1])
+        assert [doc['value'] for doc in history] == [3., 1.]
+
+        orr_predictions = get_latest_predictions('orr_onset_potential_4e', model_tag)
+        assert len(orr_predictions) == 1
+        assert orr_predictions[0]['adsorbate'] is None
+
+        with pytest.raises(ValueError):
+            write_predictions(site_ids, [1.], 'adsorption_energy', model_tag, adsorbate='CO')
+
+    finally:
+        for collection_tag in ['predictions', 'latest_predictions']:
+            with get_mongo_collection(collection_tag) as collection:
+                collection.delete_many({'model': model_tag})
+
+
+@pytest.mark.usefixtures('prediction_collections')
+def test_migrate_catalog_predictions():
+    with get_mongo_collection('catalog') as collection:
+        catalog_docs = list(collection.find({'predictions': {'$exists': True}},
+                                            {'predictions': 1}))
+    n_expected_predictions = sum(len(_unnest_catalog_predictions(doc)) for doc in catalog_docs)
+    n_expected_series = len({tuple(doc[key] for key in gasdb.PREDICTION_SERIES_KEYS)
+                             for catalog_doc in catalog_docs
+                             for doc in _unnest_catalog_predictions(catalog_doc)})
+
+    # Migrating twice should not duplicate anything
+    assert migrate_catalog_predictions() == n_expected_predictions
+    assert migrate_catalog_predictions() == n_expected_predictions
+    with get_mongo_collection('predictions') as collection:
+        assert collection.count_documents({}) == n_expected_predictions
+    with get_mongo_collection('latest_predictions') as collection:
+        assert collection.count_documents({}) == n_expected_series
+
+
+def test__unnest_catalog_predictions():
+    timestamp = datetime(2019, 1, 1)
+    catalog_doc = {'_id': ObjectId(),
+                   'predictions': {'adsorption_energy': {'CO': {'model0': [[timestamp, -1.],
+                                                                           [timestamp + timedelta(days=1), -0.5]]},
+                                                         'H': {'model0': [[timestamp, 0.1]]}},
+                                   'orr_onset_potential_4e': {'model0': [[timestamp, 0.9]]}}}
+    docs = _unnest_catalog_predictions(catalog_doc)
+
+    assert len(docs) == 4
+    assert all(doc['site_id'] == catalog_doc['_id'] for doc in docs)
+    assert {(doc['quantity'], doc['adsorbate'], doc['value']) for doc in docs} == \
+        {('adsorption_energy', 'CO', -1.), ('adsorption_energy', 'CO', -0.5),
+         ('adsorption_energy', 'H', 0.1), ('orr_onset_potential_4e', None, 0.9)}
+
+
 @pytest.mark.parametrize('latest_predictions', [True, False])
 def test__add_adsorption_energy_predictions_to_projections(latest_predictions):
     default_projections = catalog_projection()
@@ -425,6 +544,7 @@ def test__hash_doc(ignore_keys):
     assert string == expected_string
 
 
+@pytest.mark.usefixtures('catalog_predictions')
 @pytest.mark.parametrize('adsorbate, model_tag',
                          [('H', 'model0'),
                           ('CO', 'model0')])
@@ -488,6 +608,7 @@ def test_get_surface_from_doc():
     assert surface == expected_surface
 
 
+@pytest.mark.usefixtures('catalog_predictions')
 @pytest.mark.parametrize('adsorbate, model_tag',
                          [('H', 'model0'),
                           ('CO', 'model0')])
@@ -509,6 +630,25 @@ def test_get_low_coverage_ml_docs(adsorbate, model_tag):
         assert low_cov_energy <= energy
 
 
+@pytest.mark.usefixtures('catalog_predictions')
+@pytest.mark.parametrize('adsorbate, model_tag',
+                         [('H', 'model0'),
+                          ('CO', 'model0')])
+def test_get_low_coverage_ml_docs_from_catalog(monkeypatch, adsorbate, model_tag):
+    '''
+    The predictions collections should give us the same low-coverage energies
+    as the predictions stored inside the catalog
+    '''
+    docs = get_low_coverage_ml_docs(adsorbate, model_tag)
+    monkeypatch.setattr(gasdb, '_use_predictions_collection', lambda: False)
+    expected_docs = get_low_coverage_ml_docs(adsorbate, model_tag)
+
+    energies_by_surface = {get_surface_from_doc(doc): doc['energy'] for doc in docs}
+    assert len(docs) == len(expected_docs)
+    for expected_doc in expected_docs:
+        assert energies_by_surface[get_surface_from_doc(expected_doc)] == pytest.approx(expected_doc['energy'])
+
+
 def test_get_electrochemical_stability():
     # at pH=0, V=0.9
     expected_stabilities = {'mp-126': 0.861,  # Pt
@@ -0,0 +1,78 @@
+''' Tests for how long it takes to import GASpy '''
+
+__author__ = 'Kevin Tran'
+__email__ = 'ktran@andrew.cmu.edu'
+
+# Modify the python path so that we find/use the .gaspyrc.json in the testing
+# folder instead of the main folder
+import os
+os.environ['PYTHONPATH'] = '/home/GASpy/gaspy/tests:' + os.environ['PYTHONPATH']
+
+# Things we need to do the tests
+import sys
+import subprocess
+import pytest
+
+# These packages take a long time to import, so they should only be imported
+# by the functions that actually use them
+HEAVY_PACKAGES = {'luigi', 'pymatgen', 'fireworks', 'statsmodels', 'pandas',
+                  'multiprocess'}
+
+
+def _profile_import(statement):
+    '''
+    Runs an import statement in a fresh interpreter with `python -X
+    importtime` and then parses the report.
+
+    Arg:
+        statement   A string for the import statement to run, e.g., 'import
+                    gaspy.gasdb'
+    Returns:
+        cumulative_times    A dictionary whose keys are the names of every
+                            module that was imported and whose values are the
+                            cumulative import times of each module (seconds)
+        total_time          The total import time of the statement (seconds).
+                            We add up the top-level imports instead of looking
+                            up one module, because modules that get imported
+                            lazily (e.g., inside of functions) show up as
+                            top-level imports of their own.
+    '''
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', statement],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                             env=os.environ.copy(), universal_newlines=True, check=True)
+
+    # Each line looks like "import time:  self [us] | cumulative | imported package",
+    # where nested imports are indented by two more spaces than their parents
+    cumulative_times = {}
+    total_time = 0.
+    for line in process.stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        try:
+            cumulative_time = int(cumulative) / 1e6
+        except ValueError:  # The header line
+            continue
+        cumulative_times[name.strip()] = cumulative_time
+        if not name[1:].startswith(' '):
+            total_time += cumulative_time
+    return cumulative_times, total_time
+
+
+@pytest.mark.parametrize('statement, budget, allowed_packages',
+                         [('import gaspy.gasdb', 3., set()),
+                          ('import gaspy.tasks', 5., {'luigi'}),
+                          ('from gaspy.tasks import schedule_tasks', 5., {'luigi'}),
+                          ('import gaspy.tasks.calculation_finders', 5., {'luigi'})])
+def test_import_time(statement, budget, allowed_packages):
+    cumulative_times, total_time = _profile_import(statement)
+
+    # Make sure none of the heavy hitters snuck in
+    imported_packages = {name.split('.')[0] for name in cumulative_times}
+    heavy_packages = HEAVY_PACKAGES - allowed_packages
+    assert imported_packages.isdisjoint(heavy_packages), \
+        ('Running "%s" also imported %s'
+         % (statement, sorted(imported_packages & heavy_packages)))
+
+    # Make sure we stay within budget
+    assert total_time < budget
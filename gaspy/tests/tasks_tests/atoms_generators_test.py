@@ -14,8 +14,13 @@ from ...tasks.atoms_generators import (GenerateGas,
                                        GenerateSlabs,
                                        GenerateAdsorptionSites,
                                        GenerateAdslabs,
+                                       _GenerateSurfaceData,
+                                       GenerateAdslab,
+                                       make_site_index,
+                                       find_sites_in_index,
                                        GenerateAllSitesFromBulk,
-                                       _EnumerateDistinctFacets)
+                                       _EnumerateDistinctFacets,
+                                       _get_n_processes)
 
 # Things we need to do the tests
 import pytest
@@ -288,6 +293,234 @@ def test_GenerateAdslabs():
         clean_up_tasks()
 
 
+def test_GenerateAdslabs_parallel():
+    '''
+    WARNING:  This test uses `run_task_locally`, which has a chance of
+    actually submitting a FireWork to production. To avoid this, you must try
+    to make an Adslab from a bulk that shows up in the unit_testing_atoms Mongo
+    collection. If you copy/paste this test into somewhere else, make sure
+    that you use `run_task_locally` appropriately.
+
+    Using more processes should give us the exact same documents, and it
+    should not change which pickle we save them to.
+    '''
+    serial_task = GenerateAdslabs(adsorbate_name='OH', mpid='mp-2',
+                                  miller_indices=(1, 0, 0), n_processes=1)
+    parallel_task = GenerateAdslabs(adsorbate_name='OH', mpid='mp-2',
+                                    miller_indices=(1, 0, 0), n_processes=4)
+    assert serial_task.task_id == parallel_task.task_id
+
+    try:
+        run_task_locally(serial_task)
+        serial_docs = get_task_output(serial_task)
+        clean_up_tasks()
+        run_task_locally(parallel_task)
+        parallel_docs = get_task_output(parallel_task)
+
+        assert len(serial_docs) == len(parallel_docs)
+        for serial_doc, parallel_doc in zip(serial_docs, parallel_docs):
+            npt.assert_allclose(parallel_doc['adsorption_site'], serial_doc['adsorption_site'])
+            npt.assert_allclose(parallel_doc['adsorption_vector'], serial_doc['adsorption_vector'])
+            assert parallel_doc['shift'] == serial_doc['shift']
+            assert parallel_doc['top'] == serial_doc['top']
+            npt.assert_allclose(make_atoms_from_doc(parallel_doc).get_positions(),
+                                make_atoms_from_doc(serial_doc).get_positions())
+
+    finally:
+        clean_up_tasks()
+
+
+def test__get_n_processes():
+    assert _get_n_processes(3) == 3
+    assert _get_n_processes(0) == read_rc('task_n_processes')
+
+
+def test__GenerateSurfaceData():
+    '''
+    WARNING:  This test uses `run_task_locally`, which has a chance of
+    actually submitting a FireWork to production. To avoid this, you must try
+    to make an Adslab from a bulk that shows up in the unit_testing_atoms Mongo
+    collection. If you copy/paste this test into somewhere else, make sure
+    that you use `run_task_locally` appropriately.
+    '''
+    mpid = 'mp-2'
+    miller_indices = (1, 0, 0)
+    site_generator = GenerateAdsorptionSites(mpid=mpid, miller_indices=miller_indices)
+    try:
+        run_task_locally(site_generator)
+        site_docs = get_task_output(site_generator)
+        shift = site_docs[0]['shift']
+        top = site_docs[0]['top']
+
+        task = _GenerateSurfaceData(shift=shift, top=top, mpid=mpid,
+                                    miller_indices=miller_indices)
+        run_task_locally(task)
+        doc = get_task_output(task)
+
+        # We should have found the same sites as `GenerateAdsorptionSites`
+        expected_sites = [site_doc['adsorption_site'] for site_doc in site_docs
+                          if site_doc['shift'] == shift and site_doc['top'] == top]
+        npt.assert_allclose(doc['adsorption_sites'], expected_sites)
+        assert doc['slab_repeat'] == site_docs[0]['slab_repeat']
+        assert len(make_atoms_from_doc(doc)) == len(make_atoms_from_doc(site_docs[0])) - 1
+        assert len(doc['surface_atoms_indices']) > 0
+        assert 'Pd' in doc['bulk_cn_dict']
+
+    finally:
+        clean_up_tasks()
+
+
+def test_GenerateAdslab():
+    '''
+    WARNING:  This test uses `run_task_locally`, which has a chance of
+    actually submitting a FireWork to production. To avoid this, you must try
+    to make an Adslab from a bulk that shows up in the unit_testing_atoms Mongo
+    collection. If you copy/paste this test into somewhere else, make sure
+    that you use `run_task_locally` appropriately.
+
+    The single-site task should make the same adslab as the facet-wide one.
+    '''
+    adsorbate_name = 'OH'
+    mpid = 'mp-2'
+    miller_indices = (1, 0, 0)
+    adslabs_task = GenerateAdslabs(adsorbate_name=adsorbate_name, mpid=mpid,
+                                   miller_indices=miller_indices)
+    try:
+        run_task_locally(adslabs_task)
+        expected_doc = get_task_output(adslabs_task)[-1]
+
+        task = GenerateAdslab(adsorption_site=tuple(expected_doc['adsorption_site'] + 0.005),
+                              shift=expected_doc['shift'],
+                              top=expected_doc['top'],
+                              adsorbate_name=adsorbate_name,
+                              mpid=mpid,
+                              miller_indices=miller_indices)
+        run_task_locally(task)
+        doc = get_task_output(task)
+
+        npt.assert_allclose(doc['adsorption_site'], expected_doc['adsorption_site'])
+        npt.assert_allclose(doc['adsorption_vector'], expected_doc['adsorption_vector'])
+        assert doc['slab_repeat'] == expected_doc['slab_repeat']
+        assert doc['fwids'] == expected_doc['fwids']
+        adslab = make_atoms_from_doc(doc)
+        expected_adslab = make_atoms_from_doc(expected_doc)
+        assert adslab.get_chemical_symbols() == expected_adslab.get_chemical_symbols()
+        npt.assert_allclose(adslab.get_positions(), expected_adslab.get_positions())
+
+        # Sites that we would not have enumerated should fail
+        task = GenerateAdslab(adsorption_site=(0., 0., 0.),
+                              shift=expected_doc['shift'],
+                              top=expected_doc['top'],
+                              adsorbate_name=adsorbate_name,
+                              mpid=mpid,
+                              miller_indices=miller_indices)
+        with pytest.raises(RuntimeError):
+            task.run()
+
+    finally:
+        clean_up_tasks()
+
+
+def test_GenerateAdslab_multiple_terminations():
+    '''
+    WARNING:  This test uses `run_task_locally`, which has a chance of
+    actually submitting a FireWork to production. To avoid this, you must try
+    to make an Adslab from a bulk that shows up in the unit_testing_atoms Mongo
+    collection. If you copy/paste this test into somewhere else, make sure
+    that you use `run_task_locally` appropriately.
+
+    Each termination has its own surface atoms, so this makes sure that both
+    tasks align the adsorbates on every termination the same way.
+    '''
+    adsorbate_name = 'OH'
+    mpid = 'mp-1018129'
+    miller_indices = (0, 1, 1)
+    adslabs_task = GenerateAdslabs(adsorbate_name=adsorbate_name, mpid=mpid,
+                                   miller_indices=miller_indices)
+    try:
+        run_task_locally(adslabs_task)
+        expected_docs = {}
+        for doc in get_task_output(adslabs_task):
+            expected_docs.setdefault((doc['shift'], doc['top']), doc)
+        assert len(expected_docs) > 1
+
+        for (shift, top), expected_doc in expected_docs.items():
+            task = GenerateAdslab(adsorption_site=tuple(expected_doc['adsorption_site']),
+                                  shift=shift,
+                                  top=top,
+                                  adsorbate_name=adsorbate_name,
+                                  mpid=mpid,
+                                  miller_indices=miller_indices)
+            run_task_locally(task)
+            doc = get_task_output(task)
+
+            npt.assert_allclose(doc['adsorption_vector'], expected_doc['adsorption_vector'])
+            npt.assert_allclose(make_atoms_from_doc(doc).get_positions(),
+                                make_atoms_from_doc(expected_doc).get_positions())
+
+    finally:
+        clean_up_tasks()
+
+
+def test_GenerateAdslab_known_site():
+    '''
+    WARNING:  This test uses `run_task_locally`, which has a chance of
+    actually submitting a FireWork to production. To avoid this, you must try
+    to make an Adslab from a bulk that shows up in the unit_testing_atoms Mongo
+    collection. If you copy/paste this test into somewhere else, make sure
+    that you use `run_task_locally` appropriately.
+    '''
+    mpid = 'mp-2'
+    miller_indices = (1, 0, 0)
+    adslabs_task = GenerateAdslabs(adsorbate_name='CO', mpid=mpid,
+                                   miller_indices=miller_indices)
+    try:
+        run_task_locally(adslabs_task)
+        # I know what it should find because I did this by hand
+        expected_doc = get_task_output(adslabs_task)[0]
+
+        task = GenerateAdslab(adsorption_site=(1.40646118, 1.40646118, 20.89584646),
+                              shift=0.25,
+                              top=True,
+                              adsorbate_name='CO',
+                              mpid=mpid,
+                              miller_indices=miller_indices)
+        run_task_locally(task)
+        doc = get_task_output(task)
+        npt.assert_allclose(doc['adsorption_site'], expected_doc['adsorption_site'])
+        npt.assert_allclose(make_atoms_from_doc(doc).get_positions(),
+                            make_atoms_from_doc(expected_doc).get_positions())
+
+        # Bare slabs do not care about the site, so even one that we would
+        # not have enumerated should work
+        task = GenerateAdslab(adsorption_site=(0., 0., 0.),
+                              shift=0.25,
+                              top=True,
+                              adsorbate_name='',
+                              mpid=mpid,
+                              miller_indices=miller_indices)
+        run_task_locally(task)
+        doc = get_task_output(task)
+        expected_symbols = make_atoms_from_doc(expected_doc).get_chemical_symbols()
+        assert (sorted(make_atoms_from_doc(doc).get_chemical_symbols()) ==
+                sorted(symbol for symbol in expected_symbols if symbol not in {'C', 'O'}))
+
+    finally:
+        clean_up_tasks()
+
+
+def test_make_site_index():
+    sites = np.random.uniform(0., 10., (100, 3))
+    site_index = make_site_index(sites)
+
+    # Every site that is within tolerance needs to be a candidate
+    for _ in range(1000):
+        i = np.random.randint(len(sites))
+        site = sites[i] + np.random.uniform(-0.01, 0.01, 3)
+        assert i in find_sites_in_index(site_index, site)
+    assert find_sites_in_index(site_index, (-5., -5., -5.)) == []
+
+
 def test_GenerateAllSitesFromBulk():
     '''
     WARNING:  This test uses `run_task_locally`, which has a chance of
@@ -13,7 +13,12 @@ from ...tasks.calculation_finders import (FindCalculation,
                                           FindGas,
                                           FindBulk,
                                           FindAdslab,
-                                          FindSurface)
+                                          FindSurface,
+                                          resolve_calculations,
+                                          BATCH_RESOLUTION_TTL,
+                                          find_calculation_docs,
+                                          get_calculation_docs,
+                                          _get_calculation_finders)
 
 # Things we need to do the tests
 import os
@@ -410,3 +415,88 @@ class TestFindSurface():
 
         finally:
             clean_up_tasks()
+
+
+def test_resolve_calculations(monkeypatch):
+    '''
+    The batch resolver should find and save the same documents that the
+    individual tasks find, and it should remember the ones it did not find.
+    '''
+    found_task = FindGas(gas_name='H2', vasp_settings=GAS_SETTINGS['vasp'])
+    missing_task = FindGas(gas_name='CHO', vasp_settings=GAS_SETTINGS['vasp'])
+    adslab_task = FindAdslab(adsorption_site=(0., 1.41, 20.52),
+                             shift=0.25,
+                             top=True,
+                             adsorbate_name='CO',
+                             rotation={'phi': 0., 'theta': 0., 'psi': 0.},
+                             mpid='mp-2',
+                             miller_indices=(1, 0, 0),
+                             vasp_settings=ADSLAB_SETTINGS['vasp'])
+
+    try:
+        n_found = resolve_calculations([found_task, missing_task, adslab_task], _testing=True)
+        assert n_found == 2
+        assert missing_task.complete() is False
+        assert len(missing_task._rocket_counts) == 2
+
+        # Luigi reuses task instances, so old misses should not stick
+        monkeypatch.setattr(missing_task, '_find_and_save_calculation', lambda: 'queried')
+        missing_task._batch_miss_time -= BATCH_RESOLUTION_TTL
+        assert missing_task.complete() == 'queried'
+        for task in [found_task, adslab_task]:
+            doc = get_task_output(task)
+            clean_up_tasks()
+            _run_task_with_dynamic_dependencies(task)
+            assert doc == get_task_output(task)
+
+    finally:
+        clean_up_tasks()
+
+
+def test_find_calculation_docs():
+    '''
+    We should find the same documents as the tasks, but without saving them
+    '''
+    found_task = FindGas(gas_name='H2', vasp_settings=GAS_SETTINGS['vasp'])
+    missing_task = FindGas(gas_name='CHO', vasp_settings=GAS_SETTINGS['vasp'])
+
+    try:
+        docs = find_calculation_docs([found_task, missing_task])
+        assert docs[1] == {}
+        assert not os.path.isfile(found_task.output().path)
+
+        _run_task_with_dynamic_dependencies(found_task)
+        assert docs[0] == get_task_output(found_task)
+
+    finally:
+        clean_up_tasks()
+
+
+def test_get_calculation_docs():
+    '''
+    We should use the outputs of tasks that already ran and look up the rest
+    '''
+    found_task = FindGas(gas_name='H2', vasp_settings=GAS_SETTINGS['vasp'])
+    missing_task = FindGas(gas_name='CHO', vasp_settings=GAS_SETTINGS['vasp'])
+    ran_task = FindGas(gas_name='CO', vasp_settings=GAS_SETTINGS['vasp'])
+
+    try:
+        _run_task_with_dynamic_dependencies(ran_task)
+        docs = get_calculation_docs([found_task, missing_task, ran_task])
+        assert docs[0] == find_calculation_docs([found_task])[0]
+        assert docs[1] == {}
+        assert docs[2] == get_task_output(ran_task)
+        assert not os.path.isfile(found_task.output().path)
+
+    finally:
+        clean_up_tasks()
+
+
+def test__get_calculation_finders():
+    '''
+    We should find the calculation finders that are nested within other tasks
+    '''
+    from ...tasks.metadata_calculators import CalculateAdsorbateBasisEnergies
+    task = CalculateAdsorbateBasisEnergies(vasp_settings=GAS_SETTINGS['vasp'])
+    finders = _get_calculation_finders([task])
+    assert sorted(finder.gas_name for finder in finders) == ['CO', 'H2', 'H2O', 'N2']
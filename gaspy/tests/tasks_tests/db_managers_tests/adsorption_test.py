@@ -11,15 +11,21 @@ os.environ['PYTHONPATH'] = '/home/GASpy/gaspy/tests:' + os.environ['PYTHONPATH']
 # Things we're testing
 from ....tasks.db_managers.adsorption import (update_adsorption_collection,
                                               _find_atoms_docs_not_in_adsorption_collection,
+                                              _calculate_adsorption_energies_in_bulk,
                                               __run_calculate_adsorption_energy_task,
                                               __clean_calc_energy_docs,
+                                              _create_adsorption_docs,
+                                              _get_initial_adslab,
                                               __create_adsorption_doc)
 
 # Things we need to do the tests
+import math
+import pytest
 import ase
 from ..utils import clean_up_tasks
 from ...test_cases.mongo_test_collections.mongo_utils import populate_unit_testing_collection
-from ....mongo import make_atoms_from_doc
+import numpy.testing as npt
+from ....mongo import make_atoms_from_doc, make_doc_from_atoms
 from ....gasdb import get_mongo_collection
 
 
@@ -85,6 +91,31 @@ def test___run_calculate_adsorption_energy_task():
             assert len(list(collection.find({'fwid': adslab_fwid}))) == 1
 
 
+def test__calculate_adsorption_energies_in_bulk():
+    '''
+    The bulk path should give the same answers as the Luigi tasks
+    '''
+    with get_mongo_collection('atoms') as collection:
+        query = {'fwname.calculation_type': 'slab+adsorbate optimization',
+                 'fwname.adsorbate': {'$ne': ''}}
+        adslab_docs = list(collection.find(query))
+
+    try:
+        energy_docs, leftover_docs = _calculate_adsorption_energies_in_bulk(adslab_docs)
+        assert len(energy_docs) + len(leftover_docs) == len(adslab_docs)
+        assert len(energy_docs) > 0
+
+        expected_docs = [__run_calculate_adsorption_energy_task(doc) for doc in adslab_docs]
+        expected_docs = {doc['fwids']['adslab']: doc for doc in expected_docs if doc is not None}
+        for doc in energy_docs:
+            expected_doc = expected_docs[doc['fwids']['adslab']]
+            assert doc['fwids'] == expected_doc['fwids']
+            assert math.isclose(doc['adsorption_energy'], expected_doc['adsorption_energy'])
+
+    finally:
+        clean_up_tasks()
+
+
 def test___clean_calc_energy_docs():
     docs = [None,
             {'fwids': {'adslab': 2}},
@@ -94,6 +125,27 @@ def test___clean_calc_energy_docs():
     clean_docs = __clean_calc_energy_docs(docs, missing_docs)
     assert clean_docs == docs[1:3]
 
+    # If none of the calculations worked (e.g., because their bare slabs are
+    # not done yet), then we should warn instead of stopping the update
+    with pytest.warns(RuntimeWarning):
+        assert __clean_calc_energy_docs([None, None], missing_docs) == []
+
+
+def test__get_initial_adslab():
+    adslab = ase.Atoms('COPt', positions=[[0., 0., 12.], [0., 0., 13.2], [0., 0., 10.]],
+                       tags=[1, 1, 0])
+    seeded_adslab = adslab.copy()
+    seeded_adslab.positions[:2, 0] += 0.5
+    adslab_doc = {'fwname': {'adsorbate': 'CO'},
+                  'initial_configuration': make_doc_from_atoms(seeded_adslab)}
+    npt.assert_allclose(_get_initial_adslab(adslab_doc).positions, seeded_adslab.positions)
+
+    # Warm-started adslabs should use the ideal configuration instead of the
+    # seeded one
+    adslab_doc['fwname']['warm_start'] = {'slab': None, 'adslab': 42}
+    adslab_doc['ideal_configuration'] = make_doc_from_atoms(adslab)
+    npt.assert_allclose(_get_initial_adslab(adslab_doc).positions, adslab.positions)
+
 
 def test___create_adsorption_doc():
     with get_mongo_collection('atoms') as collection:
@@ -126,3 +178,24 @@ def test___create_adsorption_doc():
     assert 'fp_final' in doc
     assert all(isinstance(datum, float) for datum in doc['movement_data'].values())
     assert all(isinstance(date, str) for date in doc['calculation_dates'].values())
+
+
+def test__create_adsorption_docs():
+    '''
+    The chunked pipeline should make the same documents as the one-at-a-time
+    function
+    '''
+    with get_mongo_collection('atoms') as collection:
+        query = {'fwname.calculation_type': 'slab+adsorbate optimization',
+                 'fwname.adsorbate': {'$ne': ''}}
+        adslab_docs = list(collection.find(query))[:4]
+    try:
+        energy_docs = [__run_calculate_adsorption_energy_task(doc) for doc in adslab_docs]
+    finally:
+        clean_up_tasks()
+    energy_docs = [doc for doc in energy_docs if doc is not None]
+
+    for n_processes in [1, 2]:
+        docs = list(_create_adsorption_docs(energy_docs, n_processes=n_processes, chunk_size=2))
+        expected_docs = [__create_adsorption_doc(doc) for doc in energy_docs]
+        assert docs == expected_docs
@@ -9,8 +9,13 @@ import os
 os.environ['PYTHONPATH'] = '/home/GASpy/gaspy/tests:' + os.environ['PYTHONPATH']
 
 # Things we're testing
+from ....tasks.db_managers import atoms as atoms_manager
 from ....tasks.db_managers.atoms import (_find_fwids_missing_from_atoms_collection,
+                                         _get_fireworks_in_bulk,
+                                         _make_launch_from_doc,
                                          _make_atoms_doc_from_fwid,
+                                         _make_atoms_doc_from_fw,
+                                         _get_ideal_configuration,
                                          __patch_old_document,
                                          __patch_atoms_from_old_vasp,
                                          __get_final_atoms_object_with_vasp_forces,
@@ -19,13 +24,23 @@ from ....tasks.db_managers.atoms import (_find_fwids_missing_from_atoms_collecti
                                          __get_patched_miller)
 
 # Things we need to do the tests
+import pytest
 import subprocess
+import io
+import json
+import gzip
+import tarfile
 from datetime import datetime
 import pickle
+from types import SimpleNamespace
+from bson.objectid import ObjectId
 import ase
+from ase.calculators.singlepoint import SinglePointCalculator
 from ....gasdb import get_mongo_collection
 from ....mongo import make_atoms_from_doc, make_doc_from_atoms
-from ....fireworks_helper_scripts import get_atoms_from_fw, get_launchpad
+from ....fireworks_helper_scripts import (get_atoms_from_fw,
+                                          get_launchpad,
+                                          encode_atoms_to_trajhex)
 
 
 def test_update_atoms_collection():
@@ -83,6 +98,85 @@ def test__make_atoms_doc_from_fwid():
     assert isinstance('calculation_date', str)
 
 
+def test__make_atoms_doc_from_fwid_missing(monkeypatch):
+    monkeypatch.setattr(atoms_manager, '_get_fireworks_in_bulk', lambda fwids: [])
+    with pytest.raises(ValueError):
+        _make_atoms_doc_from_fwid(-1)
+
+
+def test__make_launch_from_doc():
+    '''
+    FireWorks moves the actions of big launches into GridFS, so we should be
+    able to read them from there too
+    '''
+    stored_data = {'opt_results': ['foo', 'bar']}
+    doc = {'launch_id': 1, 'launch_dir': '/foo', 'fworker': {'name': 'bar'},
+           'action': {'stored_data': stored_data}}
+    launch = _make_launch_from_doc(doc, lpad=None)
+    assert launch.action.stored_data == stored_data
+    assert launch.fworker.name == 'bar'
+
+    gridfs_id = ObjectId()
+    action_file = io.BytesIO(json.dumps({'stored_data': stored_data}).encode())
+    lpad = SimpleNamespace(gridfs_fallback=SimpleNamespace(get=lambda _id: action_file))
+    doc['action'] = {'gridfs_id': str(gridfs_id)}
+    launch = _make_launch_from_doc(doc, lpad)
+    assert launch.action.stored_data == stored_data
+
+
+def test__get_fireworks_in_bulk():
+    '''
+    Like `test__make_atoms_doc_from_fwid`, this test uses your real FireWorks
+    database. Change the IDs to completed rockets that you have if it fails.
+    '''
+    fwids = [365912, 101392]
+    fws = _get_fireworks_in_bulk(fwids)
+
+    # Make sure the lightweight FireWorks look like the real ones
+    lpad = get_launchpad()
+    assert sorted(fw.fw_id for fw in fws) == sorted(fwids)
+    for fw in fws:
+        expected_fw = lpad.get_fw_by_id(fw.fw_id)
+        assert fw.name == expected_fw.name
+        assert fw.created_on == expected_fw.created_on
+        assert fw.updated_on == expected_fw.updated_on
+        assert fw.launches[-1].launch_id == expected_fw.launches[-1].launch_id
+        assert fw.launches[-1].launch_dir == expected_fw.launches[-1].launch_dir
+        assert (fw.launches[-1].action.stored_data['opt_results'] ==
+                expected_fw.launches[-1].action.stored_data['opt_results'])
+
+
+def test__make_atoms_doc_from_fw():
+    '''
+    The bulk path should make the same documents as the old, one-at-a-time
+    path did
+    '''
+    fwid = 365912
+    lpad = get_launchpad()
+    fw = lpad.get_fw_by_id(fwid)
+    expected_doc = _make_atoms_doc_from_fw(fw)
+    doc = _make_atoms_doc_from_fw(_get_fireworks_in_bulk([fwid])[0])
+
+    assert doc['fwid'] == expected_doc['fwid']
+    assert doc['fwname'] == expected_doc['fwname']
+    assert doc['directory'] == expected_doc['directory']
+    assert doc['calculation_date'] == expected_doc['calculation_date']
+    assert doc['results'] == expected_doc['results']
+    assert doc['initial_configuration'] == expected_doc['initial_configuration']
+
+
+def test__get_ideal_configuration():
+    adslab = ase.Atoms('CO', positions=[[0., 0., 12.], [0., 0., 13.2]], tags=[1, 1])
+    fw = SimpleNamespace(name={'calculation_type': 'slab+adsorbate optimization'},
+                         spec={'_tasks': []})
+    assert _get_ideal_configuration(fw) is None
+
+    fw.name['warm_start'] = {'slab': 42, 'adslab': None}
+    fw.spec['ideal_configuration'] = encode_atoms_to_trajhex(adslab)
+    doc = _get_ideal_configuration(fw)
+    assert make_atoms_from_doc(doc) == adslab
+
+
 def test___patch_old_document():
     '''
     We rely on unit testing of the child functions to verify that we do the
@@ -126,7 +220,13 @@ def test___patch_atoms_from_old_vasp():
 def test___get_final_atoms_with_vasp_forces():
     atoms = __get_final_atoms_object_with_vasp_forces(101392)
     assert type(atoms) == ase.atoms.Atoms
-    assert type(atoms.get_calculator()) == ase.calculators.vasp.Vasp2
+    assert type(atoms.get_calculator()) == SinglePointCalculator
+    assert atoms.get_forces().shape == (len(atoms), 3)
+
+    # The second call should come from the cache and give the same thing
+    cached_atoms = __get_final_atoms_object_with_vasp_forces(101392)
+    assert cached_atoms == atoms
+    assert (cached_atoms.get_forces() == atoms.get_forces()).all()
 
 
 def test___dump_directory_to_tmp():
@@ -151,6 +251,32 @@ def test___dump_directory_to_tmp():
         subprocess.call('rm -r %s' % temp_loc, shell=True)
 
 
+def test___dump_file_to_tmp_members(tmpdir):
+    ''' Make sure we only extract (and unzip) the files that we ask for '''
+    source = tmpdir.mkdir('source')
+    source.join('INCAR').write('foo')
+    source.join('junk').write('bar')
+    with gzip.open(str(source.join('OUTCAR.gz')), 'wb') as file_handle:
+        file_handle.write(b'baz')
+    tarball = str(tmpdir.join('1.tar.gz'))
+    with tarfile.open(tarball, 'w:gz') as tar:
+        for name in ['INCAR', 'junk', 'OUTCAR.gz']:
+            tar.add(str(source.join(name)), arcname=name)
+
+    temp_loc = __dump_file_to_tmp(tarball, members=('INCAR', 'OUTCAR'))
+    try:
+        assert sorted(os.listdir(temp_loc)) == ['INCAR', 'OUTCAR']
+        with open(temp_loc + 'OUTCAR') as file_handle:
+            assert file_handle.read() == 'baz'
+    finally:
+        subprocess.call('rm -r %s' % temp_loc, shell=True)
+
+
+def test___dump_file_to_tmp_missing():
+    with pytest.raises(FileNotFoundError):
+        __dump_file_to_tmp('/tmp/this_backup_does_not_exist.tar.gz')
+
+
 def test__get_patched_vasp_settings():
     '''
     This is a pretty bad test, but I'm too lazy to fix it. And it's only a
@@ -11,9 +11,14 @@ os.environ['PYTHONPATH'] = '/home/GASpy/gaspy/tests:' + os.environ['PYTHONPATH']
 # Things we're testing
 from ....tasks.db_managers.catalog import (update_catalog_collection,
                                            _GetMpids,
-                                           _InsertSitesToCatalog)
+                                           _InsertSitesToCatalog,
+                                           _find_sites_in_catalog,
+                                           _claim_catalog_work,
+                                           _finish_catalog_work)
 
 # Things we need to do the tests
+import time
+from datetime import datetime, timedelta
 import numpy.testing as npt
 from pymatgen.ext.matproj import MPRester
 from ..utils import clean_up_tasks, run_task_locally
@@ -149,3 +154,99 @@ def test__InsertAllSitesFromBulkToCatalog():
         with get_mongo_collection('catalog') as collection:
             collection.delete_many({})
         populate_unit_testing_collection('catalog')
+
+
+def test__find_sites_in_catalog():
+    catalog_docs = [{'miller': [1, 1, 1], 'top': True, 'slab_repeat': [2, 2],
+                     'shift': 0.25, 'adsorption_site': [1., 2., 3.]},
+                    {'miller': [1, 1, 1], 'top': True, 'slab_repeat': [2, 2],
+                     'shift': 0.25, 'adsorption_site': [1.005, 2., 3.]},
+                    {'miller': [1, 0, 0], 'top': True, 'slab_repeat': [2, 2],
+                     'shift': 0.25, 'adsorption_site': [1., 2., 3.]}]
+    site = {'miller': (1, 1, 1), 'top': True, 'slab_repeat': (2, 2),
+            'shift': 0.25, 'adsorption_site': (1.009, 2., 3.)}
+    far_site = dict(site, adsorption_site=(1.011, 2., 3.))
+    bottom_site = dict(site, top=False)
+
+    matches = _find_sites_in_catalog([site, far_site, bottom_site], catalog_docs)
+    # We should keep the first match in the catalog, like a Mongo query would
+    assert matches[0] is catalog_docs[0]
+    assert matches[1] is catalog_docs[1]
+    assert matches[2] is None
+
+
+def test__claim_catalog_work():
+    now = datetime.utcnow()
+    work = [{'_id': 'mp-2_1', 'mpid': 'mp-2', 'max_miller': 1,
+             'state': 'queued', 'attempts': 0, 'worker': None,
+             'lease_expires_on': None},
+            # Its worker died, so we should be able to reclaim it
+            {'_id': 'mp-30_1', 'mpid': 'mp-30', 'max_miller': 1,
+             'state': 'running', 'attempts': 1, 'worker': 'dead',
+             'lease_expires_on': now - timedelta(seconds=1)},
+            # Its worker is still alive, so we should leave it alone
+            {'_id': 'mp-81_1', 'mpid': 'mp-81', 'max_miller': 1,
+             'state': 'running', 'attempts': 1, 'worker': 'alive',
+             'lease_expires_on': now + timedelta(hours=1)},
+            # Its worker died on its last attempt, so it should fail
+            {'_id': 'mp-124_1', 'mpid': 'mp-124', 'max_miller': 1,
+             'state': 'running', 'attempts': 3, 'worker': 'dead',
+             'lease_expires_on': now - timedelta(seconds=1)}]
+
+    with get_mongo_collection('catalog_queue') as collection:
+        collection.delete_many({})
+        collection.insert_many(work)
+    try:
+        first = _claim_catalog_work('foo', lease_seconds=60, max_attempts=3)
+        second = _claim_catalog_work('bar', lease_seconds=60, max_attempts=3)
+        assert first['_id'] == 'mp-2_1'
+        assert first['attempts'] == 1
+        assert first['worker'] == 'foo'
+        assert second['_id'] == 'mp-30_1'
+        assert second['attempts'] == 2
+        assert second['worker'] == 'bar'
+        assert _claim_catalog_work('baz', lease_seconds=60, max_attempts=3) is None
+
+        with get_mongo_collection('catalog_queue') as collection:
+            assert collection.find_one({'_id': 'mp-81_1'})['worker'] == 'alive'
+            assert collection.find_one({'_id': 'mp-124_1'})['state'] == 'failed'
+
+    finally:
+        with get_mongo_collection('catalog_queue') as collection:
+            collection.delete_many({})
+
+
+def test__finish_catalog_work():
+    with get_mongo_collection('catalog_queue') as collection:
+        collection.delete_many({})
+        collection.insert_many([{'_id': 'mp-%i_1' % i, 'mpid': 'mp-%i' % i,
+                                 'max_miller': 1, 'state': 'queued',
+                                 'attempts': 0, 'worker': None,
+                                 'lease_expires_on': None}
+                                for i in range(3)])
+    try:
+        # Successes are done, failures get retried until they run out of attempts
+        work = _claim_catalog_work('foo', lease_seconds=60, max_attempts=2)
+        _finish_catalog_work(work, 'foo', None, max_attempts=2)
+        work = _claim_catalog_work('foo', lease_seconds=60, max_attempts=2)
+        _finish_catalog_work(work, 'foo', 'Traceback', max_attempts=2)
+        with get_mongo_collection('catalog_queue') as collection:
+            assert collection.find_one({'_id': 'mp-0_1'})['state'] == 'done'
+            assert collection.find_one({'_id': 'mp-1_1'})['state'] == 'queued'
+
+        # Workers that lost their leases should not be able to finish things
+        with get_mongo_collection('catalog_queue') as collection:
+            collection.delete_one({'_id': 'mp-1_1'})
+        work = _claim_catalog_work('foo', lease_seconds=0, max_attempts=2)
+        time.sleep(0.01)
+        stolen_work = _claim_catalog_work('bar', lease_seconds=60, max_attempts=2)
+        assert stolen_work['_id'] == work['_id']
+        _finish_catalog_work(work, 'foo', None, max_attempts=2)
+        with get_mongo_collection('catalog_queue') as collection:
+            doc = collection.find_one({'_id': work['_id']})
+        assert doc['state'] == 'running'
+        assert doc['worker'] == 'bar'
+
+    finally:
+        with get_mongo_collection('catalog_queue') as collection:
+            collection.delete_many({})
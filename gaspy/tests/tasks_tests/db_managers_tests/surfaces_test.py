@@ -18,6 +18,7 @@ from ....tasks.db_managers.surfaces import (update_surface_energy_collection,
 import warnings
 import datetime
 import ase
+from bson.objectid import ObjectId
 from ..utils import clean_up_tasks
 from ...test_cases.mongo_test_collections.mongo_utils import populate_unit_testing_collection
 from ....gasdb import get_mongo_collection
@@ -25,6 +26,7 @@ from ....mongo import make_atoms_from_doc
 from ....tasks.core import get_task_output, schedule_tasks
 from ....tasks.calculation_finders import FindBulk
 from ....tasks.metadata_calculators import CalculateSurfaceEnergy
+from ....tasks.db_managers.watermarks import get_newest_atoms_doc_id
 
 
 def test_update_surface_energy_collection():
@@ -71,6 +73,43 @@ def test__find_atoms_docs_not_in_surface_energy_collection():
     assert fwids_in_atoms.isdisjoint(fwids_in_surf)
 
 
+def test__find_atoms_docs_not_in_surface_energy_collection_with_watermark():
+    projection = {'fwid': 1, 'fwname': 1, '_id': 0}
+    try:
+        # Clear out the surface energy collection so that we have something to
+        # find
+        with get_mongo_collection('surface_energy') as collection:
+            collection.delete_many({})
+        all_docs = _find_atoms_docs_not_in_surface_energy_collection(projection=projection)
+        assert len(all_docs) > 0
+
+        # A watermark older than everything should find everything, and we
+        # should get the parts of the documents that we asked for
+        watermark = {'value': str(ObjectId.from_datetime(datetime.datetime(2000, 1, 1))),
+                     'pending_fwids': [],
+                     'last_full_reconciliation': None}
+        docs = _find_atoms_docs_not_in_surface_energy_collection(watermark, projection)
+        assert sorted(doc['fwid'] for doc in docs) == sorted(doc['fwid'] for doc in all_docs)
+        for doc in docs:
+            assert set(doc) == {'fwid', 'fwname'}
+            assert 'mpid' in doc['fwname']
+
+        # Nothing is newer than the newest document, so we should only find
+        # the pending FWIDs
+        pending_fwid = all_docs[0]['fwid']
+        watermark = {'value': get_newest_atoms_doc_id(),
+                     'pending_fwids': [pending_fwid],
+                     'last_full_reconciliation': None}
+        docs = _find_atoms_docs_not_in_surface_energy_collection(watermark, projection)
+        assert [doc['fwid'] for doc in docs] == [pending_fwid]
+
+    # Reset the surface energy collection behind us
+    finally:
+        with get_mongo_collection('surface_energy') as collection:
+            collection.delete_many({})
+        populate_unit_testing_collection('surface_energy')
+
+
 def test___run_calculate_surface_energy_task():
     try:
         # It turns out that our `run_task` function works terribly with dynamic
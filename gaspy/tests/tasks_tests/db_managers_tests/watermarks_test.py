@@ -0,0 +1,155 @@
+''' Tests for the `gaspy.tasks.db_managers.watermarks` submodule '''
+
+__author__ = 'Kevin Tran'
+__email__ = 'ktran@andrew.cmu.edu'
+
+# Modify the python path so that we find/use the .gaspyrc.json in the testing
+# folder instead of the main folder
+import os
+os.environ['PYTHONPATH'] = '/home/GASpy/gaspy/tests:' + os.environ['PYTHONPATH']
+
+# Things we're testing
+from ....tasks.db_managers import watermarks
+from ....tasks.db_managers.watermarks import (get_watermark,
+                                              set_watermark,
+                                              get_checkpoint,
+                                              set_checkpoint,
+                                              needs_full_reconciliation,
+                                              get_newest_atoms_doc_id,
+                                              make_new_atoms_docs_query,
+                                              CollectionUpdate)
+
+# Things we need to do the tests
+import pytest
+import json
+from datetime import datetime, timedelta
+from bson.objectid import ObjectId
+from ....gasdb import get_mongo_collection
+
+
+@pytest.fixture
+def watermarks_file(tmpdir, monkeypatch):
+    ''' Points the watermarks to a temporary file '''
+    file_name = str(tmpdir.join('watermarks.json'))
+    monkeypatch.setattr(watermarks, '_get_watermarks_file', lambda: file_name)
+    return file_name
+
+
+def test_get_watermark_empty(watermarks_file):
+    watermark = get_watermark('atoms')
+    assert watermark == {'value': None,
+                         'pending_fwids': [],
+                         'last_full_reconciliation': None}
+
+
+def test_set_watermark(watermarks_file):
+    set_watermark('atoms', '2019-01-01T00:00:00.000000', [3, 1, 3])
+    set_watermark('adsorption', 'foo', [], full_reconciliation=True)
+
+    atoms_watermark = get_watermark('atoms')
+    assert atoms_watermark['value'] == '2019-01-01T00:00:00.000000'
+    assert atoms_watermark['pending_fwids'] == [1, 3]
+    assert atoms_watermark['last_full_reconciliation'] is None
+    assert get_watermark('adsorption')['last_full_reconciliation'] is not None
+
+    # Make sure we did not leave any temporary files lying around
+    with open(watermarks_file) as file_handle:
+        assert set(json.load(file_handle)) == {'atoms', 'adsorption'}
+    assert os.listdir(os.path.dirname(watermarks_file)) == ['watermarks.json']
+
+
+def test_set_watermark_keeps_reconciliation_date(watermarks_file):
+    set_watermark('atoms', 'foo', full_reconciliation=True)
+    last_full_reconciliation = get_watermark('atoms')['last_full_reconciliation']
+    set_watermark('atoms', 'bar')
+    assert get_watermark('atoms')['last_full_reconciliation'] == last_full_reconciliation
+
+
+def test_checkpoint(watermarks_file):
+    assert get_checkpoint('atoms') is None
+
+    set_checkpoint('atoms', 'foo', 5, [2, 1], full_reconciliation=True)
+    assert get_checkpoint('atoms') == {'value': 'foo',
+                                       'last_fwid': 5,
+                                       'pending_fwids': [1, 2],
+                                       'full_reconciliation': True}
+    # Checkpoints should not move the watermark itself
+    assert get_watermark('atoms')['value'] is None
+
+    # Finishing the update should clear the checkpoint
+    set_watermark('atoms', 'foo', [1, 2], full_reconciliation=True)
+    assert get_checkpoint('atoms') is None
+
+
+def test_CollectionUpdate(watermarks_file):
+    set_watermark('atoms', 'foo', [1], full_reconciliation=True)
+
+    update = CollectionUpdate('atoms', False, find_watermark=lambda: 'bar')
+    assert update.watermark['value'] == 'foo'
+    assert update.skip_finished([3, 1, 2]) == [1, 2, 3]
+    update.commit_chunk(2, [2])
+
+    # Pretend that we crashed and then started over. We should pick up
+    # from the checkpoint, even if the watermark has moved since then.
+    update = CollectionUpdate('atoms', True, find_watermark=lambda: 'baz')
+    assert update.full_reconciliation is False
+    assert update.watermark['value'] == 'foo'
+    assert update.skip_finished([3, 1, 2]) == [3]
+    update.commit_chunk(3)
+    update.finish()
+
+    watermark = get_watermark('atoms')
+    assert watermark['value'] == 'bar'
+    assert watermark['pending_fwids'] == [2]
+    assert get_checkpoint('atoms') is None
+
+
+def test_CollectionUpdate_full_reconciliation(watermarks_file):
+    update = CollectionUpdate('atoms', None, find_watermark=lambda: None)
+    assert update.full_reconciliation is True
+    assert update.watermark is None
+    update.finish()
+    assert get_watermark('atoms')['last_full_reconciliation'] is not None
+
+
+def test_needs_full_reconciliation(watermarks_file):
+    assert needs_full_reconciliation('atoms') is True
+
+    set_watermark('atoms', 'foo')
+    assert needs_full_reconciliation('atoms') is True
+
+    set_watermark('atoms', 'foo', full_reconciliation=True)
+    assert needs_full_reconciliation('atoms') is False
+    assert needs_full_reconciliation('atoms', interval=timedelta(0)) is True
+
+
+def test_needs_full_reconciliation_old_date(watermarks_file):
+    # Whole seconds make sure that we can read dates without microseconds
+    last_week = (datetime.now() - timedelta(days=8)).replace(microsecond=0)
+    with open(watermarks_file, 'w') as file_handle:
+        json.dump({'atoms': {'value': 'foo',
+                             'pending_fwids': [],
+                             'last_full_reconciliation': last_week.strftime(
+                                 watermarks.RECONCILIATION_DATE_FORMAT)}},
+                  file_handle)
+    assert needs_full_reconciliation('atoms') is True
+    assert needs_full_reconciliation('atoms', interval=timedelta(days=9)) is False
+
+
+def test_get_newest_atoms_doc_id():
+    with get_mongo_collection('atoms') as collection:
+        doc = collection.find_one({}, {'_id': 1}, sort=[('_id', -1)])
+    assert get_newest_atoms_doc_id() == str(doc['_id'])
+
+
+def test_make_new_atoms_docs_query():
+    watermark = {'value': None, 'pending_fwids': [], 'last_full_reconciliation': None}
+    assert make_new_atoms_docs_query(watermark) == {}
+
+    object_id = str(ObjectId.from_datetime(datetime(2019, 1, 1)))
+    watermark = {'value': object_id,
+                 'pending_fwids': [1, 2],
+                 'last_full_reconciliation': None}
+    query = make_new_atoms_docs_query(watermark)
+    assert query == {'$or': [{'_id': {'$gt': ObjectId(object_id)}},
+                             {'fwid': {'$in': [1, 2]}}]}
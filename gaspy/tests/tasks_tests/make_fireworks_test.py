@@ -12,7 +12,8 @@ import warnings
 warnings.filterwarnings('ignore', category=ImportWarning)
 
 # Things we're testing
-from ...tasks.make_fireworks import (FireworkMaker,
+from ...tasks.make_fireworks import (submit_fireworks_in_batches,
+                                     FireworkMaker,
                                      MakeGasFW,
                                      MakeBulkFW,
                                      MakeAdslabFW,
@@ -20,15 +21,19 @@ from ...tasks.make_fireworks import (FireworkMaker,
 
 # Things we need to do the tests
 import pytest
+import numpy.testing as npt
 import luigi
 from .utils import clean_up_tasks, run_task_locally
 from ... import defaults
 from ...utils import unfreeze_dict
+from ...mongo import make_atoms_from_doc, make_doc_from_atoms
+from ...fireworks_helper_scripts import decode_trajhex_to_atoms
 from ...tasks.core import get_task_output, schedule_tasks
 from ...tasks.calculation_finders import FindSurface
 from ...tasks.atoms_generators import (GenerateGas,
                                        GenerateBulk,
-                                       GenerateAdslabs)
+                                       GenerateAdslabs,
+                                       GenerateAdslab)
 
 GAS_SETTINGS = defaults.gas_settings()
 BULK_SETTINGS = defaults.bulk_settings()
@@ -36,6 +41,29 @@ SLAB_SETTINGS = defaults.slab_settings()
 ADSLAB_SETTINGS = defaults.adslab_settings()
 
 
+def test_submit_fireworks_in_batches():
+    clean_up_tasks()
+    tasks = [MakeGasFW(gas_name, GAS_SETTINGS['vasp']) for gas_name in ['CO', 'H', 'O']]
+    # This one is too big, so we should skip it
+    tasks.append(MakeBulkFW('mp-30', BULK_SETTINGS['vasp'], max_atoms=0))
+    # This one's requirements have not finished, so we should skip it, too
+    unfinished_task = MakeGasFW('N2', GAS_SETTINGS['vasp'])
+    unfinished_task.create_firework = lambda: open('/path/to/nowhere.pkl', 'rb')
+    tasks.append(unfinished_task)
+
+    try:
+        with pytest.warns(RuntimeWarning, match='Could not make a FireWork'):
+            fworks = submit_fireworks_in_batches(tasks, batch_size=2,
+                                                 local_scheduler=True, _testing=True)
+        assert [fwork.name['gasname'] for fwork in fworks] == ['CO', 'H', 'O']
+        assert all(task.complete() for task in tasks[:3])
+        assert tasks[3].complete() is False
+        assert tasks[4].complete() is False
+
+    finally:
+        clean_up_tasks()
+
+
 def test_FireworkMaker():
     assert issubclass(FireworkMaker, luigi.Task)
     assert FireworkMaker().complete() is False
@@ -87,6 +115,7 @@ def test_MakeBulkFW():
         assert fwork.name['calculation_type'] == 'unit cell optimization'
         assert fwork.name['mpid'] == mpid
         assert fwork.name['vasp_settings'] == BULK_SETTINGS['vasp']
+        assert fwork.spec['_priority'] == 100
         assert task.complete() is True
 
     finally:
@@ -146,9 +175,13 @@ def test_MakeAdslabFW():
                         get_slab_settings=get_slab_settings,
                         bulk_vasp_settings=bulk_vasp_settings)
 
-    # Check that our requirement is correct
+    # Check that our requirement is correct. We should be making only our one
+    # adslab.
     req = task.requires()
-    assert isinstance(req, GenerateAdslabs)
+    assert isinstance(req, GenerateAdslab)
+    assert req.adsorption_site == adsorption_site
+    assert req.shift == shift
+    assert req.top == top
     assert req.adsorbate_name == adsorbate_name
     assert unfreeze_dict(req.rotation) == rotation
     assert req.mpid == mpid
@@ -182,11 +215,26 @@ def test_MakeAdslabFW():
         assert fwork.name['vasp_settings'] == ADSLAB_SETTINGS['vasp']
         assert task.complete() is True
 
+        # Making the whole facet should not change what we require or the
+        # FireWork that we make
+        facet_req = GenerateAdslabs(adsorbate_name=adsorbate_name,
+                                    rotation=rotation,
+                                    mpid=mpid,
+                                    miller_indices=miller_indices,
+                                    min_xy=min_xy,
+                                    slab_generator_settings=slab_generator_settings,
+                                    get_slab_settings=get_slab_settings,
+                                    bulk_vasp_settings=bulk_vasp_settings)
+        run_task_locally(facet_req)
+        assert task.requires() == req
+        facet_fwork = task.run(_testing=True)
+        assert facet_fwork.name == fwork.name
+
     finally:
         clean_up_tasks()
 
 
-def test__find_matching_adslab_doc():
+def test_MakeAdslabFW_warm_start(monkeypatch):
     '''
     WARNING:  This test uses `run_task_locally`, which has a chance of
     actually submitting a FireWork to production. To avoid this, you must try
@@ -194,26 +242,49 @@ def test__find_matching_adslab_doc():
     collection. If you copy/paste this test into somewhere else, make sure
     that you use `run_task_locally` appropriately.
     '''
-    # Make a case where this function should find something successfully
-    task = GenerateAdslabs(adsorbate_name='CO', mpid='mp-2', miller_indices=(1, 0, 0))
-    run_task_locally(task)
-    docs = get_task_output(task)
-    doc = MakeAdslabFW._find_matching_adslab_doc(docs,
-                                                 adsorption_site=(1.40646118,
-                                                                  1.40646118,
-                                                                  20.89584646),
-                                                 shift=0.25, top=True)
-    # I know what it should have found because I did this by hand
-    expected_doc = docs[0]
-    assert doc == expected_doc
-
-    # Try a fail-to-find
-    with pytest.raises(RuntimeError) as exc_info:
-        doc = MakeAdslabFW._find_matching_adslab_doc(docs, adsorption_site=(0., 0., 0.),
-                                                     shift=0.25, top=False)
-        pytest.fail('Expected a RuntimeError')
-        assert ('You just tried to make an adslab FireWork rocket that we could not enumerate.'
-                in str(exc_info.value))
+    clean_up_tasks()
+    task = MakeAdslabFW(adsorption_site=(1.4064611759169474, 2.8129223518338944, 20.895846464363103),
+                        shift=0.25,
+                        top=True,
+                        adsorbate_name='OH',
+                        mpid='mp-2',
+                        miller_indices=(1, 0, 0),
+                        warm_start=True)
+
+    try:
+        run_task_locally(task.requires())
+        cold_task = MakeAdslabFW(**{key: value for key, value in task.param_kwargs.items()
+                                    if key != 'warm_start'})
+        cold_fwork = cold_task.run(_testing=True)
+
+        # If there is nothing to start from, then we should get the same
+        # FireWork as we would without warm starting
+        monkeypatch.setattr(MakeAdslabFW, '_find_relaxed_slab_doc', lambda self, slab_repeat: None)
+        monkeypatch.setattr(MakeAdslabFW, '_find_similar_adsorption_doc', lambda self, adslab: None)
+        fwork = task.run(_testing=True)
+        assert fwork.name == cold_fwork.name
+        assert 'ideal_configuration' not in fwork.spec
+
+        # Pretend that we relaxed the bare slab and make sure we record it
+        slab = make_atoms_from_doc(get_task_output(task.requires()))
+        slab = slab[slab.get_tags() == 0]
+        slab.positions[:, 2] -= 0.1
+        slab_doc = make_doc_from_atoms(slab)
+        slab_doc['fwid'] = 42
+        monkeypatch.setattr(MakeAdslabFW, '_find_relaxed_slab_doc',
+                            lambda self, slab_repeat: slab_doc)
+        fwork = task.run(_testing=True)
+        assert fwork.name['warm_start'] == {'slab': 42, 'adslab': None}
+        assert {key: value for key, value in fwork.name.items() if key != 'warm_start'} == cold_fwork.name
+
+        # We should also save the unseeded adslab so that we can fingerprint
+        # the site that we asked for
+        ideal_adslab = decode_trajhex_to_atoms(fwork.spec['ideal_configuration'])
+        cold_adslab = decode_trajhex_to_atoms(cold_fwork.spec['_tasks'][1]['args'][1])
+        npt.assert_allclose(ideal_adslab.get_positions(), cold_adslab.get_positions())
+
+    finally:
+        clean_up_tasks()
 
 
 def test_MakeSurfaceFW():
@@ -10,6 +10,8 @@ os.environ['PYTHONPATH'] = '/home/GASpy/gaspy/tests:' + os.environ['PYTHONPATH']
 
 # Things we're testing
 from ...tasks.metadata_calculators import (CalculateAdsorptionEnergy,
+                                           CalculateAdsorptionEnergies,
+                                           group_adsorption_energy_tasks,
                                            CalculateAdsorbateEnergy,
                                            CalculateAdsorbateBasisEnergies,
                                            CalculateSurfaceEnergy)
@@ -68,6 +70,72 @@ def test_CalculateAdsorptionEnergy():
         clean_up_tasks()
 
 
+def test_CalculateAdsorptionEnergies():
+    '''
+    WARNING:  This test uses `run_task_locally`, which has a chance of
+    actually submitting a FireWork to production. To avoid this, you must try
+    to make sure that you have all of the gas calculations in the unit testing
+    atoms collection.  If you copy/paste this test into somewhere else, make
+    sure that you use `run_task_locally` appropriately.
+    '''
+    adsorption_site = (0., 1.41, 20.52)
+    site_task = CalculateAdsorptionEnergy(adsorption_site=adsorption_site,
+                                          shift=0.25,
+                                          top=True,
+                                          adsorbate_name='CO',
+                                          mpid='mp-2',
+                                          miller_indices=(1, 0, 0))
+    task = CalculateAdsorptionEnergies(adsorption_sites=[adsorption_site, adsorption_site],
+                                       shift=0.25,
+                                       top=True,
+                                       adsorbate_name='CO',
+                                       mpid='mp-2',
+                                       miller_indices=(1, 0, 0))
+
+    # We should share our requirements with the per-site task
+    assert task.requires() == {key: value for key, value in site_task.requires().items()
+                               if key != 'adslab_doc'}
+
+    try:
+        run_task_locally(task)
+        docs = get_task_output(task)
+        assert len(docs) == 2
+
+        # We should give the same answer as the per-site task
+        run_task_locally(site_task)
+        assert docs[0] == docs[1] == get_task_output(site_task)
+
+    finally:
+        clean_up_tasks()
+
+
+def test_group_adsorption_energy_tasks():
+    sites = [(0., 1.41, 20.52), (1.41, 1.41, 20.52), (0., 1.41, 20.52)]
+    tasks = [CalculateAdsorptionEnergy(adsorption_site=site,
+                                       shift=0.25,
+                                       top=True,
+                                       adsorbate_name=adsorbate_name,
+                                       mpid='mp-2',
+                                       miller_indices=(1, 0, 0))
+             for adsorbate_name in ['CO', 'H'] for site in sites]
+    tasks.append(CalculateAdsorptionEnergy(adsorption_site=sites[0],
+                                           shift=0.25,
+                                           top=False,
+                                           adsorbate_name='CO',
+                                           mpid='mp-2',
+                                           miller_indices=(1, 0, 0)))
+
+    batched_tasks = group_adsorption_energy_tasks(tasks)
+    assert [(task.adsorbate_name, task.top, task.adsorption_sites) for task in batched_tasks] == \
+        [('CO', True, (sites[0], sites[1])),
+         ('H', True, (sites[0], sites[1])),
+         ('CO', False, (sites[0],))]
+    for task in batched_tasks:
+        assert isinstance(task, CalculateAdsorptionEnergies)
+        assert task.mpid == 'mp-2'
+        assert task.miller_indices == (1, 0, 0)
+
+
 def test_CalculateAdsorbateEnergy():
     '''
     WARNING:  This test uses `run_task_locally`, which has a chance of
@@ -0,0 +1,116 @@
+''' Tests for the `tracing` submodule '''
+
+__author__ = 'Kevin Tran'
+__email__ = 'ktran@andrew.cmu.edu'
+
+# Things we're testing
+from .. import tracing
+from ..tracing import (span,
+                       traced,
+                       get_spans,
+                       export_chrome_trace,
+                       get_summary)
+
+# Things we need to do the tests
+import pytest
+import json
+
+
+@pytest.fixture
+def tracing_enabled():
+    ''' Turns tracing on for a test and then cleans up afterwards '''
+    tracing.reset()
+    tracing.enable()
+    yield
+    tracing.disable()
+    tracing.reset()
+    tracing._STATE['directory'] = None
+
+
+@traced('testing')
+def _traced_function(x):
+    return x + 1
+
+
+def test_span_disabled():
+    tracing.reset()
+    tracing.disable()
+    with span('foo'):
+        pass
+    assert _traced_function(1) == 2
+    assert get_spans() == []
+
+
+def test_span(tracing_enabled):
+    with span('foo', category='bar', task_family='FindBulk', params_hash='abc'):
+        sum(range(10000))
+    spans = get_spans()
+
+    assert len(spans) == 1
+    span_ = spans[0]
+    assert span_['name'] == 'foo'
+    assert span_['category'] == 'bar'
+    assert span_['task_family'] == 'FindBulk'
+    assert span_['params_hash'] == 'abc'
+    assert span_['duration'] >= 0.
+    assert span_['cpu_time'] >= 0.
+    assert 'error' not in span_
+
+
+def test_span_error(tracing_enabled):
+    with pytest.raises(ValueError):
+        with span('foo'):
+            raise ValueError
+    assert get_spans()[0]['error'] == 'ValueError'
+
+
+def test_traced(tracing_enabled):
+    ''' Nested spans should inherit the task family of their parents '''
+    with span('GenerateAdslabs', category='task', task_family='GenerateAdslabs', params_hash='abc'):
+        assert _traced_function(1) == 2
+    spans = get_spans()
+
+    assert len(spans) == 2
+    inner_span = [span_ for span_ in spans if span_['name'] == '_traced_function'][0]
+    assert inner_span['category'] == 'testing'
+    assert inner_span['task_family'] == 'GenerateAdslabs'
+    assert inner_span['params_hash'] == 'abc'
+
+
+def test_tracing_directory(tracing_enabled, tmpdir):
+    tracing.enable(directory=str(tmpdir))
+    with span('foo'):
+        pass
+    with span('bar'):
+        pass
+
+    assert len(tmpdir.listdir()) == 1
+    assert [span_['name'] for span_ in get_spans()] == ['foo', 'bar']
+
+
+def test_export_chrome_trace(tracing_enabled, tmpdir):
+    with span('foo', task_family='FindBulk'):
+        pass
+    file_name = str(tmpdir.join('trace.json'))
+    export_chrome_trace(file_name)
+
+    with open(file_name) as file_handle:
+        trace = json.load(file_handle)
+    event = trace['traceEvents'][0]
+    assert event['name'] == 'foo'
+    assert event['ph'] == 'X'
+    assert event['dur'] >= 0.
+    assert event['args']['task_family'] == 'FindBulk'
+
+
+def test_get_summary(tracing_enabled):
+    for _ in range(3):
+        with span('foo', task_family='FindBulk'):
+            pass
+    with span('foo', task_family='FindGas'):
+        pass
+    summary = get_summary()
+
+    assert len(summary) == 2
+    counts = dict(zip(summary['task_family'], summary['count']))
+    assert counts == {'FindBulk': 3, 'FindGas': 1}
@@ -11,7 +11,11 @@ os.environ['PYTHONPATH'] = '/home/GASpy/gaspy/tests:' + os.environ['PYTHONPATH']
 # Things we're testing
 from ..utils import (read_rc,
                      _find_rc_file,
-                     unfreeze_dict)
+                     unfreeze_dict,
+                     get_nested_value,
+                     doc_matches_query,
+                     imultimap,
+                     _chunk)
 
 # Things we need to do the tests
 import pytest
@@ -109,3 +113,85 @@ def _look_for_type_in_dict(type_, dict_):
     elif isinstance(dict_, collections.Iterable) and not isinstance(dict_, str):
         for element in dict_:
             _look_for_type_in_dict(type_, element)
+
+
+def test_get_nested_value():
+    doc = {'fwname': {'adsorption_site': [0., 1.41, 20.52], 'mpid': 'mp-2'}}
+    assert get_nested_value(doc, 'fwname.mpid') == 'mp-2'
+    assert get_nested_value(doc, 'fwname.adsorption_site.1') == 1.41
+    with pytest.raises(KeyError):
+        get_nested_value(doc, 'fwname.shift')
+
+
+@pytest.mark.parametrize('query, expected_match',
+                         [({'fwname.mpid': 'mp-2'}, True),
+                          ({'fwname.mpid': 'mp-30'}, False),
+                          ({'fwname.miller': (1, 0, 0)}, True),
+                          ({'fwname.shift': {'$gte': 0.25 - 1e-3, '$lte': 0.25 + 1e-3}}, True),
+                          ({'fwname.shift': {'$gte': 0.26 - 1e-3, '$lte': 0.26 + 1e-3}}, False),
+                          ({'fwname.adsorption_site.2': {'$gte': 20.51, '$lte': 20.53}}, True),
+                          ({'fwname.vasp_settings.kpts': (4, 4, 1)}, True),
+                          ({'fwname.vasp_settings.ldau': None}, True),
+                          ({'fwname.vasp_settings.ldau': True}, False)])
+def test_doc_matches_query(query, expected_match):
+    doc = {'fwname': {'mpid': 'mp-2',
+                      'miller': [1, 0, 0],
+                      'shift': 0.25,
+                      'adsorption_site': [0., 1.41, 20.52],
+                      'vasp_settings': {'kpts': [4, 4, 1]}}}
+    assert doc_matches_query(doc, query) is expected_match
+
+
+def _square(x):
+    return x**2
+
+
+def _sum_chunk(chunk):
+    return [sum(chunk)] * len(chunk)
+
+
+def _initialize_offset(offset):
+    global _OFFSET
+    _OFFSET = offset
+
+
+def _add_offset(x):
+    return x + _OFFSET
+
+
+@pytest.mark.parametrize('backend', ['serial', 'thread', 'process'])
+@pytest.mark.parametrize('ordered', [True, False])
+def test_imultimap(backend, ordered):
+    inputs = (i for i in range(20))  # Make sure we can handle generators
+    outputs = imultimap(_square, inputs, backend=backend, processes=2, ordered=ordered)
+
+    expected_outputs = [i**2 for i in range(20)]
+    if ordered:
+        assert list(outputs) == expected_outputs
+    else:
+        assert sorted(outputs) == expected_outputs
+
+
+@pytest.mark.parametrize('backend', ['serial', 'thread', 'process'])
+def test_imultimap_chunked(backend):
+    outputs = list(imultimap(_sum_chunk, range(7), backend=backend, processes=2,
+                             chunked=True, chunksize=3))
+    assert outputs == [3, 3, 3, 12, 12, 12, 6]
+
+
+@pytest.mark.parametrize('backend', ['serial', 'thread', 'process'])
+def test_imultimap_initializer(backend):
+    outputs = list(imultimap(_add_offset, range(5), backend=backend, processes=2,
+                             initializer=_initialize_offset, initargs=(10,)))
+    assert outputs == [10, 11, 12, 13, 14]
+
+
+def test_imultimap_bad_backend():
+    with pytest.raises(ValueError):
+        list(imultimap(_square, range(5), backend='foo'))
+
+
+@pytest.mark.parametrize('iterable', [list(range(7)), (i for i in range(7))])
+def test__chunk(iterable):
+    chunks = [list(chunk) for chunk in _chunk(iterable, 3)]
+    assert chunks == [[0, 1, 2], [3, 4, 5], [6]]
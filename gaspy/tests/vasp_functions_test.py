@@ -0,0 +1,284 @@
+''' Tests for the `vasp_functions` submodule '''
+
+__author__ = 'Kevin Tran'
+__email__ = 'ktran@andrew.cmu.edu'
+
+# Things we're testing
+from .. import vasp_functions
+from ..vasp_functions import (iread_vasprun,
+                              _write_trajectory,
+                              _optimize_with_ase,
+                              _write_optimizer_state,
+                              _resolve_optimizer_state,
+                              _store_optimizer_state,
+                              OPTIMIZER_STATE_FILE)
+
+# Things we need to do the tests
+import pytest
+import json
+import warnings
+import numpy as np
+import numpy.testing as npt
+import ase
+import ase.io
+from ase.io.trajectory import Trajectory
+from ase.calculators.singlepoint import SinglePointCalculator
+from ase.constraints import FixAtoms, Hookean
+from ase.build import fcc111, add_adsorbate, molecule
+from ase.calculators.emt import EMT
+
+N_STEPS = 5
+
+_VASPRUN_HEADER = '''<?xml version="1.0" encoding="ISO-8859-1"?>
+<modeling>
+ <kpoints>
+  <varray name="kpointlist" >
+   <v>       0.00000000       0.00000000       0.00000000 </v>
+  </varray>
+  <varray name="weights" >
+   <v>       1.00000000 </v>
+  </varray>
+ </kpoints>
+ <parameters>
+  <separator name="general">
+   <i type="string" name="SYSTEM">test</i>
+  </separator>
+ </parameters>
+ <atominfo>
+  <atoms>       2 </atoms>
+  <types>       2 </types>
+  <array name="atoms" >
+   <dimension dim="1">ion</dimension>
+   <field type="string">element</field>
+   <field type="int">atomtype</field>
+   <set>
+    <rc><c>C </c><c>   1</c></rc>
+    <rc><c>O </c><c>   2</c></rc>
+   </set>
+  </array>
+ </atominfo>
+ <structure name="initialpos" >
+  <crystal>
+   <varray name="basis" >
+    <v>      10.00000000       0.00000000       0.00000000 </v>
+    <v>       0.00000000      10.00000000       0.00000000 </v>
+    <v>       0.00000000       0.00000000      10.00000000 </v>
+   </varray>
+  </crystal>
+  <varray name="positions" >
+   <v>       0.50000000       0.50000000       0.50000000 </v>
+   <v>       0.50000000       0.50000000       0.61500000 </v>
+  </varray>
+  <varray type="logical" name="selective" >
+   <v type="logical" >  F  F  F </v>
+   <v type="logical" >  T  T  T </v>
+  </varray>
+ </structure>
+'''
+
+_VASPRUN_STEP = ''' <calculation>
+  <scstep>
+   <energy>
+    <i name="e_fr_energy">    %(scf_free_energy)f </i>
+    <i name="e_0_energy">    %(scf_energy)f </i>
+   </energy>
+  </scstep>
+  <structure>
+   <crystal>
+    <varray name="basis" >
+     <v>      10.00000000       0.00000000       0.00000000 </v>
+     <v>       0.00000000      10.00000000       0.00000000 </v>
+     <v>       0.00000000       0.00000000      10.00000000 </v>
+    </varray>
+   </crystal>
+   <varray name="positions" >
+    <v>       0.50000000       0.50000000       0.50000000 </v>
+    <v>       0.50000000       0.50000000       %(z)f </v>
+   </varray>
+  </structure>
+  <varray name="forces" >
+   <v>       0.00000000       0.00000000       0.00000000 </v>
+   <v>       0.00000000       0.00000000      %(force)f </v>
+  </varray>
+  <energy>
+   <i name="e_fr_energy">    %(free_energy)f </i>
+   <i name="e_0_energy">    %(free_energy)f </i>
+  </energy>
+ </calculation>
+'''
+
+
+def _make_vasprun(file_name, n_steps=N_STEPS, finished=True):
+    ''' Writes a small vasprun.xml file of a CO molecule relaxing '''
+    with open(file_name, 'w') as file_handle:
+        file_handle.write(_VASPRUN_HEADER)
+        for i in range(n_steps):
+            file_handle.write(_VASPRUN_STEP % {'scf_free_energy': -10. - i,
+                                               'scf_energy': -10.1 - i,
+                                               'free_energy': -10. - i,
+                                               'z': 0.615 - 0.001*i,
+                                               'force': -0.1*(n_steps - i)})
+        if finished:
+            file_handle.write('</modeling>\n')
+
+
+def test_iread_vasprun(tmpdir):
+    file_name = str(tmpdir.join('vasprun.xml'))
+    _make_vasprun(file_name)
+    images = list(iread_vasprun(file_name))
+
+    # Make sure we read the same things that ASE does
+    expected_images = ase.io.read(file_name, ':', format='vasp-xml')
+    assert len(images) == len(expected_images) == N_STEPS
+    for image, expected_image in zip(images, expected_images):
+        assert image.get_chemical_symbols() == expected_image.get_chemical_symbols()
+        npt.assert_allclose(image.get_positions(), expected_image.get_positions())
+        npt.assert_allclose(image.get_cell(), expected_image.get_cell())
+        assert image.get_potential_energy() == pytest.approx(expected_image.get_potential_energy())
+        npt.assert_allclose(image.get_forces(apply_constraint=False),
+                            expected_image.get_forces(apply_constraint=False))
+        assert isinstance(image.constraints[0], FixAtoms)
+        npt.assert_array_equal(image.constraints[0].index, [0])
+
+
+def test_iread_vasprun_unfinished(tmpdir):
+    ''' If VASP did not finish writing the file, we should keep what it did write '''
+    file_name = str(tmpdir.join('vasprun.xml'))
+    _make_vasprun(file_name, finished=False)
+    with open(file_name) as file_handle:
+        contents = file_handle.read()
+    with open(file_name, 'w') as file_handle:
+        file_handle.write(contents[:-100])
+
+    images = list(iread_vasprun(file_name))
+    assert len(images) == N_STEPS - 1
+
+
+def _make_images(n_images):
+    images = []
+    for i in range(n_images):
+        atoms = ase.Atoms('CO', positions=[[0., 0., 0.], [0., 0., 1.15 + 0.01*i]])
+        forces = np.array([[0., 0., i], [0., 0., -i]], dtype=float)
+        atoms.set_calculator(SinglePointCalculator(atoms, energy=float(i), forces=forces))
+        images.append(atoms)
+    return images
+
+
+@pytest.mark.parametrize('keep_every, expected_energies',
+                         [(1, [0, 1, 2, 3, 4, 5, 6, 7, 8, 9]),
+                          (3, [0, 3, 6, 9]),
+                          (4, [0, 4, 8, 9]),
+                          (20, [0, 9])])
+def test__write_trajectory(tmpdir, keep_every, expected_energies):
+    file_name = str(tmpdir.join('all.traj'))
+    images = _make_images(10)
+    final_image = _write_trajectory(iter(images), file_name, resort=[1, 0],
+                                    keep_every=keep_every)
+
+    written_images = list(Trajectory(file_name))
+    assert [image.get_potential_energy() for image in written_images] == expected_energies
+    for image in written_images:
+        assert image.get_chemical_symbols() == ['O', 'C']
+        npt.assert_allclose(image.get_forces()[0], [0., 0., -image.get_potential_energy()])
+
+    # We should always return the last image, reordered
+    assert final_image.get_potential_energy() == 9.
+    assert final_image.get_chemical_symbols() == ['O', 'C']
+    npt.assert_allclose(final_image.get_positions(), images[-1].get_positions()[[1, 0]])
+
+
+def _make_emt_adslab(site):
+    """ Makes a CO molecule on Cu(111) with a Hookean C-O bond, like our OOH and CHO """
+    adslab = fcc111("Cu", size=(3, 3, 4), vacuum=8.)
+    adsorbate = molecule("CO")
+    add_adsorbate(adslab, adsorbate, 2., site, mol_index=0)
+    adslab.set_constraint([FixAtoms(indices=[atom.index for atom in adslab if atom.tag > 2]),
+                           Hookean(a1=len(adslab) - 2, a2=len(adslab) - 1, rt=1.4, k=5.)])
+    adslab.set_calculator(EMT())
+    return adslab
+
+
+@pytest.mark.parametrize("optimizer_settings",
+                         [None,
+                          {"optimizer": "BFGS", "hessian": "model"},
+                          {"optimizer": "PreconLBFGS"},
+                          {"optimizer": "PreconFIRE", "precon": "C1", "mu": 1.}])
+def test__optimize_with_ase(tmpdir, monkeypatch, optimizer_settings):
+    monkeypatch.chdir(tmpdir)
+    adslab = _make_emt_adslab("ontop")
+    optimizer = _optimize_with_ase(adslab, 0.05, optimizer_settings)
+    assert np.abs(adslab.get_forces()).max() < 0.05
+    assert len(Trajectory("all.traj")) > 1
+
+    # Make sure that we save a state that we can start another relaxation from
+    _write_optimizer_state(optimizer, "optimizer_state.json")
+    with open("optimizer_state.json") as file_handle:
+        optimizer_state = json.load(file_handle)
+    assert optimizer_state["optimizer"] == (optimizer_settings or {}).get("optimizer", "BFGS")
+    assert optimizer_state["n_steps"] == optimizer.nsteps
+    if optimizer_state["optimizer"] == "BFGS":
+        assert np.array(optimizer_state["hessian"]).shape == (3*len(adslab), 3*len(adslab))
+    else:
+        assert optimizer_state["mu"] > 0
+    _optimize_with_ase(_make_emt_adslab("fcc"), 0.05, optimizer_state)
+
+
+def test__optimize_with_ase_seeded_hessian(tmpdir, monkeypatch):
+    """
+    Starting from the Hessian of the same adsorbate on another site should
+    take fewer ionic steps than starting from scratch
+    """
+    monkeypatch.chdir(tmpdir)
+    reference_optimizer = _optimize_with_ase(_make_emt_adslab("hcp"), 0.05)
+    _write_optimizer_state(reference_optimizer, "optimizer_state.json")
+    with open("optimizer_state.json") as file_handle:
+        optimizer_state = json.load(file_handle)
+
+    for site in ["ontop", "fcc"]:
+        cold_optimizer = _optimize_with_ase(_make_emt_adslab(site), 0.05)
+        warm_optimizer = _optimize_with_ase(_make_emt_adslab(site), 0.05, optimizer_state)
+        assert warm_optimizer.nsteps < cold_optimizer.nsteps
+
+
+def test__optimize_with_ase_wrong_hessian(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    with warnings.catch_warnings(record=True) as warning_manager:
+        warnings.simplefilter("always")
+        optimizer = _optimize_with_ase(_make_emt_adslab("ontop"), 0.05,
+                                       {"hessian": np.eye(3).tolist()})
+    assert any(issubclass(warning.category, RuntimeWarning) for warning in warning_manager)
+    assert optimizer.nsteps > 0
+
+
+def test__resolve_optimizer_state(monkeypatch):
+    state = {"optimizer": "BFGS", "n_steps": 3, "hessian": np.eye(3).tolist()}
+    reference = {"storage": "gridfs", "bucket": "trajectories", "sha256": "foo", "size": 1}
+    monkeypatch.setattr(vasp_functions, "_read_bytes_from_gridfs",
+                        lambda reference: json.dumps(state).encode("utf-8"))
+
+    assert _resolve_optimizer_state(None) == {}
+    assert _resolve_optimizer_state({"hessian": "model"}) == {"hessian": "model"}
+    optimizer_settings = _resolve_optimizer_state({"state": reference})
+    assert optimizer_settings == {"optimizer": "BFGS", "hessian": state["hessian"]}
+
+    # We should not start one kind of optimizer from the state of another
+    with pytest.warns(RuntimeWarning):
+        optimizer_settings = _resolve_optimizer_state({"optimizer": "PreconFIRE",
+                                                       "state": reference})
+    assert optimizer_settings == {"optimizer": "PreconFIRE"}
+
+
+def test__store_optimizer_state(tmpdir, monkeypatch):
+    """ Hessians are too big for the `launches` collection, so we only put them into GridFS """
+    monkeypatch.chdir(tmpdir)
+    assert _store_optimizer_state({"mode": "gridfs"}) is None
+
+    with open(OPTIMIZER_STATE_FILE, "w") as file_handle:
+        json.dump({"optimizer": "BFGS", "n_steps": 3}, file_handle)
+    assert _store_optimizer_state() is None
+    assert _store_optimizer_state({"mode": "hex"}) is None
+
+    reference = {"storage": "gridfs", "bucket": "trajectories", "sha256": "foo", "size": 1}
+    monkeypatch.setattr(vasp_functions, "_store_trajectory_in_gridfs",
+                        lambda raw_bytes, trajectory_storage: reference)
+    assert _store_optimizer_state({"mode": "gridfs"}) == reference
@@ -0,0 +1,343 @@
+'''
+This submodule contains an opt-in tracing layer that you can use to figure out
+where GASpy spends its time, e.g., Mongo queries, pickle I/O, pymatgen slab
+generation, or Voronoi fingerprinting.
+
+Tracing is off by default. You can turn it on either by calling `enable()`
+or by setting the `GASPY_TRACE` environment variable to `1`. Once it is on,
+every span records the Luigi task family and parameters hash that it belongs
+to, its wall time, its CPU time, and the peak resident memory of the process.
+You can then export the spans with `export_chrome_trace` (which can be viewed
+with chrome://tracing or Perfetto) or with `get_summary`.
+
+Luigi and `gaspy.utils.multimap` will run things in child processes, which
+means that spans recorded there will not make it back to the parent. If you
+want to trace those too, then pass a directory to `enable` (or set the
+`GASPY_TRACE_DIR` environment variable). Each process will then append its
+spans to its own file in that directory, and the export functions will read
+all of them.
+'''
+
+__author__ = 'Kevin Tran'
+__email__ = 'ktran@andrew.cmu.edu'
+
+import os
+import sys
+import glob
+import json
+import time
+import hashlib
+import threading
+import functools
+from contextlib import contextmanager
+try:
+    import resource
+except ImportError:     # Windows
+    resource = None
+
+_STATE = {'enabled': os.environ.get('GASPY_TRACE', '') not in {'', '0'},
+          'directory': os.environ.get('GASPY_TRACE_DIR') or None,
+          'luigi_hooks_registered': False}
+_SPANS = []
+_LOCK = threading.Lock()
+_LOCAL = threading.local()
+
+
+def enable(directory=None):
+    '''
+    Turn on tracing
+
+    Arg:
+        directory   [Optional] A string indicating a directory that each
+                    process should write its spans to. You need this if you
+                    want to trace things that run in child processes.
+    '''
+    _STATE['enabled'] = True
+    if directory is not None:
+        os.makedirs(directory, exist_ok=True)
+        _STATE['directory'] = directory
+
+
+def disable():
+    ''' Turn off tracing. This does not delete the spans we have so far. '''
+    _STATE['enabled'] = False
+
+
+def is_enabled():
+    ''' Returns a Boolean indicating whether or not we are tracing '''
+    return _STATE['enabled']
+
+
+def reset():
+    '''
+    Forget all of the spans recorded so far by this process. Note that this
+    does not delete any of the span files in the tracing directory.
+    '''
+    with _LOCK:
+        del _SPANS[:]
+
+
+def hash_task_parameters(task):
+    '''
+    Make a short, deterministic hash of a Luigi task's parameters so that we
+    can tell different instances of the same task family apart.
+
+    Arg:
+        task    Instance of a `luigi.Task`
+    Returns:
+        params_hash     A 10-character hex string
+    '''
+    params = json.dumps(task.to_str_params(), sort_keys=True)
+    return hashlib.md5(params.encode()).hexdigest()[:10]
+
+
+def _get_peak_rss():
+    '''
+    Returns the peak resident set size of this process in megabytes, or `None`
+    if we cannot find it on this platform.
+    '''
+    if resource is None:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes while macOS reports bytes
+    if sys.platform == 'darwin':
+        return peak_rss / 1024**2
+    return peak_rss / 1024
+
+
+def _get_stack():
+    ''' Returns the stack of open spans for the current thread '''
+    try:
+        return _LOCAL.stack
+    except AttributeError:
+        _LOCAL.stack = []
+        return _LOCAL.stack
+
+
+def _open_span(name, category, task_family=None, params_hash=None):
+    '''
+    Start recording a span. This is the workhorse of `span`, but it is also
+    used on its own when the start and finish of a span happen in different
+    callbacks (e.g., Luigi events).
+    '''
+    # Spans that are not tasks themselves inherit the task that they are
+    # running in
+    stack = _get_stack()
+    if task_family is None and stack:
+        task_family = stack[-1]['task_family']
+        params_hash = stack[-1]['params_hash']
+
+    record = {'name': name,
+              'category': category,
+              'task_family': task_family,
+              'params_hash': params_hash,
+              'pid': os.getpid(),
+              'tid': threading.get_ident(),
+              'start': time.time(),
+              '_cpu_start': time.process_time()}
+    stack.append(record)
+    return record
+
+
+def _close_span(record, error=None):
+    ''' Finish recording a span that was started with `_open_span` '''
+    stack = _get_stack()
+    for i, open_record in enumerate(stack):
+        if open_record is record:
+            del stack[i]
+            break
+
+    record['duration'] = time.time() - record['start']
+    record['cpu_time'] = time.process_time() - record.pop('_cpu_start')
+    record['peak_rss_mb'] = _get_peak_rss()
+    if error is not None:
+        record['error'] = type(error).__name__
+
+    with _LOCK:
+        _SPANS.append(record)
+        if _STATE['directory'] is not None:
+            file_name = os.path.join(_STATE['directory'], 'trace_%i.jsonl' % record['pid'])
+            with open(file_name, 'a') as file_handle:
+                file_handle.write(json.dumps(record) + '\n')
+
+
+@contextmanager
+def span(name, category='function', task_family=None, params_hash=None):
+    '''
+    Context manager that records how long its body takes. If tracing is
+    turned off, then this does nothing.
+
+    Args:
+        name        A string for what you are timing, e.g., 'fingerprint_adslab'
+        category    A string for the type of thing you are timing, e.g.,
+                    'task', 'mongo', 'pickle', 'atoms_operators'
+        task_family [Optional] The Luigi task family that this span belongs
+                    to. Defaults to the family of the innermost open span.
+        params_hash [Optional] The hash of the Luigi task's parameters
+    '''
+    if not _STATE['enabled']:
+        yield
+        return
+
+    record = _open_span(name, category, task_family, params_hash)
+    try:
+        yield
+    except BaseException as error:
+        _close_span(record, error)
+        raise
+    _close_span(record)
+
+
+def task_span(task, name=None):
+    '''
+    Make a `span` for a Luigi task
+
+    Args:
+        task    Instance of a `luigi.Task`
+        name    [Optional] A string for what you are timing. Defaults to the
+                task family.
+    '''
+    if not _STATE['enabled']:
+        return span(None)
+    return span(name or task.task_family, category='task',
+                task_family=task.task_family,
+                params_hash=hash_task_parameters(task))
+
+
+def traced(category):
+    '''
+    Decorator that records a span every time the decorated function is called.
+
+    Arg:
+        category    A string for the type of function being traced, e.g.,
+                    'atoms_operators' or 'gasdb'
+    '''
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _STATE['enabled']:
+                return function(*args, **kwargs)
+            with span(function.__name__, category=category):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def register_luigi_hooks():
+    '''
+    Hook into Luigi's task start/finish events so that every task that Luigi
+    runs gets its own span. This is called for you by
+    `gaspy.tasks.core.schedule_tasks`, and it is safe to call more than once.
+    '''
+    if _STATE['luigi_hooks_registered']:
+        return
+    import luigi
+
+    open_spans = {}
+
+    @luigi.Task.event_handler(luigi.Event.START)
+    def _start(task):  # noqa: E306
+        if _STATE['enabled']:
+            open_spans[task.task_id] = _open_span(task.task_family, 'task',
+                                                  task.task_family,
+                                                  hash_task_parameters(task))
+
+    @luigi.Task.event_handler(luigi.Event.SUCCESS)
+    def _success(task):  # noqa: E306
+        try:
+            _close_span(open_spans.pop(task.task_id))
+        except KeyError:
+            pass
+
+    @luigi.Task.event_handler(luigi.Event.FAILURE)
+    def _failure(task, exception):    # noqa: E306
+        try:
+            _close_span(open_spans.pop(task.task_id), exception)
+        except KeyError:
+            pass
+
+    _STATE['luigi_hooks_registered'] = True
+
+
+def get_spans():
+    '''
+    Returns all of the spans we have recorded. If there is a tracing
+    directory, then this includes the spans that every process wrote there.
+
+    Returns:
+        spans   A list of dictionaries, one per span, sorted by start time
+    '''
+    if _STATE['directory'] is None:
+        with _LOCK:
+            spans = list(_SPANS)
+
+    else:
+        spans = []
+        for file_name in glob.glob(os.path.join(_STATE['directory'], 'trace_*.jsonl')):
+            with open(file_name) as file_handle:
+                spans.extend(json.loads(line) for line in file_handle if line.strip())
+
+    spans.sort(key=lambda span_: span_['start'])
+    return spans
+
+
+def export_chrome_trace(file_name):
+    '''
+    Write all of the spans into a JSON file that follows the Chrome Trace
+    Event format, which you can open with chrome://tracing or Perfetto.
+
+    Arg:
+        file_name   A string indicating where you want to save the trace
+    '''
+    events = []
+    for span_ in get_spans():
+        args = {key: value for key, value in span_.items()
+                if key not in {'name', 'category', 'pid', 'tid', 'start', 'duration'}}
+        events.append({'name': span_['name'],
+                       'cat': span_['category'],
+                       'ph': 'X',
+                       'ts': span_['start'] * 1e6,
+                       'dur': span_['duration'] * 1e6,
+                       'pid': span_['pid'],
+                       'tid': span_['tid'],
+                       'args': args})
+
+    with open(file_name, 'w') as file_handle:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, file_handle)
+
+
+def get_summary():
+    '''
+    Summarize all of the spans by task family (i.e., Luigi task class) and by
+    what was being timed.
+
+    Returns:
+        summary     A `pandas.DataFrame` with one row per task family/span
+                    name, sorted by total wall time. The columns are:
+                    task_family, name, category, count, total_time (s),
+                    mean_time (s), max_time (s), total_cpu_time (s), and
+                    peak_rss_mb.
+    '''
+    import pandas as pd
+
+    groups = {}
+    for span_ in get_spans():
+        key = (span_['task_family'] or '', span_['name'], span_['category'])
+        groups.setdefault(key, []).append(span_)
+
+    rows = []
+    for (task_family, name, category), spans in groups.items():
+        durations = [span_['duration'] for span_ in spans]
+        peak_rss = [span_['peak_rss_mb'] for span_ in spans if span_['peak_rss_mb'] is not None]
+        rows.append((task_family, name, category, len(spans),
+                     sum(durations),
+                     sum(durations) / len(durations),
+                     max(durations),
+                     sum(span_['cpu_time'] for span_ in spans),
+                     max(peak_rss) if peak_rss else None))
+
+    columns = ('task_family', 'name', 'category', 'count', 'total_time',
+               'mean_time', 'max_time', 'total_cpu_time', 'peak_rss_mb')
+    summary = pd.DataFrame(rows, columns=columns)
+    summary = summary.sort_values('total_time', ascending=False).reset_index(drop=True)
+    return summary
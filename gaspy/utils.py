@@ -5,10 +5,14 @@ __emails__ = ['ktran@andrew.cmu.edu', 'zulissi@andrew.cmu.edu']
 
 import gc
 import os
+import math
+import time
 import json
+import threading
+import itertools
 import numpy as np
-from multiprocess import Pool
-from collections import OrderedDict, Iterable, Mapping
+from collections import OrderedDict
+from collections.abc import Iterable, Mapping, Sequence
 from tqdm import tqdm
 
 
@@ -136,6 +140,79 @@ def unfreeze_dict(frozen_dict):
     return unfrozen_dict
 
 
+def get_nested_value(doc, key):
+    '''
+    Get a value out of a Mongo document using Mongo's dot notation, e.g.,
+    'fwname.adsorption_site.0'. Raises a `KeyError`, `IndexError`, or
+    `TypeError` if the value does not exist.
+    '''
+    value = doc
+    for subkey in key.split('.'):
+        if isinstance(value, list):
+            value = value[int(subkey)]
+        else:
+            value = value[subkey]
+    return value
+
+
+def _normalize_query_value(value):
+    '''
+    Luigi gives us tuples and frozen dictionaries while Mongo gives us lists
+    and dictionaries. This function converts the former into the latter so
+    that we can compare them.
+    '''
+    if isinstance(value, Mapping):
+        return {key: _normalize_query_value(subvalue) for key, subvalue in value.items()}
+    elif isinstance(value, (list, tuple)):
+        return [_normalize_query_value(subvalue) for subvalue in value]
+    return value
+
+
+def doc_matches_query(doc, query):
+    '''
+    Checks whether a Mongo document would have been returned by a Mongo query.
+    This supports only what our task queries use:  equality and the `$gte`
+    and `$lte` operators.
+
+    Args:
+        doc     A dictionary/Mongo document
+        query   A dictionary that could be passed to `collection.find`
+    Returns:
+        A Boolean indicating whether or not the document matches the query
+    '''
+    for key, condition in query.items():
+        try:
+            value = get_nested_value(doc, key)
+        except (KeyError, IndexError, TypeError, ValueError):
+            # Mongo matches missing fields to `None`
+            if condition is None:
+                continue
+            return False
+
+        if isinstance(condition, Mapping) and all(operator.startswith('$') for operator in condition):
+            try:
+                for operator, bound in condition.items():
+                    if operator == '$gte' and not value >= bound:
+                        return False
+                    elif operator == '$lte' and not value <= bound:
+                        return False
+                    elif operator not in {'$gte', '$lte'}:
+                        raise NotImplementedError('We have not implemented the %s '
+                                                  'operator for in-memory matching'
+                                                  % operator)
+            # Mongo does not match values of different types
+            except TypeError:
+                return False
+
+        else:
+            value = _normalize_query_value(value)
+            condition = _normalize_query_value(condition)
+            # Mongo will match a scalar to any element of an array
+            if value != condition and not (isinstance(value, list) and condition in value):
+                return False
+    return True
+
+
 def multimap(function, inputs, chunked=False, processes=32, maxtasksperchild=1,
              chunksize=1, n_calcs=None):
     '''
@@ -170,6 +247,8 @@ def multimap(function, inputs, chunked=False, processes=32, maxtasksperchild=1,
         output = [function(input_) for input_ in tqdm(inputs, total=n_calcs)]
         return output
 
+    # `multiprocess` pulls in `dill`, so we only import it when we need it
+    from multiprocess import Pool
     with Pool(processes=processes, maxtasksperchild=maxtasksperchild) as pool:
         # Use multiprocessing to perform the calculations. We use imap instead
         # of map so that we get an iterator, which we need for tqdm (the
@@ -184,12 +263,145 @@ def multimap(function, inputs, chunked=False, processes=32, maxtasksperchild=1,
         # appropriately
         else:
             iterator = pool.imap(function, _chunk(inputs, n=chunksize))
-            total = n_calcs / chunksize
+            total = math.ceil(n_calcs / chunksize) if n_calcs is not None else None
             outputs = list(np.concatenate(list(tqdm(iterator, total=total))))
 
     return outputs
 
 
+def imultimap(function, inputs, backend='process', processes=32, ordered=True,
+              chunked=False, chunksize=1, initializer=None, initargs=(),
+              maxtasksperchild=100, n_calcs=None):
+    '''
+    A streaming version of `multimap`. Instead of returning a list once
+    everything is done, this generator yields each output as soon as it is
+    ready. This way you can start inserting documents into Mongo (or whatever)
+    while the rest of the calculations are still going.
+
+    Args:
+        function            The function you want to execute
+        inputs              An iterable that yields proper arguments to the
+                            function. This does not need to have a length,
+                            so you can pass generators or Mongo cursors.
+        backend             A string indicating how to parallelize. 'process'
+                            uses a pool of processes and is best for CPU-bound
+                            functions (e.g., fingerprinting). 'thread' uses a
+                            pool of threads and is best for I/O-bound functions
+                            (e.g., Mongo or LaunchPad queries). 'serial' does
+                            everything in this process, which is handy for
+                            debugging.
+        processes           The number of threads/processes you want to be using
+        ordered             A Boolean indicating whether you want the outputs
+                            in the same order as the inputs. If `False`, then
+                            we yield the outputs in the order that they finish,
+                            which keeps slow calculations from holding up the
+                            rest.
+        chunked             A Boolean indicating whether your function expects
+                            single arguments or "chunked" iterables, e.g.,
+                            lists. If `True`, then we still yield the outputs
+                            one at a time.
+        chunksize           How many calculations you want to have each single
+                            processor do per task. If `chunked` is `True`, then
+                            this is how long each chunk is.
+        initializer         [Optional] A function that each worker will call
+                            once when it starts, e.g., to open a database
+                            client that the worker can reuse
+        initargs            A tuple of the arguments for the `initializer`
+        maxtasksperchild    The maximum number of tasks that a child process
+                            may do before being replaced (which clears its
+                            memory). Only used by the 'process' backend. Pass
+                            `None` to keep the processes for the life of the
+                            pool.
+        n_calcs             How many calculations you have. Only necessary for
+                            adding a percentage timer to the progress bar.
+    Yields:
+        output  Each of the inputs mapped through the function
+    '''
+    tagged_function = _WorkerTaggedFunction(function)
+    if chunked:
+        inputs = _chunk(inputs, n=chunksize)
+        chunksize = 1
+
+    progress_bar = tqdm(total=n_calcs)
+    worker_counts = {}
+    start_time = time.time()
+    last_report_time = start_time
+
+    try:
+        for worker, output in _imap_with_backend(tagged_function, inputs, backend,
+                                                 processes, ordered, chunksize,
+                                                 initializer, initargs,
+                                                 maxtasksperchild):
+            outputs = output if chunked else [output]
+
+            # Report the per-worker throughput every second or so
+            worker_counts[worker] = worker_counts.get(worker, 0) + len(outputs)
+            progress_bar.update(len(outputs))
+            now = time.time()
+            if now - last_report_time > 1.:
+                rate = sum(worker_counts.values()) / len(worker_counts) / (now - start_time)
+                progress_bar.set_postfix(workers=len(worker_counts),
+                                         per_worker='%.2f it/s' % rate,
+                                         refresh=False)
+                last_report_time = now
+
+            for output_ in outputs:
+                yield output_
+    finally:
+        progress_bar.close()
+
+
+def _imap_with_backend(function, inputs, backend, processes, ordered,
+                       chunksize, initializer, initargs, maxtasksperchild):
+    '''
+    Helper generator for `imultimap` that maps the function over the inputs
+    with whatever backend the user asked for. Refer to `imultimap` for
+    descriptions of the arguments.
+    '''
+    if backend == 'serial':
+        if initializer is not None:
+            initializer(*initargs)
+        for input_ in inputs:
+            yield function(input_)
+        return
+
+    elif backend == 'thread':
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(processes=processes, initializer=initializer,
+                          initargs=initargs)
+
+    elif backend == 'process':
+        # `multiprocess` pulls in `dill`, so we only import it when we need it
+        from multiprocess import Pool
+        pool = Pool(processes=processes, initializer=initializer,
+                    initargs=initargs, maxtasksperchild=maxtasksperchild)
+
+    else:
+        raise ValueError('The "%s" backend is not supported. Use "process", '
+                         '"thread", or "serial".' % backend)
+
+    with pool:
+        if ordered:
+            iterator = pool.imap(function, inputs, chunksize=chunksize)
+        else:
+            iterator = pool.imap_unordered(function, inputs, chunksize=chunksize)
+        for output in iterator:
+            yield output
+
+
+class _WorkerTaggedFunction:
+    '''
+    Wraps a function so that it also returns which worker (process and thread)
+    executed it. `imultimap` uses this to report per-worker throughput.
+    '''
+    def __init__(self, function):
+        self.function = function
+
+    def __call__(self, input_):
+        worker = (os.getpid(), threading.get_ident())
+        return worker, self.function(input_)
+
+
 def _chunk(iterable, n):
     '''
     Takes an iterable and then gives you a generator that yields chunked lists
@@ -203,8 +415,18 @@ def _chunk(iterable, n):
         generator   Python generator that yields lists of size `n` with the
                     same contents as the `iterable` you passed in.
     '''
-    for i in range(0, len(iterable), n):
-        yield iterable[i:i+n]
+    # If we can slice it, then slice it
+    if isinstance(iterable, Sequence) or isinstance(iterable, np.ndarray):
+        for i in range(0, len(iterable), n):
+            yield iterable[i:i+n]
+
+    # Otherwise (e.g., generators or cursors), pull chunks off one at a time
+    else:
+        iterator = iter(iterable)
+        chunk = list(itertools.islice(iterator, n))
+        while chunk:
+            yield chunk
+            chunk = list(itertools.islice(iterator, n))
 
 
 def multimap_method(instance, method, inputs, chunked=False, processes=32,
@@ -7,20 +7,34 @@ __authors__ = ["Zachary W. Ulissi", "Kevin Tran"]
 __emails__ = ["zulissi@andrew.cmu.edu", "ktran@andrew.cmu.edu"]
 
 import os
-import uuid
+import io
+import zlib
+import hashlib
+import warnings
+import json
 import binascii
 import numpy as np
 import ase.io
 from ase.io.trajectory import TrajectoryWriter
 from ase.optimize import BFGS
+from ase.optimize.precon import Exp, C1, PreconLBFGS, PreconFIRE
 from ase.calculators.vasp import Vasp2
 from ase.calculators.singlepoint import SinglePointCalculator as SPC
+from ase.constraints import FixAtoms, FixScaled
+from ase.units import GPa
 
 # TODO:  Need to handle setting the pseudopotential directory, probably in the
 # submission config if it stays constant? (vasp_qadapter.yaml)
 
+# The ASE optimizers and preconditioners that `_relax_with_ase` can use
+OPTIMIZERS = {"BFGS": BFGS, "PreconLBFGS": PreconLBFGS, "PreconFIRE": PreconFIRE}
+PRECONDITIONERS = {"Exp": Exp, "C1": C1}
+# Where `_relax_with_ase` saves the final state of its optimizer
+OPTIMIZER_STATE_FILE = "optimizer_state.json"
 
-def runVasp(fname_in, fname_out, vasp_flags):
+
+def runVasp(fname_in, fname_out, vasp_flags, trajectory_storage=None,
+            optimizer_settings=None):
     """
     This function is meant to be sent to each cluster and then used to run our
     rockets. As such, it has algorithms to run differently depending on the
@@ -33,28 +47,53 @@ def runVasp(fname_in, fname_out, vasp_flags):
                     the final, relaxed structure to.
         vasp_flags  A dictionary of settings we want to pass to the `Vasp2`
                     calculator
+        trajectory_storage  [Optional] A dictionary indicating how to store
+                            the relaxation trajectory. See the
+                            `store_trajectory` function for details. If
+                            `None`, then we return the trajectory as a hex
+                            string like we always have. You can also add a
+                            'keep_every' key with an integer `k` to save only
+                            every k-th image (plus the last one) of VASP
+                            relaxations.
+        optimizer_settings  [Optional] A dictionary indicating how ASE should
+                            relax structures that VASP cannot relax by
+                            itself. See the `_optimize_with_ase` function for
+                            details.
     Returns:
         atoms_str   A string-formatted name for the atoms
         traj_hex    A string-formatted hex enocding of the entire relaxation
-                    trajectory
+                    trajectory, or a dictionary that references where we
+                    stored the compressed trajectory
         energy      A float indicating the potential energy of the final image
                     in the relaxation [eV]
+        optimizer_state     Only returned if ASE did the relaxation, if
+                            `optimizer_settings` had `"save_state": True`,
+                            and if `trajectory_storage` used the 'gridfs'
+                            mode. It is a reference to the final state of the
+                            optimizer (see `_write_optimizer_state`) in
+                            GridFS. You can pass it as the "state" of the
+                            `optimizer_settings` of another relaxation.
     """
     # Read the input atoms object
     atoms = ase.io.read(str(fname_in))
 
     # Perform the relaxation
-    final_image = _perform_relaxation(atoms, vasp_flags, fname_out)
+    keep_every = (trajectory_storage or {}).get("keep_every", 1)
+    final_image = _perform_relaxation(atoms, vasp_flags, fname_out, keep_every,
+                                      optimizer_settings)
 
     # Parse and return output
     atoms_str = str(atoms)
-    with open('all.traj', 'rb') as fhandle:
-        traj_hex = binascii.hexlify(fhandle.read()).decode("utf-8")
+    traj_hex = store_trajectory("all.traj", trajectory_storage)
     energy = final_image.get_potential_energy()
+    optimizer_state = _store_optimizer_state(trajectory_storage)
+    if optimizer_state is not None:
+        return atoms_str, traj_hex, energy, optimizer_state
     return atoms_str, traj_hex, energy
 
 
-def _perform_relaxation(atoms, vasp_flags, fname_out):
+def _perform_relaxation(atoms, vasp_flags, fname_out, keep_every=1,
+                        optimizer_settings=None):
     """
     This function will perform the DFT relaxation while also saving the final
     image for you.
@@ -65,6 +104,10 @@ def _perform_relaxation(atoms, vasp_flags, fname_out):
                     calculator
         fname_out   A string indicating the file name you want to use when
                     saving the final, relaxed structure
+        keep_every  An integer `k` indicating that we should only save every
+                    k-th image (plus the last one) of the VASP trajectory
+        optimizer_settings  [Optional] A dictionary that we pass to
+                            `_relax_with_ase` if VASP cannot do the relaxation
     Returns:
         atoms   The relaxed `ase.Atoms` structure
     """
@@ -82,10 +125,10 @@ def _perform_relaxation(atoms, vasp_flags, fname_out):
 
     # Run with VASP by default
     if vasp_compatible:
-        final_image = _relax_with_vasp(atoms, vasp_flags)
+        final_image = _relax_with_vasp(atoms, vasp_flags, keep_every)
     # If VASP can't handle it, then use ASE/VASP together
     else:
-        final_image = _relax_with_ase(atoms, vasp_flags)
+        final_image = _relax_with_ase(atoms, vasp_flags, optimizer_settings)
 
     # Save the last image
     final_image.write(str(fname_out))
@@ -266,19 +309,27 @@ def __make_gilgamesh_vasp_command(vasp_flags):
     return command, vasp_flags
 
 
-def _relax_with_ase(atoms, vasp_flags):
+def _relax_with_ase(atoms, vasp_flags, optimizer_settings=None):
     """
     Instead of letting VASP handle the relaxation autonomously, we instead use
-    VASP only as an eletronic structure calculator and use ASE's BFGS to
-    perform the atomic position optimization.
+    VASP only as an eletronic structure calculator and use one of ASE's
+    optimizers (BFGS by default) to perform the atomic position optimization.
 
     Note that this will also write the trajectory to the 'all.traj' file and
-    save the log file as 'relax.log'.
+    save the log file as 'relax.log'. If the `optimizer_settings` have
+    `"save_state": True`, then we also save the final state of the optimizer
+    to the `OPTIMIZER_STATE_FILE`.
 
     Args:
         atoms       `ase.Atoms` object of the structure we want to relax
         vasp_flags  A dictionary of settings we want to pass to the `Vasp2`
                     calculator
+        optimizer_settings  [Optional] A dictionary indicating which optimizer
+                            to use and how to start it. See
+                            `_optimize_with_ase`. You can also start from the
+                            saved state of another relaxation by putting the
+                            reference that its `runVasp` returned under the
+                            "state" key.
     Returns:
         atoms   The relaxed `ase.Atoms` structure
     """
@@ -286,12 +337,200 @@ def _relax_with_ase(atoms, vasp_flags):
     vasp_flags["nsw"] = 0
     calc = Vasp2(**vasp_flags)
     atoms.set_calculator(calc)
-    optimizer = BFGS(atoms, logfile="relax.log", trajectory="all.traj")
-    optimizer.run(fmax=vasp_flags["ediffg"] if "ediffg" in vasp_flags else 0.05)
+    fmax = vasp_flags["ediffg"] if "ediffg" in vasp_flags else 0.05
+    optimizer_settings = _resolve_optimizer_state(optimizer_settings)
+    optimizer = _optimize_with_ase(atoms, fmax, optimizer_settings)
+    if optimizer_settings.get("save_state"):
+        _write_optimizer_state(optimizer, OPTIMIZER_STATE_FILE)
     return atoms
 
 
-def _relax_with_vasp(atoms, vasp_flags):
+def _resolve_optimizer_state(optimizer_settings):
+    """
+    FireWorks only carry a reference to the state of the optimizer that they
+    start from, because a Hessian is far too big to put in every FireWork.
+    This function fetches that state from GridFS and merges it into the
+    optimizer settings.
+
+    Arg:
+        optimizer_settings  A dictionary of settings for `_optimize_with_ase`
+                            that may have a "state" key with a reference made
+                            by `_store_optimizer_state`
+    Returns:
+        optimizer_settings  A new dictionary of settings without the "state"
+                            key. If we could read the state and it was made by
+                            the same kind of optimizer, then it also has the
+                            keys of the state.
+    """
+    optimizer_settings = dict(optimizer_settings or {})
+    reference = optimizer_settings.pop("state", None)
+    if reference is None:
+        return optimizer_settings
+
+    try:
+        state = json.loads(_read_bytes_from_gridfs(reference).decode("utf-8"))
+    except Exception as error:
+        warnings.warn("Could not read the optimizer state %s (%s); starting "
+                      "the optimizer from scratch instead." % (reference, error),
+                      RuntimeWarning)
+        return optimizer_settings
+
+    if state["optimizer"] != optimizer_settings.get("optimizer", "BFGS"):
+        warnings.warn("Ignoring the state of a %s optimizer because we are "
+                      "using a %s optimizer" % (state["optimizer"],
+                                                optimizer_settings.get("optimizer", "BFGS")),
+                      RuntimeWarning)
+        return optimizer_settings
+    state.pop("n_steps", None)
+    optimizer_settings.update(state)
+    return optimizer_settings
+
+
+def _optimize_with_ase(atoms, fmax, optimizer_settings=None):
+    """
+    Relax a structure with one of ASE's optimizers while writing the
+    trajectory to 'all.traj' and the log to 'relax.log'.
+
+    Starting BFGS from a Hessian of a similar relaxation (e.g., the same
+    adsorbate on another site of the same slab) tends to save many ionic
+    steps, because the slab's curvature barely changes between the two.
+
+    Args:
+        atoms               `ase.Atoms` object of the structure we want to
+                            relax. It needs a calculator.
+        fmax                A float indicating the force criteria [eV/Angstrom]
+        optimizer_settings  [Optional] A dictionary with the following keys.
+                            You can also pass the state that
+                            `_write_optimizer_state` saved for a similar
+                            relaxation.
+                                optimizer:  "BFGS" (default), "PreconLBFGS",
+                                            or "PreconFIRE"
+                                hessian:    BFGS only. Either "model" to
+                                            start from a model Hessian made
+                                            by the "Exp" preconditioner, or
+                                            a nested list of the Hessian
+                                            (3N x 3N, eV/Angstrom**2) to start
+                                            from. We use ASE's default if you
+                                            leave it out or if it is the wrong
+                                            size.
+                                precon:     Preconditioned optimizers only.
+                                            "Exp" (default) or "C1"
+                                mu:         Preconditioned optimizers only. The
+                                            energy scale of the
+                                            preconditioner. If you leave it
+                                            out, then ASE estimates it with a
+                                            few extra force calls.
+                                save_state: Not used here; refer to
+                                            `_relax_with_ase`
+    Returns:
+        optimizer   The ASE optimizer after it has finished
+    """
+    optimizer_settings = optimizer_settings or {}
+    name = optimizer_settings.get("optimizer", "BFGS")
+    optimizer_class = OPTIMIZERS[name]
+
+    if optimizer_class is BFGS:
+        optimizer = BFGS(atoms, logfile="relax.log", trajectory="all.traj")
+        hessian = optimizer_settings.get("hessian")
+        if hessian == "model":
+            optimizer.H0 = _make_model_hessian(atoms, optimizer.H0)
+        elif hessian is not None:
+            hessian = np.array(hessian, dtype=float)
+            if hessian.shape == optimizer.H0.shape:
+                optimizer.H0 = hessian
+            else:
+                warnings.warn("Ignoring a %s Hessian for a structure with %i atoms"
+                              % (hessian.shape, len(atoms)), RuntimeWarning)
+
+    else:
+        precon = PRECONDITIONERS[optimizer_settings.get("precon", "Exp")](
+            mu=optimizer_settings.get("mu")
+        )
+        optimizer = optimizer_class(atoms, logfile="relax.log",
+                                    trajectory="all.traj", precon=precon)
+
+    optimizer.run(fmax=fmax)
+    return optimizer
+
+
+def _make_model_hessian(atoms, default_hessian):
+    """
+    Make a model Hessian out of ASE's "Exp" preconditioner, which couples
+    neighboring atoms with springs that get weaker with distance. We do not
+    let ASE estimate its energy scale because that would cost extra force
+    calls. Instead we scale it so that its diagonal matches, on average, the
+    diagonal of ASE's default Hessian.
+
+    Args:
+        atoms           `ase.Atoms` object of the structure we want to relax
+        default_hessian The Hessian that the optimizer would otherwise start
+                        from
+    Returns:
+        hessian     A 3N x 3N numpy array
+    """
+    precon = Exp(mu=1.)
+    precon.make_precon(atoms)
+    hessian = precon.P.toarray()
+    return hessian * np.mean(np.diag(default_hessian)) / np.mean(np.diag(hessian))
+
+
+def _write_optimizer_state(optimizer, file_name):
+    """
+    Save what a future relaxation would need to pick up where an optimizer
+    left off. The keys are the same as the `optimizer_settings` of
+    `_optimize_with_ase`, so you can feed the state of one relaxation
+    directly into another.
+
+    Args:
+        optimizer   An ASE optimizer made by `_optimize_with_ase`
+        file_name   A string indicating the JSON file to write to
+    """
+    state = {"optimizer": type(optimizer).__name__, "n_steps": optimizer.nsteps}
+    if isinstance(optimizer, BFGS):
+        # Round the Hessian so that it does not take up too much space
+        hessian = getattr(optimizer, "H", None)
+        if hessian is not None:
+            state["hessian"] = np.round(hessian, 4).tolist()
+    else:
+        state["precon"] = type(optimizer.precon).__name__
+        state["mu"] = getattr(optimizer.precon, "mu", None)
+    with open(file_name, "w") as file_handle:
+        json.dump(state, file_handle)
+
+
+def _store_optimizer_state(trajectory_storage=None):
+    """
+    Save the state that `_relax_with_ase` wrote into a GridFS bucket of the
+    FireWorks database. A BFGS Hessian has (3N)**2 elements, so we do not put
+    it into the `launches` collection as a hex string like we do with the
+    trajectories.
+
+    Arg:
+        trajectory_storage  [Optional] A dictionary indicating how to store
+                            the trajectory. See `store_trajectory`. We only
+                            save the state if its mode is 'gridfs', and we
+                            use its compression and bucket.
+    Returns:
+        reference   A dictionary with the 'storage', 'bucket', 'sha256', and
+                    'size' of the state we stored, or `None` if there was no
+                    state or if we did not store it
+    """
+    trajectory_storage = trajectory_storage or {}
+    if (not os.path.isfile(OPTIMIZER_STATE_FILE) or
+            trajectory_storage.get("mode", "hex") != "gridfs"):
+        return None
+
+    with open(OPTIMIZER_STATE_FILE, "rb") as fhandle:
+        raw_bytes = fhandle.read()
+    try:
+        return _store_trajectory_in_gridfs(raw_bytes, trajectory_storage)
+    except Exception as error:
+        warnings.warn("Could not store the optimizer state in GridFS (%s); "
+                      "skipping it." % error, RuntimeWarning)
+        return None
+
+
+def _relax_with_vasp(atoms, vasp_flags, keep_every=1):
     """
     Perform a DFT relaxation with VASP and then write the trajectory to the
     'all.traj' file and save the log file.
@@ -300,6 +539,8 @@ def _relax_with_vasp(atoms, vasp_flags):
         atoms       `ase.Atoms` object of the structure we want to relax
         vasp_flags  A dictionary of settings we want to pass to the `Vasp2`
                     calculator
+        keep_every  An integer `k` indicating that we should only save every
+                    k-th image (plus the first and last ones)
     Returns:
         atoms   The relaxed `ase.Atoms` structure
     """
@@ -308,25 +549,329 @@ def _relax_with_vasp(atoms, vasp_flags):
     atoms.set_calculator(calc)
     atoms.get_potential_energy()
 
-    # Read the trajectory from the output file
-    images = []
-    for atoms in ase.io.read("vasprun.xml", ":"):
-        image = atoms.copy()
-        image = image[calc.resort]
-        image.set_calculator(
-            SPC(
-                image,
-                energy=atoms.get_potential_energy(),
-                forces=atoms.get_forces()[calc.resort],
-            )
+    # Stream the trajectory from the output file into the trajectory file
+    images = iread_vasprun("vasprun.xml")
+    return _write_trajectory(images, "all.traj", calc.resort, keep_every)
+
+
+def iread_vasprun(file_name="vasprun.xml"):
+    """
+    Read the ionic steps of a vasprun.xml file one at a time. Unlike
+    `ase.io.read`, this does not keep the XML of the earlier steps around, so
+    long relaxations do not eat up the memory of the compute node. It also
+    only reads the things that we save: the cell, positions, constraints,
+    energy, and forces.
+
+    Arg:
+        file_name   A string indicating the vasprun.xml file to read
+    Yields:
+        atoms   An `ase.Atoms` object of each ionic step, in the (sorted)
+                order that VASP uses, with a `SinglePointCalculator` holding
+                the energy and forces. The energies follow the same
+                conventions as `ase.io.read`.
+    """
+    import xml.etree.ElementTree as ET
+
+    atoms_init = None
+    pressure = 0.
+    try:
+        for _, elem in ET.iterparse(file_name, events=("end",)):
+            if elem.tag == "atominfo":
+                species = [entry[0].text.strip()
+                           for entry in elem.find("array[@name='atoms']/set")]
+
+            # We need the pressure to take the PV term out of the energy
+            elif elem.tag == "parameters":
+                pstress = elem.find(".//i[@name='PSTRESS']")
+                if pstress is not None:
+                    pressure = float(pstress.text) * 0.1 * GPa
+
+            elif elem.tag == "structure" and elem.attrib.get("name") == "initialpos":
+                atoms_init = _make_atoms_from_vasprun_structure(elem, species)
+
+            elif elem.tag == "calculation":
+                image = _make_image_from_vasprun_step(elem, atoms_init, pressure)
+                elem.clear()
+                if image is not None:
+                    yield image
+
+    # VASP might not have finished writing the file, e.g., if the job ran out
+    # of time. We keep whichever steps it did finish.
+    except ET.ParseError:
+        if atoms_init is None:
+            raise
+
+
+def _read_vasprun_varray(elem):
+    """
+    Arg:
+        elem    A `varray` element of a vasprun.xml file
+    Returns:
+        array   A `np.ndarray` of its vectors
+    """
+    return np.array([[float(value) for value in vector.text.split()] for vector in elem])
+
+
+def _make_atoms_from_vasprun_structure(elem, species):
+    """
+    Arg:
+        elem        The `structure` element of a vasprun.xml file that holds
+                    the initial positions and selective dynamics
+        species     A list of the chemical symbols of the atoms
+    Returns:
+        atoms   An `ase.Atoms` object with the initial positions and the
+                constraints
+    """
+    cell = _read_vasprun_varray(elem.find("crystal/varray[@name='basis']"))
+    scaled_positions = _read_vasprun_varray(elem.find("varray[@name='positions']"))
+
+    constraints = []
+    fixed_indices = []
+    for i, entry in enumerate(elem.findall("varray[@name='selective']/v")):
+        flags = np.array(entry.text.split()) == "F"
+        if flags.all():
+            fixed_indices.append(i)
+        elif flags.any():
+            constraints.append(FixScaled(i, flags, cell))
+    if fixed_indices:
+        constraints.append(FixAtoms(fixed_indices))
+
+    return ase.Atoms(species, cell=cell, scaled_positions=scaled_positions,
+                     constraint=constraints, pbc=True)
+
+
+def _make_image_from_vasprun_step(step, atoms_init, pressure=0.):
+    """
+    Args:
+        step        A `calculation` element of a vasprun.xml file
+        atoms_init  The output of `_make_atoms_from_vasprun_structure`
+        pressure    The external pressure (PSTRESS) [eV/Angstrom**3]
+    Returns:
+        image   An `ase.Atoms` object of the step with a
+                `SinglePointCalculator`, or `None` if VASP did not finish
+                the step
+    """
+    structure = step.find("structure")
+    if structure is None or step.find("energy") is None:
+        return None
+    cell = _read_vasprun_varray(structure.find("crystal/varray[@name='basis']"))
+    scaled_positions = _read_vasprun_varray(structure.find("varray[@name='positions']"))
+
+    # The free energy of the step includes the PV term, and its sigma->0
+    # energy can be wrong, so we take the latter from the last SCF step
+    free_energy = float(step.find("energy/i[@name='e_fr_energy']").text)
+    free_energy -= pressure * abs(np.linalg.det(cell))
+    energy = free_energy
+    scf_energies = step.findall("scstep/energy")
+    if scf_energies:
+        energy += (float(scf_energies[-1].find("i[@name='e_0_energy']").text) -
+                   float(scf_energies[-1].find("i[@name='e_fr_energy']").text))
+
+    image = atoms_init.copy()
+    image.set_cell(cell)
+    image.set_scaled_positions(scaled_positions)
+    results = {"energy": energy}
+    forces = step.find("varray[@name='forces']")
+    if forces is not None:
+        results["forces"] = _read_vasprun_varray(forces)
+    image.calc = SPC(image, **results)
+    return image
+
+
+def _write_trajectory(images, file_name, resort=None, keep_every=1):
+    """
+    Write images to a trajectory file as we get them. We also put the atoms
+    back into the order that the user gave them to VASP.
+
+    Args:
+        images      An iterable of `ase.Atoms` objects with calculators, e.g.,
+                    the output of `iread_vasprun`
+        file_name   A string indicating the trajectory file to append to
+        resort      [Optional] A sequence of integers indicating how to
+                    reorder the atoms, e.g., the `resort` attribute of a
+                    `Vasp2` calculator
+        keep_every  An integer `k` indicating that we should only write every
+                    k-th image. We always write the first and last images.
+    Returns:
+        final_image The last image, reordered
+    """
+    final_image = None
+    skipped_image = None
+    with TrajectoryWriter(file_name, "a") as tj:
+        for i, atoms in enumerate(images):
+            if i % keep_every == 0:
+                final_image = _resort_image(atoms, resort)
+                tj.write(final_image)
+                skipped_image = None
+            else:
+                skipped_image = atoms
+
+        # Always keep the last image
+        if skipped_image is not None:
+            final_image = _resort_image(skipped_image, resort)
+            tj.write(final_image)
+    return final_image
+
+
+def _resort_image(atoms, resort=None):
+    """
+    Args:
+        atoms   An `ase.Atoms` object with a calculator
+        resort  [Optional] A sequence of integers indicating how to reorder
+                the atoms
+    Returns:
+        image   A reordered copy of the atoms with a `SinglePointCalculator`
+                holding the (reordered) energy and forces
+    """
+    if resort is None:
+        resort = list(range(len(atoms)))
+    image = atoms[resort]
+    image.set_calculator(
+        SPC(
+            image,
+            energy=atoms.get_potential_energy(),
+            forces=atoms.get_forces()[resort],
         )
-        images += [image]
+    )
+    return image
+
+
+def store_trajectory(file_name, trajectory_storage=None):
+    """
+    Turn a trajectory file into something we can put into the `stored_data`
+    of a FireWorks launch.
+
+    By default, this is the hex string of the whole file. Hex strings are
+    twice as big as the file though, and they bloat the `launches` collection.
+    So you can instead choose to compress the trajectory and save it into a
+    GridFS bucket of the FireWorks database. Files in the bucket are named by
+    the SHA-256 hash of the uncompressed trajectory, so identical
+    trajectories are only stored once.
+
+    Args:
+        file_name           A string indicating the trajectory file to store
+        trajectory_storage  [Optional] A dictionary with the following keys:
+                                mode:           'hex' (default) or 'gridfs'
+                                compression:    'zlib' (default) or 'zstd'
+                                bucket:         The name of the GridFS bucket
+                                                (default 'trajectories')
+                                keep_every:     Not used here; refer to
+                                                `runVasp`
+    Returns:
+        stored_trajectory   Either a hex string of the trajectory or a
+                            dictionary with the 'storage', 'bucket',
+                            'sha256', and 'size' of the trajectory we stored
+    """
+    with open(file_name, "rb") as fhandle:
+        raw_bytes = fhandle.read()
+    trajectory_storage = trajectory_storage or {}
+
+    if trajectory_storage.get("mode", "hex") == "gridfs":
+        try:
+            return _store_trajectory_in_gridfs(raw_bytes, trajectory_storage)
+        # If we cannot reach the database from here, then fall back to the
+        # hex string so that we do not lose the calculation
+        except Exception as error:
+            warnings.warn("Could not store the trajectory in GridFS (%s); "
+                          "returning it as a hex string instead." % error,
+                          RuntimeWarning)
+    return binascii.hexlify(raw_bytes).decode("utf-8")
+
+
+def _store_trajectory_in_gridfs(raw_bytes, trajectory_storage):
+    """
+    Compress a trajectory and save it into a GridFS bucket of the FireWorks
+    database that this rocket is running under.
+
+    Args:
+        raw_bytes           The bytes of the trajectory file
+        trajectory_storage  A dictionary with the optional 'compression' and
+                            'bucket' keys described in `store_trajectory`
+    Returns:
+        reference   A dictionary with the 'storage', 'bucket', 'sha256', and
+                    'size' of the trajectory we stored
+    """
+    import gridfs
+    from fireworks import LaunchPad
 
-    # Write the trajectory
-    with TrajectoryWriter("all.traj", "a") as tj:
-        for atoms in images:
-            tj.write(atoms)
-    return images[-1]
+    compression = trajectory_storage.get("compression", "zlib")
+    bucket_name = trajectory_storage.get("bucket", "trajectories")
+    sha256 = hashlib.sha256(raw_bytes).hexdigest()
+
+    lpad = LaunchPad.auto_load()
+    bucket = gridfs.GridFS(lpad.db, bucket_name)
+    if not bucket.exists(filename=sha256):
+        bucket.put(_compress_bytes(raw_bytes, compression), filename=sha256,
+                   metadata={"compression": compression, "size": len(raw_bytes)})
+
+    reference = {"storage": "gridfs",
+                 "bucket": bucket_name,
+                 "sha256": sha256,
+                 "size": len(raw_bytes)}
+    return reference
+
+
+def _read_bytes_from_gridfs(reference):
+    """
+    Read something that `_store_trajectory_in_gridfs` saved
+
+    Arg:
+        reference   A dictionary made by `_store_trajectory_in_gridfs`
+    Returns:
+        raw_bytes   The decompressed bytes
+    """
+    import gridfs
+    from fireworks import LaunchPad
+
+    lpad = LaunchPad.auto_load()
+    try:
+        bucket = gridfs.GridFS(lpad.db, reference["bucket"])
+        grid_out = bucket.find_one({"filename": reference["sha256"]})
+        if grid_out is None:
+            raise FileNotFoundError('Could not find %s in the "%s" GridFS bucket'
+                                    % (reference["sha256"], reference["bucket"]))
+        return _decompress_bytes(grid_out.read(), grid_out.metadata["compression"])
+    finally:    # Make sure we close the connection
+        lpad.fireworks.database.client.close()
+
+
+def _compress_bytes(raw_bytes, compression="zlib"):
+    """
+    Compress some bytes
+
+    Args:
+        raw_bytes   The bytes you want to compress
+        compression A string indicating the algorithm. 'zlib' comes with
+                    Python; 'zstd' needs the `zstandard` package.
+    Returns:
+        compressed_bytes    The compressed bytes. GASpy decompresses them
+                            with `gaspy.fireworks_helper_scripts.read_trajectory_bytes`.
+    """
+    if compression == "zlib":
+        return zlib.compress(raw_bytes, 6)
+    elif compression == "zstd":
+        import zstandard
+        return zstandard.ZstdCompressor(level=10).compress(raw_bytes)
+    raise ValueError('Unknown compression "%s"; use "zlib" or "zstd"' % compression)
+
+
+def _decompress_bytes(compressed_bytes, compression):
+    """
+    Decompress bytes that were compressed by `_compress_bytes`
+
+    Args:
+        compressed_bytes    The bytes you want to decompress
+        compression         A string indicating the algorithm that was used
+                            to compress the bytes, i.e., 'zlib' or 'zstd'
+    Returns:
+        raw_bytes   The decompressed bytes
+    """
+    if compression == "zlib":
+        return zlib.decompress(compressed_bytes)
+    elif compression == "zstd":
+        import zstandard
+        return zstandard.ZstdDecompressor().decompress(compressed_bytes)
+    raise ValueError('Unknown compression "%s"; expected "zlib" or "zstd"' % compression)
 
 
 def atoms_to_hex(atoms):
@@ -338,21 +883,30 @@ def atoms_to_hex(atoms):
     Returns:
         _hex    A hex string of the `ase.Atoms` object
     """
-    # We need to write the atoms object into a file before encoding it. But we don't
-    # want multiple calls to this function to interfere with each other, so we generate
-    # a random file name via uuid to reduce this risk. Then we delete it.
-    fname = str(uuid.uuid4()) + ".traj"
-    atoms.write(fname)
-    with open(fname, "rb") as fhandle:
-        try:
-            _hex = binascii.hexlify(fhandle.read()).decode("utf-8")
-            os.remove(fname)
-        except OSError:
-            pass
-
+    # We write the trajectory into memory instead of a file so that multiple
+    # calls to this function cannot interfere with each other. The bytes are
+    # the same as what `atoms.write('foo.traj')` would give.
+    buffer_ = _TrajectoryBuffer()
+    with TrajectoryWriter(buffer_, "w") as tj:
+        tj.write(atoms)
+    _hex = binascii.hexlify(buffer_.value).decode("utf-8")
     return _hex
 
 
+class _TrajectoryBuffer(io.BytesIO):
+    """
+    An in-memory file for `TrajectoryWriter`. The writer closes its file when
+    it is done, which would normally throw away the contents of a `BytesIO`.
+    So we save them as the `value` attribute right before closing.
+    """
+    value = b""
+
+    def close(self):
+        if not self.closed:
+            self.value = self.getvalue()
+        super().close()
+
+
 #decode_hex = codecs.getdecoder("hex_codec")
 
 